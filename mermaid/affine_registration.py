@@ -0,0 +1,132 @@
+"""
+Multi-resolution affine pre-registration.
+
+The affine transform is optimized on an image pyramid (from coarse to fine). The images are warped directly by the
+affine transform (see :func:`mermaid.utils.compute_affine_warped_image_multiNC`), i.e., no dense maps are created
+during the optimization. The result can be used as initial map for a subsequent deformable registration
+(see :meth:`MultiResolutionAffineRegistration.get_initial_maps`).
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import numpy as np
+import torch
+from torch.nn.parameter import Parameter
+
+from . import utils
+from . import image_sampling as IS
+from . import module_parameters as pars
+from . import similarity_measure_factory as SM
+from . import transform_chain as TC
+from .data_wrapper import AdaptVal
+
+
+class MultiResolutionAffineRegistration(object):
+    """
+    Affine registration on an image pyramid
+    """
+
+    def __init__(self, spacing, params=None):
+        """
+        Constructor
+
+        :param spacing: image spacing [dx,dy,dz]
+        :param params: ParameterDict() object; the settings are in the category affine_pre_registration
+        """
+        self.spacing = np.array(spacing)
+        if params is None:
+            params = pars.ParameterDict()
+        self.params = params[('affine_pre_registration', {}, 'settings for the multi-resolution affine pre-registration')]
+
+        self.nr_of_levels = self.params[('nr_of_levels', 3, 'number of pyramid levels; the resolution is halved from level to level')]
+        self.nr_of_iterations = self.params[('nr_of_iterations', 100, 'number of iterations per level')]
+        self.learning_rate = self.params[('learning_rate', 0.01, 'learning rate of the adam optimizer')]
+        self.min_size = self.params[('min_size', 16, 'coarser levels whose smallest spatial dimension would be below this size are not used')]
+        self.spline_order = 1
+        self.sampler = IS.ResampleImage()
+
+        self.Ab = None
+        """affine parameters (batch size x param. vector) after registration"""
+
+    def _get_pyramid(self, ISource, ITarget):
+        """
+        Creates the image pyramid
+
+        :param ISource: source image (BxCxXxYxZ)
+        :param ITarget: target image (BxCxXxYxZ)
+        :return: list of (source image, target image, spacing) tuples from coarse to fine
+        """
+        sz = np.array(ISource.size())
+        pyramid = [(ISource, ITarget, self.spacing)]
+        for level in range(1, self.nr_of_levels):
+            low_res_size = utils._get_low_res_size_from_size(sz, 0.5 ** level)
+            if min(low_res_size[2:]) < self.min_size:
+                break
+            low_res_ISource, low_res_spacing = self.sampler.downsample_image_to_size(ISource, self.spacing, low_res_size[2:], self.spline_order)
+            low_res_ITarget, _ = self.sampler.downsample_image_to_size(ITarget, self.spacing, low_res_size[2:], self.spline_order)
+            pyramid.append((low_res_ISource, low_res_ITarget, low_res_spacing))
+        return list(reversed(pyramid))
+
+    def register(self, ISource, ITarget, Ab=None):
+        """
+        Registers the source to the target image
+
+        :param ISource: source image (BxCxXxYxZ)
+        :param ITarget: target image (BxCxXxYxZ)
+        :param Ab: initial affine parameters; identity if not given
+        :return: affine parameters (batch size x param. vector), i.e., the transform of the map (see utils.apply_affine_transform_to_map_multiNC)
+        """
+        dim = ISource.dim() - 2
+        nr_of_images = ISource.size()[0]
+
+        if Ab is None:
+            Ab = AdaptVal(torch.zeros(nr_of_images, dim * dim + dim))
+            utils.set_affine_transform_to_identity_multiN(Ab)
+        Ab = Parameter(Ab.detach().clone())
+
+        optimizer = torch.optim.Adam([Ab], lr=self.learning_rate)
+
+        for level, (ISource_l, ITarget_l, spacing_l) in enumerate(self._get_pyramid(ISource, ITarget)):
+            # the affine parameters act on physical coordinates, hence they can be reused across levels
+            similarity_measure = SM.SimilarityMeasureFactory(spacing_l).create_similarity_measure(self.params)
+            for iter in range(self.nr_of_iterations):
+                optimizer.zero_grad()
+                IWarped = utils.compute_affine_warped_image_multiNC(ISource_l, Ab, spacing_l, self.spline_order, zero_boundary=False)
+                energy = similarity_measure.compute_similarity_multiNC(IWarped, ITarget_l)
+                energy.backward()
+                optimizer.step()
+
+            print('INFO: affine pre-registration; level {} of size {}: similarity energy = {:.4f}'.format(
+                level, list(ISource_l.size()[2:]), energy.item()))
+
+        self.Ab = Ab.detach()
+        return self.Ab
+
+    def get_warped_image(self, ISource, zero_boundary=True):
+        """
+        Warps the source image with the computed affine transform
+
+        :param ISource: source image (BxCxXxYxZ)
+        :param zero_boundary: if True the image is zero outside of its domain
+        :return: warped image
+        """
+        return utils.compute_affine_warped_image_multiNC(ISource, self.Ab, self.spacing, self.spline_order, zero_boundary=zero_boundary)
+
+    def get_transform_chains(self):
+        """
+        Returns the computed affine transform and its inverse as transform chains (to which further stages can be appended)
+
+        :return: tuple (chain, inverse chain)
+        """
+        return TC.TransformChain().append_affine(self.Ab), \
+               TC.TransformChain().append_affine(utils.get_inverse_affine_param(self.Ab))
+
+    def get_initial_maps(self, sz):
+        """
+        Returns the affine map and its inverse (to be used as initial map and initial inverse map of a deformable registration)
+
+        :param sz: size of the maps (BxCxXxYxZ)
+        :return: tuple (map, inverse map)
+        """
+        chain, inverse_chain = self.get_transform_chains()
+        return chain.get_map(sz, self.spacing), inverse_chain.get_map(sz, self.spacing)
@@ -0,0 +1,226 @@
+"""
+Compiled optimization steps for fixed-size registration problems.
+
+For a fixed model and image size every iteration of the optimizer launches the same long sequence of small kernels
+(finite difference shifts, FFTs, interpolations and elementwise operations). For 2D and small 3D problems the kernel
+launch overhead then dominates. Two (opt-in) modes reduce it:
+
+* ``compile``: the energy (forward model and loss) is compiled with ``torch.compile`` (the backward pass is compiled
+  alongside by AOT autograd) and, for optimizers which do not need a closure, so is the optimizer step.
+  On the CPU the ``aot_eager`` backend is used by default, which allows testing without a compiler toolchain.
+* ``cuda_graph``: zeroing of the gradients, forward pass, backward pass and optimizer step are captured once as a
+  CUDA graph (after a few warm-up steps on a side stream) and then replayed. Inputs are bound by their memory
+  addresses, i.e., the graph is recaptured whenever they are replaced.
+
+Both are keyed by a *capture key*, which describes everything the compiled code depends on (sizes, inputs, model,
+optimizer and its hyperparameters, ...). Whenever the key changes the step is recompiled (or recaptured). Values
+which change from iteration to iteration (such as the iteration count) are therefore not part of the key, but are
+passed to the compiled code as tensors.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import torch
+
+try:
+    from torch._dynamo.exc import TorchDynamoException
+    COMPILE_ERRORS = (TorchDynamoException,)
+except ImportError:
+    COMPILE_ERRORS = ()
+"""exceptions raised if torch.compile fails (errors of the compiled code itself are not among them)"""
+
+
+class CUDAGraphCaptureError(RuntimeError):
+    """
+    Raised if an optimization step cannot be captured as a CUDA graph
+    """
+    pass
+
+
+def is_torch_compile_available():
+    """
+    Returns True if torch.compile is available
+
+    :return: True/False
+    """
+    return hasattr(torch, 'compile')
+
+
+def is_cuda_graph_available():
+    """
+    Returns True if CUDA graphs can be captured
+
+    :return: True/False
+    """
+    return hasattr(torch.cuda, 'CUDAGraph') and torch.cuda.is_available()
+
+
+def get_tensor_key(t, include_address=True):
+    """
+    Returns a key describing a tensor input of a compiled step (its size, data type, device and, optionally, its
+    memory address, so that the key changes if the tensor is replaced)
+
+    :param t: tensor or None
+    :param include_address: if True the memory address is part of the key (needed for CUDA graphs)
+    :return: hashable key
+    """
+    if t is None:
+        return None
+    key = (tuple(t.size()), str(t.dtype), str(t.device))
+    if include_address:
+        key = key + (t.data_ptr(),)
+    return key
+
+
+def get_optimizer_key(optimizer):
+    """
+    Returns a key describing an optimizer and its hyperparameters (e.g., the learning rates set by a scheduler)
+
+    :param optimizer: torch optimizer
+    :return: hashable key
+    """
+    groups = []
+    for group in optimizer.param_groups:
+        # capturable is set when the step is captured, hence it is not part of the key
+        groups.append(tuple(sorted((k, str(v)) for k, v in group.items() if k not in ['params', 'capturable'])))
+    return (id(optimizer), tuple(groups))
+
+
+def take_optimizer_step(optimizer):
+    """
+    Takes a step of an optimizer which does not require a closure (the function which is compiled in compile mode)
+
+    :param optimizer: torch optimizer
+    """
+    optimizer.step()
+
+
+class CompiledFunction(object):
+    """
+    Function compiled with torch.compile, which is recompiled whenever its capture key changes
+    """
+
+    def __init__(self, function, backend='inductor', name='function'):
+        """
+        :param function: function to compile
+        :param backend: torch.compile backend
+        :param name: name of the function (for output only)
+        """
+        self.function = function
+        self.backend = backend
+        self.name = name
+        self.key = None
+        self.compiled_function = None
+        self.nr_of_compilations = 0
+        """number of times the function was compiled (i.e., one plus the number of key changes)"""
+
+    def invalidate(self):
+        """
+        Forces a recompilation at the next call
+        """
+        self.key = None
+        self.compiled_function = None
+
+    def __call__(self, key, *args, **kwargs):
+        """
+        Calls the compiled function (and compiles it first if the key has changed)
+
+        :param key: capture key
+        :return: result of the function
+        """
+        if self.compiled_function is None or key != self.key:
+            self.compiled_function = torch.compile(self.function, backend=self.backend)
+            self.key = key
+            self.nr_of_compilations += 1
+        return self.compiled_function(*args, **kwargs)
+
+
+class CUDAGraphStep(object):
+    """
+    Captures a full optimization step (forward and backward pass as given by a step function, followed by the
+    optimizer step) as a CUDA graph and replays it. Every call performs exactly one optimization step: the first
+    nr_of_warmup_steps calls (after each change of the capture key) run eagerly on a side stream, the following call
+    captures the graph and replays it.
+    """
+
+    def __init__(self, nr_of_warmup_steps=3):
+        """
+        :param nr_of_warmup_steps: number of eager steps before the graph is captured
+        """
+        self.nr_of_warmup_steps = nr_of_warmup_steps
+        self.key = None
+        self.graph = None
+        self.static_outputs = None
+        self.nr_of_warmup_steps_done = 0
+        self.nr_of_captures = 0
+        """number of times the step was captured"""
+
+    def invalidate(self):
+        """
+        Forces a recapture (after warm-up) at the next call
+        """
+        self.key = None
+        self.graph = None
+        self.static_outputs = None
+        self.nr_of_warmup_steps_done = 0
+
+    @staticmethod
+    def _make_optimizer_capturable(optimizer):
+        """
+        Keeps the state of the optimizer (e.g., the step count of adam) on the device, so that the step can be captured
+
+        :param optimizer: torch optimizer
+        """
+        for group in optimizer.param_groups:
+            if 'capturable' in group and not group['capturable']:
+                group['capturable'] = True
+                for p in group['params']:
+                    state = optimizer.state.get(p, {})
+                    if 'step' in state and torch.is_tensor(state['step']):
+                        state['step'] = state['step'].to(p.device)
+
+    def step(self, key, optimizer, step_function):
+        """
+        Performs one optimization step
+
+        :param key: capture key
+        :param optimizer: torch optimizer (which does not require a closure)
+        :param step_function: function which computes the energy and its gradient (by calling backward) and returns
+            a tuple of tensors
+        :return: the outputs of the step function (once captured, static tensors which are overwritten by the next replay)
+        :raises CUDAGraphCaptureError: if the step cannot be captured
+        """
+        if key != self.key:
+            self.invalidate()
+            self.key = key
+            self._make_optimizer_capturable(optimizer)
+
+        if self.graph is not None:
+            self.graph.replay()
+            return self.static_outputs
+
+        # gradients are set to None, so that the backward pass assigns (rather than accumulates) them
+        optimizer.zero_grad(set_to_none=True)
+
+        if self.nr_of_warmup_steps_done < self.nr_of_warmup_steps:
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                outputs = step_function()
+                optimizer.step()
+            torch.cuda.current_stream().wait_stream(side_stream)
+            self.nr_of_warmup_steps_done += 1
+            return outputs
+
+        graph = torch.cuda.CUDAGraph()
+        try:
+            with torch.cuda.graph(graph):
+                static_outputs = step_function()
+                optimizer.step()
+        except RuntimeError as e:
+            raise CUDAGraphCaptureError(str(e))
+        self.graph = graph
+        self.nr_of_captures += 1
+        self.static_outputs = static_outputs
+        self.graph.replay()
+        return self.static_outputs
@@ -101,8 +101,11 @@ compute_params[('compute',{},'how computations are done')]
 CUDA_ON = compute_params['compute'][('CUDA_ON',False,'Determines if the code should be run on the GPU')]
 """If set to True CUDA will be used, otherwise it will not be used"""
 
-USE_FLOAT16 = compute_params['compute'][('USE_FLOAT16',False,'if set to True uses half-precision - not recommended')]
-"""If set to True 16 bit computations will be used -- not recommended and not actively supported"""
+USE_FLOAT16 = compute_params['compute'][('USE_FLOAT16',False,'DEPRECATED: if set to True automatic mixed precision is used (same as USE_AMP)')]
+"""Deprecated; used to cast all computations to 16 bit. Now simply turns on automatic mixed precision (see USE_AMP)"""
+
+USE_AMP = compute_params['compute'][('USE_AMP',False,'if set to True uses automatic mixed precision (autocast and loss scaling) on the GPU')]
+"""If set to True similarity measures, smoothing convolutions and deep networks are run in mixed precision (CUDA only); FFTs, integration and energies remain in float32"""
 
 nr_of_threads = compute_params['compute'][('nr_of_threads',mp.cpu_count(),'set the maximal number of threads')]
 """Specifies the number of threads"""
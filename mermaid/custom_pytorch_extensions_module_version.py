@@ -707,6 +707,8 @@ class FourierMultiGaussianConvolution(FourierGaussianConvolution):
         :return: Filtered-image
         """
 
+        # the accumulation is done in float32 (input may be half precision if computed under autocast)
+        input = FFTVal(input, ini=1)
         self.input =  input
         self.sigmas = sigmas if self.compute_std_gradients else self.freeze_sigma(sigmas)
         self.weights = weights if self.compute_weight_gradients else self.freeze_weight(weights)
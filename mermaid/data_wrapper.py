@@ -1,18 +1,19 @@
 from __future__ import absolute_import
 import torch
-from mermaid.config_parser import CUDA_ON, USE_FLOAT16
+from mermaid.config_parser import CUDA_ON, USE_FLOAT16, USE_AMP
 
 # ----------------- global setting ----------------------------------------
 USE_CUDA = CUDA_ON and torch.cuda.is_available()
 
+if USE_FLOAT16:
+    print('WARNING: USE_FLOAT16 is deprecated and no longer casts all computations to half precision; it now turns on automatic mixed precision (USE_AMP)')
+
 # --------------------   My Tensor -------------------------
-# a warped version of Tensor to adapt gpu, cpu and float16
+# a warped version of Tensor to adapt gpu, cpu
+# (tensors are always kept in float32; reduced precision is handled via automatic mixed precision below)
 if USE_CUDA:
     MyLongTensor = torch.cuda.LongTensor
-    if not USE_FLOAT16:
-        MyTensor = torch.cuda.FloatTensor
-    else:
-        MyTensor = torch.cuda.HalfTensor
+    MyTensor = torch.cuda.FloatTensor
 else:
     MyTensor = torch.FloatTensor
     MyLongTensor = torch.LongTensor
@@ -20,12 +21,76 @@ else:
 # ------------------  ApdatVal --------------------------
 # Adaptive Warper: used to adapt the data type, implemented on the existed Tensor/Variable
 def AdaptVal(x):
-    """ adapt float32/16, gpu/cpu, float 16 is not recommended to use for it is not stable"""
+    """ adapt gpu/cpu; data is kept in float32, use automatic mixed precision (USE_AMP) for reduced precision"""
     if USE_CUDA:
-        if not USE_FLOAT16:
-            return x.cuda()
-        else:
-            return x.cuda().half()
+        return x.cuda()
+    else:
+        return x
+
+
+# ------------------ AMP ----------------------------
+# automatic mixed precision: similarity measures, spatial smoothing convolutions and deep networks are
+# run under autocast; FFTs, integrators and energies are kept in float32
+# (float16 with loss scaling on the GPU; bfloat16, which needs no loss scaling, can also be used on the CPU)
+
+_amp_enabled = (USE_AMP or USE_FLOAT16) and USE_CUDA
+_amp_dtype = torch.float16 if USE_CUDA else torch.bfloat16
+
+
+def set_amp_enabled(enabled, dtype=None):
+    """
+    Turns automatic mixed precision on or off (for example for an individual run)
+
+    :param enabled: if True automatic mixed precision is used
+    :param dtype: reduced precision data type (torch.float16 or torch.bfloat16); if None float16 is used on the GPU
+        and bfloat16 on the CPU (float16 autocast is only supported on the GPU)
+    """
+    global _amp_enabled, _amp_dtype
+    if dtype is None:
+        dtype = torch.float16 if USE_CUDA else torch.bfloat16
+    if dtype not in [torch.float16, torch.bfloat16]:
+        raise ValueError('Unsupported data type for automatic mixed precision: {}'.format(dtype))
+    if enabled and dtype == torch.float16 and not USE_CUDA:
+        print('WARNING: float16 automatic mixed precision is only supported on the GPU; using bfloat16 instead')
+        dtype = torch.bfloat16
+    _amp_enabled = enabled
+    _amp_dtype = dtype
+
+
+def is_amp_enabled():
+    """
+    Returns if automatic mixed precision is currently enabled
+
+    :return: True if enabled, False otherwise
+    """
+    return _amp_enabled
+
+
+def get_amp_dtype():
+    """
+    Returns the reduced precision data type used by automatic mixed precision
+
+    :return: torch.float16 or torch.bfloat16
+    """
+    return _amp_dtype
+
+
+def amp_autocast(enabled=None):
+    """
+    Context manager for regions that should run in mixed precision
+
+    :param enabled: if None uses the current global setting (see set_amp_enabled)
+    :return: autocast context manager
+    """
+    if enabled is None:
+        enabled = _amp_enabled
+    return torch.autocast(device_type='cuda' if USE_CUDA else 'cpu', dtype=_amp_dtype, enabled=enabled)
+
+
+def FP32Val(x):
+    """ casts reduced precision floating point tensors (as created under autocast) back to float32; everything else is returned as is"""
+    if torch.is_tensor(x) and x.is_floating_point() and x.dtype != torch.float32 and x.dtype != torch.float64:
+        return x.float()
     else:
         return x
 
@@ -42,25 +107,19 @@ else:
 def STNVal(x, ini):
     """
     the cuda version of stn is writing in float32
-    so the input would first be converted into float32,
-    the output would be converted to adaptive type
+    so the input would first be converted into float32 (it may be half precision if computed under autocast),
+    the output is kept in float32
     """
-    if USE_CUDA:
-        if USE_FLOAT16:
-            if ini == 1:
-                return x.float()
-            elif ini == -1:
-                return x.half()
-            else:
-                raise ValueError('ini should be 1 or -1')
-        else:
-            return x
-    else:
+    if ini == 1:
+        return FP32Val(x)
+    elif ini == -1:
         return x
+    else:
+        raise ValueError('ini should be 1 or -1')
 
 
 # ------------------ FFT ----------------------------
 # specific to FFT Function
-# do same thing as  the STNVal
+# do same thing as  the STNVal, i.e., FFTs are always computed in float32
 
 FFTVal = STNVal
@@ -124,6 +124,22 @@ def DimMaxPool(dim):
         raise ValueError('Only supported for dimensions 1, 2, and 3')
 
 
+def fold_for_inference(conv, normalization, fuse_normalization=True):
+    """
+    Creates the layer which replaces a (noisy or plain) convolution and its following normalization in inference mode.
+
+    :param conv: convolution layer
+    :param normalization: normalization layer following the convolution (or None)
+    :param fuse_normalization: if True a batch normalization (with running statistics) is folded into the convolution
+    :return: plain convolution, or a sequence of the plain convolution and the normalization if the normalization could not be folded
+    """
+    plain_conv, normalization_is_folded = nc.fold_into_plain_convolution(conv, normalization if fuse_normalization else None)
+    if normalization is None or normalization_is_folded:
+        return plain_conv
+    else:
+        return nn.Sequential(plain_conv, normalization)
+
+
 class conv_norm_in_rel(nn.Module):
     def __init__(self, dim, in_channels, out_channels, kernel_size, im_sz, stride=1, active_unit='relu', same_padding=False,
                  normalization_type='layer', reverse=False, group = 1,dilation = 1,
@@ -173,7 +189,40 @@ class conv_norm_in_rel(nn.Module):
         else:
             self.active_unit = None
 
+        self.inference_mode = False
+        """if set to True (and in evaluation mode) convolution and normalization are evaluated by a folded plain convolution"""
+        self._inference_layer = None
+        self._inference_key = None
+        self._fuse_normalization = True
+
+    def set_inference_mode(self, inference_mode, fuse_normalization=True):
+        """
+        Turns the inference mode on or off. In inference mode (and if in evaluation mode) the (noisy) convolution is
+        folded once into a plain convolution (no noise is sampled) and, if possible, the following normalization is folded into it.
+
+        :param inference_mode: if True inference mode is turned on, otherwise it is turned off
+        :param fuse_normalization: if True a batch normalization is folded into the convolution
+        """
+        self.inference_mode = inference_mode
+        self._fuse_normalization = fuse_normalization
+        if inference_mode:
+            inference_layer = fold_for_inference(self.conv, self.normalization, fuse_normalization)
+        else:
+            inference_layer = None
+        # bypass nn.Module.__setattr__ so that the folded layer is not registered as a submodule (and the state dictionary does not change)
+        object.__setattr__(self, '_inference_layer', inference_layer)
+        self._inference_key = nc.get_fold_key(self) if inference_mode else None
+
     def forward(self, x, iter=0):
+        if self.inference_mode and not self.training:
+            if nc.get_fold_key(self) != self._inference_key:
+                # the parameters (or running statistics) changed since they were folded
+                self.set_inference_mode(True, self._fuse_normalization)
+            x = self._inference_layer(x)
+            if self.active_unit is not None:
+                x = self.active_unit(x)
+            return x
+
         if self.use_noisy_convolution:
             x = self.conv(x,iter=iter)
         else:
@@ -224,12 +273,44 @@ class encoder_block_2d(nn.Module):
         self.normalization_type = normalization_type
         self.dropout = nn.Dropout(0.2)
 
+        self.inference_mode = False
+        """if set to True (and in evaluation mode) the convolutions and normalizations are evaluated by folded plain convolutions"""
+        self._inference_layers = None
+        self._inference_key = None
+        self._fuse_normalization = True
+
+    def set_inference_mode(self, inference_mode, fuse_normalization=True):
+        """
+        Turns the inference mode on or off; in inference mode (and if in evaluation mode) each convolution is folded
+        (together with its normalization if possible) into a plain convolution
+
+        :param inference_mode: if True inference mode is turned on, otherwise it is turned off
+        :param fuse_normalization: if True batch normalizations are folded into the convolutions
+        """
+        self.inference_mode = inference_mode
+        self._fuse_normalization = fuse_normalization
+        self._inference_key = nc.get_fold_key(self) if inference_mode else None
+        if inference_mode:
+            # a list is not registered as a submodule, i.e., the state dictionary does not change
+            norms = [self.norm_1, self.norm_2, self.norm_3, self.norm_4] if self.normalization_type else [None]*4
+            convs = [self.conv_input, self.conv_inblock1, self.conv_inblock2, self.conv_pooling]
+            self._inference_layers = [fold_for_inference(c, n, fuse_normalization) for c,n in zip(convs,norms)]
+        else:
+            self._inference_layers = None
+
     def apply_dropout(self, input):
         if self.use_dropout:
             return self.dropout(input)
         else:
             return input
 
+    def forward_inference(self,x):
+        conv_input, conv_inblock1, conv_inblock2, conv_pooling = self._inference_layers
+        output = self.apply_dropout(self.prelu1(conv_input(x)))
+        output = self.apply_dropout(self.prelu2(conv_inblock1(output)))
+        output = self.apply_dropout(self.prelu3(conv_inblock2(output)))
+        return self.prelu4(conv_pooling(output))
+
     def forward_with_normalization(self,x):
         output = self.conv_input(x)
         output = self.apply_dropout(self.prelu1(self.norm_1(output)))
@@ -245,7 +326,12 @@ class encoder_block_2d(nn.Module):
         return self.prelu4(self.conv_pooling(output))
 
     def forward(self, x):
-        if self.normalization_type:
+        if self.inference_mode and not self.training:
+            if nc.get_fold_key(self) != self._inference_key:
+                # the parameters (or running statistics) changed since they were folded
+                self.set_inference_mode(True, self._fuse_normalization)
+            return self.forward_inference(x)
+        elif self.normalization_type:
             return self.forward_with_normalization(x)
         else:
             return self.forward_without_normalization(x)
@@ -294,12 +380,50 @@ class decoder_block_2d(nn.Module):
         self.dropout = nn.Dropout(0.2)
         self.output_feature = output_feature
 
+        self.inference_mode = False
+        """if set to True (and in evaluation mode) the convolutions and normalizations are evaluated by folded plain convolutions"""
+        self._inference_layers = None
+        self._inference_key = None
+        self._fuse_normalization = True
+
+    def set_inference_mode(self, inference_mode, fuse_normalization=True):
+        """
+        Turns the inference mode on or off; in inference mode (and if in evaluation mode) each convolution is folded
+        (together with its normalization if possible) into a plain convolution
+
+        :param inference_mode: if True inference mode is turned on, otherwise it is turned off
+        :param fuse_normalization: if True batch normalizations are folded into the convolutions
+        """
+        self.inference_mode = inference_mode
+        self._fuse_normalization = fuse_normalization
+        self._inference_key = nc.get_fold_key(self) if inference_mode else None
+        if inference_mode:
+            # a list is not registered as a submodule, i.e., the state dictionary does not change
+            if self.normalization_type:
+                norms = [self.norm_1, self.norm_2, self.norm_3, None if self.last_block else self.norm_4]
+            else:
+                norms = [None]*4
+            convs = [self.conv_unpooling, self.conv_inblock1, self.conv_inblock2, self.conv_output]
+            self._inference_layers = [fold_for_inference(c, n, fuse_normalization) for c,n in zip(convs,norms)]
+        else:
+            self._inference_layers = None
+
     def apply_dropout(self, input):
         if self.use_dropout:
             return self.dropout(input)
         else:
             return input
 
+    def forward_inference(self,x):
+        conv_unpooling, conv_inblock1, conv_inblock2, conv_output = self._inference_layers
+        output = self.prelu1(conv_unpooling(x))
+        output = self.apply_dropout(self.prelu2(conv_inblock1(output)))
+        output = self.apply_dropout(self.prelu3(conv_inblock2(output)))
+        if self.last_block:  # generates final output
+            return conv_output(output)
+        else:  # generates intermediate results
+            return self.apply_dropout(self.prelu4(conv_output(output)))
+
     def forward_with_normalization(self,x):
         output = self.prelu1(self.norm_1(self.conv_unpooling(x)))
         output = self.apply_dropout(self.prelu2(self.norm_2(self.conv_inblock1(output))))
@@ -319,7 +443,12 @@ class decoder_block_2d(nn.Module):
             return self.apply_dropout(self.prelu4(self.conv_output(output)))
 
     def forward(self, x):
-        if self.normalization_type:
+        if self.inference_mode and not self.training:
+            if nc.get_fold_key(self) != self._inference_key:
+                # the parameters (or running statistics) changed since they were folded
+                self.set_inference_mode(True, self._fuse_normalization)
+            return self.forward_inference(x)
+        elif self.normalization_type:
             return self.forward_with_normalization(x)
         else:
             return self.forward_without_normalization(x)
@@ -376,6 +505,25 @@ class DeepNetwork(with_metaclass(ABCMeta,nn.Module)):
         self.normalize_last_layer = self.params[('normalize_last_layer',True,'If set to true normalization is also used for the last layer')]
         self.normalize_last_layer_initial_affine_slope = self.params[('normalize_last_layer_initial_affine_slope',0.025,'initial slope of affine transformation for batch and group normalization')]
 
+    def set_inference_mode(self, inference_mode=True, fuse_normalization=True):
+        """
+        Turns the inference mode on or off for all layers of the network (so that the whole network switches together).
+        In inference mode the (noisy) convolutions are folded once into plain convolutions, no noise is sampled, and
+        batch normalizations (with running statistics) are folded into the preceding convolutions. Turning inference mode on
+        also puts the network into evaluation mode (the folded layers are only used in evaluation mode).
+        The folded layers are not part of the state dictionary; a layer is folded again once its parameters (or running
+        statistics) changed or were moved to a different device (changes made through .data are not detected).
+
+        :param inference_mode: if True inference mode is turned on, otherwise it is turned off
+        :param fuse_normalization: if True batch normalizations are folded into the convolutions
+        """
+        if inference_mode:
+            self.eval()
+
+        for m in self.modules():
+            if isinstance(m, (conv_norm_in_rel, encoder_block_2d, decoder_block_2d)):
+                m.set_inference_mode(inference_mode, fuse_normalization=fuse_normalization)
+
     def _find_last_layer_of_type(self, layer_types):
         ln = None
         for m in self.modules():
@@ -8,8 +8,9 @@ from future.utils import with_metaclass
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+from torch.autograd import Function
 import numpy as np
-from .data_wrapper import USE_CUDA, MyTensor, AdaptVal
+from .data_wrapper import USE_CUDA, MyTensor, AdaptVal, amp_autocast, FP32Val
 
 from . import finite_differences as fd
 from . import module_parameters as pars
@@ -241,6 +242,254 @@ def _compute_total_variation(d, spacing, pnorm=2):
     return (tv).sum()*volumeElement
 
 
+# --------------------------------------------------------------------------------------------------------------------
+# Fused implementations of the softmax family (weighted_softmax, weighted_linear_softmax, ...)
+#
+# These functions are evaluated at every Runge-Kutta stage of the adaptive models. Written as chains of elementwise
+# operations (over the channels of the Gaussian weights) each operation allocates a full-size tensor which is also kept
+# for the backward pass. The fused versions below compute the forward pass in-place where possible, only keep the input
+# (or the output) for the backward pass and evaluate the gradient in closed form. The kernels are compiled via TorchScript
+# if available (falling back to eager execution otherwise).
+# --------------------------------------------------------------------------------------------------------------------
+
+def _script_if_possible(fcn):
+    """
+    Compiles a kernel via TorchScript; if this is not possible the (eager) python function is returned
+
+    :param fcn: kernel (using type comments for TorchScript)
+    :return: tuple of compiled (or eager) kernel and flag indicating if it was compiled
+    """
+    try:
+        return torch.jit.script(fcn), True
+    except Exception:
+        return fcn, False
+
+
+def _weighted_softmax_kernel_forward(x, w, dim):
+    # type: (Tensor, Tensor, int) -> Tensor
+    # shift by the maximum for numerical stability (does not change the result)
+    ret = torch.exp(x - torch.max(x, dim, True)[0])
+    ret.mul_(w)
+    ret.div_(ret.sum(dim, True))
+    return ret
+
+
+def _weighted_softmax_kernel_backward(grad_output, x, w, y, dim, needs_weight_grad):
+    # type: (Tensor, Tensor, Tensor, Tensor, int, bool) -> Tuple[Tensor, Tensor]
+    # y_i = w_i e_i / S; dy_i/dx_k = y_i (delta_ik - y_k); dy_i/dw_k = e_k/S (delta_ik - y_i)
+    projected_grad = grad_output - (grad_output * y).sum(dim, True)
+    grad_input = y * projected_grad
+    if needs_weight_grad:
+        e = torch.exp(x - torch.max(x, dim, True)[0])
+        e.div_((w * e).sum(dim, True))
+        grad_weights = (e * projected_grad).transpose(0, dim).reshape([x.size(dim), -1]).sum(1)
+    else:
+        grad_weights = torch.zeros(0, dtype=x.dtype, device=x.device)
+    return grad_input, grad_weights
+
+
+def _linear_soft_normalization_kernel_pre(x, w, dim, subtract_mean, use_weights, use_l2_norm):
+    # type: (Tensor, Tensor, int, bool, bool, bool) -> Tuple[Tensor, Tensor, Tensor]
+    if subtract_mean:
+        u = x - x.mean(dim, True)
+        if use_weights:
+            u.add_(w)
+    elif use_weights:
+        u = x + w
+    else:
+        u = x
+    c = torch.clamp(u, 0., 1.)
+    if use_l2_norm:
+        norm = torch.sqrt((c * c).sum(dim, True))
+    else:
+        norm = c.sum(dim, True)
+    return u, c, norm
+
+
+def _linear_soft_normalization_kernel_forward(x, w, dim, subtract_mean, use_weights, use_l2_norm):
+    # type: (Tensor, Tensor, int, bool, bool, bool) -> Tensor
+    _, c, norm = _linear_soft_normalization_kernel_pre(x, w, dim, subtract_mean, use_weights, use_l2_norm)
+    return c.div_(norm)
+
+
+def _linear_soft_normalization_kernel_backward(grad_output, x, w, dim, subtract_mean, use_weights, use_l2_norm):
+    # type: (Tensor, Tensor, Tensor, int, bool, bool, bool) -> Tuple[Tensor, Tensor]
+    # recomputes the clamped values (cheaper than keeping them); y = c/N with N = \sum_j c_j or N = \sqrt{\sum_j c_j^2}
+    u, c, norm = _linear_soft_normalization_kernel_pre(x, w, dim, subtract_mean, use_weights, use_l2_norm)
+    y = c.div_(norm)
+    if use_l2_norm:
+        grad_c = grad_output - y * (grad_output * y).sum(dim, True)
+    else:
+        grad_c = grad_output - (grad_output * y).sum(dim, True)
+    grad_c.div_(norm)
+    # the clamp passes the gradient on [0,1] (boundaries included, as for torch.clamp)
+    grad_u = grad_c.mul_(((u >= 0.) & (u <= 1.)).to(grad_c.dtype))
+    if subtract_mean:
+        grad_input = grad_u - grad_u.mean(dim, True)
+    else:
+        grad_input = grad_u
+    return grad_input, grad_u
+
+
+def _weighted_sqrt_softmax_kernel_forward(x, w, dim):
+    # type: (Tensor, Tensor, int) -> Tensor
+    e = torch.exp(x - torch.max(x, dim, True)[0])
+    norm = torch.sqrt((w * e * e).sum(dim, True))
+    return e.mul_(torch.sqrt(w)).div_(norm)
+
+
+def _weighted_sqrt_softmax_kernel_backward(grad_output, x, w, y, dim, needs_weight_grad):
+    # type: (Tensor, Tensor, Tensor, Tensor, int, bool) -> Tuple[Tensor, Tensor]
+    # y_i^2 is the weighted softmax of 2x, hence dy_i/dx_k = y_i (delta_ik - y_k^2)
+    gy = (grad_output * y).sum(dim, True)
+    grad_input = y * (grad_output - y * gy)
+    if needs_weight_grad:
+        e = torch.exp(x - torch.max(x, dim, True)[0])
+        e.div_(torch.sqrt((w * e * e).sum(dim, True)))
+        # dL/dw_i = \sum g_i e_i/(2 \sqrt{w_i S}) - e_i^2/(2S) \sum_k g_k y_k
+        # (the weights are clamped, so that the gradient stays finite for zero weights)
+        grad_w = 0.5 * (grad_output * e / torch.sqrt(torch.clamp(w, min=1e-12)) - e * e * gy)
+        grad_weights = grad_w.transpose(0, dim).reshape([x.size(dim), -1]).sum(1)
+    else:
+        grad_weights = torch.zeros(0, dtype=x.dtype, device=x.device)
+    return grad_input, grad_weights
+
+
+_weighted_softmax_kernel_forward, _is_scripted_0 = _script_if_possible(_weighted_softmax_kernel_forward)
+_weighted_softmax_kernel_backward, _is_scripted_1 = _script_if_possible(_weighted_softmax_kernel_backward)
+_linear_soft_normalization_kernel_pre, _is_scripted_2 = _script_if_possible(_linear_soft_normalization_kernel_pre)
+_linear_soft_normalization_kernel_forward, _is_scripted_3 = _script_if_possible(_linear_soft_normalization_kernel_forward)
+_linear_soft_normalization_kernel_backward, _is_scripted_4 = _script_if_possible(_linear_soft_normalization_kernel_backward)
+_weighted_sqrt_softmax_kernel_forward, _is_scripted_5 = _script_if_possible(_weighted_sqrt_softmax_kernel_forward)
+_weighted_sqrt_softmax_kernel_backward, _is_scripted_6 = _script_if_possible(_weighted_sqrt_softmax_kernel_backward)
+
+softmax_kernels_are_scripted = all([_is_scripted_0, _is_scripted_1, _is_scripted_2, _is_scripted_3,
+                                    _is_scripted_4, _is_scripted_5, _is_scripted_6])
+"""True if the kernels of the fused softmax family could be compiled via TorchScript (otherwise they run eagerly)"""
+
+
+def _weights_for_dimension(weights, input, dim):
+    """
+    Converts the weights (list, numpy array or tensor) to a tensor which broadcasts along dimension dim of the input
+
+    :param weights: weights (one per entry along dim)
+    :param input: input tensor
+    :param dim: dimension
+    :return: tuple of weight tensor (1D, keeps the autograd history if weights was a tensor) and its broadcastable view
+    """
+    w = torch.as_tensor(weights, dtype=input.dtype, device=input.device).reshape(-1)
+    if w.numel() != input.size(dim):
+        raise ValueError('Number of weights ({}) needs to match the size of the input along dimension {} ({})'.format(w.numel(), dim, input.size(dim)))
+    view_sz = [1] * input.dim()
+    view_sz[dim] = w.numel()
+    return w, w.view(view_sz)
+
+
+def _check_dimension(input, dim):
+    if dim is None:
+        raise ValueError('dimension needs to be defined!')
+    if dim < 0:
+        dim += input.dim()
+    if dim < 0 or dim >= input.dim():
+        raise ValueError('dimension {} is out of range for an input of dimension {}'.format(dim, input.dim()))
+    return dim
+
+
+class FusedWeightedSoftmax(Function):
+    """
+    Fused weighted softmax :math:`\\frac{w_i exp(x_i)}{\\sum_j w_j exp(x_j)}` with closed-form backward pass;
+    only the output is kept for the backward pass (and the input if the gradient with respect to the weights is needed)
+    """
+
+    @staticmethod
+    def forward(ctx, input, weights, dim):
+        _, w = _weights_for_dimension(weights, input, dim)
+        ret = _weighted_softmax_kernel_forward(input, w, dim)
+        ctx.dim = dim
+        ctx.save_for_backward(input, weights, ret)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, weights, ret = ctx.saved_tensors
+        _, w = _weights_for_dimension(weights, input, ctx.dim)
+        grad_input, grad_weights = _weighted_softmax_kernel_backward(grad_output, input, w, ret, ctx.dim,
+                                                                     ctx.needs_input_grad[1])
+        if not ctx.needs_input_grad[1]:
+            grad_weights = None
+        return grad_input, grad_weights, None
+
+
+class FusedLinearSoftNormalization(Function):
+    """
+    Fused clamp-based normalization :math:`\\frac{clamp(w_i+x_i-\\bar{x},0,1)}{N}`, where N is either the sum
+    or the L2 norm of the clamped values along the dimension (used for the linear softmax and softnorm variants).
+    Only the input is kept for the backward pass; the clamped values are recomputed.
+    """
+
+    @staticmethod
+    def forward(ctx, input, weights, dim, subtract_mean, use_l2_norm):
+        use_weights = weights is not None
+        if use_weights:
+            _, w = _weights_for_dimension(weights, input, dim)
+        else:
+            w = input.new_zeros(0)
+        ret = _linear_soft_normalization_kernel_forward(input, w, dim, subtract_mean, use_weights, use_l2_norm)
+        ctx.dim = dim
+        ctx.subtract_mean = subtract_mean
+        ctx.use_weights = use_weights
+        ctx.use_l2_norm = use_l2_norm
+        ctx.save_for_backward(input, weights if use_weights else None)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, weights = ctx.saved_tensors
+        if ctx.use_weights:
+            _, w = _weights_for_dimension(weights, input, ctx.dim)
+        else:
+            w = input.new_zeros(0)
+        grad_input, grad_u = _linear_soft_normalization_kernel_backward(grad_output, input, w, ctx.dim,
+                                                                        ctx.subtract_mean, ctx.use_weights, ctx.use_l2_norm)
+        grad_weights = None
+        if ctx.use_weights and ctx.needs_input_grad[1]:
+            grad_weights = grad_u.transpose(0, ctx.dim).reshape(input.size(ctx.dim), -1).sum(1)
+        return grad_input, grad_weights, None, None, None
+
+
+class FusedWeightedSqrtSoftmax(Function):
+    """
+    Fused weighted square-root softmax :math:`\\frac{\\sqrt{w_i} exp(x_i)}{\\sqrt{\\sum_j w_j (exp(x_j))^2}}` with
+    closed-form backward pass
+    """
+
+    @staticmethod
+    def forward(ctx, input, weights, dim):
+        _, w = _weights_for_dimension(weights, input, dim)
+        ret = _weighted_sqrt_softmax_kernel_forward(input, w, dim)
+        ctx.dim = dim
+        ctx.save_for_backward(input, weights, ret)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, weights, ret = ctx.saved_tensors
+        _, w = _weights_for_dimension(weights, input, ctx.dim)
+        grad_input, grad_weights = _weighted_sqrt_softmax_kernel_backward(grad_output, input, w, ret, ctx.dim,
+                                                                          ctx.needs_input_grad[1])
+        if not ctx.needs_input_grad[1]:
+            grad_weights = None
+        return grad_input, grad_weights, None
+
+
+def _weights_as_tensor(input, dim, weights, default_weight):
+    # weights may be given as a list, a numpy array or a tensor (autograd history is kept for tensors)
+    if weights is None:
+        weights = [default_weight] * input.size(dim)
+    w, _ = _weights_for_dimension(weights, input, dim)
+    return w
+
+
 def weighted_softmax(input, dim=None, weights=None ):
     r"""Applies a softmax function.
 
@@ -258,59 +507,8 @@ def weighted_softmax(input, dim=None, weights=None ):
         dim (int): A dimension along which weighted_softmax will be computed.
 
     """
-    if dim is None:
-        raise ValueError('dimension needs to be defined!')
-
-    sz = input.size()
-    if weights is None: # just make them all one; this is the default softmax
-        weights = [1.]*sz[dim]
-
-    nr_of_weights = len(weights)
-    assert( sz[dim]==nr_of_weights )
-
-    ret = torch.zeros_like(input)
-
-    # for numerical reasons we first compute the maximum inout along the dimension and then
-    # subtract if from all the exponents (this assures that we do not get exp(100) and then a NaN
-    # this is ok, because we can multiply the nominator and denominator with the same constant
-    # and by doing this shift the exponentials
-
-    max_in,_ = torch.max(input, dim=dim)
-
-    if dim==0:
-        norm = torch.zeros_like(input[0,...])
-        for c in range(sz[0]):
-            norm += weights[c]*torch.exp(input[c,...]-max_in)
-        for c in range(sz[0]):
-            ret[c,...] = weights[c]*torch.exp(input[c,...]-max_in)/norm
-    elif dim==1:
-        norm = torch.zeros_like(input[:,0, ...])
-        for c in range(sz[1]):
-            norm += weights[c] * torch.exp(input[:,c, ...]-max_in)
-        for c in range(sz[1]):
-            ret[:,c, ...] = weights[c] * torch.exp(input[:,c, ...]-max_in) / norm
-    elif dim==2:
-        norm = torch.zeros_like(input[:,:,0, ...])
-        for c in range(sz[2]):
-            norm += weights[c] * torch.exp(input[:,:,c, ...]-max_in)
-        for c in range(sz[2]):
-            ret[:,:,c, ...] = weights[c] * torch.exp(input[:,:,c, ...]-max_in) / norm
-    elif dim==3:
-        norm = torch.zeros_like(input[:,:,:,0, ...])
-        for c in range(sz[3]):
-            norm += weights[c] * torch.exp(input[:,:,:,c, ...]-max_in)
-        for c in range(sz[3]):
-            ret[:,:,:,c, ...] = weights[c] * torch.exp(input[:,:,:,c, ...]-max_in) / norm
-    elif dim==4:
-        norm = torch.zeros_like(input[:,:,:,:,0, ...])
-        for c in range(sz[4]):
-            norm += weights[c] * torch.exp(input[:,:,:,:,c, ...]-max_in)
-        for c in range(sz[4]):
-            ret[:,:,:,:,c, ...] = weights[c] * torch.exp(input[:,:,:,:,c, ...]-max_in) / norm
-    else:
-        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
-
-    return ret
+    dim = _check_dimension(input, dim)
+    return FusedWeightedSoftmax.apply(input, _weights_as_tensor(input, dim, weights, 1.), dim)
 
 
 class WeightedSoftmax(nn.Module):
@@ -359,7 +557,7 @@ class WeightedSoftmax(nn.Module):
 
     def forward(self, input):
 
-        return weighted_softmax(input, self.dim, self.weights, _stacklevel=5)
+        return weighted_softmax(input, self.dim, self.weights)
 
     def __repr__(self):
 
@@ -382,53 +580,9 @@ def stable_softmax(input, dim=None):
         dim (int): A dimension along which stable_softmax will be computed.
 
     """
-    if dim is None:
-        raise ValueError('dimension needs to be defined!')
-
-    sz = input.size()
-    ret = torch.zeros_like(input)
-
-    # for numerical reasons we first compute the maximum inout along the dimension and then
-    # subtract if from all the exponents (this assures that we do not get exp(100) and then a NaN
-    # this is ok, because we can multiply the nominator and denominator with the same constant
-    # and by doing this shift the exponentials
-
-    max_in,_ = torch.max(input, dim=dim)
-
-    if dim==0:
-        norm = torch.zeros_like(input[0,...])
-        for c in range(sz[0]):
-            norm += torch.exp(input[c,...]-max_in)
-        for c in range(sz[0]):
-            ret[c,...] = torch.exp(input[c,...]-max_in)/norm
-    elif dim==1:
-        norm = torch.zeros_like(input[:,0, ...])
-        for c in range(sz[1]):
-            norm += torch.exp(input[:,c, ...]-max_in)
-        for c in range(sz[1]):
-            ret[:,c, ...] = torch.exp(input[:,c, ...]-max_in) / norm
-    elif dim==2:
-        norm = torch.zeros_like(input[:,:,0, ...])
-        for c in range(sz[2]):
-            norm += torch.exp(input[:,:,c, ...]-max_in)
-        for c in range(sz[2]):
-            ret[:,:,c, ...] = torch.exp(input[:,:,c, ...]-max_in) / norm
-    elif dim==3:
-        norm = torch.zeros_like(input[:,:,:,0, ...])
-        for c in range(sz[3]):
-            norm += torch.exp(input[:,:,:,c, ...]-max_in)
-        for c in range(sz[3]):
-            ret[:,:,:,c, ...] = torch.exp(input[:,:,:,c, ...]-max_in) / norm
-    elif dim==4:
-        norm = torch.zeros_like(input[:,:,:,:,0, ...])
-        for c in range(sz[4]):
-            norm += torch.exp(input[:,:,:,:,c, ...]-max_in)
-        for c in range(sz[4]):
-            ret[:,:,:,:,c, ...] = torch.exp(input[:,:,:,:,c, ...]-max_in) / norm
-    else:
-        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
-
-    return ret
+    dim = _check_dimension(input, dim)
+    # the native softmax is numerically stable (subtracts the maximum) and computed by a single fused kernel
+    return torch.softmax(input, dim=dim)
 
 
 class StableSoftmax(nn.Module):
@@ -470,7 +624,7 @@ class StableSoftmax(nn.Module):
 
     def forward(self, input):
 
-        return stable_softmax(input, self.dim, _stacklevel=5)
+        return stable_softmax(input, self.dim)
 
     def __repr__(self):
 
@@ -493,57 +647,10 @@ def weighted_linear_softmax(input, dim=None, weights=None ):
         dim (int): A dimension along which weighted_linear_softmax will be computed.
 
     """
-    if dim is None:
-        raise ValueError('dimension needs to be defined!')
-
-    sz = input.size()
-    if weights is None: # just make them all one/nr_of_weights
-        weights = [1./sz[dim]]*sz[dim]
-
-    nr_of_weights = len(weights)
-    assert( sz[dim]==nr_of_weights )
-
-    ret = torch.zeros_like(input)
-
-    # todo: subtracting the input mean (so that the values perturb around the offset and leave the sum constant)
-    # todo: seems highly beneficial for training, find a theoretical justification for this (-> tangent space)
-
-    input_offset = input.sum(dim=dim) / sz[dim]
-
-    if dim==0:
-        norm = torch.zeros_like(input[0,...])
-        for c in range(sz[0]):
-            norm += torch.clamp(weights[c]+input[c,...]-input_offset,min=0,max=1)
-        for c in range(sz[0]):
-            ret[c,...] = torch.clamp(weights[c]+input[c,...]-input_offset,min=0,max=1)/norm
-    elif dim==1:
-        norm = torch.zeros_like(input[:,0, ...])
-        for c in range(sz[1]):
-            norm += torch.clamp(weights[c]+input[:,c, ...]-input_offset,min=0,max=1)
-        for c in range(sz[1]):
-            ret[:,c, ...] = torch.clamp(weights[c]+input[:,c, ...]-input_offset,min=0,max=1)/norm
-    elif dim==2:
-        norm = torch.zeros_like(input[:,:,0, ...])
-        for c in range(sz[2]):
-            norm += torch.clamp(weights[c]+input[:,:,c, ...]-input_offset,min=0,max=1)
-        for c in range(sz[2]):
-            ret[:,:,c, ...] = torch.clamp(weights[c]+input[:,:,c, ...]-input_offset,min=0,max=1)/norm
-    elif dim==3:
-        norm = torch.zeros_like(input[:,:,:,0, ...])
-        for c in range(sz[3]):
-            norm += torch.clamp(weights[c]+input[:,:,:,c, ...]-input_offset,min=0,max=1)
-        for c in range(sz[3]):
-            ret[:,:,:,c, ...] = torch.clamp(weights[c]+input[:,:,:,c, ...]-input_offset,min=0,max=1)/norm
-    elif dim==4:
-        norm = torch.zeros_like(input[:,:,:,:,0, ...])
-        for c in range(sz[4]):
-            norm += torch.clamp(weights[c]+input[:,:,:,:,c, ...]-input_offset,min=0,max=1)
-        for c in range(sz[4]):
-            ret[:,:,:,:,c, ...] = torch.clamp(weights[c]+input[:,:,:,:,c, ...]-input_offset,min=0,max=1)/norm
-    else:
-        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
-
-    return ret
+    dim = _check_dimension(input, dim)
+    # subtracting the input mean (so that the values perturb around the offset and leave the sum constant)
+    # seems highly beneficial for training (todo: find a theoretical justification for this (-> tangent space))
+    return FusedLinearSoftNormalization.apply(input, _weights_as_tensor(input, dim, weights, 1./input.size(dim)), dim, True, False)
 
 
 class WeightedLinearSoftmax(nn.Module):
@@ -591,7 +698,7 @@ class WeightedLinearSoftmax(nn.Module):
 
     def forward(self, input):
 
-        return weighted_linear_softmax(input, self.dim, self.weights, _stacklevel=5)
+        return weighted_linear_softmax(input, self.dim, self.weights)
 
     def __repr__(self):
 
@@ -614,72 +721,8 @@ def weighted_linear_softnorm(input, dim=None, weights=None ):
         dim (int): A dimension along which weighted_linear_softnorm will be computed.
 
     """
-    if dim is None:
-        raise ValueError('dimension needs to be defined!')
-
-    sz = input.size()
-    if weights is None: # just make them all one/nr_of_weights
-        weights = [1./sz[dim]]*sz[dim]
-
-    nr_of_weights = len(weights)
-    assert( sz[dim]==nr_of_weights )
-
-    ret = torch.zeros_like(input)
-
-    # todo: subtracting the input mean (so that the values perturb around the offset and leave the sum constant)
-    # todo: seems highly beneficial for training, find a theoretical justification for this (-> tangent space)
-
-    # clamped_vals = torch.clamp(input, min=0, max=1)
-    # norm = torch.norm(clamped_vals, p=2, dim=dim)
-    #
-    # # todo: subtracting the input mean (so that the values perturb around the offset and leave the sum constant)
-    # # todo: seems highly beneficial for training, find a theoretical justification for this (-> tangent space)
-    #
-    # if dim == 0:
-    #     for c in range(sz[0]):
-    #         ret[c, ...] = clamped_vals[c, ...] / norm
-
-    clamped_vals = torch.zeros_like(input)
-
-    if dim==0:
-        input_offset = input.sum(dim=0)/sz[0]
-        for c in range(sz[0]):
-            clamped_vals[c,...] = torch.clamp(weights[c]+input[c,...]-input_offset,min=0,max=1)
-        norm = torch.norm(clamped_vals, p=2, dim=dim)
-        for c in range(sz[0]):
-            ret[c,...] = clamped_vals[c,...]/norm
-    elif dim==1:
-        input_offset = input.sum(dim=1)/sz[1]
-        for c in range(sz[1]):
-            clamped_vals[:,c,...] = torch.clamp(weights[c]+input[:,c, ...]-input_offset,min=0,max=1)
-        norm = torch.norm(clamped_vals, p=2, dim=dim)
-        for c in range(sz[1]):
-            ret[:,c, ...] = clamped_vals[:,c,...]/norm
-    elif dim==2:
-        input_offset = input.sum(dim=2)/sz[2]
-        for c in range(sz[2]):
-            clamped_vals[:,:,c,...] = torch.clamp(weights[c]+input[:,:,c, ...]-input_offset,min=0,max=1)
-        norm = torch.norm(clamped_vals, p=2, dim=dim)
-        for c in range(sz[2]):
-            ret[:,:,c, ...] = clamped_vals[:,:,c, ...]/norm
-    elif dim==3:
-        input_offset = input.sum(dim=3)/sz[3]
-        for c in range(sz[3]):
-            clamped_vals[:,:,:,c,...] = torch.clamp(weights[c]+input[:,:,:,c, ...]-input_offset,min=0,max=1)
-        norm = torch.norm(clamped_vals, p=2, dim=dim)
-        for c in range(sz[3]):
-            ret[:,:,:,c, ...] = clamped_vals[:,:,:,c, ...]/norm
-    elif dim==4:
-        input_offset = input.sum(dim=4)/sz[4]
-        for c in range(sz[4]):
-            clamped_vals[:,:,:,:,c,...] = torch.clamp(weights[c]+input[:,:,:,:,c, ...]-input_offset,min=0,max=1)
-        norm = torch.norm(clamped_vals, p=2, dim=dim)
-        for c in range(sz[4]):
-            ret[:,:,:,:,c, ...] = clamped_vals[:,:,:,:,c, ...]/norm
-    else:
-        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
-
-    return ret
+    dim = _check_dimension(input, dim)
+    return FusedLinearSoftNormalization.apply(input, _weights_as_tensor(input, dim, weights, 1./input.size(dim)), dim, True, True)
 
 
 class WeightedLinearSoftnorm(nn.Module):
@@ -727,7 +770,7 @@ class WeightedLinearSoftnorm(nn.Module):
 
     def forward(self, input):
 
-        return weighted_linear_softnorm(input, self.dim, self.weights, _stacklevel=5)
+        return weighted_linear_softnorm(input, self.dim, self.weights)
 
     def __repr__(self):
 
@@ -750,37 +793,8 @@ def linear_softnorm(input, dim=None):
         dim (int): A dimension along which linear_softnorm will be computed.
 
     """
-    if dim is None:
-        raise ValueError('dimension needs to be defined!')
-
-    sz = input.size()
-
-    ret = torch.zeros_like(input)
-    clamped_vals = torch.clamp(input, min=0, max=1)
-    norm = torch.norm(clamped_vals,p=2,dim=dim)
-
-    # todo: subtracting the input mean (so that the values perturb around the offset and leave the sum constant)
-    # todo: seems highly beneficial for training, find a theoretical justification for this (-> tangent space)
-
-    if dim==0:
-        for c in range(sz[0]):
-            ret[c,...] = clamped_vals[c,...]/norm
-    elif dim==1:
-        for c in range(sz[1]):
-            ret[:,c, ...] = clamped_vals[:,c,...]/norm
-    elif dim==2:
-        for c in range(sz[2]):
-            ret[:,:,c, ...] = clamped_vals[:,:,c,...]/norm
-    elif dim==3:
-        for c in range(sz[3]):
-            ret[:,:,:,c, ...] = clamped_vals[:,:,:,c,...]/norm
-    elif dim==4:
-        for c in range(sz[4]):
-            ret[:,:,:,:,c, ...] = clamped_vals[:,:,:,:,c,...]/norm
-    else:
-        raise ValueError('linear_softnorm is only supported for dimensions 0, 1, 2, 3, and 4.')
-
-    return ret
+    dim = _check_dimension(input, dim)
+    return FusedLinearSoftNormalization.apply(input, None, dim, False, True)
 
 
 class LinearSoftnorm(nn.Module):
@@ -822,7 +836,7 @@ class LinearSoftnorm(nn.Module):
 
     def forward(self, input):
 
-        return linear_softnorm(input, self.dim, _stacklevel=5)
+        return linear_softnorm(input, self.dim)
 
     def __repr__(self):
 
@@ -845,47 +859,8 @@ def linear_softmax(input, dim=None):
         dim (int): A dimension along which linear_softmax will be computed.
 
     """
-    if dim is None:
-        raise ValueError('dimension needs to be defined!')
-
-    sz = input.size()
-
-    ret = torch.zeros_like(input)
-
-    if dim==0:
-        norm = torch.zeros_like(input[0,...])
-        for c in range(sz[0]):
-            norm += torch.clamp(input[c,...],min=0,max=1)
-        for c in range(sz[0]):
-            ret[c,...] = torch.clamp(input[c,...],min=0,max=1)/norm
-    elif dim==1:
-        norm = torch.zeros_like(input[:,0, ...])
-        for c in range(sz[1]):
-            norm += torch.clamp(input[:,c, ...],min=0,max=1)
-        for c in range(sz[1]):
-            ret[:,c, ...] = torch.clamp(input[:,c, ...],min=0,max=1)/norm
-    elif dim==2:
-        norm = torch.zeros_like(input[:,:,0, ...])
-        for c in range(sz[2]):
-            norm += torch.clamp(input[:,:,c, ...],min=0,max=1)
-        for c in range(sz[2]):
-            ret[:,:,c, ...] = torch.clamp(input[:,:,c, ...],min=0,max=1)/norm
-    elif dim==3:
-        norm = torch.zeros_like(input[:,:,:,0, ...])
-        for c in range(sz[3]):
-            norm += torch.clamp(input[:,:,:,c, ...],min=0,max=1)
-        for c in range(sz[3]):
-            ret[:,:,:,c, ...] = torch.clamp(input[:,:,:,c, ...],min=0,max=1)/norm
-    elif dim==4:
-        norm = torch.zeros_like(input[:,:,:,:,0, ...])
-        for c in range(sz[4]):
-            norm += torch.clamp(input[:,:,:,:,c, ...],min=0,max=1)
-        for c in range(sz[4]):
-            ret[:,:,:,:,c, ...] = torch.clamp(input[:,:,:,:,c, ...],min=0,max=1)/norm
-    else:
-        raise ValueError('linear_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
-
-    return ret
+    dim = _check_dimension(input, dim)
+    return FusedLinearSoftNormalization.apply(input, None, dim, False, False)
 
 
 class LinearSoftmax(nn.Module):
@@ -927,7 +902,7 @@ class LinearSoftmax(nn.Module):
 
     def forward(self, input):
 
-        return linear_softmax(input, self.dim, _stacklevel=5)
+        return linear_softmax(input, self.dim)
 
     def __repr__(self):
 
@@ -950,64 +925,8 @@ def weighted_sqrt_softmax(input, dim=None, weights=None ):
         dim (int): A dimension along which weighted_softmax will be computed.
 
     """
-    if dim is None:
-        raise ValueError('dimension needs to be defined!')
-
-    sz = input.size()
-    if weights is None: # just make them all one; this is the default softmax
-        weights = [1.]*sz[dim]
-
-    nr_of_weights = len(weights)
-    assert( sz[dim]==nr_of_weights )
-
-    ret = torch.zeros_like(input)
-
-    # for numerical reasons we first compute the maximum inout along the dimension and then
-    # subtract if from all the exponents (this assures that we do not get exp(100) and then a NaN
-    # this is ok, because we can multiply the nominator and denominator with the same constant
-    # and by doing this shift the exponentials
-
-    max_in, _ = torch.max(input, dim=dim)
-
-    if dim==0:
-        norm_sqr = torch.zeros_like(input[0,...])
-        for c in range(sz[0]):
-            norm_sqr += weights[c]*(torch.exp(input[c,...]-max_in))**2
-        norm = torch.sqrt(norm_sqr)
-        for c in range(sz[0]):
-            ret[c,...] = torch.sqrt(weights[c])*torch.exp(input[c,...]-max_in)/norm
-    elif dim==1:
-        norm_sqr = torch.zeros_like(input[:,0, ...])
-        for c in range(sz[1]):
-            norm_sqr += weights[c] * (torch.exp(input[:,c, ...]-max_in))**2
-        norm = torch.sqrt(norm_sqr)
-        for c in range(sz[1]):
-            ret[:,c, ...] = torch.sqrt(weights[c]) * torch.exp(input[:,c, ...]-max_in) / norm
-    elif dim==2:
-        norm_sqr = torch.zeros_like(input[:,:,0, ...])
-        for c in range(sz[2]):
-            norm_sqr += weights[c] * (torch.exp(input[:,:,c, ...]-max_in))**2
-        norm = torch.sqrt(norm_sqr)
-        for c in range(sz[2]):
-            ret[:,:,c, ...] = torch.sqrt(weights[c]) * torch.exp(input[:,:,c, ...]-max_in) / norm
-    elif dim==3:
-        norm_sqr = torch.zeros_like(input[:,:,:,0, ...])
-        for c in range(sz[3]):
-            norm_sqr += weights[c] * (torch.exp(input[:,:,:,c, ...]-max_in))**2
-        norm = torch.sqrt(norm_sqr)
-        for c in range(sz[3]):
-            ret[:,:,:,c, ...] = torch.sqrt(weights[c]) * torch.exp(input[:,:,:,c, ...]-max_in) / norm
-    elif dim==4:
-        norm_sqr = torch.zeros_like(input[:,:,:,:,0, ...])
-        for c in range(sz[4]):
-            norm_sqr += weights[c] * (torch.exp(input[:,:,:,:,c, ...]-max_in))**2
-        norm = torch.sqrt(norm_sqr)
-        for c in range(sz[4]):
-            ret[:,:,:,:,c, ...] = torch.sqrt(weights[c]) * torch.exp(input[:,:,:,:,c, ...]-max_in) / norm
-    else:
-        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
-
-    return ret
+    dim = _check_dimension(input, dim)
+    return FusedWeightedSqrtSoftmax.apply(input, _weights_as_tensor(input, dim, weights, 1.), dim)
 
 class WeightedSqrtSoftmax(nn.Module):
     r"""Applies the WeightedSqrtSoftmax function to an n-dimensional input Tensor
@@ -1059,7 +978,7 @@ class WeightedSqrtSoftmax(nn.Module):
 
     def forward(self, input):
 
-        return weighted_sqrt_softmax(input, self.dim, self.weights, _stacklevel=5)
+        return weighted_sqrt_softmax(input, self.dim, self.weights)
 
     def __repr__(self):
 
@@ -1075,15 +994,114 @@ def compute_weighted_multi_smooth_v(momentum, weights, gaussian_stds, gaussian_f
     sz_mv = [sz_m[0]]+ [len(gaussian_stds)] + list(sz_m[1:])
     dim = sz_m[1]
     weighted_multi_smooth_v = AdaptVal(MyTensor(*sz_mv))
+    stds = _gaussian_stds_as_tensor(gaussian_stds)
     # and fill it with weighted smoothed velocity fields
-    for i,g in enumerate(gaussian_stds):
+    for i in range(len(stds)):
         weighted_momentum_i = weights[:,i:i+1,...]*momentum
-        current_g = MyTensor([g])
-        current_weighted_smoothed_v_i = ce.fourier_set_of_gaussian_convolutions(weighted_momentum_i, gaussian_fourier_filter_generator,current_g, compute_std_gradients=False)
-        weighted_multi_smooth_v[:,i,...] = current_weighted_smoothed_v_i[0,...]
+        weighted_multi_smooth_v[:,i,...] = _smooth_with_single_gaussian(weighted_momentum_i, stds[i:i+1], gaussian_fourier_filter_generator)
 
     return weighted_multi_smooth_v
 
+def _gaussian_stds_as_tensor(gaussian_stds):
+    # all standard deviations in one tensor (created once per call); a single Gaussian is then selected by slicing
+    if torch.is_tensor(gaussian_stds):
+        return gaussian_stds.detach().type(MyTensor)
+    return MyTensor(list(gaussian_stds))
+
+def _smooth_with_single_gaussian(v, gaussian_std, gaussian_fourier_filter_generator):
+    # returns K*v for the Gaussian with the given standard deviation (a one element tensor; same dimension as v)
+    return ce.fourier_set_of_gaussian_convolutions(v, gaussian_fourier_filter_generator, gaussian_std,
+                                                   compute_std_gradients=False)[0, ...]
+
+def _effective_smoothing_weights(weights, min_weight, sqrt_weights):
+    # clamps the weights from below and takes their square root (if desired); a single new tensor is created
+    if min_weight is not None:
+        w = torch.clamp(weights, min=min_weight)
+    else:
+        w = weights.clone()
+    if sqrt_weights:
+        w.sqrt_()
+    return w
+
+
+class WeightedMultiGaussianSmoothing(Function):
+    r"""
+    Computes the locally weighted multi-Gaussian smoothing y = \sum_i w_i K_i*(w_i m) by streaming over the Gaussians,
+    i.e., the multi-velocity stack (batch x K x dim x X x Y x ...) is never materialized. The backward pass recomputes
+    the smoothed fields one Gaussian at a time (the Gaussian kernels are symmetric, i.e., K_i is self-adjoint), hence the
+    memory consumption is O(field) instead of O(K field).
+    The post-processing of the weights, w = clamp(weights,min_weight) and (optionally) w = sqrt(w), is part of the function
+    as well: only the raw weights are kept for the backward pass, which recomputes w and applies the chain rule itself.
+    """
+
+    @staticmethod
+    def forward(ctx, momentum, weights, gaussian_stds, gaussian_fourier_filter_generator, min_weight, sqrt_weights):
+        ctx.save_for_backward(momentum, weights)
+        ctx.gaussian_stds = _gaussian_stds_as_tensor(gaussian_stds)
+        ctx.gaussian_fourier_filter_generator = gaussian_fourier_filter_generator
+        ctx.min_weight = min_weight
+        ctx.sqrt_weights = sqrt_weights
+
+        w = _effective_smoothing_weights(weights, min_weight, sqrt_weights)
+        stds = ctx.gaussian_stds
+        ret = torch.zeros_like(momentum)
+        for i in range(len(stds)):
+            w_i = w[:,i:i+1,...]
+            ret.addcmul_(w_i, _smooth_with_single_gaussian(w_i*momentum, stds[i:i+1], gaussian_fourier_filter_generator))
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        momentum, weights = ctx.saved_tensors
+        grad_momentum = None
+        grad_weights = None
+
+        if ctx.needs_input_grad[0]:
+            grad_momentum = torch.zeros_like(momentum)
+        if ctx.needs_input_grad[1]:
+            grad_weights = torch.zeros_like(weights)
+
+        w = _effective_smoothing_weights(weights, ctx.min_weight, ctx.sqrt_weights)
+        stds = ctx.gaussian_stds
+        for i in range(len(stds)):
+            w_i = w[:,i:i+1,...]
+            # K_i*(w_i dy)
+            smoothed_weighted_grad_i = _smooth_with_single_gaussian(w_i*grad_output, stds[i:i+1], ctx.gaussian_fourier_filter_generator)
+            if grad_momentum is not None:
+                grad_momentum.addcmul_(w_i, smoothed_weighted_grad_i)
+            if grad_weights is not None:
+                # dL/dw_i = \sum_c dy K_i*(w_i m) + m K_i*(w_i dy)
+                smoothed_weighted_momentum_i = _smooth_with_single_gaussian(w_i*momentum, stds[i:i+1], ctx.gaussian_fourier_filter_generator)
+                grad_weights[:,i,...] = torch.sum(grad_output*smoothed_weighted_momentum_i + momentum*smoothed_weighted_grad_i, dim=1)
+
+        if grad_weights is not None:
+            # chain rule for the post-processing of the weights: d sqrt(w)/dw = 1/(2 sqrt(w)); clamping stops the gradient
+            if ctx.sqrt_weights:
+                grad_weights.div_(2.*w)
+            if ctx.min_weight is not None:
+                grad_weights.masked_fill_(weights<ctx.min_weight, 0.)
+
+        return grad_momentum, grad_weights, None, None, None, None
+
+
+def weighted_multi_gaussian_smoothing(momentum, weights, gaussian_stds, gaussian_fourier_filter_generator, min_weight=None, sqrt_weights=False):
+    r"""
+    Fused version of computing compute_weighted_multi_smooth_v followed by weighting with the same weights and
+    summing over all Gaussians; i.e., returns \sum_i w_i K_i*(w_i m) without creating the multi-velocity stack.
+    The weights can be post-processed as part of the fused computation: w = clamp(weights,min_weight) and w = sqrt(w).
+
+    :param momentum: momentum, batch x dim x X x Y x ...
+    :param weights: weights, batch x K x X x Y x ...
+    :param gaussian_stds: standard deviations of the K Gaussians
+    :param gaussian_fourier_filter_generator: generator which will create Gaussian Fourier filter (and caches them)
+    :param min_weight: if not None the weights are clamped to this minimum value
+    :param sqrt_weights: if set to True the square roots of the (clamped) weights are used
+    :return: smoothed field, batch x dim x X x Y x ...
+    """
+    return WeightedMultiGaussianSmoothing.apply(momentum, weights, gaussian_stds, gaussian_fourier_filter_generator,
+                                                min_weight, sqrt_weights)
+
+
 def _project_weights_to_min_sum_one(weights,min_val,dim=1):
 
     sz = weights.size()
@@ -1096,18 +1114,10 @@ def _project_weights_to_min_sum_one(weights,min_val,dim=1):
     eff_min_val = min_val/(1.-nr_of_weights*min_val)
 
     max_weights = torch.clamp(weights,min=eff_min_val)
-    max_weight_sum = torch.sum(max_weights, dim=dim)
+    max_weight_sum = torch.sum(max_weights, dim=dim, keepdim=True)
 
-    projected_weights = torch.zeros_like(max_weights)
-
-    if dim==0:
-        for n in range(nr_of_weights):
-            projected_weights[n,...] = max_weights[n,...]/max_weight_sum
-    elif dim==1:
-        for n in range(nr_of_weights):
-            projected_weights[:,n,...] = max_weights[:,n,...]/max_weight_sum
-    else:
-        raise ValueError('Only dimensions 0 or 1 are currently supported')
+    # all weights are normalized at once (by broadcasting) instead of one weight at a time
+    projected_weights = max_weights/max_weight_sum
 
     return projected_weights
 
@@ -1122,18 +1132,10 @@ def _project_weights_to_min_sum_of_squares_one(weights,min_val,dim=1):
     eff_min_val = float(min_val / np.sqrt(1. - nr_of_weights * min_val**2))
 
     max_weights = torch.clamp(weights, min=eff_min_val)
-    max_weight_norm = torch.sqrt(torch.sum(max_weights**2, dim=dim))
+    max_weight_norm = torch.sqrt(torch.sum(max_weights**2, dim=dim, keepdim=True))
 
-    projected_weights = torch.zeros_like(max_weights)
-
-    if dim==0:
-        for n in range(nr_of_weights):
-            projected_weights[n, ...] = max_weights[n, ...] / max_weight_norm
-    elif dim==1:
-        for n in range(nr_of_weights):
-            projected_weights[:, n, ...] = max_weights[:, n, ...] / max_weight_norm
-    else:
-        raise ValueError('Only dimensions 0 or 1 are currently supported')
+    # all weights are normalized at once (by broadcasting) instead of one weight at a time
+    projected_weights = max_weights / max_weight_norm
 
     return projected_weights
 
@@ -1425,6 +1427,16 @@ class DeepSmoothingModel(with_metaclass(ABCMeta,nn.Module)):
     def get_omt_power(self):
         return self.loss.omt_power
 
+    def set_inference_mode(self, inference_mode=True):
+        """
+        Turns the inference mode of the network which computes the weights on or off (see DeepNetwork.set_inference_mode)
+
+        :param inference_mode: if True inference mode is turned on, otherwise it is turned off
+        """
+        network = getattr(self, 'network', None)
+        if isinstance(network, dn.DeepNetwork):
+            network.set_inference_mode(inference_mode)
+
     def _initialize_weights(self):
 
         print('WARNING: weight initialization DISABLED; using pyTorch default network initialization, which is probably not a good idea.')
@@ -1702,9 +1714,6 @@ class DeepSmoothingModel(with_metaclass(ABCMeta,nn.Module)):
         # get the size of the multi-velocity field; multi_v x batch x channels x X x Y
         sz_mv = [self.nr_of_gaussians] + list(sz_m)
 
-        # create the output tensor: will be of dimension: batch x channels x X x Y
-        ret = AdaptVal(MyTensor(*sz_m))
-
         # now determine the size for the weights
         # Since the smoothing will be the same for all spatial directions (for a velocity field),
         # this basically amounts to cutting out the channels; i.e., multi_v x batch x X x Y
@@ -1745,16 +1754,18 @@ class DeepSmoothingModel(with_metaclass(ABCMeta,nn.Module)):
                 self.current_penalty += current_penalty
         # multiply the velocity fields by the weights and sum over them
         # this is then the multi-Gaussian output
-        weights = torch.clamp((weights), min=1e-3)
         if self.weighting_type=='sqrt_w_K_sqrt_w':
-            sqrt_weights = torch.sqrt(weights)
-            sqrt_weighted_multi_smooth_v = compute_weighted_multi_smooth_v( momentum=momentum, weights=sqrt_weights, gaussian_stds=self.gaussian_stds,
-                                                                   gaussian_fourier_filter_generator=gaussian_fourier_filter_generator )
+            # w_i*K_i*(w_i m) with w_i = sqrt(clamp(weights)), streamed over the Gaussians (clamping and sqrt are fused)
+            return weighted_multi_gaussian_smoothing(momentum=momentum, weights=weights, gaussian_stds=self.gaussian_stds,
+                                                     gaussian_fourier_filter_generator=gaussian_fourier_filter_generator,
+                                                     min_weight=1e-3, sqrt_weights=True)
         elif self.weighting_type=='w_K_w':
-            # now create the weighted multi-smooth-v
-            weighted_multi_smooth_v = compute_weighted_multi_smooth_v( momentum=momentum, weights=weights, gaussian_stds=self.gaussian_stds,
-                                                                       gaussian_fourier_filter_generator=gaussian_fourier_filter_generator )
+            # w_i*K_i*(w_i m) with w_i = clamp(weights), streamed over the Gaussians (clamping is fused)
+            return weighted_multi_gaussian_smoothing(momentum=momentum, weights=weights, gaussian_stds=self.gaussian_stds,
+                                                     gaussian_fourier_filter_generator=gaussian_fourier_filter_generator,
+                                                     min_weight=1e-3)
         elif self.weighting_type=='w_K':
+            weights = torch.clamp((weights), min=1e-3)
             # todo: check if we can do a more generic datatype conversion than using .float()
             multi_smooth_v = ce.fourier_set_of_gaussian_convolutions(momentum,
                                                                      gaussian_fourier_filter_generator=gaussian_fourier_filter_generator,
@@ -1763,6 +1774,9 @@ class DeepSmoothingModel(with_metaclass(ABCMeta,nn.Module)):
         else:
             raise ValueError('Unknown weighting_type: {}'.format(self.weighting_type))
 
+        # create the output tensor: will be of dimension: batch x channels x X x Y
+        ret = AdaptVal(MyTensor(*sz_m))
+
         # now we apply this weight across all the channels; weight output is B x weights x X x Y
         for n in range(self.dim):
             #  we have batch x multi_velocity x X x Y
@@ -1771,24 +1785,9 @@ class DeepSmoothingModel(with_metaclass(ABCMeta,nn.Module)):
             # (channels here are the vector field components); i.e. as many as there are dimensions
             # each one of those should be smoothed the same
 
-            # let's smooth this on the fly, as the smoothing will be of form
-            # w_i*K_i*(w_i m)
-
-            if self.weighting_type=='sqrt_w_K_sqrt_w':
-                # roc should be: batch x multi_v x X x Y
-                roc = sqrt_weighted_multi_smooth_v[:, :, n, ...]
-                #print(sqrt_weighted_multi_smooth_v.shape, sqrt_weights.shape,roc.shape)
-                yc = torch.sum(roc * sqrt_weights, dim=1)
-            elif self.weighting_type=='w_K_w':
-                # roc should be: batch x multi_v x X x Y
-                roc = weighted_multi_smooth_v[:, :, n, ...]
-                yc = torch.sum(roc*weights,dim=1)
-            elif self.weighting_type=='w_K':
-                # roc should be: batch x multi_v x X x Y
-                roc = torch.transpose(multi_smooth_v[:, :, n, ...], 0, 1)
-                yc = torch.sum(roc * weights, dim=1)
-            else:
-                raise ValueError('Unknown weighting_type: {}'.format(self.weighting_type))
+            # roc should be: batch x multi_v x X x Y
+            roc = torch.transpose(multi_smooth_v[:, :, n, ...], 0, 1)
+            yc = torch.sum(roc * weights, dim=1)
 
             ret[:, n, ...] = yc # ret is: batch x channels x X x Y
 
@@ -1895,7 +1894,10 @@ class GeneralNetworkWeightedSmoothingModel(DeepSmoothingModel):
         # now let's apply all the convolution layers, until the last
         # (because the last one is not relu-ed
 
-        x = self.network(x_in,iter=iter)
+        # the network itself may run in mixed precision, the weights are computed in float32
+        with amp_autocast():
+            x = self.network(x_in,iter=iter)
+        x = FP32Val(x)
         if self.clamp_local_weight:
             x = x.clamp(min=-self.local_pre_weight_max,max=self.local_pre_weight_max)
 
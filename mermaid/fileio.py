@@ -23,8 +23,6 @@ import glob
 
 import copy
 
-from .config_parser import USE_FLOAT16
-
 from abc import ABCMeta, abstractmethod
 from future.utils import with_metaclass
 
@@ -38,10 +36,8 @@ class FileIO(with_metaclass(ABCMeta, object)):
         """
         Constructor
         """
-        if USE_FLOAT16:
-            self.default_datatype = 'float16'
-        else:
-            self.default_datatype = 'float32'
+        self.default_datatype = 'float32'
+        """Data is always kept in float32; reduced precision is handled via automatic mixed precision"""
 
         self.datatype_conversion = True
         """Automatically convers the datatype to the default_data_type when loading or writing"""
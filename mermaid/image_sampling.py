@@ -120,7 +120,7 @@ class ResampleImage(object):
         #     raise('For upsampling sizes need to increase')
 
         newspacing = spacing*((sz[2::].astype('float')-1)/(desiredSizeNC[2::].astype('float')-1))##################################
-        idDes = AdaptVal(torch.from_numpy(utils.identity_map_multiN(desiredSizeNC,newspacing)))
+        idDes = utils._get_shared_identity_map(desiredSizeNC,newspacing)
 
         # now use this map for resampling
         IZ = utils.compute_warped_image_multiNC(I, idDes, newspacing, spline_order,zero_boundary)
@@ -155,7 +155,7 @@ class ResampleImage(object):
         smoothedImage_multiNC = smoother.smooth(I)
 
         newspacing = spacing*((sz[2::].astype('float')-1.)/(desiredSizeNC[2::].astype('float')-1.)) ###########################################
-        idDes = AdaptVal(torch.from_numpy(utils.identity_map_multiN(desiredSizeNC,newspacing)))
+        idDes = utils._get_shared_identity_map(desiredSizeNC,newspacing)
 
         # now use this map for resampling
         ID = utils.compute_warped_image_multiNC(smoothedImage_multiNC, idDes, newspacing, spline_order,zero_boundary)
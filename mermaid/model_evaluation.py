@@ -1,8 +1,10 @@
 import os
+import numpy as np
 import torch
 from . import model_factory as MF
 from . import visualize_registration_results as vizReg
 from . import image_sampling as IS
+from . import smoother_factory as SF
 from .data_wrapper import AdaptVal
 from .data_wrapper import USE_CUDA
 from . import utils
@@ -18,7 +20,7 @@ def evaluate_model(ISource_in, ITarget_in, sz, spacing,
                    spline_order=None,
                    individual_parameters=None,shared_parameters=None,params=None,extra_info=None,visualize=True,visual_param=None,given_weight=False, init_map=None,lowres_init_map=None, init_inverse_map=None,lowres_init_inverse_map=None,):
 
-    """
+    r"""
 
     #todo: Support initial maps which are not identity
 
@@ -97,12 +99,10 @@ def evaluate_model(ISource_in, ITarget_in, sz, spacing,
 
     if use_map:
         # create the identity map [-1,1]^d, since we will use a map-based implementation
-        id = utils.identity_map_multiN(sz, spacing)
-        identityMap = AdaptVal(torch.from_numpy(id))
+        identityMap = utils._get_shared_identity_map(sz, spacing)
         if map_low_res_factor is not None:
             # create a lower resolution map for the computations
-            lowres_id = utils.identity_map_multiN(lowResSize, lowResSpacing)
-            lowResIdentityMap = AdaptVal(torch.from_numpy(lowres_id))
+            lowResIdentityMap = utils._get_shared_identity_map(lowResSize, lowResSpacing)
             sampler = IS.ResampleImage()
 
     if USE_CUDA:
@@ -128,6 +128,10 @@ def evaluate_model(ISource_in, ITarget_in, sz, spacing,
     if 'local_weights'in individual_parameters and individual_parameters['local_weights'] is not None:
         model.local_weights.data= AdaptVal(individual_parameters['local_weights'])
 
+    # the model is only evaluated; use the inference fast path of learned smoother networks (needs to be set after all parameters are loaded)
+    if hasattr(model, 'smoother'):
+        model.smoother.set_inference_mode(True)
+
     opt_variables = {'iter': 0, 'epoch': 0,'extra_info':extra_info,'over_scale_iter_count':0}
 
     # now let's run the model
@@ -243,11 +247,12 @@ def evaluate_model(ISource_in, ITarget_in, sz, spacing,
         model_dict['lam'] = model_pars['lam']
     model_dict['m'] = m
     model_dict['v'] = v
+    # the identity maps are shared (see utils._get_shared_identity_map), hence copies are returned
     if use_map:
-        model_dict['id'] = identityMap
+        model_dict['id'] = identityMap.clone()
     if map_low_res_factor is not None:
         model_dict['map_low_res_factor'] = map_low_res_factor
-        model_dict['low_res_id'] = lowResIdentityMap
+        model_dict['low_res_id'] = lowResIdentityMap.clone() if lowResIdentityMap is not None else None
 
     return rec_IWarped,rec_phiWarped, rec_phiInverseWarped, model_dict
 
@@ -257,7 +262,7 @@ def evaluate_model_low_level_interface(model,I_source,opt_variables=None,use_map
                                        map_low_res_factor=None,
                                        sampler=None,low_res_spacing=None,spline_order=1,
                                        low_res_I_source=None,low_res_initial_map=None,low_res_initial_inverse_map=None,compute_similarity_measure_at_low_res=False):
-    """
+    r"""
     Evaluates a registration model. Core functionality for optimizer. Use evaluate_model for a convenience implementation which recomputes settings on the fly
 
     :param model: registration model
@@ -364,3 +369,267 @@ def evaluate_model_low_level_interface(model,I_source,opt_variables=None,use_map
         rec_IWarped = model(I_source, opt_variables)
 
     return rec_IWarped,rec_phiWarped,rec_phiInverseWarped
+
+
+class ModelEvaluator(object):
+    """
+    Reusable evaluator to apply saved registration parameters (e.g., momenta) to many images.
+    In contrast to evaluate_model the model (with its smoothers and integrators), the shared parameters, the sampler
+    and the (low-res) identity maps are only set up once. Each evaluation then only sets the individual parameters
+    and integrates the model (without keeping track of gradients).
+    The low-res source and target images are computed into preallocated buffers (which are only recomputed if a
+    different image is passed in) and only the identity maps for the most recent batch size are kept.
+    """
+
+    def __init__(self, sz, spacing, params,
+                 shared_parameters=None,
+                 model_name=None,
+                 use_map=None,
+                 compute_inverse_map=False,
+                 map_low_res_factor=None,
+                 compute_similarity_measure_at_low_res=None,
+                 spline_order=None):
+        """
+        Constructor
+
+        :param sz: size of the images (BxCxXxYxZ format); the batch size may differ between evaluations
+        :param spacing: spacing for the images
+        :param params: parameter dictionary (of model_dictionary type) which configures the model or filename of a json file to load it from
+        :param shared_parameters: shared registration parameters
+        :param model_name: name of the desired model (string); if None it is taken from params
+        :param use_map: if set to True then map-based mode is used; if None it is taken from params
+        :param compute_inverse_map: if set to True the inverse map will be computed
+        :param map_low_res_factor: if set to None then computations will be at full resolution, otherwise at a fraction of the resolution
+        :param compute_similarity_measure_at_low_res: if set to True maps are returned at the low resolution
+        :param spline_order: desired spline order for the sampler
+        """
+
+        if type(params) == type('acharacter'):
+            params_filename = params
+            params = pars.ParameterDict()
+            params.load_JSON(params_filename)
+        elif params is None:
+            print('INFO: WARNING: no params specified, creating empty parameter dictionary')
+            params = pars.ParameterDict()
+
+        self.params = params
+
+        if model_name is None:
+            model_name = params['model']['registration_model']['type']
+
+        if use_map is None:
+            use_map = params['model']['deformation']['use_map']
+
+        if map_low_res_factor is None:
+            map_low_res_factor = params['model']['deformation'][('map_low_res_factor', None, 'low_res_factor')]
+
+        if compute_similarity_measure_at_low_res is None:
+            compute_similarity_measure_at_low_res = params['model']['deformation'][('compute_similarity_measure_at_low_res', False, 'to compute Sim at lower resolution')]
+
+        if spline_order is None:
+            spline_order = params['model']['registration_model'][('spline_order', 1, 'Spline interpolation order; 1 is linear interpolation (default); 3 is cubic spline')]
+
+        if not use_map:
+            if compute_inverse_map:
+                raise ValueError('Cannot compute inverse map in non-map mode')
+            if compute_similarity_measure_at_low_res:
+                raise ValueError('Low res similarity measure computations are only supported in map mode')
+
+        self.sz = sz
+        self.spacing = spacing
+        self.model_name = model_name
+        self.use_map = use_map
+        self.compute_inverse_map = compute_inverse_map
+        self.map_low_res_factor = map_low_res_factor
+        self.compute_similarity_measure_at_low_res = compute_similarity_measure_at_low_res
+        self.spline_order = spline_order
+
+        self.low_res_size = None
+        self.low_res_spacing = None
+        self.sampler = None
+
+        if map_low_res_factor is not None:
+            self.low_res_size = utils._get_low_res_size_from_size(sz, map_low_res_factor)
+            self.low_res_spacing = utils._get_low_res_spacing_from_spacing(spacing, sz, self.low_res_size)
+            self.sampler = IS.ResampleImage()
+
+            if compute_similarity_measure_at_low_res:
+                mf = MF.ModelFactory(self.low_res_size, self.low_res_spacing, self.low_res_size, self.low_res_spacing)
+            else:
+                mf = MF.ModelFactory(sz, spacing, self.low_res_size, self.low_res_spacing)
+        else:
+            mf = MF.ModelFactory(sz, spacing, sz, spacing)
+
+        self.model, _ = mf.create_registration_model(model_name, params['model'], compute_inverse_map=compute_inverse_map)
+        self.model.eval()
+
+        if USE_CUDA:
+            self.model = self.model.cuda()
+
+        if shared_parameters is not None:
+            self.model.load_shared_state_dict(shared_parameters)
+
+        # the model is only evaluated; use the inference fast path of learned smoother networks (shared parameters are loaded at this point)
+        if hasattr(self.model, 'smoother'):
+            self.model.smoother.set_inference_mode(True)
+
+        self._identity_maps = None
+        """tuple (batch size, identity map, low-res identity map) for the most recent batch size"""
+
+        self._downsampling_size = None
+        """size (BxCxXxYxZ) of the images the downsampling smoother and the low-res buffers were set up for"""
+        self._downsampling_smoother = None
+        self._downsampling_identity_map = None
+        self._low_res_images = dict()
+        """preallocated buffers for the smoothed and the low-res images (and the image they were computed from) for 'source' and 'target'"""
+
+    def _get_identity_maps(self, batch_size):
+        """
+        Returns the (cached) identity map and low-res identity map for a given batch size.
+        Only the maps for the most recent batch size are kept.
+
+        :param batch_size: batch size
+        :return: tuple (identity map, low-res identity map); the low-res identity map is None if computations are at full resolution
+        """
+        if self._identity_maps is None or self._identity_maps[0] != batch_size:
+            sz = list(self.sz)
+            sz[0] = batch_size
+            identity_map = utils._get_shared_identity_map(sz, self.spacing)
+            low_res_identity_map = None
+            if self.map_low_res_factor is not None:
+                low_res_sz = list(self.low_res_size)
+                low_res_sz[0] = batch_size
+                low_res_identity_map = utils._get_shared_identity_map(low_res_sz, self.low_res_spacing)
+            self._identity_maps = (batch_size, identity_map, low_res_identity_map)
+
+        return self._identity_maps[1], self._identity_maps[2]
+
+    def _get_low_res_image(self, I, name):
+        """
+        Returns the low-res version of an image (same result as utils._compute_low_res_image).
+        The smoother and the buffers are set up once per image size and the low-res image is only recomputed
+        if a different image (or a modified one) is passed in.
+
+        :param I: image (BxCxXxYxZ format)
+        :param name: name of the buffer ('source' or 'target')
+        :return: returns the low-res image; this is a buffer which is overwritten by subsequent evaluations
+        """
+        sz = list(I.size())
+        if self._downsampling_size != sz:
+            self._downsampling_size = sz
+            self._downsampling_smoother = SF.DiffusionSmoother(np.array(sz), self.spacing, self.sampler.params)
+            low_res_sz = sz[0:2] + list(self.low_res_size[2::])
+            self._downsampling_identity_map = utils._get_shared_identity_map(low_res_sz, self.low_res_spacing)
+            self._low_res_images = dict()
+
+        if name not in self._low_res_images:
+            low_res_sz = sz[0:2] + list(self.low_res_size[2::])
+            self._low_res_images[name] = {'I': None, 'version': None,
+                                          'smoothed': torch.zeros_like(I),
+                                          'low_res': torch.zeros(low_res_sz, dtype=I.dtype, device=I.device)}
+
+        buffers = self._low_res_images[name]
+        if buffers['I'] is not I or buffers['version'] != I._version:
+            self._downsampling_smoother.smooth(I, vout=buffers['smoothed'])
+            buffers['low_res'][:] = utils.compute_warped_image_multiNC(buffers['smoothed'], self._downsampling_identity_map,
+                                                                       self.low_res_spacing, self.spline_order, zero_boundary=False)
+            # keep a reference to the image, so that it is not freed (and its memory reused) while it is cached
+            buffers['I'] = I
+            buffers['version'] = I._version
+
+        return buffers['low_res']
+
+    def _set_individual_parameters(self, individual_parameters):
+        model_pars = utils.individual_parameters_to_model_parameters(individual_parameters)
+        self.model.set_individual_registration_parameters(model_pars)
+        if 'm' in model_pars and model_pars['m'] is not None:
+            self.model.m.data = AdaptVal(model_pars['m'])
+        if 'local_weights' in model_pars and model_pars['local_weights'] is not None:
+            self.model.local_weights.data = AdaptVal(model_pars['local_weights'])
+
+    def evaluate(self, ISource_in, individual_parameters, ITarget_in=None, return_maps=True, return_warped_images=True):
+        """
+        Evaluates the model for a batch of source images and their individual parameters
+
+        :param ISource_in: source images (BxCxXxYxZ format)
+        :param individual_parameters: individual registration parameters for this batch (e.g., the momentum)
+        :param ITarget_in: target images; only needed for models whose smoothers make use of the target image
+        :param return_maps: if set to True the map and the inverse map (if computed) are returned
+        :param return_warped_images: if set to True the warped source images are returned
+        :return: returns a tuple (I_warped,phi,phi_inverse); entries which were not requested (or are not available for the model) are None
+        """
+
+        ISource = AdaptVal(ISource_in)
+        ITarget = AdaptVal(ITarget_in) if ITarget_in is not None else None
+
+        with torch.no_grad():
+            self._set_individual_parameters(individual_parameters)
+
+            identity_map = None
+            low_res_identity_map = None
+            if self.use_map:
+                identity_map, low_res_identity_map = self._get_identity_maps(ISource.size()[0])
+
+            low_res_ISource = None
+            low_res_ITarget = None
+            if self.map_low_res_factor is not None:
+                low_res_ISource = self._get_low_res_image(ISource, 'source')
+                if ITarget is not None:
+                    low_res_ITarget = self._get_low_res_image(ITarget, 'target')
+
+            dictionary_to_pass_to_integrator = dict()
+            if self.map_low_res_factor is not None:
+                dictionary_to_pass_to_integrator['I0'] = low_res_ISource
+                dictionary_to_pass_to_integrator['I1'] = low_res_ITarget
+            else:
+                dictionary_to_pass_to_integrator['I0'] = ISource
+                dictionary_to_pass_to_integrator['I1'] = ITarget
+            self.model.set_dictionary_to_pass_to_integrator(dictionary_to_pass_to_integrator)
+
+            opt_variables = {'iter': 0, 'epoch': 0, 'extra_info': None, 'over_scale_iter_count': 0}
+
+            rec_IWarped, rec_phiWarped, rec_phiInverseWarped = evaluate_model_low_level_interface(
+                model=self.model,
+                I_source=ISource,
+                opt_variables=opt_variables,
+                use_map=self.use_map,
+                initial_map=identity_map,
+                compute_inverse_map=self.compute_inverse_map,
+                initial_inverse_map=identity_map,
+                map_low_res_factor=self.map_low_res_factor,
+                sampler=self.sampler,
+                low_res_spacing=self.low_res_spacing,
+                spline_order=self.spline_order,
+                low_res_I_source=low_res_ISource,
+                low_res_initial_map=low_res_identity_map,
+                low_res_initial_inverse_map=low_res_identity_map,
+                compute_similarity_measure_at_low_res=self.compute_similarity_measure_at_low_res)
+
+            if self.use_map:
+                if return_warped_images:
+                    if self.compute_similarity_measure_at_low_res:
+                        rec_IWarped = utils.compute_warped_image_multiNC(low_res_ISource, rec_phiWarped, self.low_res_spacing, self.spline_order, zero_boundary=True)
+                    else:
+                        rec_IWarped = utils.compute_warped_image_multiNC(ISource, rec_phiWarped, self.spacing, self.spline_order, zero_boundary=True)
+                if not return_maps:
+                    rec_phiWarped = None
+                    rec_phiInverseWarped = None
+            elif not return_warped_images:
+                rec_IWarped = None
+
+        return rec_IWarped, rec_phiWarped, rec_phiInverseWarped
+
+    def evaluate_batches(self, batches, return_maps=True, return_warped_images=True):
+        """
+        Evaluates the model for a sequence of batches
+
+        :param batches: iterable of (source images, individual parameters) or (source images, individual parameters, target images) tuples;
+            the target images are only needed for models whose smoothers make use of the target image
+        :param return_maps: if set to True the maps are returned
+        :param return_warped_images: if set to True the warped source images are returned
+        :return: generator yielding a tuple (I_warped,phi,phi_inverse) per batch (see evaluate)
+        """
+        for batch in batches:
+            ISource, individual_parameters = batch[0], batch[1]
+            ITarget = batch[2] if len(batch) > 2 else None
+            yield self.evaluate(ISource, individual_parameters, ITarget_in=ITarget, return_maps=return_maps, return_warped_images=return_warped_images)
@@ -0,0 +1,94 @@
+"""
+Fused multi-tensor operations for updating many small parameter tensors at once.
+
+Deep smoothers have hundreds of (small) parameter tensors. Updating them one by one (for example to clip their norms)
+launches a few kernels per tensor (and, when comparing norms in Python, synchronizes for each of them), so that
+the updates become launch-bound. The operations here use the multi-tensor (``torch._foreach_*``) operations,
+which process a whole list of tensors per kernel launch. If these are not available in the installed torch version
+(or if their use is disabled) they fall back to a loop over the tensors.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import inspect
+
+import torch
+
+
+def is_foreach_available():
+    """
+    Returns True if the multi-tensor (torch._foreach_*) operations are available
+
+    :return: True/False
+    """
+    return hasattr(torch, '_foreach_mul_')
+
+
+def get_foreach_optimizer_settings(optimizer_class, use_foreach=True):
+    """
+    Returns the keyword arguments which select the multi-tensor implementation of a torch optimizer
+
+    :param optimizer_class: optimizer class, e.g., torch.optim.SGD
+    :param use_foreach: if False no settings are returned (i.e., the default implementation of torch is used)
+    :return: dictionary of keyword arguments ({'foreach': True} if supported, empty otherwise)
+    """
+    if not use_foreach:
+        return dict()
+    try:
+        supports_foreach = 'foreach' in inspect.signature(optimizer_class.__init__).parameters
+    except (TypeError, ValueError):
+        supports_foreach = False
+    if supports_foreach:
+        return {'foreach': True}
+    else:
+        return dict()
+
+
+def clamp_(tensors, min_val, max_val, use_foreach=True):
+    """
+    Clamps a list of tensors (in place)
+
+    :param tensors: list of tensors
+    :param min_val: minimum value
+    :param max_val: maximum value
+    :param use_foreach: if True the multi-tensor operations are used (if available)
+    """
+    if len(tensors) == 0:
+        return
+    if use_foreach and hasattr(torch, '_foreach_clamp_min_') and hasattr(torch, '_foreach_clamp_max_'):
+        torch._foreach_clamp_min_(tensors, min_val)
+        torch._foreach_clamp_max_(tensors, max_val)
+    else:
+        for t in tensors:
+            t.clamp_(min_val, max_val)
+
+
+def clip_norm_per_sample_(tensors, max_norm, norm_type=2, use_foreach=True):
+    """
+    Rescales (in place) all samples, i.e., entries along the first dimension, of a list of tensors whose norm exceeds
+    max_norm, so that their norm becomes max_norm. With the multi-tensor operations the norms of the samples of all
+    tensors are computed at once (by torch._foreach_norm on views of the samples); otherwise they are computed tensor
+    by tensor. The norms are never read back, i.e., no synchronization is needed.
+
+    :param tensors: list of tensors (with at least two dimensions)
+    :param max_norm: maximal norm of a sample
+    :param norm_type: type of the norm (e.g., 1 or 2)
+    :param use_foreach: if True the multi-tensor operations are used (if available)
+    """
+    if len(tensors) == 0:
+        return
+
+    if use_foreach and is_foreach_available() and hasattr(torch, '_foreach_norm') \
+            and len(set((t.dtype, t.device) for t in tensors)) == 1:
+        nr_of_samples = [t.size()[0] for t in tensors]
+        samples = [sample for t in tensors for sample in t.reshape(t.size()[0], -1).unbind(0)]
+        sample_norms = torch.stack(torch._foreach_norm(samples, norm_type))
+        # samples with a smaller norm are multiplied by one
+        clip_coefficients = torch.clamp(max_norm / sample_norms, max=1.).split(nr_of_samples)
+        torch._foreach_mul_(tensors, [clip_coefficient.view([-1] + [1] * (t.dim() - 1))
+                                      for t, clip_coefficient in zip(tensors, clip_coefficients)])
+    else:
+        for t in tensors:
+            sample_norms = t.reshape(t.size()[0], -1).norm(norm_type, dim=1)
+            clip_coefficient = torch.clamp(max_norm / sample_norms, max=1.)
+            t.mul_(clip_coefficient.view([-1] + [1] * (t.dim() - 1)))
@@ -12,23 +12,34 @@ from abc import ABCMeta, abstractmethod
 import os
 import time
 import copy
+import traceback
+import queue
+import socket
+import contextlib
 from . import utils
 from . import visualize_registration_results as vizReg
 from . import custom_optimizers as CO
 import numpy as np
 import torch
-from .data_wrapper import USE_CUDA, AdaptVal, MyTensor
+import torch.multiprocessing as torch_mp
+from .data_wrapper import USE_CUDA, AdaptVal, MyTensor, is_amp_enabled, get_amp_dtype
+from .config_parser import nr_of_threads
 from . import model_factory as MF
 from . import image_sampling as IS
 from .metrics import get_multi_metric
 from .res_recorder import XlsxRecorder
 from .data_utils import make_dir
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 from . import optimizer_data_loaders as OD
 from . import fileio as FIO
 from . import model_evaluation
+from . import profiling
+from . import roi as ROI
+from . import compiled_step as CS
+from . import multi_tensor as MT
+from . import similarity_measure_factory as SM
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from future.utils import with_metaclass
 
 from termcolor import colored, cprint
@@ -39,13 +50,16 @@ class SimpleRegistration(with_metaclass(ABCMeta, object)):
            Abstract optimizer base class.
     """
 
-    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None):
+    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None,
+                 roi_mask=None, roi_bounding_box=None):
         """
         :param ISource: source image
         :param ITarget: target image
         :param spacing: image spacing
         :param params: parameters
         :param compute_inverse_map: for map-based method the inverse map can be computed on the fly
+        :param roi_mask: if given, the registration is restricted to the bounding box of this mask (BxCxXxYxZ; enlarged by the margin in the roi settings) and the similarity measure to its voxels
+        :param roi_bounding_box: if given, the registration is restricted to this bounding box (list of [start,end) voxel indices for each spatial dimension; enlarged by the margin in the roi settings)
         """
         self.params = params
         self.use_map = self.params['model']['deformation'][('use_map', True, '[True|False] either do computations via a map or directly using the image')]
@@ -58,6 +72,58 @@ class SimpleRegistration(with_metaclass(ABCMeta, object)):
         self.default_learning_rate=default_learning_rate
         self.optimizer = None
 
+        self.roi_bounding_box = None
+        """bounding box the registration is restricted to (None if the registration is computed on the full domain)"""
+        self.roi_similarity_mask = None
+        """mask (cropped to the bounding box) the similarity measure is restricted to"""
+        self.full_ISource = ISource
+        """source image of the full domain"""
+        self.full_sz = sz
+        """size of the full domain"""
+        self.full_LSource = None
+        """source label of the full domain"""
+
+        if roi_mask is not None or roi_bounding_box is not None:
+            self._crop_to_roi(roi_mask, roi_bounding_box)
+
+    def _crop_to_roi(self, roi_mask, roi_bounding_box):
+        """
+        Restricts the computational domain to the (enlarged) bounding box of the region of interest. Needs to be
+        called before the optimizer is created, as the model is created for the size of the cropped domain.
+
+        :param roi_mask: mask of the region of interest or None
+        :param roi_bounding_box: bounding box of the region of interest or None (the bounding box of the mask is used)
+        :return: n/a
+        """
+        if type(self.ISource) != torch.Tensor or type(self.ITarget) != torch.Tensor:
+            raise ValueError('A region of interest can only be used for images given as tensors')
+
+        roi_params = self.params[('roi', {}, 'settings for registrations restricted to a region of interest')]
+        margin = roi_params[('margin', 5, 'number of voxels by which the bounding box of the region of interest is enlarged (in each direction)')]
+        restrict_similarity = roi_params[('restrict_similarity_to_mask', True, 'if set to True (and a mask is given) the similarity measure is only evaluated on the voxels of the mask')]
+
+        if roi_bounding_box is not None:
+            self.roi_bounding_box = ROI.enlarge_bounding_box(roi_bounding_box, margin, self.ISource.size()[2:])
+        else:
+            self.roi_bounding_box = ROI.get_bounding_box_from_mask(roi_mask, margin)
+
+        self.ISource = ROI.crop_to_bounding_box(self.ISource, self.roi_bounding_box).contiguous()
+        self.ITarget = ROI.crop_to_bounding_box(self.ITarget, self.roi_bounding_box).contiguous()
+        self.sz = np.array(self.ISource.size())
+
+        if roi_mask is not None and restrict_similarity:
+            self.roi_similarity_mask = ROI.crop_to_bounding_box(roi_mask, self.roi_bounding_box).contiguous()
+
+        print('INFO: registration restricted to the region of interest {} of size {} (full size {})'.format(
+            self.roi_bounding_box, list(self.sz[2:]), list(self.full_sz[2:])))
+
+    def _set_roi_similarity_mask_of_optimizer(self):
+        """
+        Passes the mask of the region of interest to the optimizer (once it was created)
+        """
+        if self.roi_similarity_mask is not None:
+            self.optimizer.set_similarity_mask(self.roi_similarity_mask)
+
     def get_history(self):
         """
         Returns the optimization history as a dictionary. Keeps track of energies, iterations counts, and additonal custom measures.
@@ -103,12 +169,52 @@ class SimpleRegistration(with_metaclass(ABCMeta, object)):
         else:
             return None
 
+    def _embed_map(self, phi):
+        """
+        Embeds a map of the region of interest into the identity map of the full domain
+
+        :param phi: map (of the region of interest if one was specified)
+        :return: map of the full domain
+        """
+        if self.roi_bounding_box is None or phi is None:
+            return phi
+        else:
+            return ROI.embed_map_into_identity(phi, self.roi_bounding_box, self.full_sz, self.spacing)
+
+    def set_source_label(self, LSource):
+        """
+        Sets the source label (of the full domain)
+
+        :param LSource: source label
+        :return: n/a
+        """
+        self.full_LSource = LSource
+        if self.roi_bounding_box is not None:
+            LSource = ROI.crop_to_bounding_box(LSource, self.roi_bounding_box).contiguous()
+        self.optimizer.set_source_label(LSource)
+
+    def set_target_label(self, LTarget):
+        """
+        Sets the target label (of the full domain)
+
+        :param LTarget: target label
+        :return: n/a
+        """
+        if self.roi_bounding_box is not None:
+            LTarget = ROI.crop_to_bounding_box(LTarget, self.roi_bounding_box).contiguous()
+        self.optimizer.set_target_label(LTarget)
+
     def get_warped_label(self):
         """
         Returns the warped label
         :return: the warped label
         """
         if self.optimizer is not None:
+            if self.roi_bounding_box is not None and self.use_map:
+                # the map is embedded into the full domain, hence the label of the full domain is warped
+                if self.full_LSource is None:
+                    raise ValueError('The warped label of a registration restricted to a region of interest requires the source label of the full domain; set it via set_source_label')
+                return utils.get_warped_label_map(self.full_LSource, self.get_map(), self.spacing)
             return self.optimizer.get_warped_label()
         else:
             return None
@@ -119,6 +225,13 @@ class SimpleRegistration(with_metaclass(ABCMeta, object)):
         :return: the warped image
         """
         if self.optimizer is not None:
+            if self.roi_bounding_box is not None:
+                if self.use_map:
+                    return utils.compute_warped_image_multiNC(self.full_ISource, self.get_map(), self.spacing, self.optimizer.spline_order, zero_boundary=True)
+                else:
+                    IWarped = self.full_ISource.clone()
+                    ROI.crop_to_bounding_box(IWarped, self.roi_bounding_box)[:] = self.optimizer.get_warped_image()
+                    return IWarped
             return self.optimizer.get_warped_image()
         else:
             return None
@@ -132,6 +245,11 @@ class SimpleRegistration(with_metaclass(ABCMeta, object)):
         :return: n/a
         """
         if self.optimizer is not None:
+            if self.roi_bounding_box is not None:
+                # maps are given on the full domain, but the registration is computed in the coordinates of the roi
+                map0 = ROI.crop_map_to_bounding_box(map0, self.roi_bounding_box, self.spacing)
+                if initial_inverse_map is not None:
+                    initial_inverse_map = ROI.crop_map_to_bounding_box(initial_inverse_map, self.roi_bounding_box, self.spacing)
             self.optimizer.set_initial_map(map0, initial_inverse_map)
             # self.optimizer.set_initial_inverse_map(initial_inverse_map)
 
@@ -148,7 +266,7 @@ class SimpleRegistration(with_metaclass(ABCMeta, object)):
         """
 
         if self.optimizer is not None:
-            return self.optimizer.get_initial_map()
+            return self._embed_map(self.optimizer.get_initial_map())
         else:
             return None
 
@@ -161,7 +279,7 @@ class SimpleRegistration(with_metaclass(ABCMeta, object)):
         """
 
         if self.optimizer is not None:
-            return self.optimizer.get_initial_inverse_map()
+            return self._embed_map(self.optimizer.get_initial_inverse_map())
         else:
             return None
 
@@ -171,7 +289,7 @@ class SimpleRegistration(with_metaclass(ABCMeta, object)):
         :return: deformation map
         """
         if self.optimizer is not None:
-            return self.optimizer.get_map()
+            return self._embed_map(self.optimizer.get_map())
 
     def get_inverse_map(self):
         """
@@ -179,7 +297,7 @@ class SimpleRegistration(with_metaclass(ABCMeta, object)):
         :return: deformation map
         """
         if self.optimizer is not None:
-            return self.optimizer.get_inverse_map()
+            return self._embed_map(self.optimizer.get_inverse_map())
 
     def get_model_parameters(self):
         """
@@ -221,9 +339,11 @@ class SimpleSingleScaleRegistration(SimpleRegistration):
     """
     Simple single scale registration
     """
-    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None):
-        super(SimpleSingleScaleRegistration, self).__init__(ISource,ITarget,spacing,sz,params,compute_inverse_map=compute_inverse_map,default_learning_rate=default_learning_rate)
+    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None,
+                 roi_mask=None, roi_bounding_box=None):
+        super(SimpleSingleScaleRegistration, self).__init__(ISource,ITarget,spacing,sz,params,compute_inverse_map=compute_inverse_map,default_learning_rate=default_learning_rate,roi_mask=roi_mask,roi_bounding_box=roi_bounding_box)
         self.optimizer = SingleScaleRegistrationOptimizer(self.sz,self.spacing,self.use_map,self.map_low_res_factor,self.params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate)
+        self._set_roi_similarity_mask_of_optimizer()
 
     def register(self):
         """
@@ -238,9 +358,13 @@ class SimpleSingleScaleConsensusRegistration(SimpleRegistration):
     Single scale registration making use of consensus optimization (to allow for multiple independent registration
     that can share parameters).
     """
-    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None):
-        super(SimpleSingleScaleConsensusRegistration, self).__init__(ISource,ITarget,spacing,sz,params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate)
+    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None,
+                 roi_mask=None, roi_bounding_box=None):
+        if roi_mask is not None or roi_bounding_box is not None:
+            raise ValueError('Regions of interest are not supported for consensus optimization (the images are read by the data loader)')
+        super(SimpleSingleScaleConsensusRegistration, self).__init__(ISource,ITarget,spacing,sz,params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate,roi_mask=roi_mask,roi_bounding_box=roi_bounding_box)
         self.optimizer = SingleScaleConsensusRegistrationOptimizer(self.sz,self.spacing,self.use_map,self.map_low_res_factor,self.params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate)
+        self._set_roi_similarity_mask_of_optimizer()
 
     def register(self):
         """
@@ -254,9 +378,13 @@ class SimpleSingleScaleBatchRegistration(SimpleRegistration):
     """
     Single scale registration making use of batch optimization (to allow optimizing over many or large images).
     """
-    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None):
-        super(SimpleSingleScaleBatchRegistration, self).__init__(ISource,ITarget,spacing,sz,params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate)
+    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None,
+                 roi_mask=None, roi_bounding_box=None):
+        if roi_mask is not None or roi_bounding_box is not None:
+            raise ValueError('Regions of interest are not supported for batch optimization (the images are read by the data loader)')
+        super(SimpleSingleScaleBatchRegistration, self).__init__(ISource,ITarget,spacing,sz,params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate,roi_mask=roi_mask,roi_bounding_box=roi_bounding_box)
         self.optimizer = SingleScaleBatchRegistrationOptimizer(self.sz,self.spacing,self.use_map,self.map_low_res_factor,self.params,compute_inverse_map=compute_inverse_map,default_learning_rate=default_learning_rate)
+        self._set_roi_similarity_mask_of_optimizer()
 
     def register(self):
         """
@@ -270,9 +398,11 @@ class SimpleMultiScaleRegistration(SimpleRegistration):
     """
     Simple multi scale registration
     """
-    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None):
-        super(SimpleMultiScaleRegistration, self).__init__(ISource, ITarget, spacing,sz,params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate)
+    def __init__(self,ISource,ITarget,spacing,sz,params,compute_inverse_map=False, default_learning_rate=None,
+                 roi_mask=None, roi_bounding_box=None):
+        super(SimpleMultiScaleRegistration, self).__init__(ISource, ITarget, spacing,sz,params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate,roi_mask=roi_mask,roi_bounding_box=roi_bounding_box)
         self.optimizer = MultiScaleRegistrationOptimizer(self.sz,self.spacing,self.use_map,self.map_low_res_factor,self.params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate)
+        self._set_roi_similarity_mask_of_optimizer()
 
     def register(self):
         """
@@ -566,6 +696,8 @@ class ImageRegistrationOptimizer(Optimizer):
         """ count of the iterations over multi-resolution"""
         self.recording_step = None
         """sets the step-size for recording all intermediate results to the history"""
+        self.similarity_mask = None
+        """if not None, the similarity measure is only evaluated on the voxels of this mask"""
 
     def set_recording_step(self, step):
         assert step > 0, 'Recording step needs to be larger than 0'
@@ -692,6 +824,36 @@ class ImageRegistrationOptimizer(Optimizer):
     def set_pair_name(self, pair_name):
         self.pair_name = pair_name
 
+    def set_similarity_mask(self, mask):
+        """
+        Restricts the similarity measure to the voxels of a mask (for example a region of interest)
+
+        :param mask: mask of format BxCxXxYxZ (of the image size; B and C may be one) or None to use all voxels
+        :return: n/a
+        """
+        raise ValueError('Similarity masks are not supported by ' + self.__class__.__name__)
+
+    def get_similarity_mask(self):
+        """
+        Returns the mask the similarity measure is restricted to
+
+        :return: mask (or None if all voxels are used)
+        """
+        return self.similarity_mask
+
+    def _downsample_similarity_mask_to_size(self, desired_sz):
+        """
+        Downsamples the similarity mask; voxels which are at least half covered by the mask stay in the mask
+
+        :param desired_sz: desired size (BxCxXxYxZ format)
+        :return: downsampled mask
+        """
+        mask = AdaptVal((self.similarity_mask != 0).float())
+        if list(mask.size()[2:]) == list(desired_sz[2:]):
+            return mask
+        low_res_mask, _ = IS.ResampleImage().downsample_image_to_size(mask, self.spacing, desired_sz[2:], 1)
+        return (low_res_mask >= 0.5).float()
+
 
     def get_pair_name(self):
         return self.pair_name
@@ -839,6 +1001,22 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
     def __init__(self, sz, spacing, useMap, mapLowResFactor, params, compute_inverse_map=False, default_learning_rate=None):
         super(SingleScaleRegistrationOptimizer, self).__init__(sz, spacing, useMap, mapLowResFactor, params,compute_inverse_map=compute_inverse_map, default_learning_rate=default_learning_rate)
 
+        inverse_map_params = self.params['model']['deformation'][('inverse_map', {}, 'settings for the computation of the inverse map')]
+        self.compute_inverse_map_by_fixed_point_iteration = inverse_map_params[('fixed_point_iteration', False, 'If set to True the inverse map is not integrated alongside the map, but computed (only when requested) by a fixed-point iteration')]
+        """if True the inverse map is computed post-hoc (in get_inverse_map) instead of being integrated"""
+        self.inverse_map_tolerance = inverse_map_params[('tolerance', 1e-4, 'fixed-point iteration stops once the inconsistency |phi(phi_inverse(x))-x| is below this value')]
+        self.inverse_map_max_nr_of_iterations = inverse_map_params[('max_nr_of_iterations', 50, 'maximal number of fixed-point iterations')]
+        if self.inverse_map_max_nr_of_iterations < 0:
+            raise ValueError('inverse_map.max_nr_of_iterations needs to be non-negative')
+        self.inverse_map_residual = None
+        """inconsistency of the last inverse map computed by the fixed-point iteration"""
+
+        if self.compute_inverse_map and self.compute_inverse_map_by_fixed_point_iteration and self.useMap:
+            # the model only integrates the map; the inverse is computed on request
+            self.compute_inverse_map = False
+        else:
+            self.compute_inverse_map_by_fixed_point_iteration = False
+
         if self.mapLowResFactor is not None:
             # computes model at a lower resolution than the image similarity
             if self.compute_similarity_measure_at_low_res:
@@ -881,6 +1059,8 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         if self.weight_clipping_type!='pre_lsm_weights':
             self.weight_clipping_value = c_params[('weight_clipping_value', 1.0, 'Value to which the norm is being clipped')]
             """Desired norm after clipping"""
+        self.use_foreach = c_params[('use_foreach', True, 'If set to True the optimizer update (sgd and adam) and the weight clipping use fused multi-tensor operations (if supported by the installed torch version)')]
+        """if True many parameter tensors are updated at once (via torch._foreach_* operations)"""
 
         extent = self.spacing * self.sz[2:]
         max_extent = max(extent)
@@ -892,6 +1072,29 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         self.clip_shared_gradient = clip_params[('clip_shared_gradient', True, 'If set to True, the gradient for the shared parameters will be clipped')] # todo recover the clip gradient,or it may cause unstable
         self.clip_shared_gradient_value = clip_params[('clip_shared_gradient_value', 1.0, 'Value to which the gradient for the shared parameters is clipped')]
 
+        profiling_params = c_params[('profiling',{},'opt-in per-phase timing and memory instrumentation')]
+        self.profile_phases = profiling_params[('enabled', False, 'If set to True wall time, CUDA time and peak memory are recorded per phase and iteration (in the history under profile)')]
+        self.chrome_trace_filename = profiling_params[('chrome_trace_filename', '', 'If not empty (and profiling is enabled) the phase events are written to this file in Chrome trace format')]
+        self.profiler = profiling.PhaseProfiler(enabled=self.profile_phases, record_chrome_trace=(self.chrome_trace_filename!=''))
+        """records the timings and memory consumption of the different phases of an iteration (if enabled)"""
+
+        reporting_params = c_params[('reporting',{},'settings for how the energies are reported during the optimization')]
+        self.analysis_step = reporting_params[('analysis_step', 1, 'Energies are kept on the device and only read back (to be printed, recorded, checked for convergence and visualized) every analysis_step iterations; 1 analyzes every iteration. Iterations which are visualized or recorded are always read back. As convergence is only checked at a read back, the optimization may continue for up to analysis_step-1 iterations past the tolerance')]
+        """number of iterations between read backs of the energies; for values >1 the GPU does not need to synchronize in every iteration.
+        Iterations which are visualized (visualize_step) or recorded (recording_step) are always read back. Convergence (rel_ftol)
+        is only checked at a read back, i.e., iterations continue past the tolerance until the next read back."""
+        self._pending_analysis = []
+
+        compiled_step_params = c_params[('compiled_step',{},'opt-in compiled optimization step (for a fixed model and image size)')]
+        self.compiled_step_mode = compiled_step_params[('mode', 'none', "[none|compile|cuda_graph]; compile: the energy (and the step of closure-free optimizers) is compiled with torch.compile; cuda_graph: forward pass, backward pass and optimizer step are captured once as a CUDA graph and replayed")].lower()
+        """mode of the compiled optimization step (see mermaid.compiled_step)"""
+        self.compiled_step_backend = compiled_step_params[('backend', 'auto', 'torch.compile backend; auto uses inductor on the GPU and aot_eager on the CPU')]
+        self.compiled_step_nr_of_warmup_steps = compiled_step_params[('nr_of_warmup_steps', 3, 'number of eager steps (on a side stream) before the CUDA graph is captured')]
+        self._active_compiled_step_mode = 'none'
+        self._compiled_energy = None
+        self._compiled_optimizer_step = None
+        self._cuda_graph_step = None
+
         self.scheduler = None # for the step size scheduler
         self.patience = None # for the step size scheduler
         self._use_external_scheduler = False
@@ -923,6 +1126,12 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         self.over_scale_iter_count = None #accumulated iter count over different scales
         self.n_scale = None #the index of  current scale, torename and document  todo
 
+        self.distributed_shared_gradients = False
+        """if set to True the gradients of the shared parameters are summed over all processes of the (initialized) process group"""
+
+        self.grad_scaler = None
+        """scales the loss (and hence the gradients) when running in automatic mixed precision"""
+
 
     def write_parameters_to_settings(self):
         if self.model is not None:
@@ -942,6 +1151,8 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             d['model']['size'] = self.model.sz
             d['model']['spacing'] = self.model.spacing
             d['optimizer_state'] = self.optimizer_instance.state_dict()
+            if self.grad_scaler is not None:
+                d['grad_scaler_state'] = self.grad_scaler.state_dict()
             return d
         else:
             raise ValueError('Unable to create checkpoint, because either the model or the optimizer have not been initialized')
@@ -952,6 +1163,8 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             if load_optimizer_state:
                 try:
                     self.optimizer_instance.load_state_dict(d['optimizer_state'])
+                    if self.grad_scaler is not None and 'grad_scaler_state' in d:
+                        self.grad_scaler.load_state_dict(d['grad_scaler_state'])
                     print('INFO: Was able to load the previous optimzer state from checkpoint data')
                 except:
                     print('INFO: Could not load the previous optimizer state')
@@ -1015,11 +1228,32 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
 
     def get_inverse_map(self):
         """
-        Returns the deformation map
-        :return: deformation map
+        Returns the inverse deformation map (computed by a fixed-point iteration if so specified in the settings)
+        :return: inverse deformation map
         """
+        if self.compute_inverse_map_by_fixed_point_iteration and self.rec_phiInverseWarped is None and self.rec_phiWarped is not None:
+            if self.mapLowResFactor is not None and self.compute_similarity_measure_at_low_res:
+                map_spacing = self.lowResSpacing
+            else:
+                map_spacing = self.spacing
+            self.rec_phiInverseWarped, self.inverse_map_residual = utils.compute_inverse_map_by_fixed_point_iteration(
+                self.rec_phiWarped, map_spacing,
+                tolerance=self.inverse_map_tolerance,
+                max_nr_of_iterations=self.inverse_map_max_nr_of_iterations,
+                spline_order=self.spline_order)
+            print('INFO: inverse map computed by fixed-point iteration; residual inconsistency = {:.2e}'.format(self.inverse_map_residual))
+            if self.inverse_map_residual > self.inverse_map_tolerance:
+                print('WARNING: fixed-point iteration for the inverse map did not reach the tolerance of {:.2e}'.format(self.inverse_map_tolerance))
         return self.rec_phiInverseWarped
 
+    def get_inverse_map_residual(self):
+        """
+        Returns the inconsistency max|phi(phi_inverse(x))-x| of the inverse map computed by the fixed-point iteration
+
+        :return: residual (None if the inverse map was not computed by the fixed-point iteration)
+        """
+        return self.inverse_map_residual
+
     def set_n_scale(self, n_scale):
         """
         the path of saved figures, default is the ../data/expr_name
@@ -1038,28 +1272,24 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             if self.map0_external is not None:
                 self.initialMap = self.map0_external
             else:
-                id = utils.identity_map_multiN(self.sz, self.spacing)
-                self.initialMap = AdaptVal(torch.from_numpy(id))
+                self.initialMap = utils._get_shared_identity_map(self.sz, self.spacing)
 
             if self.map0_inverse_external is not None:
                 self.initialInverseMap = self.map0_inverse_external
             else:
-                id =utils.identity_map_multiN(self.sz, self.spacing)
-                self.initialInverseMap =  AdaptVal(torch.from_numpy(id))
+                self.initialInverseMap = utils._get_shared_identity_map(self.sz, self.spacing)
 
             if self.mapLowResFactor is not None:
                 # create a lower resolution map for the computations
                 if self.map0_external is None:
-                    lowres_id = utils.identity_map_multiN(self.lowResSize, self.lowResSpacing)
-                    self.lowResInitialMap = AdaptVal(torch.from_numpy(lowres_id))
+                    self.lowResInitialMap = utils._get_shared_identity_map(self.lowResSize, self.lowResSpacing)
                 else:
                     sampler = IS.ResampleImage()
                     lowres_id, _ = sampler.downsample_image_to_size(self.initialMap , self.spacing,self.lowResSize[2::] , 1,zero_boundary=False)
                     self.lowResInitialMap = AdaptVal(lowres_id)
 
                 if self.map0_inverse_external is None:
-                    lowres_id = utils.identity_map_multiN(self.lowResSize, self.lowResSpacing)
-                    self.lowResInitialInverseMap = AdaptVal(torch.from_numpy(lowres_id))
+                    self.lowResInitialInverseMap = utils._get_shared_identity_map(self.lowResSize, self.lowResSpacing)
                 else:
                     sampler = IS.ResampleImage()
                     lowres_inverse_id, _ = sampler.downsample_image_to_size(self.initialInverseMap, self.spacing, self.lowResSize[2::],
@@ -1079,6 +1309,26 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         print(self.model)
 
         self._create_initial_maps()
+        self._set_similarity_mask_of_criterion()
+
+    def set_similarity_mask(self, mask):
+        """
+        Restricts the similarity measure to the voxels of a mask (for example a region of interest)
+
+        :param mask: mask of format BxCxXxYxZ (of the image size; B and C may be one) or None to use all voxels
+        :return: n/a
+        """
+        self.similarity_mask = mask
+        if self.criterion is not None:
+            self._set_similarity_mask_of_criterion()
+
+    def _set_similarity_mask_of_criterion(self):
+        if self.similarity_mask is None:
+            self.criterion.set_similarity_mask(None)
+        elif self.mapLowResFactor is not None and self.compute_similarity_measure_at_low_res:
+            self.criterion.set_similarity_mask(self._downsample_similarity_mask_to_size(self.lowResSize))
+        else:
+            self.criterion.set_similarity_mask(self._downsample_similarity_mask_to_size(self.sz))
 
     def set_initial_map(self,map0,map0_inverse=None):
         """
@@ -1114,13 +1364,13 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         """
         Returns the initial map
 
-        :return: initial map
+        :return: initial map (a copy, as the identity map is shared, see utils._get_shared_identity_map)
         """
 
         if self.initialMap is not None:
-            return self.initialMap
+            return self.initialMap.clone()
         elif self.map0_external is not None:
-            return self.map0_external
+            return self.map0_external.clone()
         else:
             return None
 
@@ -1128,13 +1378,13 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         """
         Returns the initial inverse map
 
-        :return: initial inverse map
+        :return: initial inverse map (a copy, as the identity map is shared, see utils._get_shared_identity_map)
         """
 
         if self.initialInverseMap is not None:
-            return self.initialInverseMap
+            return self.initialInverseMap.clone()
         elif self.map0_inverse_external is not None:
-            return self.map0_inverse_external
+            return self.map0_inverse_external.clone()
         else:
             return None
 
@@ -1218,23 +1468,25 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
     def _aux_do_weight_clipping_norm(self,pars,desired_norm):
         """does weight clipping but only for conv or bias layers (assuming they are named as such); be careful with the namimg here"""
         if self.weight_clipping_value > 0:
+            vectors = []
+            tensors = []
             for key in pars:
                 # only do the clipping if it is a conv layer or a bias term
                 if key.lower().find('conv')>0 or key.lower().find('bias')>0:
                     p = pars[key]
                     if self._is_vector(p.data):
-                        # just normalize this vector component-by-component, norm does not matter here as these are only scalars
-                        p.data = p.data.clamp_(-self.weight_clipping_value, self.weight_clipping_value)
+                        vectors.append(p.data)
                     elif self._is_tensor(p.data):
-                        # normalize sample-by-sample individually
-                        for b in range(p.data.size()[0]):
-                            param_norm = p.data[b, ...].norm(desired_norm)
-                            if param_norm > self.weight_clipping_value:
-                                clip_coef = self.weight_clipping_value / param_norm
-                                p.data[b, ...].mul_(clip_coef)
+                        tensors.append(p.data)
                     else:
                         raise ValueError('Unknown data type; I do not know how to clip this')
 
+            # all parameters are clipped at once (with fused multi-tensor operations if enabled)
+            # just normalize the vectors component-by-component, norm does not matter here as these are only scalars
+            MT.clamp_(vectors, -self.weight_clipping_value, self.weight_clipping_value, use_foreach=self.use_foreach)
+            # normalize the tensors sample-by-sample individually
+            MT.clip_norm_per_sample_(tensors, self.weight_clipping_value, norm_type=desired_norm, use_foreach=self.use_foreach)
+
     def _do_shared_weight_clipping_pre_lsm(self):
         multi_gaussian_weights = self.params['model']['registration_model']['forward_model']['smoother'][('multi_gaussian_weights', -1, 'the used multi gaussian weights')]
         if multi_gaussian_weights==-1:
@@ -1352,6 +1604,96 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             pl.append(pars[p_key])
         return pl
 
+    def set_distributed_shared_gradients(self,distributed_shared_gradients):
+        """
+        Turns on/off summation of the shared parameter gradients across all processes of the process group
+        (data-parallel optimization of the shared parameters). Requires torch.distributed to be initialized.
+
+        :param distributed_shared_gradients: True/False
+        :return: n/a
+        """
+        self.distributed_shared_gradients = distributed_shared_gradients
+
+    def _get_shared_parameters_requiring_gradients(self):
+        return [p for p in self._collect_individual_or_shared_parameters_in_list(self.get_shared_model_parameters()) if p.requires_grad]
+
+    def _all_reduce_shared_gradients(self):
+        """
+        Sums the gradients of the shared parameters over all processes. The energy of a batch is the sum over its
+        pairs, hence the summed gradient is the gradient of the batch formed by the local batches of all processes
+        (i.e., the same as for a single process with a batch size of batch_size times the number of processes).
+        Individual parameters stay local. All gradients are reduced in one flattened buffer.
+
+        :return: n/a
+        """
+        pars = self._get_shared_parameters_requiring_gradients()
+        if len(pars)==0:
+            return
+
+        # parameters may not have a gradient on all processes (e.g., if not used by the local batch)
+        has_grad = MyTensor([0.0 if p.grad is None else 1.0 for p in pars])
+        torch.distributed.all_reduce(has_grad, op=torch.distributed.ReduceOp.MAX)
+
+        grads = []
+        for p,h in zip(pars,has_grad.tolist()):
+            if h>0:
+                if p.grad is None:
+                    p.grad = torch.zeros_like(p.data)
+                grads.append(p.grad.data)
+
+        if len(grads)==0:
+            return
+
+        flat_grads = torch._utils._flatten_dense_tensors(grads)
+        torch.distributed.all_reduce(flat_grads)
+        for g, reduced_g in zip(grads, torch._utils._unflatten_dense_tensors(flat_grads, grads)):
+            g.copy_(reduced_g)
+
+    def _broadcast_shared_parameters(self,src=0):
+        """
+        Makes the shared parameters of all processes identical to the ones of process src.
+
+        :param src: rank of the process to broadcast from
+        :return: n/a
+        """
+        for p in self._collect_individual_or_shared_parameters_in_list(self.get_shared_model_parameters()):
+            torch.distributed.broadcast(p.data, src=src)
+
+    def _all_reduce_found_inf(self):
+        """
+        Non-finite gradients of one process are spread to all processes by the reduction of the shared gradients.
+        Hence, the non-finite flags recorded by the loss scaler (when unscaling) are combined over all processes, so
+        that all of them skip the step (and reduce the loss scale) together.
+
+        :return: n/a
+        """
+        optimizer_state = self.grad_scaler._per_optimizer_states[id(self.optimizer_instance)]
+        for found_inf in optimizer_state['found_inf_per_device'].values():
+            torch.distributed.all_reduce(found_inf, op=torch.distributed.ReduceOp.MAX)
+
+    def _any_process_agrees(self,flag):
+        """
+        Returns True if flag is True on any of the processes (e.g., to stop distributed iterations on all processes
+        as soon as one of them cannot proceed).
+
+        :param flag: local boolean
+        :return: boolean
+        """
+        t = MyTensor([1.0 if flag else 0.0])
+        torch.distributed.all_reduce(t, op=torch.distributed.ReduceOp.MAX)
+        return t.item()>0
+
+    def _all_processes_agree(self,flag):
+        """
+        Returns True only if flag is True on all processes (to terminate distributed iterations consistently).
+
+        :param flag: local boolean
+        :return: boolean
+        """
+        t = MyTensor([1.0 if flag else 0.0])
+        torch.distributed.all_reduce(t, op=torch.distributed.ReduceOp.MIN)
+        return t.item()>0
+
     def load_shared_state_dict(self,sd):
         """
         Loads the shared part of a state dictionary
@@ -1367,6 +1709,23 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         """
         return self.model.shared_state_dict()
 
+    def share_shared_optimizer_state_with(self, other):
+        """
+        Uses the optimizer state (e.g., the momentum) of the shared parameters of another optimizer of the same model
+        for the shared parameters of this one, i.e., both optimizers then update one and the same state. The values of
+        the shared parameters are not changed (see load_shared_state_dict).
+
+        :param other: single scale optimizer of the same model (e.g., for images of a different size)
+        :return: n/a
+        """
+        if self.optimizer_instance is None or other.optimizer_instance is None:
+            raise ValueError('Optimizer not yet created')
+
+        other_shared_pars = other.model.get_shared_registration_parameters()
+        for name, par in self.model.get_shared_registration_parameters().items():
+            if name in other_shared_pars:
+                self.optimizer_instance.state[par] = other.optimizer_instance.state[other_shared_pars[name]]
+
     def load_individual_state_dict(self):
         raise ValueError('Not yet implemented')
 
@@ -1417,18 +1776,24 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         """
         return self.nrOfIterations
 
-    def _closure(self):
-        self.optimizer_instance.zero_grad()
-        # 1) Forward pass: Compute predicted y by passing x to the model
-        # 2) Compute loss
-
-        # first define variables that will be passed to the model and the criterion (for further use)
+    def _get_opt_variables(self):
+        """
+        Returns the optimization variables which are passed to the model and the criterion
 
+        :return: dictionary with the iteration, epoch and scale
+        """
         over_scale_iter_count = self.iter_count if self.over_scale_iter_count is None else self.over_scale_iter_count + self.iter_count
-        opt_variables = {'iter': self.iter_count, 'epoch': self.current_epoch, 'scale': self.n_scale,
-                         'over_scale_iter_count': over_scale_iter_count}
+        return {'iter': self.iter_count, 'epoch': self.current_epoch, 'scale': self.n_scale,
+                'over_scale_iter_count': over_scale_iter_count}
+
+    def _evaluate_model(self, opt_variables):
+        """
+        Forward pass of the model
 
-        self.rec_IWarped, self.rec_phiWarped, self.rec_phiInverseWarped = model_evaluation.evaluate_model_low_level_interface(
+        :param opt_variables: optimization variables (see _get_opt_variables)
+        :return: tuple (IWarped, phiWarped, phiInverseWarped)
+        """
+        return model_evaluation.evaluate_model_low_level_interface(
             model=self.model,
             I_source=self.ISource,
             opt_variables=opt_variables,
@@ -1445,20 +1810,28 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             low_res_initial_inverse_map=self.lowResInitialInverseMap,
             compute_similarity_measure_at_low_res=self.compute_similarity_measure_at_low_res)
 
-        # compute the respective losses
+    def _evaluate_loss(self, IWarped, phiWarped, opt_variables):
+        """
+        Computes the energies for the output of the model
+
+        :param IWarped: warped image (for image-based models)
+        :param phiWarped: map (for map-based models)
+        :param opt_variables: optimization variables (see _get_opt_variables)
+        :return: tuple (overall energy, similarity energy, regularization energy, optimizer parameter energy)
+        """
         if self.useMap:
             if self.mapLowResFactor is not None and self.compute_similarity_measure_at_low_res:
-                loss_overall_energy, sim_energy, reg_energy = self.criterion(self.lowResInitialMap, self.rec_phiWarped,
+                loss_overall_energy, sim_energy, reg_energy = self.criterion(self.lowResInitialMap, phiWarped,
                                                                              self.lowResISource, self.lowResITarget,
                                                                              self.lowResISource,
                                                                              self.model.get_variables_to_transfer_to_loss_function(),
                                                                              opt_variables)
             else:
-                loss_overall_energy,sim_energy,reg_energy = self.criterion(self.initialMap, self.rec_phiWarped, self.ISource, self.ITarget, self.lowResISource,
+                loss_overall_energy,sim_energy,reg_energy = self.criterion(self.initialMap, phiWarped, self.ISource, self.ITarget, self.lowResISource,
                                                                            self.model.get_variables_to_transfer_to_loss_function(),
                                                                            opt_variables)
         else:
-            loss_overall_energy,sim_energy,reg_energy = self.criterion(self.rec_IWarped, self.ISource, self.ITarget,
+            loss_overall_energy,sim_energy,reg_energy = self.criterion(IWarped, self.ISource, self.ITarget,
                                   self.model.get_variables_to_transfer_to_loss_function(),
                                   opt_variables )
 
@@ -1466,15 +1839,62 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         # based on shared parameters
         opt_par_loss_energy = self.compute_optimizer_parameter_loss(self.model.get_shared_registration_parameters())
         loss_overall_energy  = loss_overall_energy + opt_par_loss_energy
-        loss_overall_energy.backward()
 
-        # do gradient clipping
+        return loss_overall_energy, sim_energy, reg_energy, opt_par_loss_energy
+
+    def _compute_energies(self, opt_variables):
+        """
+        Forward pass of the model followed by the computation of the energies (this is what is compiled in compile mode)
+
+        :param opt_variables: optimization variables (see _get_opt_variables)
+        :return: tuple (overall energy, similarity energy, regularization energy, optimizer parameter energy, IWarped, phiWarped, phiInverseWarped)
+        """
+        IWarped, phiWarped, phiInverseWarped = self._evaluate_model(opt_variables)
+        return self._evaluate_loss(IWarped, phiWarped, opt_variables) + (IWarped, phiWarped, phiInverseWarped)
+
+    def _compute_energies_from_static_and_iteration_variables(self, static_opt_variables, iteration_opt_variables):
+        """
+        Function which is compiled in compile mode; recombines the optimization variables split by _call_compiled_energy
+
+        :param static_opt_variables: optimization variables which are constant over the iterations
+        :param iteration_opt_variables: optimization variables which change over the iterations (as tensors)
+        :return: see _compute_energies
+        """
+        opt_variables = dict(static_opt_variables)
+        opt_variables.update(iteration_opt_variables)
+        return self._compute_energies(opt_variables)
+
+    def _call_compiled_energy(self, opt_variables):
+        """
+        Evaluates the compiled energy. The iteration counters change at every iteration, hence they are passed as
+        tensors (python numbers would be specialized on and trigger a recompilation); all other optimization variables
+        are part of the capture key.
+
+        :param opt_variables: optimization variables (see _get_opt_variables)
+        :return: see _compute_energies
+        """
+        static_opt_variables = dict()
+        iteration_opt_variables = dict()
+        for k, v in opt_variables.items():
+            if k in ['iter', 'epoch', 'over_scale_iter_count'] and v is not None:
+                iteration_opt_variables[k] = torch.tensor(v)
+            else:
+                static_opt_variables[k] = v
+        key = (self._get_compiled_step_key(include_addresses=False), tuple(sorted(static_opt_variables.items())))
+        return self._compiled_energy(key, static_opt_variables, iteration_opt_variables)
+
+    def _clip_gradients(self, display=True):
+        """
+        Clips the gradients of the individual and/or the shared parameters (as specified in the settings)
+
+        :param display: if True (and clip_display is set) it is printed if clipping occurred (requires a synchronization)
+        """
         if self.clip_individual_gradient:
             current_individual_grad_norm = torch.nn.utils.clip_grad_norm_(
                 self._collect_individual_or_shared_parameters_in_list(self.get_individual_model_parameters()),
                 self.clip_individual_gradient_value)
 
-            if self.clip_display:
+            if self.clip_display and display:
                 if current_individual_grad_norm>self.clip_individual_gradient_value:
                     print('INFO: Individual gradient was clipped: {} -> {}'.format(current_individual_grad_norm,self.clip_individual_gradient_value))
 
@@ -1483,13 +1903,53 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
                 self._collect_individual_or_shared_parameters_in_list(self.get_shared_model_parameters()),
                 self.clip_shared_gradient_value)
 
-            if self.clip_display:
+            if self.clip_display and display:
                 if current_shared_grad_norm > self.clip_shared_gradient_value:
                     print('INFO: Shared gradient was clipped: {} -> {}'.format(current_shared_grad_norm,
                                                                                    self.clip_shared_gradient_value))
 
-        self.rec_custom_optimizer_output_string = self.model.get_custom_optimizer_output_string()
-        self.rec_custom_optimizer_output_values = self.model.get_custom_optimizer_output_values()
+    def _closure(self):
+        self.optimizer_instance.zero_grad()
+        # 1) Forward pass: Compute predicted y by passing x to the model
+        # 2) Compute loss
+
+        # first define variables that will be passed to the model and the criterion (for further use)
+        opt_variables = self._get_opt_variables()
+
+        if self._compiled_energy is not None:
+            with self.profiler.phase('forward_model_and_loss'):
+                loss_overall_energy, sim_energy, reg_energy, opt_par_loss_energy, \
+                self.rec_IWarped, self.rec_phiWarped, self.rec_phiInverseWarped = \
+                    self._call_compiled_energy(opt_variables)
+        else:
+            with self.profiler.phase('forward_model'):
+                self.rec_IWarped, self.rec_phiWarped, self.rec_phiInverseWarped = self._evaluate_model(opt_variables)
+
+            # compute the respective losses
+            with self.profiler.phase('loss'):
+                loss_overall_energy, sim_energy, reg_energy, opt_par_loss_energy = self._evaluate_loss(self.rec_IWarped, self.rec_phiWarped, opt_variables)
+
+        with self.profiler.phase('backward'):
+            if self.grad_scaler is not None:
+                self.grad_scaler.scale(loss_overall_energy).backward()
+            else:
+                loss_overall_energy.backward()
+
+        with self.profiler.phase('gradient_processing'):
+            # gradients need to be unscaled before they can be reduced and clipped
+            if self.grad_scaler is not None:
+                self.grad_scaler.unscale_(self.optimizer_instance)
+
+            # for data-parallel optimization the shared gradients are summed over all processes (before clipping)
+            if self.distributed_shared_gradients:
+                self._all_reduce_shared_gradients()
+                if self.grad_scaler is not None:
+                    self._all_reduce_found_inf()
+
+            # do gradient clipping
+            self._clip_gradients()
+
+        self._record_custom_optimizer_output()
 
         self.rec_energy = loss_overall_energy
         self.rec_similarityEnergy = sim_energy
@@ -1508,7 +1968,7 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
 
         return loss_overall_energy
 
-    def analysis(self, energy, similarityEnergy, regEnergy, opt_par_energy, phi_or_warped_image, custom_optimizer_output_string ='', custom_optimizer_output_values=None, force_visualization=False):
+    def analysis(self, energy, similarityEnergy, regEnergy, opt_par_energy, phi_or_warped_image, custom_optimizer_output_string ='', custom_optimizer_output_values=None, force_visualization=False, energies_only=False):
         """
         print out the and visualize the result
         :param energy:
@@ -1516,6 +1976,7 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         :param regEnergy:
         :param opt_par_energy
         :param phi_or_warped_image:
+        :param energies_only: if True only the energies are analyzed (no recording or visualization), used for deferred analysis of previous iterations
         :return: returns tuple: first entry True if termination tolerance was reached, otherwise returns False; second entry if the image was visualized
         """
 
@@ -1583,6 +2044,9 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         iter_count = self.iter_count
         self.last_energy = cur_energy
 
+        if energies_only:
+            return reached_tolerance, was_visualized
+
         if self.recording_step is not None:
             if iter_count % self.recording_step == 0 or iter_count == 0:
                 if self.useMap:
@@ -1711,6 +2175,95 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
 
         return reached_tolerance, was_visualized
 
+    def _requires_read_back(self, iter_count):
+        """
+        Returns True if an iteration is visualized or recorded by the analysis, i.e., if its energies need to be read
+        back even for deferred analysis (see analysis_step)
+
+        :param iter_count: iteration
+        :return: True/False
+        """
+        if self.recording_step is not None:
+            if iter_count % self.recording_step == 0 or iter_count == 0:
+                return True
+        if self.visualize or self.save_fig:
+            if self.visualize_step and (iter_count % self.visualize_step == 0):
+                return True
+        return False
+
+    def _is_read_back_iteration(self, iter_count):
+        """
+        Returns True if the energies of an iteration are read back by the deferred analysis (see analysis_step), i.e.,
+        if analysis_step iterations are pending, if it is the last iteration or if it is visualized or recorded
+
+        :param iter_count: iteration (which has not yet been added to the pending iterations)
+        :return: True/False
+        """
+        return len(self._pending_analysis)+1 >= self.analysis_step or iter_count == self.nrOfIterations-1 \
+               or self._requires_read_back(iter_count)
+
+    def _record_custom_optimizer_output(self):
+        """
+        Records the custom optimizer output (string and history values) of the model for the current iteration. Its
+        computation reads values back from the device, hence for deferred analysis it is only computed for the
+        iterations which are read back (the other ones have no custom output).
+        """
+        if self.analysis_step > 1 and not self._is_read_back_iteration(self.iter_count):
+            self.rec_custom_optimizer_output_string = ''
+            self.rec_custom_optimizer_output_values = None
+        else:
+            self.rec_custom_optimizer_output_string = self.model.get_custom_optimizer_output_string()
+            self.rec_custom_optimizer_output_values = self.model.get_custom_optimizer_output_values()
+
+    def _deferred_analysis(self, phi_or_warped_image, force_read_back=False):
+        """
+        Keeps the energies of the current iteration on the device and only reads them back (with a single transfer for
+        all pending iterations) every analysis_step iterations. The pending iterations are then analyzed in order
+        (history, output, convergence check and step size scheduler) with the same (per-sample) energies as
+        the analysis of every iteration; recording and visualization is only done for the current iteration.
+        Iterations which are to be recorded or visualized are therefore always read back.
+
+        :param phi_or_warped_image: current map or warped image
+        :param force_read_back: if True the energies are read back independent of the number of pending iterations
+        :return: returns tuple: first entry True if termination tolerance was reached, otherwise returns False; second entry if the image was visualized
+        """
+        read_back = force_read_back or self._is_read_back_iteration(self.iter_count)
+
+        energies = [self.rec_energy, self.rec_similarityEnergy, self.rec_regEnergy, self.rec_opt_par_loss_energy]
+        self._pending_analysis.append((self.iter_count,
+                                       torch.cat([e.detach().float().reshape(-1) for e in energies]),
+                                       [e.numel() for e in energies],
+                                       self.rec_custom_optimizer_output_string,
+                                       self.rec_custom_optimizer_output_values))
+
+        if not read_back:
+            return False, False
+
+        pending = self._pending_analysis
+        self._pending_analysis = []
+        all_energies = torch.from_numpy(utils.t2np(torch.cat([p[1] for p in pending])))
+        offsets = np.cumsum([0] + [p[1].numel() for p in pending])
+
+        current_iter_count = self.iter_count
+        tolerance_reached = False
+        was_visualized = False
+        for i, (iter_count, _, sizes, custom_output_string, custom_output_values) in enumerate(pending):
+            self.iter_count = iter_count
+            energy, similarity_energy, reg_energy, opt_par_energy = \
+                torch.split(all_energies[offsets[i]:offsets[i+1]], sizes)
+            reached, visualized = self.analysis(energy, similarity_energy, reg_energy, opt_par_energy,
+                                                phi_or_warped_image,
+                                                custom_output_string, custom_output_values,
+                                                energies_only=(i < len(pending)-1))
+            tolerance_reached = tolerance_reached or reached
+            was_visualized = was_visualized or visualized
+
+            if not self._use_external_scheduler and self.use_step_size_scheduler:
+                self.scheduler.step(energy[0].item())
+
+        self.iter_count = current_iter_count
+        return tolerance_reached, was_visualized
+
     def _debugging_saving_intermid_img(self,img=None,is_label_map=False, append=''):
         folder_path = os.path.join(self.save_fig_path,'debugging')
         folder_path = os.path.join(folder_path, self.pair_name[0])
@@ -2145,7 +2698,8 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
                     settings_individual=settings_individual,
                     settings_shared=settings_shared)
 
-                opt_instance = torch.optim.SGD(self._sgd_par_list)
+                opt_instance = torch.optim.SGD(self._sgd_par_list,
+                                               **MT.get_foreach_optimizer_settings(torch.optim.SGD, self.use_foreach))
 
                 return opt_instance
             elif self.optimizer_name == 'adam':
@@ -2165,7 +2719,8 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
                 opt_instance = torch.optim.Adam(self.model.parameters(), lr=desired_lr,
                                                 betas=adam_betas,
                                                 eps=adam_eps,
-                                                weight_decay=adam_weight_decay)
+                                                weight_decay=adam_weight_decay,
+                                                **MT.get_foreach_optimizer_settings(torch.optim.Adam, self.use_foreach))
                 return opt_instance
             else:
                 raise ValueError('Optimizer = ' + str(self.optimizer_name) + ' not yet supported')
@@ -2188,12 +2743,32 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         if self.optimizer_instance is None:
             self.optimizer_instance = self._get_optimizer_instance()
 
+        if self.grad_scaler is None and is_amp_enabled():
+            self.grad_scaler = self._get_grad_scaler()
+
         if USE_CUDA:
             self.model = self.model.cuda()
 
         self.compute_low_res_image_if_needed()
         self.optimizer_has_been_initialized = True
 
+    def _get_grad_scaler(self):
+        """
+        Creates the loss scaler for automatic mixed precision. Loss scaling requires that the closure is evaluated
+        exactly once per step, hence it is not supported for optimizers which need a closure (e.g., the line-search
+        based lbfgs_ls optimizer or an externally specified optimizer such as torch.optim.LBFGS), which then run with
+        autocast only. It is not needed for bfloat16, which has the same range as float32.
+
+        :return: gradient scaler or None if loss scaling is not needed or not supported by the optimizer
+        """
+        if get_amp_dtype() != torch.float16:
+            return None
+        elif self._optimizer_requires_closure():
+            print('WARNING: loss scaling is not supported for optimizers which require a closure; using automatic mixed precision without loss scaling')
+            return None
+        else:
+            return torch.cuda.amp.GradScaler()
+
     def set_scheduler_patience(self,patience):
         self.params['optimizer']['scheduler']['patience'] = patience
         self.scheduler_patience = patience
@@ -2231,6 +2806,188 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
 
         return d
 
+    def reset_for_new_image_pair(self, individual_parameters=None):
+        """
+        Prepares an already initialized optimizer to register a new image pair of the same size with the same model.
+        The model (and with it its smoothers and Fourier filters) as well as the initial maps are kept. The state of the
+        optimizer, the step size scheduler and the history are cleared so that the next optimization starts from scratch.
+
+        :param individual_parameters: optional dictionary (as returned by get_model_individual_parameters_snapshot)
+            to which the individual (i.e., per-pair) model parameters are reset; shared parameters are not touched
+        """
+
+        if individual_parameters is not None:
+            if self.model is None:
+                raise ValueError('The model needs to be created before its parameters can be reset')
+            current_parameters = self.model.get_individual_registration_parameters()
+            with torch.no_grad():
+                for key in individual_parameters:
+                    current_parameters[key].copy_(individual_parameters[key])
+
+        # the optimizer and the scheduler hold state (e.g., moments, line-search history) of the previous pair
+        self.optimizer_instance = None
+        self.scheduler = None
+        self.last_successful_step_size_taken = None
+        self.last_energy = None
+        self.rel_f = None
+        self._pending_analysis = []
+        self.history = dict()
+        if self.recording_step is not None:
+            self.history['recording'] = []
+
+        self.rec_energy = None
+        self.rec_similarityEnergy = None
+        self.rec_regEnergy = None
+        self.rec_opt_par_loss_energy = None
+        self.rec_phiWarped = None
+        self.rec_phiInverseWarped = None
+        self.rec_IWarped = None
+        self.inverse_map_residual = None
+
+    def get_model_individual_parameters_snapshot(self):
+        """
+        Returns a (detached) copy of the current individual (i.e., per-pair) model parameters; can be used to reset
+        the parameters via reset_for_new_image_pair
+
+        :return: ordered dictionary parameter name -> tensor
+        """
+        if self.model is None:
+            raise ValueError('The model needs to be created before its parameters can be copied')
+
+        snapshot = OrderedDict()
+        for key, value in self.model.get_individual_registration_parameters().items():
+            snapshot[key] = value.detach().clone()
+        return snapshot
+
+    def _optimizer_requires_closure(self):
+        """
+        Returns True if the optimizer needs to re-evaluate the energy during its step (e.g., for a line search); this
+        is assumed for all externally specified optimizers
+
+        :return: True/False
+        """
+        return self.optimizer is not None or self.optimizer_name not in ['sgd', 'adam']
+
+    def _get_compiled_step_key(self, include_addresses=True):
+        """
+        Returns the capture key of the compiled step, i.e., everything the compiled (or captured) step depends on.
+        If it changes the step is recompiled (or recaptured).
+
+        :param include_addresses: if True the memory addresses of the inputs and parameters are part of the key
+            (required for CUDA graphs, which read their inputs from fixed addresses)
+        :return: hashable key
+        """
+        tensors = [self.ISource, self.ITarget, self.initialMap, self.initialInverseMap,
+                   self.lowResISource, self.lowResITarget, self.lowResInitialMap, self.lowResInitialInverseMap,
+                   self.similarity_mask]
+        if include_addresses:
+            tensors += list(self.model.parameters())
+        return (id(self.model), id(self.criterion), self.useMap, self.compute_inverse_map, self.spline_order,
+                self.mapLowResFactor, self.compute_similarity_measure_at_low_res,
+                tuple(CS.get_tensor_key(t, include_address=include_addresses) for t in tensors))
+
+    def _initialize_compiled_step(self):
+        """
+        Sets up the compiled optimization step as specified by optimizer.compiled_step.mode. Modes which are not
+        supported in the current setting fall back to the next simpler one (cuda_graph -> compile -> none).
+        """
+        mode = self.compiled_step_mode
+        if mode not in ['none', 'compile', 'cuda_graph']:
+            raise ValueError('Unknown compiled step mode {}; use none, compile or cuda_graph'.format(mode))
+
+        if mode == 'cuda_graph':
+            reason = None
+            if not CS.is_cuda_graph_available():
+                reason = 'CUDA is not available'
+            elif self._optimizer_requires_closure():
+                reason = 'the optimizer needs to re-evaluate the energy (only sgd and adam are supported)'
+            elif self.grad_scaler is not None:
+                reason = 'loss scaling is used'
+            elif self.distributed_shared_gradients:
+                reason = 'the shared gradients are reduced over processes'
+            if reason is not None:
+                print('WARNING: cannot capture the optimization step as a CUDA graph, because {}; using compile mode instead'.format(reason))
+                mode = 'compile'
+
+        if mode == 'compile' and not CS.is_torch_compile_available():
+            print('WARNING: torch.compile is not available; the optimization step is not compiled')
+            mode = 'none'
+
+        backend = self.compiled_step_backend
+        if backend == 'auto':
+            backend = 'inductor' if USE_CUDA else 'aot_eager'
+
+        if mode == 'compile':
+            if self._compiled_energy is None or self._compiled_energy.backend != backend:
+                self._compiled_energy = CS.CompiledFunction(self._compute_energies_from_static_and_iteration_variables, backend=backend, name='energy')
+            if self.grad_scaler is None and not self._optimizer_requires_closure():
+                if self._compiled_optimizer_step is None or self._compiled_optimizer_step.backend != backend:
+                    self._compiled_optimizer_step = CS.CompiledFunction(CS.take_optimizer_step, backend=backend, name='optimizer step')
+            else:
+                self._compiled_optimizer_step = None
+        else:
+            self._compiled_energy = None
+            self._compiled_optimizer_step = None
+
+        if mode == 'cuda_graph':
+            if self._cuda_graph_step is None:
+                self._cuda_graph_step = CS.CUDAGraphStep(nr_of_warmup_steps=self.compiled_step_nr_of_warmup_steps)
+        else:
+            self._cuda_graph_step = None
+
+        self._active_compiled_step_mode = mode
+
+    def _captured_step_function(self):
+        """
+        Forward and backward pass which is captured as a CUDA graph. The optimization variables (iteration count,
+        epoch, ...) are those at the time of the capture. Gradient clipping is captured, but never displayed.
+
+        :return: tuple (overall energy, similarity energy, regularization energy, optimizer parameter energy, IWarped, phiWarped, phiInverseWarped)
+        """
+        outputs = self._compute_energies(self._get_opt_variables())
+        outputs[0].backward()
+        self._clip_gradients(display=False)
+        return outputs
+
+    def _take_compiled_step(self):
+        """
+        Takes one optimization step in compile or cuda_graph mode
+
+        :return: overall energy
+        """
+        if self._cuda_graph_step is not None:
+            try:
+                outputs = self._cuda_graph_step.step(
+                    key=(self._get_compiled_step_key(include_addresses=True), CS.get_optimizer_key(self.optimizer_instance)),
+                    optimizer=self.optimizer_instance,
+                    step_function=self._captured_step_function)
+            except CS.CUDAGraphCaptureError as e:
+                print('WARNING: capturing the optimization step as a CUDA graph failed ({}); continuing without'.format(e))
+                self._cuda_graph_step = None
+                self._active_compiled_step_mode = 'none'
+                return self.optimizer_instance.step(self._closure)
+
+            loss_overall_energy, sim_energy, reg_energy, opt_par_loss_energy, \
+            self.rec_IWarped, self.rec_phiWarped, self.rec_phiInverseWarped = outputs
+            # the energies are copied as they are overwritten by the next replay (and may be analyzed later)
+            self.rec_energy = loss_overall_energy.detach().clone()
+            self.rec_similarityEnergy = sim_energy.detach().clone()
+            self.rec_regEnergy = reg_energy.detach().clone()
+            self.rec_opt_par_loss_energy = opt_par_loss_energy.detach().clone()
+            self._record_custom_optimizer_output()
+            return self.rec_energy
+
+        current_loss = self._closure()
+        if self._compiled_optimizer_step is not None:
+            try:
+                self._compiled_optimizer_step(CS.get_optimizer_key(self.optimizer_instance), self.optimizer_instance)
+                return current_loss
+            except CS.COMPILE_ERRORS as e:
+                print('WARNING: compiling the optimizer step failed ({}); continuing without'.format(e))
+                self._compiled_optimizer_step = None
+        self.optimizer_instance.step()
+        return current_loss
+
     def optimize(self):
         """
         Do the single scale optimization
@@ -2274,29 +3031,46 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
                                                                             factor=self.scheduler_factor,
                                                                             patience=self.scheduler_patience)
 
+        self._initialize_compiled_step()
+
         self.iter_count = 0
+        self._pending_analysis = []
         for iter in range(self.nrOfIterations):
 
             # take a step of the optimizer
             # for p in self.optimizer_instance._params:
             #     p.data = p.data.float()
 
-            current_loss = self.optimizer_instance.step(self._closure)
+            with self.profiler.activate(), self.profiler.phase('optimizer_step'):
+                if self._active_compiled_step_mode != 'none' and self.grad_scaler is None and not self._optimizer_requires_closure():
+                    current_loss = self._take_compiled_step()
+                elif self.grad_scaler is not None:
+                    # with loss scaling the closure cannot be passed to the optimizer; steps with inf/nan gradients are skipped
+                    current_loss = self._closure()
+                    self.grad_scaler.step(self.optimizer_instance)
+                    self.grad_scaler.update()
+                else:
+                    current_loss = self.optimizer_instance.step(self._closure)
 
-            # do weight clipping if it is desired
-            self._do_weight_clipping()
+                # do weight clipping if it is desired
+                self._do_weight_clipping()
 
             # an external scheduler may for example be used in batch optimization
-            if not self._use_external_scheduler:
+            # (for deferred analysis the scheduler is stepped once the energies are read back)
+            if not self._use_external_scheduler and self.analysis_step==1:
                 if self.use_step_size_scheduler:
                     self.scheduler.step(current_loss.data[0])
 
             if hasattr(self.optimizer_instance,'last_step_size_taken'):
                 self.last_successful_step_size_taken = self.optimizer_instance.last_step_size_taken()
 
-            if self.last_successful_step_size_taken==0.0:
+            could_not_find_successful_step = (self.last_successful_step_size_taken==0.0)
+            if self.distributed_shared_gradients and hasattr(self.optimizer_instance,'last_step_size_taken'):
+                # all processes need to stop together (the closure below and all further iterations reduce gradients)
+                could_not_find_successful_step = self._any_process_agrees(could_not_find_successful_step)
+
+            if could_not_find_successful_step:
                 print('Optimizer was not able to find a successful step. Stopping iterations.')
-                could_not_find_successful_step = True
                 if iter==0:
                     print('The gradient was likely too large or the optimization started from an optimal point.')
                     print('If this behavior is unexpected try adjusting the settings of the similiarity measure or allow the optimizer to try out smaller steps.')
@@ -2309,11 +3083,24 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             else:
                 vis_arg = self.rec_IWarped
 
-            tolerance_reached, was_visualized = self.analysis(self.rec_energy, self.rec_similarityEnergy,
-                                                              self.rec_regEnergy, self.rec_opt_par_loss_energy,
-                                                              vis_arg,
-                                                              self.rec_custom_optimizer_output_string,
-                                                              self.rec_custom_optimizer_output_values)
+            with self.profiler.phase('analysis'):
+                if self.analysis_step>1:
+                    tolerance_reached, was_visualized = self._deferred_analysis(vis_arg,
+                                                                                force_read_back=(iter==self.nrOfIterations-1) or could_not_find_successful_step)
+                else:
+                    tolerance_reached, was_visualized = self.analysis(self.rec_energy, self.rec_similarityEnergy,
+                                                                      self.rec_regEnergy, self.rec_opt_par_loss_energy,
+                                                                      vis_arg,
+                                                                      self.rec_custom_optimizer_output_string,
+                                                                      self.rec_custom_optimizer_output_values)
+
+            if self.profile_phases:
+                self._add_to_history('profile', self.profiler.end_iteration())
+
+            if self.distributed_shared_gradients and len(self._pending_analysis)==0:
+                # all processes need to do the same number of iterations as gradients are reduced in every iteration
+                # (only needs to be checked when the energies were read back, which happens synchronously on all processes)
+                tolerance_reached = self._all_processes_agree(tolerance_reached)
 
             if tolerance_reached or could_not_find_successful_step:
                 if tolerance_reached:
@@ -2331,10 +3118,56 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
 
             self.iter_count = iter+1
 
+        if self.profile_phases and self.chrome_trace_filename!='':
+            self.profiler.export_chrome_trace(self.chrome_trace_filename)
+
         if self.show_iteration_output:
             cprint('-->Elapsed time {:.5f}[s]'.format(time.time() - start),  'green')
 
 
+def _distributed_batch_worker(rank, world_size, config):
+    """
+    Process for the distributed (data-parallel) batch optimization. Sets up the process group, selects the GPU
+    (if CUDA is used), and runs the batch optimization on its shard of the registration pairs.
+
+    :param rank: rank of this process
+    :param world_size: total number of processes
+    :param config: configuration dictionary as created by SingleScaleBatchRegistrationOptimizer._get_worker_configuration
+    :return: n/a
+    """
+
+    if USE_CUDA:
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+
+    torch.distributed.init_process_group(backend=config['backend'], init_method=config['init_method'],
+                                         rank=rank, world_size=world_size)
+    try:
+        bopt = SingleScaleBatchRegistrationOptimizer(config['sz'], config['spacing'], config['useMap'],
+                                                     config['mapLowResFactor'], config['params'],
+                                                     compute_inverse_map=config['compute_inverse_map'],
+                                                     default_learning_rate=config['default_learning_rate'])
+        bopt.distributed_rank = rank
+        bopt.distributed_world_size = world_size
+
+        bopt.model_name = config['model_name']
+        bopt.add_model_name = config['add_model_name']
+        bopt.add_model_networkClass = config['add_model_networkClass']
+        bopt.add_model_lossClass = config['add_model_lossClass']
+        bopt.addSimName = config['addSimName']
+        bopt.addSimMeasure = config['addSimMeasure']
+        bopt.optimizer_name = config['optimizer_name']
+        bopt.set_rel_ftol(config['rel_ftol'])
+        # only visualize in the first process
+        bopt.set_visualization(config['visualize'] and rank==0)
+        bopt.set_visualize_step(config['visualize_step'])
+
+        bopt.set_source_image(config['ISource'])
+        bopt.set_target_image(config['ITarget'])
+        bopt.optimize()
+    finally:
+        torch.distributed.destroy_process_group()
+
+
 class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
 
     def __init__(self, sz, spacing, useMap, mapLowResFactor, params, compute_inverse_map=False, default_learning_rate=None):
@@ -2378,6 +3211,9 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
         self.show_sample_optimizer_output = cparams[('show_sample_optimizer_output',False,'If true shows the energies during optimizaton of a sample')]
         """Shows iterations for each sample being optimized"""
 
+        self.use_size_buckets = cparams[('use_size_buckets',False,'If set to True pairs of different sizes are grouped into buckets of equal (padded) size (see data_loader.bucketing); one model is created per bucket and the batches of the buckets are optimized in turns (with one optimizer state for the shared parameters); requires a voxelwise similarity measure (ssd|ncc|ncc_positive|ncc_negative|mi)')]
+        """if True pairs of different sizes are supported by grouping them into buckets"""
+
         self.also_eliminate_shared_state_between_samples_during_first_epoch = \
             self.params['optimizer']['sgd'][('also_eliminate_shared_state_between_samples_during_first_epoch', False,
                                              'if set to true all states are eliminated, otherwise only the individual ones')]
@@ -2393,6 +3229,21 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
             self.scheduler_patience = self.params['optimizer']['scheduler'][
                 ('patience', 5, 'how many steps without reduction before LR is changed')]
 
+        dparams = cparams[('distributed', {}, 'settings for distributed (multi-GPU/multi-process) data-parallel optimization')]
+        self.use_distributed = dparams[('use_distributed', False, 'If set to True the pairs are sharded across processes; individual parameters stay local and the gradients of the shared parameters are all-reduced')]
+        """if set to True the batch optimization is data-parallel over multiple processes"""
+        self.nr_of_distributed_processes = dparams[('nr_of_processes', 0, 'Number of processes; 0 uses one per GPU (and a single process on the CPU)')]
+        """number of processes for distributed optimization"""
+        self.distributed_backend = dparams[('backend', 'auto', 'torch.distributed backend [auto|nccl|gloo]; auto uses nccl on the GPU and gloo on the CPU')]
+        """backend for torch.distributed"""
+        self.distributed_init_method = dparams[('init_method', 'auto', 'URL to set up the process group; auto uses a free local TCP port (so that concurrent runs do not collide)')]
+        """how the process group is initialized"""
+
+        self.distributed_rank = None
+        """rank of this process; only set inside of a distributed worker process"""
+        self.distributed_world_size = 1
+        """number of processes taking part in the distributed optimization"""
+
         self.model_name = None
         self.add_model_name = None
         self.add_model_networkClass = None
@@ -2402,6 +3253,13 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
 
         self.ssOpt = None
 
+        self.bucket_optimizers = OrderedDict()
+        """single scale optimizers (one per bucket and batch size) if size buckets are used"""
+        self.bucket_schedulers = OrderedDict()
+        """step size schedulers of the bucket optimizers (by number of the bucket optimizer)"""
+        self.current_bucket_optimizer_nr = None
+        """number of the bucket optimizer which is currently used"""
+
     def write_parameters_to_settings(self):
         if self.ssOpt is not None:
             self.ssOpt.write_parameters_to_settings()
@@ -2438,6 +3296,114 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
         self.add_model_networkClass = add_model_networkClass
         self.add_model_lossClass = add_model_lossClass
 
+    def _is_distributed_worker(self):
+        return self.distributed_rank is not None
+
+    def _is_main_process(self):
+        return self.distributed_rank is None or self.distributed_rank==0
+
+    def _get_nr_of_distributed_processes(self):
+        if self.nr_of_distributed_processes > 0:
+            return self.nr_of_distributed_processes
+        elif USE_CUDA:
+            return max(1,torch.cuda.device_count())
+        else:
+            return 1
+
+    def _get_distributed_backend(self):
+        if self.distributed_backend=='auto':
+            return 'nccl' if USE_CUDA else 'gloo'
+        else:
+            return self.distributed_backend
+
+    def _get_distributed_init_method(self):
+        """
+        Returns the URL used to set up the process group. For init_method=auto a free TCP port on the local host is
+        picked, so that several distributed optimizations can run at the same time.
+
+        :return: URL
+        """
+        if self.distributed_init_method=='auto':
+            with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+                s.bind(('127.0.0.1', 0))
+                port = s.getsockname()[1]
+            return 'tcp://127.0.0.1:{}'.format(port)
+        else:
+            return self.distributed_init_method
+
+    def _get_worker_configuration(self):
+        """
+        Creates the (picklable) configuration a distributed worker process needs to recreate this optimizer.
+
+        :return: configuration dictionary
+        """
+        return {'sz': self.sz,
+                'spacing': self.spacing,
+                'useMap': self.useMap,
+                'mapLowResFactor': self.mapLowResFactor,
+                'params': self.params,
+                'compute_inverse_map': self.compute_inverse_map,
+                'default_learning_rate': self.default_learning_rate,
+                'model_name': self.model_name,
+                'add_model_name': self.add_model_name,
+                'add_model_networkClass': self.add_model_networkClass,
+                'add_model_lossClass': self.add_model_lossClass,
+                'addSimName': self.addSimName,
+                'addSimMeasure': self.addSimMeasure,
+                'optimizer_name': self.optimizer_name,
+                'rel_ftol': self.get_rel_ftol(),
+                'visualize': self.get_visualization(),
+                'visualize_step': self.get_visualize_step(),
+                'ISource': self.ISource,
+                'ITarget': self.ITarget,
+                'backend': self._get_distributed_backend(),
+                'init_method': self._get_distributed_init_method()}
+
+    def _reduce_epoch_energies(self,mean_energies,min_energies,max_energies):
+        """
+        Combines the energy statistics of an epoch over all processes, so all processes report (and schedule) alike.
+
+        :param mean_energies: list of the locally averaged energies
+        :param min_energies: list of the local minimum energies
+        :param max_energies: list of the local maximum energies
+        :return: tuple of lists (mean_energies,min_energies,max_energies) over all processes
+        """
+        t_mean = MyTensor(mean_energies)
+        t_min = MyTensor(min_energies)
+        t_max = MyTensor(max_energies)
+        torch.distributed.all_reduce(t_mean)
+        torch.distributed.all_reduce(t_min, op=torch.distributed.ReduceOp.MIN)
+        torch.distributed.all_reduce(t_max, op=torch.distributed.ReduceOp.MAX)
+        t_mean /= self.distributed_world_size
+        return t_mean.tolist(), t_min.tolist(), t_max.tolist()
+
+    def _optimize_distributed(self):
+        """
+        Spawns the processes for data-parallel batch optimization and waits for them to finish. Afterwards the
+        shared parameters written by the first process are loaded, so the optimizer can be queried as usual.
+
+        :return: n/a
+        """
+        world_size = self._get_nr_of_distributed_processes()
+        print('Distributed batch optimization with {} processes (backend={})'.format(world_size,self._get_distributed_backend()))
+
+        torch_mp.spawn(_distributed_batch_worker, args=(world_size,self._get_worker_configuration()), nprocs=world_size, join=True)
+
+        # recreate the optimizer locally so that the shared parameters can be accessed
+        registration_data_set = OD.PairwiseRegistrationDataset(output_directory=self.individual_parameter_output_dir,
+                                                               source_image_filenames=self.ISource,
+                                                               target_image_filenames=self.ITarget,
+                                                               params=self.params)
+        sample = registration_data_set[0]
+        batch_size = min(self.batch_size,len(registration_data_set))
+        current_source_batch = AdaptVal(sample['ISource'].unsqueeze(0).expand(batch_size,*sample['ISource'].size()).contiguous())
+        current_target_batch = AdaptVal(sample['ITarget'].unsqueeze(0).expand(batch_size,*sample['ITarget'].size()).contiguous())
+
+        self.ssOpt = self._create_single_scale_optimizer(current_source_batch.size())
+        self.ssOpt.set_source_image(current_source_batch)
+        self.ssOpt.set_target_image(current_target_batch)
+        self.ssOpt._set_all_still_missing_parameters()
+        self.ssOpt.load_shared_state_dict(torch.load(self._get_shared_parameter_filename(self.shared_parameter_output_dir)))
 
     def get_checkpoint_dict(self):
         d = super(SingleScaleBatchRegistrationOptimizer, self).get_checkpoint_dict()
@@ -2520,8 +3486,10 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
 
         self.optimizer_has_been_initialized = True
 
-    def _create_single_scale_optimizer(self,batch_size):
-        ssOpt = SingleScaleRegistrationOptimizer(batch_size, self.spacing, self.useMap, self.mapLowResFactor, self.params, compute_inverse_map=self.compute_inverse_map, default_learning_rate=self.default_learning_rate)
+    def _create_single_scale_optimizer(self,batch_size,spacing=None):
+        if spacing is None:
+            spacing = self.spacing
+        ssOpt = SingleScaleRegistrationOptimizer(batch_size, spacing, self.useMap, self.mapLowResFactor, self.params, compute_inverse_map=self.compute_inverse_map, default_learning_rate=self.default_learning_rate)
 
         if ((self.add_model_name is not None) and
                 (self.add_model_networkClass is not None) and
@@ -2546,6 +3514,38 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
 
         return ssOpt
 
+    def _check_similarity_measure_for_size_buckets(self):
+        """
+        Raises a ValueError if the similarity measure is not voxelwise. Images are zero-padded to the size of their
+        bucket and only voxelwise measures exclude the padded voxels; all others (e.g., lncc or omt) would see them.
+        """
+        sim_factory = SM.SimilarityMeasureFactory(self.spacing)
+        if (self.addSimName is not None) and (self.addSimMeasure is not None):
+            sim_factory.add_similarity_measure(self.addSimName, self.addSimMeasure)
+        cparams = self.params['model']['registration_model'][('similarity_measure', {}, 'settings for the similarity measure')]
+        similarity_measure_type = cparams[('type', sim_factory.similarity_measure_default_type, 'type of similarity measure (ssd/ncc/lncc/mi/nmi/...)')]
+        similarity_measure_class = sim_factory.simMeasures.get(similarity_measure_type)
+        if similarity_measure_class is not None and not similarity_measure_class.voxelwise:
+            raise ValueError('Size buckets require a voxelwise similarity measure (padded voxels would enter the ' + similarity_measure_type + ' similarity measure)')
+
+    def _select_bucket_optimizer(self,batch_size,spacing):
+        """
+        Selects (and if needed creates) the optimizer for a batch of a size bucket. The shared parameters are
+        passed on from the previously used optimizer, so all buckets optimize the same shared parameters.
+
+        :param batch_size: size of the batch (BxCxXxYxZ)
+        :param spacing: spacing of the images of the bucket
+        :return: tuple (initialize_optimizer, previous optimizer); initialize_optimizer is True if the optimizer was created
+        """
+        key = (tuple(int(v) for v in batch_size),tuple(float(v) for v in spacing))
+        previous_ssOpt = self.ssOpt
+        initialize_optimizer = key not in self.bucket_optimizers
+        if initialize_optimizer:
+            self.bucket_optimizers[key] = self._create_single_scale_optimizer(batch_size,np.array(spacing))
+        self.ssOpt = self.bucket_optimizers[key]
+        self.current_bucket_optimizer_nr = list(self.bucket_optimizers.keys()).index(key)
+        return initialize_optimizer, previous_ssOpt
+
     def _get_individual_checkpoint_filenames(self,output_directory,idx,epoch_iter):
         filenames = []
         for v in idx:
@@ -2600,31 +3600,70 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
         self._set_all_still_missing_parameters()
         self._create_all_output_directories()
 
+        if self.use_distributed and self.use_size_buckets:
+            raise ValueError('Size buckets are not yet supported for distributed batch optimization')
+
+        if self.use_size_buckets:
+            self._check_similarity_measure_for_size_buckets()
+
+        if self.use_distributed and not self._is_distributed_worker():
+            if self.optimizer_name=='lbfgs_ls':
+                raise ValueError('Distributed batch optimization requires a stochastic gradient optimizer (sgd|adam); lbfgs_ls line searches are not synchronized between processes.')
+            self._optimize_distributed()
+            return
+
         iter_offset = 0
 
         if torch.is_tensor(self.ISource) or torch.is_tensor(self.ITarget):
             raise ValueError('Batch optimizer expects lists of filenames as inputs for the source and target images')
 
-        registration_data_set = OD.PairwiseRegistrationDataset(output_directory=self.individual_parameter_output_dir,
-                                                               source_image_filenames=self.ISource,
-                                                               target_image_filenames=self.ITarget,
-                                                               params=self.params)
+        if self.use_size_buckets:
+            registration_data_set = OD.SizeBucketedPairwiseRegistrationDataset(output_directory=self.individual_parameter_output_dir,
+                                                                               source_image_filenames=self.ISource,
+                                                                               target_image_filenames=self.ITarget,
+                                                                               params=self.params)
+        else:
+            registration_data_set = OD.PairwiseRegistrationDataset(output_directory=self.individual_parameter_output_dir,
+                                                                   source_image_filenames=self.ISource,
+                                                                   target_image_filenames=self.ITarget,
+                                                                   params=self.params)
 
         nr_of_datasets = len(registration_data_set)
         if nr_of_datasets<self.batch_size:
             print('INFO: nr of datasets is smaller than batch-size. Reducing batch size to ' + str(nr_of_datasets))
             self.batch_size=nr_of_datasets
 
-        if nr_of_datasets%self.batch_size!=0:
+        if nr_of_datasets%self.batch_size!=0 and not self.use_size_buckets:
             raise ValueError('nr_of_datasets = {}; batch_size = {}: Number of registration pairs needs to be divisible by the batch size.'.format(nr_of_datasets,self.batch_size))
 
-        dataloader = DataLoader(registration_data_set, batch_size=self.batch_size,
-                                shuffle=self.shuffle, num_workers=self.num_workers)
+        if self.use_size_buckets:
+            # batches only contain pairs of the same bucket; the buckets take turns
+            sampler = None
+            batch_sampler = OD.RoundRobinBucketBatchSampler(registration_data_set.get_buckets(), self.batch_size, shuffle=self.shuffle)
+            dataloader = DataLoader(registration_data_set, batch_sampler=batch_sampler, num_workers=self.num_workers)
+        elif self._is_distributed_worker():
+            # each process gets its own shard of the pairs (all processes need to see the same number of batches)
+            if nr_of_datasets%(self.batch_size*self.distributed_world_size)!=0:
+                raise ValueError('nr_of_datasets = {}; batch_size = {}; nr_of_processes = {}: Number of registration pairs needs to be divisible by batch size times number of processes.'.format(nr_of_datasets,self.batch_size,self.distributed_world_size))
+
+            sampler = DistributedSampler(registration_data_set,
+                                         num_replicas=self.distributed_world_size,
+                                         rank=self.distributed_rank,
+                                         shuffle=self.shuffle)
+            dataloader = DataLoader(registration_data_set, batch_size=self.batch_size,
+                                    sampler=sampler, num_workers=self.num_workers)
+        else:
+            sampler = None
+            dataloader = DataLoader(registration_data_set, batch_size=self.batch_size,
+                                    shuffle=self.shuffle, num_workers=self.num_workers)
 
         self.ssOpt = None
         last_batch_size = None
 
-        nr_of_samples = nr_of_datasets//self.batch_size
+        if self.use_size_buckets:
+            nr_of_samples = len(dataloader)
+        else:
+            nr_of_samples = nr_of_datasets//(self.batch_size*self.distributed_world_size)
 
         last_energy = None
         last_sim_energy = None
@@ -2676,6 +3715,13 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
             cur_min_opt_energy = None
             cur_max_opt_energy = None
 
+            # energies of the batches of each bucket optimizer (for their step size schedulers)
+            cur_bucket_energies = defaultdict(list)
+
+            if sampler is not None:
+                # so that the shuffling differs between epochs but is consistent across processes
+                sampler.set_epoch(iter_epoch)
+
             for i, sample in enumerate(dataloader, 0):
 
                 # get the data from the dataloader
@@ -2684,19 +3730,28 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
 
                 # create the optimizer
                 batch_size = current_source_batch.size()
-                if (batch_size != last_batch_size) and (last_batch_size is not None):
-                    raise ValueError('Ooops, this should not have happened.')
+                previous_ssOpt = None
+                if self.use_size_buckets:
+                    # one optimizer (and model) per bucket
+                    bucket_spacing = registration_data_set.get_bucket_spacing(int(sample['bucket'][0]))
+                    initialize_optimizer, previous_ssOpt = self._select_bucket_optimizer(batch_size,bucket_spacing)
+                else:
+                    if (batch_size != last_batch_size) and (last_batch_size is not None):
+                        raise ValueError('Ooops, this should not have happened.')
 
-                initialize_optimizer = False
-                if (batch_size != last_batch_size) or (self.ssOpt is None):
-                    initialize_optimizer = True
-                    # we need to create a new optimizer; otherwise optimizer already exists
-                    self.ssOpt = self._create_single_scale_optimizer(batch_size)
+                    initialize_optimizer = False
+                    if (batch_size != last_batch_size) or (self.ssOpt is None):
+                        initialize_optimizer = True
+                        # we need to create a new optimizer; otherwise optimizer already exists
+                        self.ssOpt = self._create_single_scale_optimizer(batch_size)
 
                 # images need to be set before calling _set_all_still_missing_parameters
                 self.ssOpt.set_source_image(current_source_batch)
                 self.ssOpt.set_target_image(current_target_batch)
                 self.ssOpt.set_current_epoch(iter_epoch)
+                if self.use_size_buckets:
+                    # padded voxels do not contribute to the similarity measure
+                    self.ssOpt.set_similarity_mask(AdaptVal(sample['mask']))
 
                 if initialize_optimizer:
                     # to make sure we have the model initialized, force parameter installation
@@ -2709,16 +3764,31 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
                     else:
                         self.ssOpt.turn_iteration_output_off()
 
-                    if self.use_step_size_scheduler and self.scheduler is None:
+                    if self.use_step_size_scheduler and self.use_size_buckets:
+                        self.bucket_schedulers[self.current_bucket_optimizer_nr] = torch.optim.lr_scheduler.ReduceLROnPlateau(self.ssOpt.optimizer_instance, 'min',
+                                                                                                                               verbose=self.scheduler_verbose,
+                                                                                                                               factor=self.scheduler_factor,
+                                                                                                                               patience=self.scheduler_patience)
+                    elif self.use_step_size_scheduler and self.scheduler is None:
                         self.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(self.ssOpt.optimizer_instance, 'min',
                                                                                     verbose=self.scheduler_verbose,
                                                                                     factor=self.scheduler_factor,
                                                                                     patience=self.scheduler_patience)
 
-                    if load_shared_parameters_before_first_epoch:
+                    if load_shared_parameters_before_first_epoch and previous_ssOpt is None:
                         print('Loading the shared parameters/state.')
                         self.ssOpt.load_shared_state_dict(torch.load(shared_parameter_filename))
 
+                    if self._is_distributed_worker():
+                        # all processes start from the same shared parameters and then average their gradients
+                        self.ssOpt._broadcast_shared_parameters(src=0)
+                        self.ssOpt.set_distributed_shared_gradients(True)
+
+                if previous_ssOpt is not None and previous_ssOpt is not self.ssOpt:
+                    # the models of all buckets share the same shared parameters (and their optimizer state)
+                    self.ssOpt.load_shared_state_dict(previous_ssOpt.shared_state_dict())
+                    self.ssOpt.share_shared_optimizer_state_with(previous_ssOpt)
+
                 last_batch_size = batch_size
 
                 if iter_epoch!=0 or load_individual_parameters_during_first_epoch: # only load the individual parameters after the first epoch
@@ -2733,8 +3803,13 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
                 else:
                     # this is the case when optimization is run for the first time for a batch or if previous results should not be used
                     # In this case we want to have a fresh start for the initial conditions
-                    par_file = os.path.join(self.individual_parameter_output_dir,'default_init.pt')
-                    if i==0:
+                    if self._is_distributed_worker():
+                        par_file = os.path.join(self.individual_parameter_output_dir,'default_init_rank_{:03d}.pt'.format(self.distributed_rank))
+                    elif self.use_size_buckets:
+                        par_file = os.path.join(self.individual_parameter_output_dir,'default_init_bucket_{:03d}.pt'.format(self.current_bucket_optimizer_nr))
+                    else:
+                        par_file = os.path.join(self.individual_parameter_output_dir,'default_init.pt')
+                    if initialize_optimizer:
                         # this is the first time, so we store the individual parameters
                         torch.save(self.ssOpt.get_individual_model_parameters(),par_file)
                     else:
@@ -2767,6 +3842,9 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
                 cur_energy,cur_sim_energy,cur_reg_energy = self.ssOpt.get_energy()
                 cur_opt_energy = self.ssOpt.get_opt_par_energy()
 
+                if self.use_size_buckets:
+                    cur_bucket_energies[self.current_bucket_optimizer_nr].append(cur_energy)
+
                 cur_running_energy += 1./nr_of_samples*cur_energy
                 cur_running_sim_energy += 1./nr_of_samples*cur_sim_energy
                 cur_running_reg_energy += 1./nr_of_samples*cur_reg_energy
@@ -2801,13 +3879,22 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
                         individual_filenames = self._get_individual_checkpoint_filenames(self.individual_checkpoint_output_directory,sample['idx'],iter_epoch)
                         self.ssOpt._write_out_individual_parameters(self.ssOpt.get_sgd_individual_model_parameters_and_optimizer_states(),individual_filenames)
 
-                        if i==nr_of_samples-1:
+                        if i==nr_of_samples-1 and self._is_main_process():
                             if self.verbose_output:
                                 print('Writing out shared checkpoint data for epoch ' + str(iter_epoch))
                             shared_filename = self._get_shared_checkpoint_filename(self.shared_checkpoint_output_directory,iter_epoch)
                             self.ssOpt._write_out_shared_parameters(self.ssOpt.get_sgd_shared_model_parameters(),shared_filename)
 
-            if self.show_sample_optimizer_output:
+            if self._is_distributed_worker():
+                mean_energies, min_energies, max_energies = self._reduce_epoch_energies(
+                    [cur_running_energy,cur_running_sim_energy,cur_running_reg_energy,cur_running_opt_energy],
+                    [cur_min_energy,cur_min_sim_energy,cur_min_reg_energy,cur_min_opt_energy],
+                    [cur_max_energy,cur_max_sim_energy,cur_max_reg_energy,cur_max_opt_energy])
+                cur_running_energy,cur_running_sim_energy,cur_running_reg_energy,cur_running_opt_energy = mean_energies
+                cur_min_energy,cur_min_sim_energy,cur_min_reg_energy,cur_min_opt_energy = min_energies
+                cur_max_energy,cur_max_sim_energy,cur_max_reg_energy,cur_max_opt_energy = max_energies
+
+            if self.show_sample_optimizer_output and self._is_main_process():
                 if (last_energy is not None) and (last_sim_energy is not None) and (last_reg_energy is not None):
                     print('\n\nEpoch {:05d}: Last energies   : E=[{:2.5f}], simE=[{:2.5f}], regE=[{:2.5f}], optE=[{:2.5f}]'\
                           .format(iter_epoch-1,last_energy,last_sim_energy,last_reg_energy,last_opt_energy))
@@ -2821,12 +3908,12 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
             last_reg_energy = cur_running_reg_energy
             last_opt_energy = cur_running_opt_energy
 
-            if self.show_sample_optimizer_output:
+            if self.show_sample_optimizer_output and self._is_main_process():
                 print('Epoch {:05d}: Current energies: E=[{:2.5f}], simE=[{:2.5f}], regE=[{:2.5f}], optE=[{:2.5f}]'\
                   .format(iter_epoch,last_energy, last_sim_energy,last_reg_energy,last_opt_energy))
                 print('    / image: Current energies: E=[{:2.5f}], simE=[{:2.5f}], regE=[{:2.5f}]' \
                       .format(last_energy/batch_size[0], last_sim_energy/batch_size[0], last_reg_energy/batch_size[0]))
-            else:
+            elif self._is_main_process():
                 print('Epoch {:05d}: Current energies: E={:2.5f}:[{:1.2f},{:1.2f}], simE={:2.5f}:[{:1.2f},{:1.2f}], regE={:2.5f}:[{:1.2f},{:1.2f}], optE={:1.2f}:[{:1.2f},{:1.2f}]'\
                       .format(iter_epoch, last_energy, cur_min_energy, cur_max_energy,
                               last_sim_energy, cur_min_sim_energy, cur_max_sim_energy,
@@ -2837,14 +3924,132 @@ class SingleScaleBatchRegistrationOptimizer(ImageRegistrationOptimizer):
                             last_sim_energy/batch_size[0], cur_min_sim_energy/batch_size[0], cur_max_sim_energy/batch_size[0],
                             last_reg_energy/batch_size[0], cur_min_reg_energy/batch_size[0], cur_max_reg_energy/batch_size[0]))
 
-            if self.show_sample_optimizer_output:
+            if self.show_sample_optimizer_output and self._is_main_process():
                 print('\n\n')
 
             if self.use_step_size_scheduler:
-                self.scheduler.step(last_energy)
+                if self.use_size_buckets:
+                    # each scheduler steps on the mean energy of the batches of its own bucket
+                    for bucket_optimizer_nr, scheduler in self.bucket_schedulers.items():
+                        if len(cur_bucket_energies[bucket_optimizer_nr]) > 0:
+                            scheduler.step(np.mean(cur_bucket_energies[bucket_optimizer_nr]))
+                else:
+                    self.scheduler.step(last_energy)
+
+        if self._is_main_process():
+            print('Writing out shared parameter/state file to ' + shared_parameter_filename )
+            torch.save(self.ssOpt.shared_state_dict(),shared_parameter_filename)
+
+
+def _consensus_worker(worker_id, config, batches, command_queue, result_queue):
+    """
+    Worker process for the parallel consensus optimization. Solves the sub-problems of all the batches it was
+    assigned to. Individual parameters and dual variables stay in the memory of the worker; only the consensus state
+    (received from the main process) and the scaled shared parameters (sent back to it) are exchanged via the queues.
+
+    :param worker_id: id of the worker (also selects the GPU if CUDA is used)
+    :param config: configuration dictionary as created by SingleScaleConsensusRegistrationOptimizer._get_worker_configuration
+    :param batches: list of dictionaries with keys 'batch_nr', 'ISource', 'ITarget', and 'weight' (fraction of images in the batch)
+    :param command_queue: queue the main process uses to send commands (dictionaries, see _optimize_with_multiple_batches_in_parallel) to this worker
+    :param result_queue: queue to send results back to the main process
+    :return: n/a
+    """
+
+    try:
+        if USE_CUDA:
+            torch.cuda.set_device(worker_id % torch.cuda.device_count())
+        else:
+            torch.set_num_threads(config['nr_of_threads'])
+
+        copt = SingleScaleConsensusRegistrationOptimizer(config['sz'], config['spacing'], config['useMap'],
+                                                         config['mapLowResFactor'], config['params'],
+                                                         compute_inverse_map=config['compute_inverse_map'],
+                                                         default_learning_rate=config['default_learning_rate'])
+        copt.model_name = config['model_name']
+        copt.add_model_name = config['add_model_name']
+        copt.add_model_networkClass = config['add_model_networkClass']
+        copt.add_model_lossClass = config['add_model_lossClass']
+        copt.addSimName = config['addSimName']
+        copt.addSimMeasure = config['addSimMeasure']
+        copt.optimizer_name = config['optimizer_name']
+        copt.set_rel_ftol(config['rel_ftol'])
+        copt.set_visualization(False)
+
+        # in-memory replacement for the checkpoint files: model/optimizer state and dual variable per batch
+        states = dict()
+        duals = dict()
+        batches = {batch['batch_nr']: batch for batch in batches}
+
+        while True:
+            command = command_queue.get()
+            if command['command'] == 'stop':
+                break
+
+            iter_batch = command['iter_batch']
+            consensus_state = command['consensus_state']
+            if consensus_state is not None:
+                copt.current_consensus_state = {k: AdaptVal(consensus_state[k]) for k in consensus_state}
+
+            results = dict()
+            for current_batch in command['batch_nrs']:
+                batch = batches[current_batch]
+                current_source_batch = AdaptVal(batch['ISource'])
+                current_target_batch = AdaptVal(batch['ITarget'])
+                current_batch_image_size = np.array(current_source_batch.size())
+
+                ssOpt = copt._create_single_scale_optimizer(current_batch_image_size,consensus_penalty=(iter_batch > 0))
+                ssOpt.set_visualization(False)
+                ssOpt._set_all_still_missing_parameters()
 
-        print('Writing out shared parameter/state file to ' + shared_parameter_filename )
-        torch.save(self.ssOpt.shared_state_dict(),shared_parameter_filename)
+                if iter_batch == 0 and command['last_shared_state'] is not None:
+                    # same warm start as in the sequential optimization
+                    last_shared_state = command['last_shared_state']
+                    ssOpt.set_shared_model_parameters({k: AdaptVal(last_shared_state[k]) for k in last_shared_state})
+
+                copt._initialize_consensus_variables_if_needed(ssOpt)
+
+                if iter_batch == 0:
+                    copt.current_consensus_dual = copy.deepcopy(copt.current_consensus_dual)
+                    copt._set_state_to_zero(copt.current_consensus_dual)
+                else:
+                    if current_batch in states:
+                        ssOpt.load_checkpoint_dict(states[current_batch])
+                        copt.current_consensus_dual = duals[current_batch]
+                    else:
+                        # resuming from a previous run; this is the only time the checkpoint files are read
+                        copt._custom_load_checkpoint(ssOpt,copt._get_checkpoint_filename(current_batch,iter_batch-1))
+
+                    copt._add_scaled_difference_to_state(copt.current_consensus_dual,
+                                                         ssOpt.get_shared_model_parameters(),
+                                                         copt.current_consensus_state,-1.0)
+
+                ssOpt.set_source_image(current_source_batch)
+                ssOpt.set_target_image(current_target_batch)
+                ssOpt.optimize()
+
+                contribution = copy.deepcopy(copt.current_consensus_dual)
+                copt._set_state_to_zero(contribution)
+                copt._add_scaled_difference_to_state(contribution,
+                                                     ssOpt.get_shared_model_parameters(),
+                                                     copt.current_consensus_dual,batch['weight'])
+
+                states[current_batch] = copy.deepcopy(ssOpt.get_checkpoint_dict())
+                duals[current_batch] = copt.current_consensus_dual
+
+                # checkpoints are only written as output here (so results can be queried and runs can be resumed)
+                copt._custom_save_checkpoint(ssOpt,copt._get_checkpoint_filename(current_batch,iter_batch))
+
+                # only what is needed for the consensus step is sent back (the history only when it is recorded)
+                shared_state = ssOpt.get_shared_model_parameters()
+                results[current_batch] = {'contribution': {k: contribution[k].detach().cpu() for k in contribution},
+                                          'shared_state': {k: shared_state[k].detach().cpu() for k in shared_state}}
+                if current_batch in command['return_history_for']:
+                    results[current_batch]['history'] = ssOpt.get_history()
+
+            result_queue.put(('result', worker_id, results))
+
+    except Exception:
+        result_queue.put(('error', worker_id, traceback.format_exc()))
 
 
 class SingleScaleConsensusRegistrationOptimizer(ImageRegistrationOptimizer):
@@ -2880,6 +4085,15 @@ class SingleScaleConsensusRegistrationOptimizer(ImageRegistrationOptimizer):
         self.load_optimizer_state_from_checkpoint = cparams[('load_optimizer_state_from_checkpoint',True,'If set to False only the state of the model is loaded when resuming from a checkpoint')]
         """If set to False only the state of the model is loaded when resuming from a checkpoint"""
 
+        self.use_parallel_workers = cparams[('use_parallel_workers',False,'If set to True the batches are optimized in parallel in separate worker processes (one per GPU or a CPU pool)')]
+        """If set to True the batch sub-problems are solved in parallel worker processes"""
+
+        self.nr_of_workers = cparams[('nr_of_workers',0,'Number of worker processes for parallel consensus optimization; 0 uses one per GPU (or one per batch on the CPU)')]
+        """number of worker processes used for parallel consensus optimization; 0 selects it automatically"""
+
+        self.worker_timeout = cparams[('worker_timeout',0,'Maximal time (in seconds) to wait for the result of a worker in parallel consensus optimization; 0 waits as long as the workers are alive')]
+        """maximal time to wait for the results of a worker; 0 waits as long as the workers are alive"""
+
         self.nr_of_batches = None
         self.nr_of_images = None
 
@@ -3183,7 +4397,7 @@ class SingleScaleConsensusRegistrationOptimizer(ImageRegistrationOptimizer):
 
             self.ssOpt.optimize()
 
-            if (current_batch == self.nr_of_batches - 1) and (iter_batch == self.nr_of_epochs - 1):
+            if (current_batch == self.nr_of_batches - 1) and (iter_batch == self.iter_offset + self.nr_of_epochs - 1):
                 # the last time we run this
                 all_histories.append(self.ssOpt.get_history())
 
@@ -3271,7 +4485,7 @@ class SingleScaleConsensusRegistrationOptimizer(ImageRegistrationOptimizer):
 
                 self._copy_state(self.last_shared_state,self.ssOpt.get_shared_model_parameters())
 
-                if (current_batch==self.nr_of_batches-1) and (iter_batch==self.nr_of_epochs-1):
+                if (current_batch==self.nr_of_batches-1) and (iter_batch==self.nr_of_epochs+iter_offset-1):
                     # the last time we run this
                     all_histories.append( self.ssOpt.get_history() )
 
@@ -3291,6 +4505,218 @@ class SingleScaleConsensusRegistrationOptimizer(ImageRegistrationOptimizer):
                 consensus_filename = self._get_consensus_checkpoint_filename(iter_batch)
                 torch.save({'consensus_state':self.current_consensus_state},consensus_filename)
 
+        self.iter_offset = iter_offset
+
+
+    def _get_nr_of_parallel_workers(self):
+        """
+        Returns the number of worker processes for parallel consensus optimization. By default there is one worker
+        per GPU (or one per batch if computations are on the CPU); never more workers than batches.
+
+        :return: number of workers
+        """
+        if self.nr_of_workers > 0:
+            nr_of_workers = self.nr_of_workers
+        elif USE_CUDA:
+            nr_of_workers = torch.cuda.device_count()
+        else:
+            nr_of_workers = self.nr_of_batches
+
+        return max(1,min(nr_of_workers,self.nr_of_batches))
+
+    def _get_worker_configuration(self,nr_of_workers):
+        """
+        Creates the (picklable) configuration a worker process needs to set up its single scale optimizers.
+
+        :param nr_of_workers: total number of workers
+        :return: configuration dictionary
+        """
+        return {'sz': self.sz,
+                'spacing': self.spacing,
+                'useMap': self.useMap,
+                'mapLowResFactor': self.mapLowResFactor,
+                'params': self.params,
+                'compute_inverse_map': self.compute_inverse_map,
+                'default_learning_rate': self.default_learning_rate,
+                'model_name': self.model_name,
+                'add_model_name': self.add_model_name,
+                'add_model_networkClass': self.add_model_networkClass,
+                'add_model_lossClass': self.add_model_lossClass,
+                'addSimName': self.addSimName,
+                'addSimMeasure': self.addSimMeasure,
+                'optimizer_name': self.optimizer_name,
+                'rel_ftol': self.get_rel_ftol(),
+                'nr_of_threads': max(1,nr_of_threads//nr_of_workers)}
+
+    def _get_worker_command(self, iter_batch, batch_nrs, consensus_state, return_history_for):
+        """
+        Creates the command which asks a worker of the parallel consensus optimization to solve some of its batches
+
+        :param iter_batch: current epoch
+        :param batch_nrs: numbers of the batches which should be solved
+        :param consensus_state: current consensus state (on the CPU) or None in the first epoch
+        :param return_history_for: numbers of the batches for which the history should be sent back
+        :return: command dictionary
+        """
+        if self.last_shared_state is None:
+            last_shared_state = None
+        else:
+            last_shared_state = {k: self.last_shared_state[k].detach().cpu() for k in self.last_shared_state}
+
+        return {'command': 'optimize',
+                'iter_batch': iter_batch,
+                'batch_nrs': batch_nrs,
+                'consensus_state': consensus_state,
+                'last_shared_state': last_shared_state,
+                'return_history_for': return_history_for}
+
+    def _get_worker_results(self, result_queue, workers):
+        """
+        Waits for the results of one of the workers of the parallel consensus optimization. Raises an error if a worker
+        failed, terminated or (if worker_timeout is set) did not respond in time.
+
+        :param result_queue: queue the workers send their results to
+        :param workers: list of worker processes
+        :return: dictionary of results (one entry per batch)
+        """
+        start = time.time()
+        while True:
+            try:
+                status, worker_id, results = result_queue.get(timeout=1.0)
+                break
+            except queue.Empty:
+                dead_workers = [worker_id for worker_id, worker in enumerate(workers) if not worker.is_alive()]
+                if len(dead_workers) > 0:
+                    # the error message of a failed worker may still be on its way
+                    try:
+                        status, worker_id, results = result_queue.get(timeout=1.0)
+                        break
+                    except queue.Empty:
+                        raise ValueError('Consensus worker(s) ' + str(dead_workers) + ' terminated unexpectedly')
+                if self.worker_timeout > 0 and time.time()-start > self.worker_timeout:
+                    raise ValueError('Consensus workers did not respond within ' + str(self.worker_timeout) + 's')
+
+        if status == 'error':
+            raise ValueError('Consensus worker ' + str(worker_id) + ' failed:\n' + results)
+        return results
+
+    def _optimize_with_multiple_batches_in_parallel(self, resume_from_iter=None):
+        """
+        Does consensus optimization over multiple batches, where the batches are distributed over worker processes
+        (one per GPU or a CPU pool). Performs the same updates as _optimize_with_multiple_batches, but the
+        consensus state and the (scaled) shared parameters are exchanged via queues (backed by shared memory)
+        instead of being re-read from checkpoint files. Checkpoint files are still written, so results can be
+        retrieved and optimizations can be resumed.
+
+        As in the sequential optimization, each batch of the first epoch is warm-started with the shared parameters
+        of the batch before (or of the previous run), hence the batches of the first epoch are solved one after
+        another; all following epochs are solved in parallel.
+
+        :param resume_from_iter: resumes computations from this iteration (assumes the corresponding checkpoint exists here)
+        :return: n/a
+        """
+
+        if resume_from_iter is not None:
+            iter_offset = resume_from_iter+1
+            print('Resuming from checkpoint iteration: ' + str(resume_from_iter))
+            consensus_filename = self._get_consensus_checkpoint_filename(resume_from_iter)
+            if os.path.isfile(consensus_filename):
+                self.current_consensus_state = torch.load(consensus_filename)['consensus_state']
+        else:
+            iter_offset = 0
+
+        nr_of_workers = self._get_nr_of_parallel_workers()
+        print('Distributing ' + str(self.nr_of_batches) + ' batches over ' + str(nr_of_workers) + ' worker processes')
+
+        # assign the batches round-robin to the workers
+        worker_batches = [[] for _ in range(nr_of_workers)]
+        for current_batch in range(self.nr_of_batches):
+            from_image = current_batch*self.batch_size
+            to_image = min(self.nr_of_images,(current_batch+1)*self.batch_size)
+            worker_batches[current_batch % nr_of_workers].append(
+                {'batch_nr': current_batch,
+                 'ISource': self.ISource[from_image:to_image, ...].detach().cpu(),
+                 'ITarget': self.ITarget[from_image:to_image, ...].detach().cpu(),
+                 'weight': float(to_image-from_image)/float(self.nr_of_images)})
+
+        # spawn is required so CUDA can be initialized in the workers
+        ctx = torch_mp.get_context('spawn')
+        result_queue = ctx.Queue()
+        command_queues = []
+        workers = []
+        config = self._get_worker_configuration(nr_of_workers)
+        for worker_id in range(nr_of_workers):
+            command_queue = ctx.Queue()
+            worker = ctx.Process(target=_consensus_worker,
+                                 args=(worker_id,config,worker_batches[worker_id],command_queue,result_queue))
+            worker.start()
+            command_queues.append(command_queue)
+            workers.append(worker)
+
+        try:
+            for iter_batch in range(iter_offset,self.nr_of_epochs+iter_offset):
+                print('Computing epoch ' + str(iter_batch+1) + ' of ' + str(iter_offset+self.nr_of_epochs))
+
+                if iter_batch==0 or self.current_consensus_state is None:
+                    consensus_state = None
+                else:
+                    consensus_state = {k: self.current_consensus_state[k].detach().cpu() for k in self.current_consensus_state}
+
+                return_history_for = [self.nr_of_batches-1] if iter_batch==self.nr_of_epochs+iter_offset-1 else []
+
+                all_results = dict()
+                if iter_batch==0:
+                    # as in the sequential optimization each batch is warm-started with the shared parameters of
+                    # the batch before, hence the batches of the first epoch are solved one after another
+                    for current_batch in range(self.nr_of_batches):
+                        command_queues[current_batch % nr_of_workers].put(
+                            self._get_worker_command(iter_batch,[current_batch],consensus_state,return_history_for))
+                        results = self._get_worker_results(result_queue,workers)
+                        self.last_shared_state = results[current_batch]['shared_state']
+                        all_results.update(results)
+                else:
+                    for worker_id in range(nr_of_workers):
+                        batch_nrs = [batch['batch_nr'] for batch in worker_batches[worker_id]]
+                        command_queues[worker_id].put(
+                            self._get_worker_command(iter_batch,batch_nrs,consensus_state,return_history_for))
+                    for _ in range(nr_of_workers):
+                        all_results.update(self._get_worker_results(result_queue,workers))
+
+                # same as for the sequential optimization: these are the shared parameters of the last batch
+                last_shared_state = all_results[self.nr_of_batches-1]['shared_state']
+                self.last_shared_state = {k: AdaptVal(last_shared_state[k]) for k in last_shared_state}
+
+                # the consensus state is the sum of the scaled shared parameters (minus duals) over all the batches
+                self.next_consensus_state = None
+                for current_batch in range(self.nr_of_batches):
+                    contribution = all_results[current_batch]['contribution']
+                    if self.next_consensus_state is None:
+                        self.next_consensus_state = {k: contribution[k].clone() for k in contribution}
+                    else:
+                        for k in self.next_consensus_state:
+                            self.next_consensus_state[k] += contribution[k]
+
+                all_histories = []
+                if iter_batch==self.nr_of_epochs+iter_offset-1:
+                    # the last time we run this
+                    all_histories.append(all_results[self.nr_of_batches-1]['history'])
+
+                self._add_to_history('batch_history', copy.deepcopy(all_histories))
+                self.current_consensus_state = {k: AdaptVal(self.next_consensus_state[k]) for k in self.next_consensus_state}
+
+                if self.save_consensus_state_checkpoints:
+                    consensus_filename = self._get_consensus_checkpoint_filename(iter_batch)
+                    torch.save({'consensus_state':self.current_consensus_state},consensus_filename)
+        finally:
+            for worker, command_queue in zip(workers,command_queues):
+                if worker.is_alive():
+                    command_queue.put({'command': 'stop'})
+            for worker in workers:
+                worker.join(timeout=self.worker_timeout if self.worker_timeout > 0 else None)
+                if worker.is_alive():
+                    worker.terminate()
+
+        self.iter_offset = iter_offset
 
     def _get_checkpoint_iter_with_complete_batch(self,start_at_iter):
 
@@ -3387,6 +4813,8 @@ class SingleScaleConsensusRegistrationOptimizer(ImageRegistrationOptimizer):
 
         if compute_as_single_batch:
             self._optimize_as_single_batch(resume_from_iter=last_checkpoint_iteration)
+        elif self.use_parallel_workers:
+            self._optimize_with_multiple_batches_in_parallel(resume_from_iter=last_checkpoint_iteration)
         else:
             self._optimize_with_multiple_batches(resume_from_iter=last_checkpoint_iteration)
 
@@ -3458,6 +4886,16 @@ class MultiScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             self.weight_map = weight_map
             self.freeze_weight = freeze_weight
 
+    def set_similarity_mask(self, mask):
+        """
+        Restricts the similarity measure to the voxels of a mask (for example a region of interest); the mask is
+        downsampled for the coarser scales
+
+        :param mask: mask of format BxCxXxYxZ (of the image size; B and C may be one) or None to use all voxels
+        :return: n/a
+        """
+        self.similarity_mask = mask
+
     def set_pair_name(self,pair_name):
         # f = lambda name: os.path.split(name)
         # get_in = lambda x: os.path.splitext(f(x)[1])[0]
@@ -3667,6 +5105,8 @@ class MultiScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             self.ssOpt.set_model(self.model_name)
             if weight_map is not None:
                 self.ssOpt.set_initial_weight_map(weight_map,self.freeze_weight)
+            if self.similarity_mask is not None:
+                self.ssOpt.set_similarity_mask(self._downsample_similarity_mask_to_size(szC))
 
 
             if (self.addSimName is not None) and (self.addSimMeasure is not None):
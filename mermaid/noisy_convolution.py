@@ -113,9 +113,8 @@ class NoisyLayer(nn.Module):
 
     def forward(self, input, iter=0):
 
-        noise_epsilon = MyTensor(input.size()).normal_()
-
         if self.training:
+            noise_epsilon = MyTensor(input.size()).normal_()
             effective_iter = max(0,iter-self.start_reducing_from_iter)
             output = input + 1. / (effective_iter + 1) * self.std_init * noise_epsilon
         else:
@@ -149,6 +148,11 @@ class _NoisyConvNd(nn.Module):
 
         self.start_reducing_from_iter = start_reducing_from_iter
 
+        self.inference_mode = False
+        """if set to True (and in evaluation mode) the layer is evaluated as a plain convolution; see set_inference_mode"""
+        self._plain_convolution = None
+        self._plain_convolution_key = None
+
         if self.std_init is None:
             self.std_init = 0.25
         else:
@@ -222,6 +226,35 @@ class _NoisyConvNd(nn.Module):
         #if self.bias is not None:
         #    self.bias.data.uniform_(-stdv, stdv)
 
+    def set_inference_mode(self, inference_mode):
+        """
+        Turns the inference mode on or off. In inference mode (and if the layer is in evaluation mode) the noise-free
+        parameters are folded once into a plain nn.ConvNd (or nn.ConvTransposeNd), i.e., no noise is sampled and
+        no effective weights are rebuilt during the forward pass. The plain convolution is not registered as a submodule
+        (so the state dictionary does not change). It is folded again once the parameters change or are moved to a
+        different device (see get_fold_key).
+
+        :param inference_mode: if True inference mode is turned on, otherwise it is turned off
+        """
+        self.inference_mode = inference_mode
+        if inference_mode:
+            plain_convolution = fold_into_plain_convolution(self)[0]
+        else:
+            plain_convolution = None
+        # bypass nn.Module.__setattr__ so that the plain convolution is not registered as a submodule
+        object.__setattr__(self, '_plain_convolution', plain_convolution)
+        self._plain_convolution_key = get_fold_key(self) if inference_mode else None
+
+    def _get_plain_convolution(self):
+        """
+        Returns the plain convolution of the inference mode (folded again if the parameters changed since it was folded)
+
+        :return: plain convolution
+        """
+        if get_fold_key(self) != self._plain_convolution_key:
+            self.set_inference_mode(True)
+        return self._plain_convolution
+
     def extra_repr(self):
         s = ('{in_channels}, {out_channels}, kernel_size={kernel_size}'
              ', stride={stride}')
@@ -350,8 +383,12 @@ class NoisyConv1d(_NoisyConvNd):
 
     def forward(self, input, iter=0):
 
-        weight_epsilon = MyTensor(*(self.out_channels, self.in_channels, *self.kernel_size)).normal_()
-        bias_epsilon = MyTensor(self.out_channels).normal_()
+        if self.inference_mode and not self.training:
+            return self._get_plain_convolution()(input)
+
+        if self.training:
+            weight_epsilon = MyTensor(*self.weight.size()).normal_()
+            bias_epsilon = MyTensor(self.out_channels).normal_()
 
         if self.bias is not None:
             if self.training:
@@ -526,8 +563,12 @@ class NoisyConv2d(_NoisyConvNd):
 
     def forward(self, input, iter=0):
 
-        weight_epsilon = MyTensor(*(self.out_channels, self.in_channels, *self.kernel_size)).normal_()
-        bias_epsilon = MyTensor(self.out_channels).normal_()
+        if self.inference_mode and not self.training:
+            return self._get_plain_convolution()(input)
+
+        if self.training:
+            weight_epsilon = MyTensor(*self.weight.size()).normal_()
+            bias_epsilon = MyTensor(self.out_channels).normal_()
 
         if self.bias is not None:
             if self.training:
@@ -696,10 +737,14 @@ class NoisyConv3d(_NoisyConvNd):
             in_channels, out_channels, kernel_size, stride, padding, dilation,
             False, _triple(0), groups, bias, scalar_sigmas, optimize_sigmas, std_init, start_reducing_from_iter)
 
-    def forward(self, input):
+    def forward(self, input, iter=0):
 
-        weight_epsilon = MyTensor(*(self.out_channels, self.in_channels, *self.kernel_size)).normal_()
-        bias_epsilon = MyTensor(self.out_channels).normal_()
+        if self.inference_mode and not self.training:
+            return self._get_plain_convolution()(input)
+
+        if self.training:
+            weight_epsilon = MyTensor(*self.weight.size()).normal_()
+            bias_epsilon = MyTensor(self.out_channels).normal_()
 
         if self.bias is not None:
             if self.training:
@@ -888,10 +933,14 @@ class NoisyConvTranspose1d(_NoisyConvTransposeMixin, _NoisyConvNd):
             start_reducing_from_iter=start_reducing_from_iter)
 
     def forward(self, input, output_size=None, iter=0):
+        if self.inference_mode and not self.training:
+            return self._get_plain_convolution()(input, output_size=output_size)
+
         output_padding = self._output_padding(input, output_size)
 
-        weight_epsilon = MyTensor(*(self.out_channels, self.in_channels, *self.kernel_size)).normal_()
-        bias_epsilon = MyTensor(self.out_channels).normal_()
+        if self.training:
+            weight_epsilon = MyTensor(*self.weight.size()).normal_()
+            bias_epsilon = MyTensor(self.out_channels).normal_()
 
         if self.bias is not None:
             if self.training:
@@ -1072,10 +1121,14 @@ class NoisyConvTranspose2d(_NoisyConvTransposeMixin, _NoisyConvNd):
             start_reducing_from_iter=start_reducing_from_iter)
 
     def forward(self, input, output_size=None, iter=0):
+        if self.inference_mode and not self.training:
+            return self._get_plain_convolution()(input, output_size=output_size)
+
         output_padding = self._output_padding(input, output_size)
 
-        weight_epsilon = MyTensor(*(self.out_channels, self.in_channels, *self.kernel_size)).normal_()
-        bias_epsilon = MyTensor(self.out_channels).normal_()
+        if self.training:
+            weight_epsilon = MyTensor(*self.weight.size()).normal_()
+            bias_epsilon = MyTensor(self.out_channels).normal_()
 
         if self.bias is not None:
             if self.training:
@@ -1252,11 +1305,15 @@ class NoisyConvTranspose3d(_NoisyConvTransposeMixin, _NoisyConvNd):
             scalar_sigmas=scalar_sigmas, optimize_sigmas=optimize_sigmas, std_init=std_init,
             start_reducing_from_iter=start_reducing_from_iter)
 
-    def forward(self, input, output_size=None):
+    def forward(self, input, output_size=None, iter=0):
+        if self.inference_mode and not self.training:
+            return self._get_plain_convolution()(input, output_size=output_size)
+
         output_padding = self._output_padding(input, output_size)
 
-        weight_epsilon = MyTensor(*(self.out_channels, self.in_channels, *self.kernel_size)).normal_()
-        bias_epsilon = MyTensor(self.out_channels).normal_()
+        if self.training:
+            weight_epsilon = MyTensor(*self.weight.size()).normal_()
+            bias_epsilon = MyTensor(self.out_channels).normal_()
 
         if self.bias is not None:
             if self.training:
@@ -1308,3 +1365,89 @@ class NoisyConvTranspose3d(_NoisyConvTransposeMixin, _NoisyConvNd):
                                       new_bias_value,
                                       self.stride,
                                       self.padding, output_padding, self.groups, self.dilation)
+
+
+def get_fold_key(module):
+    """
+    Returns a key describing the state of the parameters and buffers of a module whose layers were folded for
+    inference (see fold_into_plain_convolution). It changes whenever one of them is changed in place (by an optimizer
+    step, by load_state_dict, or by updating the running statistics of a batch normalization in training mode) or
+    replaced (e.g., when the module is moved to a different device). Changes made through .data are not tracked.
+
+    :param module: module
+    :return: hashable key
+    """
+    return tuple((t._version, t.data_ptr()) for t in list(module.parameters()) + list(module.buffers()))
+
+
+def _plain_convolution_type(conv):
+    dim = len(conv.kernel_size)
+    if dim not in [1, 2, 3]:
+        raise ValueError('Only supported for dimensions 1, 2, and 3')
+    if conv.transposed:
+        return [nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d][dim - 1]
+    else:
+        return [nn.Conv1d, nn.Conv2d, nn.Conv3d][dim - 1]
+
+
+def fold_into_plain_convolution(conv, normalization=None):
+    """
+    Folds the noise-free parameters of a (noisy or plain, possibly transposed) convolution into a plain
+    nn.ConvNd (or nn.ConvTransposeNd) which can be used for inference. If the convolution is followed by a batch
+    normalization which uses running statistics, this normalization is folded into the weights and the bias as well.
+    Instance, layer and group normalizations depend on the input and can hence not be folded.
+
+    :param conv: convolution layer (_NoisyConvNd or nn.ConvNd / nn.ConvTransposeNd)
+    :param normalization: normalization layer following the convolution (or None)
+    :return: tuple of the plain convolution (its parameters do not require gradients) and a flag indicating if the normalization was folded into it
+    """
+
+    fold_normalization = isinstance(normalization, nn.modules.batchnorm._BatchNorm) \
+                         and normalization.track_running_stats and normalization.running_mean is not None
+    with_bias = (conv.bias is not None) or fold_normalization
+
+    if conv.transposed:
+        plain_conv = _plain_convolution_type(conv)(conv.in_channels, conv.out_channels, conv.kernel_size,
+                                                   stride=conv.stride, padding=conv.padding,
+                                                   output_padding=conv.output_padding, groups=conv.groups,
+                                                   bias=with_bias, dilation=conv.dilation)
+    else:
+        plain_conv = _plain_convolution_type(conv)(conv.in_channels, conv.out_channels, conv.kernel_size,
+                                                   stride=conv.stride, padding=conv.padding, dilation=conv.dilation,
+                                                   groups=conv.groups, bias=with_bias)
+    plain_conv = plain_conv.to(device=conv.weight.device, dtype=conv.weight.dtype)
+
+    with torch.no_grad():
+        weight = conv.weight.detach().clone()
+        if conv.bias is not None:
+            bias = conv.bias.detach().clone()
+        else:
+            bias = torch.zeros(conv.out_channels, dtype=weight.dtype, device=weight.device)
+
+        if fold_normalization:
+            # BN(y) = (y-mean)/sqrt(var+eps)*gamma+beta, i.e., a scaling and a shift per output channel
+            scale = torch.rsqrt(normalization.running_var + normalization.eps)
+            if normalization.affine:
+                scale = scale * normalization.weight
+            bias = (bias - normalization.running_mean) * scale
+            if normalization.affine:
+                bias = bias + normalization.bias
+
+            nr_of_kernel_dims = len(conv.kernel_size)
+            if conv.transposed:
+                # weight is in_channels x out_channels/groups x kernel; output channel = group*out_channels/groups + j
+                g = conv.groups
+                sz = weight.size()
+                weight = (weight.view(g, conv.in_channels // g, conv.out_channels // g, *conv.kernel_size)
+                          * scale.view(g, 1, conv.out_channels // g, *([1] * nr_of_kernel_dims))).view(sz)
+            else:
+                weight = weight * scale.view(-1, *([1] * (nr_of_kernel_dims + 1)))
+
+        plain_conv.weight.copy_(weight)
+        if with_bias:
+            plain_conv.bias.copy_(bias)
+
+    for p in plain_conv.parameters():
+        p.requires_grad = False
+
+    return plain_conv, fold_normalization
@@ -1,9 +1,50 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from collections import OrderedDict
+import numpy as np
 import torch
 import os
 
 from . import fileio as FIO
 
+
+def get_bucket_size(sz, canonical_sizes=None, pad_to_multiple_of=1):
+    """
+    Returns the (spatial) size an image is padded to. This is the smallest canonical size (by number of voxels)
+    which contains the image or, if there is none, the size rounded up to a multiple of pad_to_multiple_of.
+
+    :param sz: spatial size of the image [X,Y,Z]
+    :param canonical_sizes: list of canonical spatial sizes (or None)
+    :param pad_to_multiple_of: sizes are rounded up to a multiple of this value if no canonical size fits (1 keeps the size)
+    :return: tuple with the spatial size of the bucket
+    """
+    sz = [int(v) for v in sz]
+    if canonical_sizes is not None:
+        candidates = [c for c in canonical_sizes if len(c)==len(sz) and all(int(c[d])>=sz[d] for d in range(len(sz)))]
+        if len(candidates)>0:
+            return tuple(int(v) for v in min(candidates, key=lambda c: np.prod(c)))
+    m = int(pad_to_multiple_of)
+    return tuple(((v+m-1)//m)*m for v in sz)
+
+
+def pad_image_to_size(I, sz):
+    """
+    Pads an image with zeros at the end of each spatial dimension (so the coordinates of the image voxels do not change)
+
+    :param I: image (numpy array), format CxXxYxZ
+    :param sz: desired spatial size [X,Y,Z]
+    :return: tuple (padded image, mask), the mask (format 1xXxYxZ) is one on the voxels of the original image
+    """
+    dim = len(sz)
+    image_sz = I.shape[-dim:]
+    if any(int(sz[d])<image_sz[d] for d in range(dim)):
+        raise ValueError('Cannot pad an image of size {} to the smaller size {}'.format(list(image_sz),list(sz)))
+
+    padding = [(0,0)]*(I.ndim-dim) + [(0,int(sz[d])-image_sz[d]) for d in range(dim)]
+    mask = np.zeros([1]+[int(v) for v in sz],dtype=I.dtype)
+    mask[(slice(None),)+tuple(slice(0,v) for v in image_sz)] = 1
+    return np.pad(I,padding,mode='constant'), mask
+
+
 class PairwiseRegistrationDataset(Dataset):
     """keeps track of pairwise image as well as checkpoints for their parameters"""
 
@@ -70,4 +111,128 @@ class PairwiseRegistrationDataset(Dataset):
         sample['ISource'] = ISource[0,...] # as we only loaded a batch-of-one we remove the first dimension
         sample['ITarget'] = ITarget[0,...] # as we only loaded a batch-of-one we remove the first dimension
 
-        return sample
\ No newline at end of file
+        return sample
+
+
+class SizeBucketedPairwiseRegistrationDataset(PairwiseRegistrationDataset):
+    """
+    Pairwise registration dataset for pairs of different sizes. The pairs are grouped into buckets of equal (padded)
+    size and equal physical spacing; the images of a pair are padded (with zeros) to the size of their bucket. If the
+    spacing is normalized, it is normalized for the padded size of the bucket (and not for the size of the individual
+    images, which would differ for images of different sizes). Each sample contains the bucket number and a mask of the
+    (unpadded) target image, so that padded voxels can be excluded from the similarity measure. The images are read
+    once on construction to determine their sizes.
+
+    Settings in json::
+
+        "data_loader": {
+            "bucketing": {
+                "canonical_sizes": [[128,128],[256,256]],
+                "pad_to_multiple_of": 1
+            }
+    """
+
+    def __init__(self, output_directory, source_image_filenames, target_image_filenames, params):
+
+        super(SizeBucketedPairwiseRegistrationDataset, self).__init__(output_directory, source_image_filenames, target_image_filenames, params)
+
+        bparams = self.params['data_loader'][('bucketing', {}, 'settings for grouping pairs of different sizes into buckets')]
+        self.canonical_sizes = bparams[('canonical_sizes', [], 'spatial sizes pairs are padded to (the smallest one which fits is used); if empty pairs are only padded as specified by pad_to_multiple_of')]
+        self.pad_to_multiple_of = bparams[('pad_to_multiple_of', 1, 'sizes which do not fit any canonical size are rounded up to a multiple of this value; 1 groups pairs of identical size only')]
+
+        self.buckets = OrderedDict()
+        """maps (spatial size, physical spacing) of a bucket to the indices of its pairs"""
+        self.bucket_of_pair = []
+        """bucket number of each pair"""
+
+        im_io = FIO.ImageIO()
+        for idx in range(len(self)):
+            current_source_filename, current_target_filename = self._get_source_target_image_filenames(idx)
+            sizes = []
+            spacings = []
+            for filename in [current_source_filename, current_target_filename]:
+                # the physical spacing (normalizing it here would depend on the size of the individual image)
+                I,_,_,spacing = im_io.read_to_nc_format(filename,
+                                                        squeeze_image=self.squeeze_image,
+                                                        normalize_spacing=False,
+                                                        silent_mode=True)
+                sizes.append(I.shape[2:])
+                spacings.append(tuple(np.round(np.array(spacing,dtype='float64'),decimals=8)))
+            if spacings[0]!=spacings[1]:
+                raise ValueError('Source and target image of pair {} need to have the same spacing'.format(idx))
+
+            sz = np.maximum(np.array(sizes[0]),np.array(sizes[1]))
+            key = (get_bucket_size(sz,self.canonical_sizes,self.pad_to_multiple_of), spacings[0])
+            if key not in self.buckets:
+                self.buckets[key] = []
+            self.buckets[key].append(idx)
+            self.bucket_of_pair.append(list(self.buckets.keys()).index(key))
+
+        print('INFO: grouped {} pairs into {} buckets of sizes {}'.format(len(self),len(self.buckets),[list(k[0]) for k in self.buckets]))
+
+    def get_buckets(self):
+        """
+        Returns the indices of the pairs of each bucket
+
+        :return: list with a list of pair indices for each bucket
+        """
+        return list(self.buckets.values())
+
+    def get_bucket_spacing(self, bucket_nr):
+        """
+        Returns the spacing of the (padded) images of a bucket; it is normalized for the size of the bucket if the
+        spacing is normalized
+
+        :param bucket_nr: bucket number
+        :return: spacing (numpy array)
+        """
+        bucket_sz, spacing = list(self.buckets.keys())[bucket_nr]
+        spacing = np.array(spacing)
+        if self.normalize_spacing:
+            spacing = FIO.ImageIO()._normalize_spacing(spacing, bucket_sz, silent_mode=True)
+        return spacing
+
+    def __getitem__(self,idx):
+
+        sample = super(SizeBucketedPairwiseRegistrationDataset, self).__getitem__(idx)
+
+        bucket_nr = self.bucket_of_pair[idx]
+        bucket_sz = list(self.buckets.keys())[bucket_nr][0]
+        sample['ISource'],_ = pad_image_to_size(sample['ISource'],bucket_sz)
+        sample['ITarget'],sample['mask'] = pad_image_to_size(sample['ITarget'],bucket_sz)
+        sample['bucket'] = bucket_nr
+
+        return sample
+
+
+class RoundRobinBucketBatchSampler(Sampler):
+    """
+    Batch sampler which only batches pairs of the same bucket. The batches of the buckets are drawn in turns
+    (round-robin), so that all buckets (and hence all models) are updated at a similar rate. The last batch of a
+    bucket may be smaller than the batch size.
+    """
+
+    def __init__(self, buckets, batch_size, shuffle=True):
+        """
+        :param buckets: list with a list of (dataset) indices for each bucket
+        :param batch_size: maximal number of pairs per batch
+        :param shuffle: if True the pairs of each bucket are shuffled in every epoch
+        """
+        self.buckets = buckets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def _get_batches_of_bucket(self, bucket):
+        if self.shuffle:
+            bucket = [bucket[i] for i in torch.randperm(len(bucket)).tolist()]
+        return [bucket[i:i+self.batch_size] for i in range(0,len(bucket),self.batch_size)]
+
+    def __iter__(self):
+        batches = [self._get_batches_of_bucket(bucket) for bucket in self.buckets]
+        for i in range(max(len(b) for b in batches)):
+            for bucket_batches in batches:
+                if i<len(bucket_batches):
+                    yield bucket_batches[i]
+
+    def __len__(self):
+        return sum((len(bucket)+self.batch_size-1)//self.batch_size for bucket in self.buckets)
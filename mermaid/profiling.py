@@ -0,0 +1,248 @@
+"""
+Opt-in per-phase timing and memory instrumentation for the registration optimizers.
+
+Phases are marked with :func:`phase` (or :meth:`PhaseProfiler.phase`). If no profiler is active these calls return
+a shared no-op context, i.e., the instrumentation does not synchronize, allocate or record anything.
+For an active profiler each phase records
+
+* the wall time (on the host; CUDA kernels run asynchronously, hence see also the CUDA time),
+* the CUDA-event time (elapsed GPU time between events recorded at the start and the end of the phase),
+* the peak allocated CUDA memory within the phase,
+
+accumulated per iteration. Phases may be nested (times of nested phases are included in the time of the
+enclosing phase). Optionally all phase events can be exported as a Chrome trace (chrome://tracing).
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import time
+
+import torch
+
+from .data_wrapper import USE_CUDA
+
+
+class _NullPhase(object):
+    """
+    No-op phase which is used if profiling is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_phase = _NullPhase()
+
+_active_profiler = None
+
+
+def set_active_profiler(profiler):
+    """
+    Sets the profiler which is used by :func:`phase`
+
+    :param profiler: PhaseProfiler instance or None (to disable profiling)
+    :return: the previously active profiler (so it can be restored)
+    """
+    global _active_profiler
+    previous_profiler = _active_profiler
+    _active_profiler = profiler
+    return previous_profiler
+
+
+def get_active_profiler():
+    """
+    Returns the currently active profiler
+
+    :return: PhaseProfiler instance or None
+    """
+    return _active_profiler
+
+
+def phase(name):
+    """
+    Marks a phase for the currently active profiler; to be used as a context manager, e.g.,
+
+    .. code:: python
+
+        with profiling.phase('similarity'):
+            sim = ...
+
+    :param name: name of the phase
+    :return: context manager (no-op if there is no active and enabled profiler)
+    """
+    if _active_profiler is None:
+        return _null_phase
+    else:
+        return _active_profiler.phase(name)
+
+
+class _Activation(object):
+    """
+    Makes a profiler the active profiler (used by :func:`phase`) for the duration of a with block
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.previous_profiler = None
+
+    def __enter__(self):
+        self.previous_profiler = set_active_profiler(self.profiler)
+        return self.profiler
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        set_active_profiler(self.previous_profiler)
+        return False
+
+
+class _Phase(object):
+    """
+    Records a single occurrence of a phase
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start_wall_time = None
+        self.wall_time = None
+        self.start_event = None
+        self.end_event = None
+        self.peak_memory = 0
+
+    def __enter__(self):
+        self.profiler._enter_phase(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler._exit_phase(self)
+        return False
+
+
+class PhaseProfiler(object):
+    """
+    Records wall time, CUDA-event time and peak memory for (possibly nested) phases, accumulated per iteration
+    """
+
+    def __init__(self, enabled=False, record_chrome_trace=False):
+        """
+        Constructor
+
+        :param enabled: if False all phases are no-ops
+        :param record_chrome_trace: if True the individual phase events are kept so that they can be exported as a Chrome trace
+        """
+        self.enabled = enabled
+        """if set to False no instrumentation is performed"""
+        self.record_chrome_trace = record_chrome_trace
+        """if set to True all phase events are kept for the Chrome trace export"""
+        self.use_cuda = USE_CUDA
+        """CUDA-event times and memory are only recorded if the computations run on the GPU (see CUDA_ON)"""
+
+        self._phase_stack = []
+        self._finished_phases = []
+        self._trace_events = []
+        self._start_time = time.perf_counter()
+        self.iteration = 0
+        """current iteration"""
+
+    def phase(self, name):
+        """
+        Creates a phase which is to be used as a context manager
+
+        :param name: name of the phase
+        :return: context manager
+        """
+        if not self.enabled:
+            return _null_phase
+        else:
+            return _Phase(self, name)
+
+    def activate(self):
+        """
+        Makes this profiler the active one (so that phases marked via :func:`phase` are recorded); to be used as a context manager
+
+        :return: context manager (no-op if the profiler is disabled)
+        """
+        if not self.enabled:
+            return _null_phase
+        else:
+            return _Activation(self)
+
+    def _enter_phase(self, p):
+        if self.use_cuda:
+            if len(self._phase_stack) > 0:
+                # peak memory of the enclosing phase up to now (as the statistics are reset for the nested phase)
+                parent = self._phase_stack[-1]
+                parent.peak_memory = max(parent.peak_memory, torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+            p.start_event = torch.cuda.Event(enable_timing=True)
+            p.end_event = torch.cuda.Event(enable_timing=True)
+            p.start_event.record()
+        self._phase_stack.append(p)
+        p.start_wall_time = time.perf_counter()
+
+    def _exit_phase(self, p):
+        p.wall_time = time.perf_counter() - p.start_wall_time
+        if self.use_cuda:
+            p.end_event.record()
+            p.peak_memory = max(p.peak_memory, torch.cuda.max_memory_allocated())
+        self._phase_stack.pop()
+        if len(self._phase_stack) > 0:
+            # memory used by the nested phase also counts for the enclosing phase
+            parent = self._phase_stack[-1]
+            parent.peak_memory = max(parent.peak_memory, p.peak_memory)
+        self._finished_phases.append(p)
+
+    def end_iteration(self):
+        """
+        Finishes an iteration. Synchronizes (once) to resolve the CUDA-event times and returns the accumulated statistics.
+
+        :return: dictionary phase name -> dictionary with 'count', 'wall_time' [s], 'cuda_time' [s] and 'peak_memory' [bytes]
+        """
+        if not self.enabled:
+            return dict()
+
+        if self.use_cuda:
+            torch.cuda.synchronize()
+
+        stats = dict()
+        for p in self._finished_phases:
+            if p.start_event is not None:
+                cuda_time = p.start_event.elapsed_time(p.end_event) / 1000.
+            else:
+                cuda_time = 0.
+
+            if p.name not in stats:
+                stats[p.name] = {'count': 0, 'wall_time': 0., 'cuda_time': 0., 'peak_memory': 0}
+            s = stats[p.name]
+            s['count'] += 1
+            s['wall_time'] += p.wall_time
+            s['cuda_time'] += cuda_time
+            s['peak_memory'] = max(s['peak_memory'], p.peak_memory)
+
+            if self.record_chrome_trace:
+                self._trace_events.append({'name': p.name, 'cat': 'registration', 'ph': 'X',
+                                           'ts': (p.start_wall_time - self._start_time) * 1e6,
+                                           'dur': p.wall_time * 1e6,
+                                           'pid': 0, 'tid': 0,
+                                           'args': {'iteration': self.iteration,
+                                                    'cuda_time_ms': cuda_time * 1000.,
+                                                    'peak_memory_bytes': p.peak_memory}})
+
+        self._finished_phases = []
+        self.iteration += 1
+
+        return stats
+
+    def export_chrome_trace(self, filename):
+        """
+        Writes the recorded phase events in the Chrome trace format (can be opened via chrome://tracing)
+
+        :param filename: output filename (json)
+        """
+        if not self.record_chrome_trace:
+            print('WARNING: Chrome trace recording was not enabled; trace will be empty')
+
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self._trace_events, 'displayTimeUnit': 'ms'}, f)
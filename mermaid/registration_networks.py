@@ -28,7 +28,7 @@ from mermaid.deep_smoothers import stable_softmax
 from . import rungekutta_integrators as RK
 
 from . import forward_models as FM
-from .data_wrapper import AdaptVal
+from .data_wrapper import AdaptVal, amp_autocast, FP32Val
 from . import regularizer_factory as RF
 from . import similarity_measure_factory as SM
 
@@ -37,6 +37,7 @@ from . import image_sampling as IS
 from . import ode_int as ODE
 from .data_wrapper import MyTensor
 from . import utils
+from . import profiling
 import collections
 
 from abc import ABCMeta, abstractmethod
@@ -748,6 +749,8 @@ class RegistrationLoss(with_metaclass(ABCMeta, nn.Module)):
         """factory to create similarity measures on the fly"""
         self.similarityMeasure = None
         """the similarity measure itself"""
+        self.similarity_mask = None
+        """if not None, the similarity measure is only evaluated on the voxels of this mask (of size sz_sim)"""
 
         self._default_dictionary_to_pass_to_smoother = dict()
         self.env = params[('env', {},
@@ -776,6 +779,14 @@ class RegistrationLoss(with_metaclass(ABCMeta, nn.Module)):
 
         return self._default_dictionary_to_pass_to_smoother
 
+    def set_similarity_mask(self, mask):
+        """
+        Restricts the similarity measure to the voxels of a mask (see SimilarityMeasure.compute_similarity_multiNC_in_mask)
+
+        :param mask: mask of format BxCxXxYxZ (of the size of the similarity measure; B and C may be one) or None to use all voxels
+        """
+        self.similarity_mask = mask
+
     def add_similarity_measure(self, simName, simMeasure):
         """
         To add a custom similarity measure to the similarity measure factory
@@ -800,8 +811,13 @@ class RegistrationLoss(with_metaclass(ABCMeta, nn.Module)):
         """
         if self.similarityMeasure is None:
             self.similarityMeasure = self.smFactory.create_similarity_measure(self.params)
-        sim = self.similarityMeasure.compute_similarity_multiNC(I1_warped, I1_target, I0_source, phi)
-        return sim
+        # the similarity measure may be evaluated in mixed precision, but the energy is always returned in float32
+        with profiling.phase('similarity'), amp_autocast():
+            if self.similarity_mask is None:
+                sim = self.similarityMeasure.compute_similarity_multiNC(I1_warped, I1_target, I0_source, phi)
+            else:
+                sim = self.similarityMeasure.compute_similarity_multiNC_in_mask(I1_warped, I1_target, self.similarity_mask, I0_source, phi)
+        return FP32Val(sim)
 
     @abstractmethod
     def compute_regularization_energy(self, I0_source, variables_from_forward_model=None,
@@ -839,7 +855,8 @@ class RegistrationImageLoss(RegistrationLoss):
         """
         sim = self.compute_similarity_energy(I1_warped, I1_target, I0_source, None, variables_from_forward_model,
                                              variables_from_optimizer)
-        reg = self.compute_regularization_energy(I0_source, variables_from_forward_model, variables_from_optimizer)
+        with profiling.phase('regularization'):
+            reg = FP32Val(self.compute_regularization_energy(I0_source, variables_from_forward_model, variables_from_optimizer))
         energy = sim + reg
 
         # saveguard against infinity
@@ -899,15 +916,17 @@ class RegistrationMapLoss(RegistrationLoss):
         :return: registration energy
         """
         # print(I0_source.shape)
-        I1_warped = utils.compute_warped_image_multiNC(I0_source, phi1, self.spacing_sim, self.spline_order,
-                                                       zero_boundary=True)
+        with profiling.phase('warping'):
+            I1_warped = utils.compute_warped_image_multiNC(I0_source, phi1, self.spacing_sim, self.spline_order,
+                                                           zero_boundary=True)
         sim = self.compute_similarity_energy(I1_warped, I1_target, I0_source, phi1, variables_from_forward_model,
                                              variables_from_optimizer)
-        if lowres_I0 is not None:
-            # todo the lowes_I0 is not used when we compute adaptive method, maybe we should remove this and only compute on full resolution
-            reg = self.compute_regularization_energy(lowres_I0, variables_from_forward_model, variables_from_optimizer)
-        else:
-            reg = self.compute_regularization_energy(I0_source, variables_from_forward_model, variables_from_optimizer)
+        with profiling.phase('regularization'):
+            if lowres_I0 is not None:
+                # todo the lowes_I0 is not used when we compute adaptive method, maybe we should remove this and only compute on full resolution
+                reg = FP32Val(self.compute_regularization_energy(lowres_I0, variables_from_forward_model, variables_from_optimizer))
+            else:
+                reg = FP32Val(self.compute_regularization_energy(I0_source, variables_from_forward_model, variables_from_optimizer))
 
         if self.limit_displacement:
             # first compute squared displacement
@@ -1277,6 +1296,18 @@ class AffineMapNet(RegistrationNet):
         phi1 = utils.apply_affine_transform_to_map_multiNC(self.Ab, phi)
         return phi1
 
+    def warp_image(self, I0_source, spline_order=1, zero_boundary=True):
+        """
+        Warps an image by the current affine transform directly (i.e., without creating and transforming a dense map);
+        equivalent to warping with the map returned by forward for an identity initial map
+
+        :param I0_source: source image, format BxCxXxYxZ
+        :param spline_order: spline order for the interpolation
+        :param zero_boundary: if True the image is zero outside of its domain
+        :return: returns the warped image
+        """
+        return utils.compute_affine_warped_image_multiNC(I0_source, self.Ab, self.spacing, spline_order, zero_boundary=zero_boundary)
+
 
 class AffineMapLoss(RegistrationMapLoss):
     """
@@ -2227,7 +2258,7 @@ class OneStepMapNet(ShootingVectorMomentumNet):
         self.compute_inverse_map = compute_inverse_map
         """If set to True the inverse map is computed on the fly"""
         super(OneStepMapNet, self).__init__(sz, spacing, params)
-        self.identity_map = AdaptVal(torch.from_numpy(utils.identity_map_multiN(sz, spacing)))
+        self.identity_map = utils._get_shared_identity_map(sz, spacing)
         self.spacing = spacing
         self.integrator = self.create_integrator()
         """integrator to solve EPDiff variant"""
@@ -0,0 +1,447 @@
+"""
+Long-lived local registration service (localhost HTTP) which keeps registration models warm.
+
+Starting a registration through :mod:`mermaid.simple_interface` pays for the Python imports, loading of the settings,
+the model construction (smoothers, Gaussian Fourier filters, identity maps) and the CUDA initialization. The server
+pays these costs once: it keeps a :class:`mermaid.simple_interface.RegistrationSession` per (model, size, spacing) and
+reuses it for all requests of this kind. Requests are queued and requests of compatible size are collected into batches,
+which a single worker thread (which owns the GPU) registers with the same warm session. The image pairs of a batch are
+registered one after the other, i.e., each pair is optimized on its own energy (with its own step sizes and stopping),
+so that its result does not depend on the requests it was batched with.
+
+Requests are posted to /register as npz archives (see :class:`RegistrationClient`), containing
+
+* 'source' and 'target': the images (BxCxXxYxZ format),
+* 'spacing': the image spacing,
+* 'model_name' (optional): name of the registration model (otherwise the default model of the server is used).
+
+The response is an npz archive with 'warped_image', and, for map-based models, 'phi' (and 'phi_inverse' if the
+inverse map is computed). A GET on /status returns the state of the server as json.
+
+The server can also be started from the command line:
+
+.. code:: bash
+
+    python -m mermaid.registration_server --port 8765 --model_name lddmm_shooting_map --nr_of_iterations 50
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import copy
+import io
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+try:
+    import queue
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from http.client import HTTPConnection
+except ImportError:
+    import Queue as queue
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from httplib import HTTPConnection
+
+import numpy as np
+
+from . import module_parameters as pars
+from . import simple_interface as SI
+
+
+def _arrays_to_npz_bytes(arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def _npz_bytes_to_arrays(data):
+    with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+        return dict((key, npz[key]) for key in npz.files)
+
+
+class _PendingRequest(object):
+    """
+    A queued registration request; the handler thread waits until the worker has filled in the result
+    """
+
+    def __init__(self, ISource, ITarget, spacing, model_name):
+        self.ISource = ISource
+        self.ITarget = ITarget
+        self.spacing = spacing
+        self.model_name = model_name
+        self.key = (model_name, tuple(ISource.shape[1:]), tuple(float(s) for s in spacing))
+        """requests with the same key can be registered with the same session (independent of their number of pairs)"""
+        self.batch_size = ISource.shape[0]
+
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        if self.server.registration_server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            status = self.server.registration_server.get_status()
+            self._send(200, 'application/json', json.dumps(status).encode('utf-8'))
+        else:
+            self._send(404, 'text/plain', b'unknown path')
+
+    def do_POST(self):
+        if self.path != '/register':
+            self._send(404, 'text/plain', b'unknown path')
+            return
+
+        # any failure to parse or queue the request is due to a malformed request (e.g., no npz data or missing
+        # arrays); failures of the registration itself are reported as server errors below
+        try:
+            length = int(self.headers['Content-Length'])
+            arrays = _npz_bytes_to_arrays(self.rfile.read(length))
+            model_name = str(arrays['model_name']) if 'model_name' in arrays else None
+            request = self.server.registration_server.submit(arrays['source'], arrays['target'], arrays['spacing'], model_name)
+        except Exception as e:
+            self._send(400, 'text/plain', '{}: {}'.format(type(e).__name__, e).encode('utf-8'))
+            return
+
+        request.done.wait()
+
+        if request.error is not None:
+            self._send(500, 'text/plain', request.error.encode('utf-8'))
+        else:
+            self._send(200, 'application/octet-stream', _arrays_to_npz_bytes(request.result))
+
+
+class RegistrationServer(object):
+    """
+    Local registration server which keeps registration sessions (models, filters, identity maps) warm per
+    (model, size, spacing) and registers queued requests of compatible size in batches
+    """
+
+    def __init__(self, host='localhost', port=0, model_name='lddmm_shooting_map', params=None, session_settings=None,
+                 max_batch_size=4, batch_timeout=0.05, max_nr_of_sessions=4, verbose=False):
+        """
+        Constructor
+
+        :param host: host to listen on (should be a local address)
+        :param port: port to listen on; if 0 a free port is chosen (see get_address)
+        :param model_name: default registration model (if not specified by a request)
+        :param params: parameter structure (ParameterDict) or filename to load the settings from; each session gets its own copy
+        :param session_settings: dictionary of additional keyword arguments for the registration sessions (e.g., {'nr_of_iterations': 50})
+        :param max_batch_size: maximal number of image pairs which are collected into a batch (the pairs of a batch are
+            registered one after the other with the same session; each pair is optimized on its own)
+        :param batch_timeout: time [s] the worker waits for further compatible requests before it starts a batch
+        :param max_nr_of_sessions: number of sessions which are kept; the least recently used one is dropped
+        :param verbose: if set to True the individual http requests are logged
+        """
+
+        self.model_name = model_name
+        self.params = params
+        self.session_settings = session_settings if session_settings is not None else dict()
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.max_nr_of_sessions = max_nr_of_sessions
+        self.verbose = verbose
+
+        self._sessions = OrderedDict()
+        self._queue = queue.Queue()
+        self._deferred = deque()
+        """requests which were taken from the queue but were not compatible with the batch being assembled"""
+        self._stop_requested = False
+        self.nr_of_registered_pairs = 0
+        self.nr_of_batches = 0
+
+        self._http_server = _ThreadingHTTPServer((host, port), _RequestHandler)
+        self._http_server.registration_server = self
+        self._http_thread = None
+        self._worker_thread = None
+
+    def get_address(self):
+        """
+        Returns the address the server is listening on
+
+        :return: tuple (host, port)
+        """
+        return self._http_server.server_address[:2]
+
+    def get_status(self):
+        """
+        Returns the state of the server
+
+        :return: dictionary
+        """
+        return {'sessions': [{'model_name': key[0], 'size': list(key[1]), 'spacing': list(key[2])} for key in list(self._sessions.keys())],
+                'queued_requests': self._queue.qsize() + len(self._deferred),
+                'nr_of_registered_pairs': self.nr_of_registered_pairs,
+                'nr_of_batches': self.nr_of_batches}
+
+    def start(self):
+        """
+        Starts the http server and the registration worker in background threads
+
+        :return: tuple (host, port) the server is listening on
+        """
+        self._stop_requested = False
+        self._worker_thread = threading.Thread(target=self._work)
+        self._worker_thread.daemon = True
+        self._worker_thread.start()
+        self._http_thread = threading.Thread(target=self._http_server.serve_forever)
+        self._http_thread.daemon = True
+        self._http_thread.start()
+        return self.get_address()
+
+    def serve_forever(self):
+        """
+        Starts the server and blocks until it is interrupted
+        """
+        host, port = self.start()
+        print('INFO: registration server listening on http://{}:{}'.format(host, port))
+        try:
+            while self._http_thread.is_alive():
+                self._http_thread.join(1.)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stops the server; queued requests are still processed by the worker
+        """
+        if self._http_thread is not None:
+            self._http_server.shutdown()
+        self._http_server.server_close()
+        self._stop_requested = True
+        self._queue.put(None)
+        if self._worker_thread is not None:
+            self._worker_thread.join()
+
+    def submit(self, ISource, ITarget, spacing, model_name=None):
+        """
+        Queues a registration request
+
+        :param ISource: source image (BxCxXxYxZ format)
+        :param ITarget: target image (of the same size as the source image)
+        :param spacing: image spacing
+        :param model_name: name of the registration model; if None the default model of the server is used
+        :return: request; its done event is set once the result (or error) is available
+        """
+        if ISource.shape != ITarget.shape:
+            raise ValueError('Source and target image need to be of the same size')
+        if len(spacing) != ISource.ndim - 2:
+            raise ValueError('Spacing needs to be given for each spatial dimension')
+        if model_name is None:
+            model_name = self.model_name
+
+        request = _PendingRequest(ISource.astype('float32'), ITarget.astype('float32'), np.array(spacing, dtype='float64'), model_name)
+        self._queue.put(request)
+        return request
+
+    def _get_session(self, model_name, sz, spacing):
+        """
+        Returns the session for a model, image size and spacing (which is created if needed)
+
+        :param model_name: name of the registration model
+        :param sz: size of the images without the batch dimension (CxXxYxZ); the session registers one pair at a time
+        :param spacing: image spacing
+        :return: registration session
+        """
+        key = (model_name, tuple(int(v) for v in sz), tuple(float(s) for s in spacing))
+        if key in self._sessions:
+            self._sessions[key] = self._sessions.pop(key)  # most recently used
+        else:
+            if len(self._sessions) >= self.max_nr_of_sessions:
+                self._sessions.popitem(last=False)
+            if self.params is None:
+                params = pars.ParameterDict()
+            elif type(self.params) == pars.ParameterDict:
+                params = copy.deepcopy(self.params)
+            else:
+                params = pars.ParameterDict()
+                params.load_JSON(self.params)
+            self._sessions[key] = SI.RegistrationSession([1] + list(sz), spacing, model_name=model_name, params=params, **self.session_settings)
+        return self._sessions[key]
+
+    def _next_batch(self):
+        """
+        Waits for the next request and collects compatible requests (up to max_batch_size image pairs)
+
+        :return: list of requests or None if the server is stopped
+        """
+        if len(self._deferred) > 0:
+            first = self._deferred.popleft()
+        else:
+            first = self._queue.get()
+            if first is None:
+                return None
+
+        batch = [first]
+        nr_of_pairs = first.batch_size
+
+        still_deferred = deque()
+        for request in self._deferred:
+            if request.key == first.key and nr_of_pairs + request.batch_size <= self.max_batch_size:
+                batch.append(request)
+                nr_of_pairs += request.batch_size
+            else:
+                still_deferred.append(request)
+        self._deferred = still_deferred
+
+        deadline = time.time() + self.batch_timeout
+        while nr_of_pairs < self.max_batch_size and not self._stop_requested:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # keep the stop signal for the next round
+                self._queue.put(None)
+                break
+            if request.key == first.key and nr_of_pairs + request.batch_size <= self.max_batch_size:
+                batch.append(request)
+                nr_of_pairs += request.batch_size
+            else:
+                self._deferred.append(request)
+
+        return batch
+
+    def _register_request(self, session, request):
+        """
+        Registers the image pairs of a request one after the other
+
+        :param session: registration session (for a single image pair)
+        :param request: pending request; its result is filled in
+        """
+        outputs = OrderedDict()
+        for n in range(request.batch_size):
+            warped_image, phi, phi_inverse = session.register(request.ISource[n:n+1], request.ITarget[n:n+1])
+            for name, value in [('warped_image', warped_image), ('phi', phi), ('phi_inverse', phi_inverse)]:
+                if value is not None:
+                    outputs.setdefault(name, []).append(value.cpu().numpy())
+        request.result = dict((name, np.concatenate(values, axis=0)) for name, values in outputs.items())
+        self.nr_of_registered_pairs += request.batch_size
+
+    def _register_batch(self, batch):
+        session = self._get_session(batch[0].model_name, batch[0].ISource.shape[1:], batch[0].spacing)
+        for request in batch:
+            try:
+                self._register_request(session, request)
+            except Exception as e:
+                request.error = '{}: {}'.format(type(e).__name__, e)
+        self.nr_of_batches += 1
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                self._register_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = '{}: {}'.format(type(e).__name__, e)
+            finally:
+                for request in batch:
+                    request.done.set()
+
+
+class RegistrationClient(object):
+    """
+    Client for the local registration server
+    """
+
+    def __init__(self, host='localhost', port=8765, timeout=None):
+        """
+        Constructor
+
+        :param host: host of the registration server
+        :param port: port of the registration server
+        :param timeout: timeout [s] for a request; None waits until the registration is done
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def _request(self, method, path, body=None):
+        connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body=body)
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise ValueError('Registration server error ({}): {}'.format(response.status, data.decode('utf-8')))
+        return data
+
+    def get_status(self):
+        """
+        Returns the state of the server
+
+        :return: dictionary
+        """
+        return json.loads(self._request('GET', '/status').decode('utf-8'))
+
+    def register(self, ISource, ITarget, spacing, model_name=None):
+        """
+        Registers an image pair
+
+        :param ISource: source image (BxCxXxYxZ format, numpy array)
+        :param ITarget: target image (BxCxXxYxZ format, numpy array)
+        :param spacing: image spacing
+        :param model_name: name of the registration model; if None the default model of the server is used
+        :return: tuple (warped image, map, inverse map) as numpy arrays; map and inverse map are None if not available
+        """
+        arrays = {'source': np.asarray(ISource), 'target': np.asarray(ITarget), 'spacing': np.asarray(spacing)}
+        if model_name is not None:
+            arrays['model_name'] = np.array(model_name)
+
+        result = _npz_bytes_to_arrays(self._request('POST', '/register', _arrays_to_npz_bytes(arrays)))
+        return result['warped_image'], result.get('phi'), result.get('phi_inverse')
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local registration server which keeps registration models warm.')
+
+    parser.add_argument('--host', required=False, type=str, default='localhost', help='Host to listen on')
+    parser.add_argument('--port', required=False, type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--model_name', required=False, type=str, default='lddmm_shooting_map', help='Default registration model')
+    parser.add_argument('--config', required=False, type=str, default=None, help='JSON settings file for the registrations')
+    parser.add_argument('--nr_of_iterations', required=False, type=int, default=None, help='Number of iterations per registration')
+    parser.add_argument('--max_batch_size', required=False, type=int, default=4, help='Maximal number of image pairs registered together')
+    parser.add_argument('--batch_timeout', required=False, type=float, default=0.05, help='Time [s] to wait for compatible requests to form a batch')
+    parser.add_argument('--verbose', action='store_true', help='Logs the individual http requests')
+
+    args = parser.parse_args()
+
+    session_settings = dict()
+    if args.nr_of_iterations is not None:
+        session_settings['nr_of_iterations'] = args.nr_of_iterations
+
+    server = RegistrationServer(host=args.host, port=args.port, model_name=args.model_name, params=args.config,
+                                session_settings=session_settings, max_batch_size=args.max_batch_size,
+                                batch_timeout=args.batch_timeout, verbose=args.verbose)
+    server.serve_forever()
@@ -10,6 +10,7 @@ from abc import ABCMeta, abstractmethod
 import torch
 
 from . import finite_differences as fd
+from . import spectral_operators as SO
 from .data_wrapper import MyTensor
 from future.utils import with_metaclass
 
@@ -40,10 +41,30 @@ class Regularizer(with_metaclass(ABCMeta, object)):
     def _compute_regularizer(self, v):
         pass
 
-    def compute_regularizer_multiN(self, v):
+    def _compute_regularizer_multiN(self, v):
         """
-        Compute a regularized vector field
-        
+        Computes the regularizer energy for all images and vector field components at once (in one tensor expression).
+        Derived classes which support this override this method.
+
+        :param v: Input vector field, BxdimxXxYxZ
+        :return: Regularizer energy or None if not supported (the energy is then computed image by image)
+        """
+        return None
+
+    def _all_components(self, v):
+        """
+        Returns a view of the vector field in which all components of all images are stacked along the first dimension,
+        i.e., of size (B*dim)xXxYxZ, which is the batch format of the finite difference operators
+
+        :param v: Input vector field, BxdimxXxYxZ
+        :return: stacked components
+        """
+        return v.reshape([-1] + list(v.size()[2:]))
+
+    def compute_regularizer_multiN_by_looping(self, v):
+        """
+        Compute the regularizer energy image by image (reference implementation)
+
         :param v: Input vector field
         :return: Regularizer energy
         """
@@ -53,6 +74,22 @@ class Regularizer(with_metaclass(ABCMeta, object)):
             reg = reg + self._compute_regularizer(v[nrI, ...])
         return reg
 
+    def compute_regularizer_multiN(self, v):
+        """
+        Compute a regularized vector field
+        
+        :param v: Input vector field
+        :return: Regularizer energy
+        """
+        if self.dim not in [1, 2, 3]:
+            raise ValueError('Regularizer is currently only supported in dimensions 1 to 3')
+
+        reg = self._compute_regularizer_multiN(v)
+        if reg is None:
+            return self.compute_regularizer_multiN_by_looping(v)
+        else:
+            return reg.reshape(1)
+
 
 class DiffusionRegularizer(Regularizer):
     """
@@ -68,6 +105,15 @@ class DiffusionRegularizer(Regularizer):
         """
         super(DiffusionRegularizer, self).__init__(spacing, params)
 
+    def _compute_regularizer_multiN(self, v):
+        d = self._all_components(v)
+        energy = self.fdt.dXc(d) ** 2
+        if self.dim > 1:
+            energy = energy + self.fdt.dYc(d) ** 2
+        if self.dim > 2:
+            energy = energy + self.fdt.dZc(d) ** 2
+        return energy.sum() * self.volumeElement
+
     def _compute_regularizer(self, d):
         # just do the standard component-wise norm of gradient squared
 
@@ -118,6 +164,13 @@ class CurvatureRegularizer(Regularizer):
         """
         super(CurvatureRegularizer, self).__init__(spacing, params)
 
+    def _compute_regularizer_multiN(self, v):
+        energy = (self.fdt.lap(self._all_components(v)) ** 2).sum()
+        if self.dim == 3:
+            # the 3D energy has always included the squared y-derivative of the last component (see _compute_regularizer_3d)
+            energy = energy + (self.fdt.dYc(v[:, 2, ...]) ** 2).sum()
+        return energy * self.volumeElement
+
     def _compute_regularizer(self, d):
         # just do the standard component-wise norm of gradient squared
 
@@ -180,6 +233,18 @@ class TotalVariationRegularizer(Regularizer):
         """
         return self.pnorm
 
+    def _compute_regularizer_multiN(self, v):
+        d = self._all_components(v)
+        if self.dim == 1:
+            # need to use torch.abs here to make sure the proper subgradient is computed at zero
+            return torch.abs(self.fdt.dXc(d)).sum() * self.volumeElement
+        elif self.dim == 2:
+            gradient = torch.stack((self.fdt.dXc(d), self.fdt.dYc(d)))
+        else:
+            gradient = torch.stack((self.fdt.dXc(d), self.fdt.dYc(d), self.fdt.dZc(d)))
+        # need to use torch.norm here to make sure the proper subgradient is computed at zero
+        return torch.norm(gradient, self.pnorm, 0).sum() * self.volumeElement
+
     def _compute_regularizer(self, d):
         # just do the standard component-wise Euclidean norm of the gradient
 
@@ -245,6 +310,8 @@ class HelmholtzRegularizer(Regularizer):
         """penalty for second derivative"""
         self.gamma = params[('gamma', 1.0, 'penalty for magnitude' )]
         """penalty for magnitude"""
+        self.use_fourier = params[('use_fourier', False, 'if True the operator is applied in the Fourier domain (assumes periodic boundary conditions)')]
+        """if True the Helmholtz operator is applied via its Fourier symbol"""
 
     def set_alpha(self,alpha):
         """
@@ -280,6 +347,14 @@ class HelmholtzRegularizer(Regularizer):
         """
         return self.gamma
 
+    def _compute_regularizer_multiN(self, v):
+        if self.use_fourier:
+            Lv = SO.apply_helmholtz_operator(v, self.spacing, self.alpha, self.gamma)
+            return (Lv ** 2).sum() * self.volumeElement
+        d = self._all_components(v)
+        Lv = d * self.gamma - self.fdt.lap(d) * self.alpha
+        return (Lv ** 2).sum() * self.volumeElement
+
     def _compute_regularizer(self, v):
         # just do the standard component-wise gamma id -\alpha \Delta
 
@@ -0,0 +1,127 @@
+"""
+Registration restricted to a region of interest (ROI).
+
+The computational domain is cropped to the bounding box of a mask (or to a given bounding box), enlarged by a margin.
+The registration is then solved on the cropped images only, i.e., the cost scales with the size of the ROI and not
+with the size of the scan. The resulting maps are given in the coordinates of the cropped domain; they are shifted
+by the origin of the bounding box and embedded into the identity map of the full domain
+(see :func:`embed_map_into_identity`).
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import numpy as np
+import torch
+
+from . import utils
+
+
+def enlarge_bounding_box(bounding_box, margin, sz):
+    """
+    Enlarges a bounding box by a margin (the bounding box is clipped to the domain)
+
+    :param bounding_box: list of [start,end) tuples, one for each spatial dimension
+    :param margin: number of voxels by which the bounding box is enlarged (in each direction); a scalar or one value per dimension
+    :param sz: spatial size of the domain [X,Y,Z]
+    :return: enlarged bounding box
+    """
+    dim = len(bounding_box)
+    margin = np.ones(dim, dtype='int') * np.array(margin, dtype='int')
+    return [(max(int(start) - int(margin[d]), 0), min(int(end) + int(margin[d]), int(sz[d])))
+            for d, (start, end) in enumerate(bounding_box)]
+
+
+def get_bounding_box_from_mask(mask, margin=0):
+    """
+    Computes the bounding box of the non-zero voxels of a mask (over all images and channels)
+
+    :param mask: mask, format BxCxXxYxZ
+    :param margin: number of voxels by which the bounding box is enlarged (in each direction); a scalar or one value per dimension
+    :return: bounding box as a list of [start,end) tuples, one for each spatial dimension
+    """
+    dim = mask.dim() - 2
+    sz = mask.size()[2:]
+
+    support = (mask != 0).reshape(mask.size()[0] * mask.size()[1], *sz).any(dim=0)
+    if not support.any():
+        raise ValueError('Cannot compute the bounding box of an empty mask')
+
+    bounding_box = []
+    for d in range(dim):
+        other_dims = [i for i in range(dim) if i != d]
+        if len(other_dims) > 0:
+            support_d = support.permute([d] + other_dims).contiguous().view(sz[d], -1).any(dim=1)
+        else:
+            support_d = support
+        indices = torch.nonzero(support_d).view(-1)
+        bounding_box.append((int(indices[0]), int(indices[-1]) + 1))
+    return enlarge_bounding_box(bounding_box, margin, sz)
+
+
+def get_bounding_box_origin(bounding_box, spacing):
+    """
+    Returns the physical coordinates of the first voxel of the bounding box
+
+    :param bounding_box: list of [start,end) tuples
+    :param spacing: spacing of the full domain
+    :return: numpy array with the origin
+    """
+    return np.array([start for start, _ in bounding_box], dtype='float64') * np.array(spacing)
+
+
+def crop_to_bounding_box(I, bounding_box):
+    """
+    Crops an image (or map) to a bounding box
+
+    :param I: image or map, format BxCxXxYxZ
+    :param bounding_box: list of [start,end) tuples, one for each spatial dimension
+    :return: cropped image (a view of I)
+    """
+    slices = [slice(None), slice(None)] + [slice(start, end) for start, end in bounding_box]
+    return I[tuple(slices)]
+
+
+def crop_map_to_bounding_box(phi, bounding_box, spacing):
+    """
+    Crops a map of the full domain to a bounding box and expresses it in the coordinates of the cropped domain,
+    e.g., to use an initial map (of the full domain) for a registration restricted to the bounding box
+
+    :param phi: map of the full domain, format BxdimxXxYxZ
+    :param bounding_box: list of [start,end) tuples
+    :param spacing: spacing of the full domain
+    :return: map of the cropped domain
+    """
+    origin = get_bounding_box_origin(bounding_box, spacing)
+    offset = torch.from_numpy(origin).to(device=phi.device, dtype=phi.dtype).view([1, -1] + [1] * len(bounding_box))
+    return crop_to_bounding_box(phi, bounding_box) - offset
+
+
+def embed_map_into_identity(phi_roi, bounding_box, sz, spacing):
+    """
+    Embeds a map which was computed on the cropped domain into the identity map of the full domain. The map may
+    have been computed at a lower resolution; it is then interpolated to the resolution of the bounding box first.
+
+    :param phi_roi: map of the cropped domain (in the coordinates of the cropped domain), format BxdimxXxYxZ
+    :param bounding_box: list of [start,end) tuples
+    :param sz: size of the full domain (BxCxXxYxZ)
+    :param spacing: spacing of the full domain
+    :return: map of the full domain (identity outside of the bounding box)
+    """
+    dim = len(bounding_box)
+    spacing = np.array(spacing)
+    roi_sz = np.array([end - start for start, end in bounding_box])
+
+    if list(phi_roi.size()[2:]) != list(roi_sz):
+        phi_sz = np.array(phi_roi.size()[2:])
+        phi_spacing = spacing * (roi_sz - 1.) / (phi_sz - 1.)
+        id_roi = utils._get_shared_identity_map([phi_roi.size()[0], dim] + list(roi_sz), spacing,
+                                                dtype=phi_roi.dtype, device=phi_roi.device)
+        phi_roi = utils.compute_warped_image_multiNC(phi_roi, id_roi, phi_spacing, 1, zero_boundary=False)
+
+    origin = get_bounding_box_origin(bounding_box, spacing)
+    offset = torch.from_numpy(origin).to(device=phi_roi.device, dtype=phi_roi.dtype).view([1, -1] + [1] * dim)
+
+    phi = utils.get_identity_map([phi_roi.size()[0], dim] + list(sz[2:]), spacing,
+                                 dtype=phi_roi.dtype, device=phi_roi.device)
+    crop_to_bounding_box(phi, bounding_box)[:] = phi_roi + offset
+    return phi
@@ -10,6 +10,8 @@ from abc import ABCMeta, abstractmethod
 
 import torch
 from . import utils
+from .data_wrapper import FP32Val
+from . import profiling
 import numpy as np
 from future.utils import with_metaclass
 
@@ -87,6 +89,9 @@ class RKIntegrator(with_metaclass(ABCMeta, object)):
         # arguments need to be list so we can pass multiple variables at the same time
         assert type(x)==list
 
+        # the state is always accumulated in float32 (also when the right hand side is evaluated under autocast)
+        x = [FP32Val(a) for a in x]
+
         dT = toT-fromT
         nr_of_timepoints = int(round(self.nrOfTimeSteps_perUnitTimeInterval*dT))
 
@@ -94,24 +99,25 @@ class RKIntegrator(with_metaclass(ABCMeta, object)):
         dt = timepoints[1]-timepoints[0]
         currentT = fromT
         #iter = 0
-        for i in range(0, nr_of_timepoints):
-            #print('RKIter = ' + str( iter ) )
-            #iter+=1
-            x = self.solve_one_step(x, currentT, dt, variables_from_optimizer)
-            currentT += dt
+        with profiling.phase('integration'):
+            for i in range(0, nr_of_timepoints):
+                #print('RKIter = ' + str( iter ) )
+                #iter+=1
+                x = self.solve_one_step(x, currentT, dt, variables_from_optimizer)
+                currentT += dt
         #print( x )
         return x
 
     def _xpyts(self, x, y, v):
         # x plus y times scalar
-        return [a+b*v for a,b in zip(x,y)]
+        return [a+FP32Val(b)*v for a,b in zip(x,y)]
 
     def _xts(self, x, v):
         # x times scalar
-        return [a*v for a in x]
+        return [FP32Val(a)*v for a in x]
 
     def _xpy(self, x, y):
-        return [a+b for a,b in zip(x,y)]
+        return [a+FP32Val(b) for a,b in zip(x,y)]
 
     @abstractmethod
     def solve_one_step(self, x, t, dt, variables_from_optimizer=None):
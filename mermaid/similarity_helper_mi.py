@@ -0,0 +1,130 @@
+"""
+Helper functions for the mutual information based similarity measures: joint histograms with cubic B-spline
+Parzen windows (computed for all voxels at once by a scatter-add on the device) and their analytic gradient.
+"""
+from __future__ import absolute_import
+
+import torch
+from torch.autograd import Function
+
+
+def _cubic_bspline(u):
+    """
+    Cubic B-spline
+
+    :param u: argument
+    :return: B(u)
+    """
+    a = torch.abs(u)
+    return torch.where(a < 1., (4. - 6. * a ** 2 + 3. * a ** 3) / 6.,
+                       torch.where(a < 2., (2. - a) ** 3 / 6., torch.zeros_like(a)))
+
+
+def _cubic_bspline_derivative(u):
+    """
+    Derivative of the cubic B-spline
+
+    :param u: argument
+    :return: B'(u)
+    """
+    a = torch.abs(u)
+    s = torch.sign(u)
+    return torch.where(a < 1., s * (-2. * a + 1.5 * a ** 2),
+                       torch.where(a < 2., -s * 0.5 * (2. - a) ** 2, torch.zeros_like(a)))
+
+
+def _get_taps(t):
+    """
+    Returns the bins and the offsets of the four bins covered by the cubic B-spline Parzen window
+
+    :param t: continuous bin coordinates (in [1,nr_of_bins-3])
+    :return: tuple (bins, offsets), both of size 4 x (size of t)
+    """
+    k = torch.floor(t).unsqueeze(0) + torch.arange(-1, 3, device=t.device, dtype=t.dtype).view([4] + [1] * t.dim())
+    return k.long(), t.unsqueeze(0) - k
+
+
+def intensities_to_bin_coordinates(I, nr_of_bins):
+    """
+    Maps the intensities of each image/channel linearly to continuous bin coordinates in [1,nr_of_bins-3], so that the
+    support of the Parzen window stays within the histogram. The minimum and maximum are not differentiated.
+
+    :param I: intensities, BxP (one row per image/channel)
+    :param nr_of_bins: number of histogram bins
+    :return: bin coordinates, BxP
+    """
+    I_min = I.detach().min(1, keepdim=True)[0]
+    I_max = I.detach().max(1, keepdim=True)[0]
+    scale = (nr_of_bins - 4) / torch.clamp(I_max - I_min, min=1e-8)
+    return 1. + (I - I_min) * scale
+
+
+class ParzenJointHistogram(Function):
+    """
+    Joint histogram with cubic B-spline Parzen windows. The gradient (wrt. the first coordinates only; these
+    belong to the warped image) is computed analytically, i.e., the 16 contributions of each voxel are not stored.
+    """
+
+    @staticmethod
+    def forward(ctx, t0, t1, nr_of_bins):
+        """
+        :param ctx: context
+        :param t0: bin coordinates of the first (warped) image, BxP
+        :param t1: bin coordinates of the second (target) image, BxP
+        :param nr_of_bins: number of bins
+        :return: joint histograms (normalized to sum to one), B x nr_of_bins x nr_of_bins
+        """
+        nr_of_images = t0.size()[0]
+        nr_of_points = t0.size()[1]
+
+        k0, u0 = _get_taps(t0)
+        k1, u1 = _get_taps(t1)
+        w0 = _cubic_bspline(u0)
+        w1 = _cubic_bspline(u1)
+
+        offsets = (torch.arange(nr_of_images, device=t0.device) * nr_of_bins * nr_of_bins).view(1, 1, nr_of_images, 1)
+        indices = (k0.unsqueeze(1) * nr_of_bins + k1.unsqueeze(0) + offsets).view(-1)
+        vals = (w0.unsqueeze(1) * w1.unsqueeze(0)).view(-1)
+
+        histogram = torch.zeros(nr_of_images * nr_of_bins * nr_of_bins, dtype=t0.dtype, device=t0.device)
+        histogram.index_add_(0, indices, vals)
+
+        ctx.save_for_backward(t0, t1)
+        ctx.nr_of_bins = nr_of_bins
+
+        return histogram.view(nr_of_images, nr_of_bins, nr_of_bins) / nr_of_points
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        t0, t1 = ctx.saved_tensors
+        nr_of_bins = ctx.nr_of_bins
+        nr_of_images = t0.size()[0]
+        nr_of_points = t0.size()[1]
+
+        k0, u0 = _get_taps(t0)
+        k1, u1 = _get_taps(t1)
+
+        offsets = (torch.arange(nr_of_images, device=t0.device) * nr_of_bins * nr_of_bins).view(1, 1, nr_of_images, 1)
+        indices = k0.unsqueeze(1) * nr_of_bins + k1.unsqueeze(0) + offsets
+        g = grad_output.contiguous().view(-1)[indices.view(-1)].view(indices.size())
+
+        # d/dt0 B(t0-k0) = B'(t0-k0)
+        grad_t0 = (g * _cubic_bspline_derivative(u0).unsqueeze(1) * _cubic_bspline(u1).unsqueeze(0)).sum(0).sum(0)
+
+        return grad_t0 / nr_of_points, None, None
+
+
+def compute_entropies(histogram, eps=1e-10):
+    """
+    Computes the marginal and joint entropies of joint histograms
+
+    :param histogram: normalized joint histograms, B x nr_of_bins x nr_of_bins
+    :param eps: small value to avoid log(0)
+    :return: tuple (H0, H1, H01) of the entropies for each histogram
+    """
+    p0 = histogram.sum(2)
+    p1 = histogram.sum(1)
+    H0 = -(p0 * torch.log(p0 + eps)).sum(1)
+    H1 = -(p1 * torch.log(p1 + eps)).sum(1)
+    H01 = -(histogram * torch.log(histogram + eps)).sum(2).sum(1)
+    return H0, H1, H01
@@ -6,6 +6,7 @@ from __future__ import absolute_import
 from builtins import range
 from builtins import object
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 import torch
 from torch.autograd import Function
 from .data_wrapper import AdaptVal
@@ -246,3 +247,227 @@ class OTSimilarityGradient(object):
         return gradient
 
 
+_log_gibbs_kernel_cache = OrderedDict()
+"""memoized (log-domain) Gibbs kernels (least recently used entries are dropped first)"""
+_log_gibbs_kernel_cache_max_nr_of_entries = 16
+
+
+def clear_log_gibbs_kernel_cache():
+    """Removes all cached Gibbs kernels."""
+    _log_gibbs_kernel_cache.clear()
+
+
+def get_log_gibbs_kernels(shape, std, dtype=torch.float32, device=None):
+    """
+    Returns the separable Gibbs kernels (see OTSimilarityGradient.build_kernel_matrix) in the log domain. The kernels
+    are memoized per shape, standard deviation, dtype, and device.
+
+    :param shape: spatial shape [X,Y,Z]
+    :param std: standard deviation of the Gaussian kernel
+    :param dtype: torch data type
+    :param device: device of the kernels
+    :return: list of log kernels (one matrix per dimension)
+    """
+    device = torch.device('cpu') if device is None else torch.device(device)
+    key = (tuple(int(s) for s in shape), float(std), dtype, str(device))
+
+    kernels = _log_gibbs_kernel_cache.pop(key, None)
+    if kernels is None:
+        kernels = []
+        for length in shape:
+            x = torch.linspace(0, 1, int(length), dtype=torch.float64)
+            c = (x.unsqueeze(0) - x.unsqueeze(1)) ** 2 / std ** 2
+            kernels.append((-c).to(device=device, dtype=dtype))
+
+    _log_gibbs_kernel_cache[key] = kernels
+    while len(_log_gibbs_kernel_cache) > _log_gibbs_kernel_cache_max_nr_of_entries:
+        _log_gibbs_kernel_cache.popitem(last=False)
+
+    return kernels
+
+
+_max_nr_of_elements_per_chunk = 2**22
+"""maximal number of elements of the temporaries of _apply_log_kernels (the contracted axis is processed in chunks)"""
+
+
+def _apply_log_kernels(L, log_kernels):
+    """
+    Applies a separable kernel in the log domain, i.e., computes log(K exp(L)) in a numerically stable way. The
+    contracted axis is processed in chunks (which are combined by logaddexp), so that the temporaries stay bounded by
+    _max_nr_of_elements_per_chunk elements instead of growing with the image size times the length of the axis.
+
+    :param L: log of the batch of multipliers, BxXxYxZ
+    :param log_kernels: list of log kernels (one per spatial dimension)
+    :return: log(K exp(L)), BxXxYxZ
+    """
+    for d, log_kernel in enumerate(log_kernels):
+        Lt = L.transpose(d + 1, -1).unsqueeze(-2)
+        length = log_kernel.size()[1]
+        nr_of_outputs = (Lt.numel() // length) * log_kernel.size()[0]
+        chunk_size = max(1, min(length, _max_nr_of_elements_per_chunk // max(1, nr_of_outputs)))
+
+        result = None
+        for start in range(0, length, chunk_size):
+            partial_result = torch.logsumexp(log_kernel[:, start:start + chunk_size] + Lt[..., start:start + chunk_size], dim=-1)
+            result = partial_result if result is None else torch.logaddexp(result, partial_result)
+        L = result.transpose(d + 1, -1)
+    return L
+
+
+class OMTSinkhornEngine(object):
+    """
+    Batched, stabilized log-domain Sinkhorn solver for the optimal mass transport similarity (same energy as
+    OTSimilarityGradient; the gradient with respect to the map is obtained by differentiating the warping, see
+    BatchedOTSimilarityHelper). The Gibbs kernels are cached, the iterations run on the device of the images and stop once the
+    marginal error is below a tolerance. The multipliers of the last solve are kept and used as warm start for the next one
+    (e.g., in the next iteration of the optimizer), but only if the target images are the same as for the last solve
+    (i.e., they are discarded when a new batch is processed).
+    """
+
+    def __init__(self, std_sinkhorn=0.08, max_nr_of_iterations=200, tolerance=1e-5, warm_start=True, check_interval=10):
+        """
+        Constructor
+
+        :param std_sinkhorn: standard deviation of the entropic regularization
+        :param max_nr_of_iterations: maximal number of Sinkhorn iterations
+        :param tolerance: iterations stop once the L1 error of the first marginal is below this value (for all images)
+        :param warm_start: if True the iterations start from the multipliers of the previous solve (if it was for the same target images)
+        :param check_interval: the marginal error is checked every check_interval iterations
+        """
+        self.std_sinkhorn = std_sinkhorn
+        self.max_nr_of_iterations = int(max_nr_of_iterations)
+        self.tolerance = tolerance
+        self.warm_start = warm_start
+        self.check_interval = check_interval
+        self.small_mass = 0.00001
+
+        self.log_multiplier1 = None
+        """log of the second multiplier of the last solve (used for warm starts)"""
+        self.warm_start_target = None
+        """target images of the last solve (the warm start is only used for the same targets)"""
+        self.nr_of_iterations = None
+        """number of iterations of the last solve"""
+        self.marginal_error = None
+        """marginal error (maximum over the batch) of the last solve"""
+
+    def reset(self):
+        """
+        Discards the multipliers of the last solve (the next solve is started from scratch)
+        """
+        self.log_multiplier1 = None
+        self.warm_start_target = None
+
+    def _can_warm_start(self, I1):
+        """
+        Returns True if the multipliers of the last solve belong to the given target images
+
+        :param I1: second densities, BxXxYxZ
+        :return: True/False
+        """
+        if not self.warm_start or self.log_multiplier1 is None or self.warm_start_target is None:
+            return False
+        if self.warm_start_target.size() != I1.size() or self.warm_start_target.device != I1.device \
+                or self.warm_start_target.dtype != I1.dtype:
+            return False
+        # the memory of a previous batch may be reused for the next one, hence the values are compared
+        return torch.equal(self.warm_start_target, I1)
+
+    def _get_densities(self, I):
+        # as for OTSimilarityGradient: add a small amount of mass to have non-zero coefficients
+        temp = I + self.small_mass
+        return temp / temp.reshape(temp.size()[0], -1).sum(1).view([-1] + [1] * (temp.dim() - 1))
+
+    def solve(self, I0, I1):
+        """
+        Computes the OT-based similarity measure between two batches of densities
+
+        :param I0: first densities, BxXxYxZ
+        :param I1: second densities, BxXxYxZ
+        :return: tuple (W^2 for each batch entry, log of the first multipliers, log of the second multipliers)
+        """
+        a = self._get_densities(I0)
+        b = self._get_densities(I1)
+        log_a = torch.log(a)
+        log_b = torch.log(b)
+        log_kernels = get_log_gibbs_kernels(I0.size()[1:], self.std_sinkhorn, dtype=I0.dtype, device=I0.device)
+
+        if self._can_warm_start(I1):
+            log_v = self.log_multiplier1
+        else:
+            log_v = torch.zeros_like(log_b)
+
+        log_Kv = _apply_log_kernels(log_v, log_kernels)
+        marginal_error = None
+        for iter in range(self.max_nr_of_iterations):
+            log_u = log_a - log_Kv
+            log_v = log_b - _apply_log_kernels(log_u, log_kernels)
+            log_Kv = _apply_log_kernels(log_v, log_kernels)
+            if (iter + 1) % self.check_interval == 0 or iter == self.max_nr_of_iterations - 1:
+                marginal_error = (torch.exp(log_u + log_Kv) - a).abs().reshape(a.size()[0], -1).sum(1).max().item()
+                if marginal_error < self.tolerance:
+                    break
+
+        self.nr_of_iterations = iter + 1
+        self.marginal_error = marginal_error
+        self.log_multiplier1 = log_v.detach()
+        if self.warm_start:
+            self.warm_start_target = I1.detach().clone()
+
+        nr_of_images = a.size()[0]
+        value = (log_u * a).reshape(nr_of_images, -1).sum(1) + (log_v * b).reshape(nr_of_images, -1).sum(1) \
+                - torch.exp(log_u + log_Kv).reshape(nr_of_images, -1).sum(1)
+
+        return (self.std_sinkhorn ** 2) * value, log_u, log_v
+
+    def compute_image_gradient(self, I0, log_u):
+        """
+        Computes the gradient of the similarity with respect to the first images (before their normalization to
+        densities). As the multipliers are optimal at convergence, the derivative of W^2 with respect to the first
+        density is std_sinkhorn^2 log(u) (with the multipliers held fixed); it is then mapped back through the
+        normalization.
+
+        :param I0: first images, BxXxYxZ
+        :param log_u: log of the first multipliers, BxXxYxZ
+        :return: gradient wrt. the first images, BxXxYxZ
+        """
+        nr_of_images = I0.size()[0]
+        view_size = [-1] + [1] * (I0.dim() - 1)
+        mass = (I0 + self.small_mass).reshape(nr_of_images, -1).sum(1).view(view_size)
+        a = self._get_densities(I0)
+        mean_log_u = (log_u * a).reshape(nr_of_images, -1).sum(1).view(view_size)
+        return (self.std_sinkhorn ** 2) * (log_u - mean_log_u) / mass
+
+
+class BatchedOTSimilarityHelper(Function):
+    """Implements the pytorch function of optimal mass transport for a batch of multi-channel images.
+    The backward pass reuses the multipliers of the forward pass and returns the gradient with respect to the warped
+    source images, so that the gradient with respect to the map is obtained by differentiating the warping.
+    """
+    @staticmethod
+    def forward(ctx, I0, I1, engine):
+        """
+        :param ctx: context
+        :param I0: warped source images, BxCxXxYxZ
+        :param I1: target images, BxCxXxYxZ
+        :param engine: OMTSinkhornEngine instance
+        :return: sum over the images of the channel-averaged W^2
+        """
+        nr_of_images = I0.size()[0]
+        nr_of_channels = I0.size()[1]
+        sz = list(I0.size()[2:])
+
+        I0_batch = I0.detach().reshape([nr_of_images * nr_of_channels] + sz)
+        value, log_u, log_v = engine.solve(I0_batch, I1.detach().reshape([nr_of_images * nr_of_channels] + sz))
+
+        ctx.save_for_backward(I0_batch, log_u)
+        ctx.engine = engine
+        ctx.image_size = I0.size()
+        ctx.nr_of_channels = nr_of_channels
+
+        return value.view(nr_of_images, nr_of_channels).mean(1).sum()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        I0_batch, log_u = ctx.saved_tensors
+        gradient = ctx.engine.compute_image_gradient(I0_batch, log_u) / ctx.nr_of_channels
+        return gradient.view(ctx.image_size) * grad_output, None, None
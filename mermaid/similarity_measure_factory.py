@@ -8,11 +8,12 @@ from builtins import range
 from builtins import object
 from abc import ABCMeta, abstractmethod
 import torch
-from .data_wrapper import AdaptVal,USE_CUDA
+from .data_wrapper import AdaptVal,USE_CUDA,FP32Val
 from .data_wrapper import MyTensor
 from . import utils
 from math import floor
 from .similarity_helper_omt import *
+from . import similarity_helper_mi as MI
 import torch.nn.functional as F
 
 import numpy as np
@@ -37,6 +38,9 @@ class SimilarityMeasure(with_metaclass(ABCMeta, object)):
         self.sigma = params['similarity_measure'][('sigma', 0.1, '1/sigma^2 is the weight in front of the similarity measure')]
         """1/sigma^2 is a balancing constant"""
 
+    voxelwise = False
+    """True if the measure only depends on the intensity pairs of the voxels (and not on their spatial arrangement)"""
+
     @abstractmethod
     def compute_similarity_multiNC(self, I0, I1, I0Source=None, phi=None):
         """
@@ -50,6 +54,47 @@ class SimilarityMeasure(with_metaclass(ABCMeta, object)):
         """
         pass
 
+    def _compute_similarity_multiNC_on_voxels_of_mask(self, I0, I1, mask):
+        """
+        Gathers the voxels of a mask (the union of the masks of all images and channels) and evaluates a voxelwise
+        measure on them
+
+        :param I0: first image (the warped source image)
+        :param I1: second image (target image)
+        :param mask: boolean mask of format BxCxXxYxZ (B and C may be one)
+        :return: returns similarity measure
+        """
+        support = mask.reshape(mask.size()[0] * mask.size()[1], -1).any(dim=0)
+        indices = torch.nonzero(support).view(-1)
+        I0 = I0.reshape(I0.size()[0], I0.size()[1], -1)[:, :, indices]
+        I1 = I1.reshape(I1.size()[0], I1.size()[1], -1)[:, :, indices]
+        return self.compute_similarity_multiNC(I0, I1)
+
+    def compute_similarity_multiNC_in_mask(self, I0, I1, mask, I0Source=None, phi=None):
+        """
+        Computes the image similarity only on the voxels of a mask. For voxelwise measures only the masked voxels
+        are gathered and the measure is evaluated on them (image by image if the images have individual masks);
+        all other measures are evaluated on the masked images (which are set to zero outside of the mask).
+
+        :param I0: first image (the warped source image)
+        :param I1: second image (target image)
+        :param mask: mask of format BxCxXxYxZ (B and C may be one)
+        :param I0Source: source image (will typically not be used)
+        :param phi: map in the target image to warp the source image (will typically not be used)
+        :return: returns similarity measure
+        """
+        mask = mask != 0
+        if self.voxelwise:
+            if mask.size()[0] == 1:
+                return self._compute_similarity_multiNC_on_voxels_of_mask(I0, I1, mask)
+            else:
+                # the similarity measures are summed over the batch
+                return sum(self._compute_similarity_multiNC_on_voxels_of_mask(I0[n:n+1, ...], I1[n:n+1, ...], mask[n:n+1, ...])
+                           for n in range(I0.size()[0]))
+        else:
+            mask = mask.to(I0.dtype)
+            return self.compute_similarity_multiNC(I0 * mask, I1 * mask, I0Source, phi)
+
     def set_sigma(self, sigma):
         """
         Set balancing constant :math:`\\sigma`
@@ -85,9 +130,23 @@ class SimilarityMeasureSingleImage(SimilarityMeasure):
         self.sigma = params['similarity_measure'][('sigma', 0.1, '1/sigma^2 is the weight in front of the similarity measure')]
         """1/sigma^2 is a balancing constant"""
 
-    def compute_similarity_multiNC(self, I0, I1, I0Source=None, phi=None):
+    def _compute_similarity_multiNC(self, I0, I1, I0Source=None, phi=None):
         """
-        Compute the multi-image multi-channel image similarity between two images of format BxCxXxYzZ
+        Computes the multi-image multi-channel image similarity for all images and channels at once (in one tensor expression).
+        Derived classes which support this override this method. The result needs to agree with
+        compute_similarity_multiNC_by_looping, i.e., the similarities are averaged over the channels and summed over the images.
+
+        :param I0: first image (the warped source image), BxCxXxYxZ
+        :param I1: second image (target image), BxCxXxYxZ
+        :param I0Source: source image (will typically not be used)
+        :param phi: map in the target image to warp the source image, BxdimxXxYxZ (will typically not be used)
+        :return: returns similarity measure or None if not supported (the similarity is then computed image by image and channel by channel)
+        """
+        return None
+
+    def compute_similarity_multiNC_by_looping(self, I0, I1, I0Source=None, phi=None):
+        """
+        Compute the multi-image multi-channel image similarity image by image (reference implementation)
 
         :param I0: first image (the warped source image)
         :param I1: second image (target image)
@@ -99,10 +158,27 @@ class SimilarityMeasureSingleImage(SimilarityMeasure):
         sim = torch.zeros(1).type_as(I0)
 
         for nrI in range(n_batch):  # loop over all the images
-            sim = sim + self.compute_similarity_multiC(I0[nrI, ...], I1[nrI, ...], None, None )
+            sim = sim + self.compute_similarity_multiC(I0[nrI, ...], I1[nrI, ...],
+                                                       None if I0Source is None else I0Source[nrI, ...],
+                                                       None if phi is None else phi[nrI, ...])
 
         return sim[0]
 
+    def compute_similarity_multiNC(self, I0, I1, I0Source=None, phi=None):
+        """
+        Compute the multi-image multi-channel image similarity between two images of format BxCxXxYzZ
+
+        :param I0: first image (the warped source image)
+        :param I1: second image (target image)
+        :param I0Source: source image (will typically not be used)
+        :param phi: map in the target image to warp the source image (will typically not be used)
+        :return: returns similarity measure
+        """
+        sim = self._compute_similarity_multiNC(I0, I1, I0Source, phi)
+        if sim is None:
+            return self.compute_similarity_multiNC_by_looping(I0, I1, I0Source, phi)
+        else:
+            return sim
 
     def compute_similarity_multiC(self, I0, I1, I0Source=None, phi=None):
         """
@@ -160,7 +236,12 @@ class SSDSingleImageSimilarity(SimilarityMeasureSingleImage):
     """
 
     def __init__(self, spacing, params):
-        super(SSDSimilarity,self).__init__(spacing,params)
+        super(SSDSingleImageSimilarity,self).__init__(spacing,params)
+
+    def _compute_similarity_multiNC(self, I0, I1, I0Source=None, phi=None):
+        # SSD of each channel, averaged over the channels and summed over the images
+        ssd = utils.remove_infs_from_variable((I0 - I1) ** 2).sum() / I0.size()[1]
+        return AdaptVal(ssd / (self.sigma ** 2) * self.volumeElement)
 
     def compute_similarity(self, I0, I1, I0Source=None, phi=None):
         """
@@ -186,6 +267,8 @@ class SSDSimilarity(SimilarityMeasure):
     :math:`1/sigma^2||I_0-I_1||^2`
     """
 
+    voxelwise = True
+
     def __init__(self, spacing, params):
         super(SSDSimilarity,self).__init__(spacing,params)
 
@@ -227,6 +310,71 @@ class OptimalMassTransportSimilarity(SimilarityMeasureSingleImage):
         self.spline_order = params[('spline_order', 1, 'Spline interpolation order; 1 is linear interpolation (default); 3 is cubic spline')]
         """order of spline for interpolation (if needed)"""
 
+        cparams = params['similarity_measure'][('omt', {}, 'settings for the optimal mass transport similarity measure')]
+        self.use_batched_sinkhorn = cparams[('use_batched_sinkhorn', False, 'if True a batched log-domain Sinkhorn (on the device of the images) is used (opt-in; same energy, but the gradient is obtained by differentiating the warping); otherwise each image is processed on its own')]
+        """if True OMTSinkhornEngine is used"""
+        self.sinkhorn_engine = OMTSinkhornEngine(std_sinkhorn=std_sinkhorn,
+                                                 max_nr_of_iterations=sinkhorn_iterations,
+                                                 tolerance=cparams[('sinkhorn_tolerance', 1e-5, 'Sinkhorn iterations stop once the L1 error of the marginal is below this value')],
+                                                 warm_start=cparams[('warm_start', True, 'if True the Sinkhorn iterations start from the multipliers of the previous evaluation')])
+        """batched log-domain Sinkhorn solver"""
+
+    def _compute_similarity_multiNC(self, I0, I1, I0Source=None, phi=None, mask=None):
+        if phi is None:
+            raise ValueError('OptimalMassTransportSimiliary can only be computed for map-based models.')
+
+        # all images and channels are warped at once (one interpolation call for the batch)
+        I1_warped = utils.compute_warped_image_multiNC(I0Source, phi, self.spacing, self.spline_order)
+        if mask is not None:
+            mask = (mask != 0).to(I1_warped.dtype)
+            I1_warped = I1_warped * mask
+            I1 = I1 * mask
+
+        if self.use_batched_sinkhorn:
+            sim = BatchedOTSimilarityHelper.apply(I1_warped, I1, self.sinkhorn_engine)
+            return sim/(self.std_dev**2)
+
+        n_batch = I1.size()[0]
+        n_channel = I1.size()[1]
+        sim = torch.zeros(1).type_as(I1)
+        for nrI in range(n_batch):
+            for nrC in range(n_channel):
+                sim = sim + self._compute_sinkhorn_similarity(I1_warped[nrI, nrC, ...], I1[nrI, nrC, ...], phi[nrI, ...])
+        return sim[0] / n_channel
+
+    def compute_similarity_multiNC_in_mask(self, I0, I1, mask, I0Source=None, phi=None):
+        """
+        Computes the OMT similarity only on the voxels of a mask. As the source image is warped by phi here (and I0 is
+        not used), the mask is applied to the warped source image and to the target image.
+
+        :param I0: first image (not used)
+        :param I1: second image (target image)
+        :param mask: mask of format BxCxXxYxZ (B and C may be one)
+        :param I0Source: source image (not warped)
+        :param phi: map to warp the source image to the target
+        :return: OMTSimilarity/sigma^2
+        """
+        return self._compute_similarity_multiNC(I0, I1, I0Source, phi, mask=mask)
+
+    def _compute_sinkhorn_similarity(self, I1_warped, I1, phi):
+        """
+        Computes the OMT similarity between a warped source image and the target image
+
+        :param I1_warped: warped source image, XxYxZ
+        :param I1: target image, XxYxZ
+        :param phi: map which was used to warp the source image, dimxXxYxZ
+        :return: OMTSimilarity/sigma^2
+        """
+        # Encapsulate the data in tensor Variables
+        multiplier0 = torch.zeros(I1_warped.size())
+        multiplier1 = torch.zeros(I1.size())
+        nr_iterations_sinkhorn = torch.Tensor([self.sinkhorn_iterations])
+        std_sink = torch.Tensor([self.std_sinkhorn])
+
+        # Compute the actual similarity
+        result = OTSimilarityHelper.apply(phi,I1_warped,I1,multiplier0,multiplier1,torch.Tensor(self.spacing),nr_iterations_sinkhorn,std_sink)
+        return result/(self.std_dev**2)
+
     def compute_similarity(self, I0, I1, I0Source, phi):
         """
         Computes the SSD measure between two images
@@ -238,8 +386,7 @@ class OptimalMassTransportSimilarity(SimilarityMeasureSingleImage):
         :return: OMTSimilarity/sigma^2
         """
 
-        # todo: using the map here is not very efficient. It is much more efficient to apply the map
-        # todo: to an entire batch of images.
+        # note: compute_similarity_multiNC warps the entire batch at once; this is only used for single images
 
         # FX: put your OMT code here; this is just a placeholder for now which is simple SSD (but using the source image and the map)
         if phi is None:
@@ -249,15 +396,7 @@ class OptimalMassTransportSimilarity(SimilarityMeasureSingleImage):
         # but okay for now and no overhead if you only use one image pair at a time)
         I1_warped = utils.compute_warped_image(I0Source, phi, self.spacing,self.spline_order)
 
-        # Encapsulate the data in tensor Variables
-        multiplier0 = torch.zeros(I0.size())
-        multiplier1 = torch.zeros(I1.size())
-        nr_iterations_sinkhorn = torch.Tensor([self.sinkhorn_iterations])
-        std_sink = torch.Tensor([self.std_sinkhorn])
-
-        # Compute the actual similarity
-        result = OTSimilarityHelper.apply(phi,I1_warped,I1,multiplier0,multiplier1,torch.Tensor(self.spacing),nr_iterations_sinkhorn,std_sink)
-        return result/(self.std_dev**2)
+        return self._compute_sinkhorn_similarity(I1_warped, I1, phi)
 
 class NCCSimilarity(SimilarityMeasure):
     """
@@ -265,6 +404,9 @@ class NCCSimilarity(SimilarityMeasure):
     The result of each pair of image is normalized over channel dimension and sum up over batch dimension.
     :math:`sim = (1-ncc^2)/(\\sigma^2)`
     """
+
+    voxelwise = True
+
     def __init__(self, spacing, params):
         super(NCCSimilarity,self).__init__(spacing,params)
 
@@ -311,6 +453,9 @@ class NCCPositiveSimilarity(SimilarityMeasure):
     The result of each pair of image is normalized over channel dimension and sum up over batch dimension.
     :math:`sim = (1-ncc)/(\\sigma^2)`
     """
+
+    voxelwise = True
+
     def __init__(self, spacing, params):
         super(NCCPositiveSimilarity,self).__init__(spacing,params)
 
@@ -348,6 +493,9 @@ class NCCNegativeSimilarity(SimilarityMeasure):
     The result of each pair of image is normalized over channel dimension and sum up over batch dimension.
     :math:`sim = (ncc)/(\\sigma^2)`
     """
+
+    voxelwise = True
+
     def __init__(self, spacing, params):
         super(NCCNegativeSimilarity,self).__init__(spacing,params)
 
@@ -544,6 +692,102 @@ class LNCCSimilarity(SimilarityMeasure):
         return lncc_total / (self.sigma ** 2)
 
 
+class MutualInformationSimilarity(SimilarityMeasure):
+    """
+    Mutual information (MI) similarity measure for multi-modal registrations. The joint histogram uses cubic B-spline Parzen
+    windows and is computed for all voxels (of all images and channels) at once on the device; its gradient is computed
+    analytically. Optionally only a random subset of voxels is used in every evaluation.
+    The result of each pair of images is averaged over the channels and summed up over the batch.
+
+    :math:`sim = -MI/(\\sigma^2)`
+
+    Settings in json::
+
+        "similarity_measure": {
+                "sigma": 0.5,
+                "type": "mi",
+                "mi":{
+                    "nr_of_bins": 32,
+                    "sampling_fraction": 1.0
+                }
+    """
+
+    voxelwise = True
+
+    def __init__(self, spacing, params):
+        super(MutualInformationSimilarity,self).__init__(spacing,params)
+        cparams = params['similarity_measure'][('mi', {}, 'settings for the mutual information similarity measures')]
+        self.nr_of_bins = cparams[('nr_of_bins', 32, 'number of histogram bins')]
+        """number of bins of the joint histogram"""
+        self.sampling_fraction = cparams[('sampling_fraction', 1.0, 'fraction of voxels (randomly drawn in every evaluation) used to compute the histogram; 1.0 uses all voxels')]
+        """fraction of voxels used to compute the histogram"""
+
+    def _compute_entropies(self, I0, I1):
+        """
+        Computes the marginal and joint entropies for all images and channels
+
+        :param I0: first image (the warped source image), BxCxXxYxZ
+        :param I1: second image (target image), BxCxXxYxZ
+        :return: tuple (H0, H1, H01) of size BxC each
+        """
+        n_batch = I0.size()[0]
+        n_channel = I0.size()[1]
+        I0 = I0.reshape(n_batch * n_channel, -1)
+        I1 = I1.reshape(n_batch * n_channel, -1)
+
+        if self.sampling_fraction < 1.:
+            nr_of_samples = max(1, int(self.sampling_fraction * I0.size()[1]))
+            samples = torch.randperm(I0.size()[1], device=I0.device)[:nr_of_samples]
+            I0 = I0[:, samples]
+            I1 = I1[:, samples]
+
+        t0 = MI.intensities_to_bin_coordinates(I0, self.nr_of_bins)
+        t1 = MI.intensities_to_bin_coordinates(I1, self.nr_of_bins)
+        histogram = MI.ParzenJointHistogram.apply(t0, t1, self.nr_of_bins)
+        return [H.view(n_batch, n_channel) for H in MI.compute_entropies(histogram)]
+
+    def compute_similarity_multiNC(self, I0, I1, I0Source=None, phi=None):
+        """
+        Computes the MI-based image similarity measure between two images
+
+        :param I0: first image (the warped source image)
+        :param I1: second image (target image)
+        :param I0Source: not used
+        :param phi: not used
+        :return: -MI/sigma^2
+        """
+        H0, H1, H01 = self._compute_entropies(FP32Val(I0), FP32Val(I1))
+        mi = (H0 + H1 - H01).mean(dim=1).sum()
+        return AdaptVal(-mi/self.sigma**2)
+
+
+class NormalizedMutualInformationSimilarity(MutualInformationSimilarity):
+    """
+    Normalized mutual information (NMI) similarity measure, :math:`NMI=(H_0+H_1)/H_{01}\\in[1,2]`
+    (see MutualInformationSimilarity; uses the same settings).
+
+    :math:`sim = (2-NMI)/(\\sigma^2)`
+    """
+
+    def __init__(self, spacing, params):
+        super(NormalizedMutualInformationSimilarity,self).__init__(spacing,params)
+
+    def compute_similarity_multiNC(self, I0, I1, I0Source=None, phi=None):
+        """
+        Computes the NMI-based image similarity measure between two images
+
+        :param I0: first image (the warped source image)
+        :param I1: second image (target image)
+        :param I0Source: not used
+        :param phi: not used
+        :return: (2-NMI)/sigma^2
+        """
+        n_batch = I0.size()[0]
+        H0, H1, H01 = self._compute_entropies(FP32Val(I0), FP32Val(I1))
+        nmi = ((H0 + H1) / H01).mean(dim=1).sum()
+        return AdaptVal((2.*n_batch-nmi)/self.sigma**2)
+
+
 class SimilarityMeasureFactory(object):
     """
     Factory to quickly generate similarity measures that can then be used by the different registration algorithms.
@@ -564,6 +808,8 @@ class SimilarityMeasureFactory(object):
             'ncc_negative': NCCNegativeSimilarity,
             'lncc': LNCCSimilarity,#LocalizedNCCSimilarity,
             'omt': OptimalMassTransportSimilarity,
+            'mi': MutualInformationSimilarity,
+            'nmi': NormalizedMutualInformationSimilarity,
             'ssd_single': SSDSingleImageSimilarity
         }
         """currently implemented similiarity measures"""
@@ -620,6 +866,12 @@ class SimilarityMeasureFactory(object):
         """
         self.similarity_measure_default_type = 'lncc'
 
+    def set_similarity_measure_default_type_to_mi(self):
+        """
+        Set the default similarity measure to mutual information
+        """
+        self.similarity_measure_default_type = 'mi'
+
     def create_similarity_measure(self, params):
         """
         Create the actual similarity measure
@@ -629,7 +881,7 @@ class SimilarityMeasureFactory(object):
         """
 
         cparams = params[('similarity_measure',{},'settings for the similarity measure')]
-        similarityMeasureType = cparams[('type', self.similarity_measure_default_type, 'type of similarity measure (ssd/ncc)')]
+        similarityMeasureType = cparams[('type', self.similarity_measure_default_type, 'type of similarity measure (ssd/ncc/lncc/mi/nmi/...)')]
 
         if similarityMeasureType in self.simMeasures:
             print('Using ' + similarityMeasureType + ' similarity measure')
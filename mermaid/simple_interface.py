@@ -11,6 +11,7 @@ from . import multiscale_optimizer as MO
 from . import module_parameters as pars
 from . import model_factory as MF
 from . import fileio
+from . import affine_registration as AR
 import numpy as np
 
 import torch
@@ -19,6 +20,82 @@ import torch.nn
 from .data_wrapper import AdaptVal
 
 
+def _get_registration_params(params, model_name):
+    """
+    Creates the parameter structure of a registration
+
+    :param params: None (default settings), a ParameterDict or the filename of a JSON settings file
+    :param model_name: name of the desired registration model
+    :return: tuple (ParameterDict, model name); if the settings are loaded from file the model name is taken from there
+    """
+    if params is None:
+        params = pars.ParameterDict()
+    elif type(params) == pars.ParameterDict:
+        pass
+    elif type(params) == type('acharacter'):
+        params_filename = params
+        params = pars.ParameterDict()
+        params.load_JSON(params_filename)
+        model_name = params['model']['registration_model']['type']
+    else:
+        raise ValueError('Unknown parameter format: ' + str(type(params)))
+    return params, model_name
+
+
+def _set_registration_settings(params, model_name, use_map,
+                               nr_of_iterations=None,
+                               similarity_measure_type=None,
+                               similarity_measure_sigma=None,
+                               compute_similarity_measure_at_low_res=None,
+                               map_low_res_factor=None,
+                               rel_ftol=None,
+                               smoother_type=None,
+                               optimizer_name=None):
+    """
+    Writes the model and the explicitly specified settings of a registration into its parameter structure
+    (settings which are None are left as they are)
+
+    :param params: ParameterDict
+    :param model_name: name of the registration model
+    :param use_map: if the model is map-based
+    :param nr_of_iterations: nr of iterations
+    :param similarity_measure_type: type of similarity measure ('ssd' or 'ncc')
+    :param similarity_measure_sigma: similarity measures are weighted by 1/sigma^2
+    :param compute_similarity_measure_at_low_res: allows computation of similarity measure at lower resolution
+    :param map_low_res_factor: allows for parameterization of the registration at lower resolution than the image (0,1]
+    :param rel_ftol: relative function tolerance for optimizer
+    :param smoother_type: type of smoother (e.g., 'gaussian' or 'multiGaussian')
+    :param optimizer_name: name of the optimizer lbfgs_ls|adam|sgd
+    :return: n/a
+    """
+    params['model']['deformation']['use_map'] = use_map
+    params['model']['registration_model']['type'] = model_name
+
+    if optimizer_name is not None:
+        params['optimizer']['name'] = optimizer_name
+
+    if nr_of_iterations is not None:
+        params['optimizer']['single_scale']['nr_of_iterations'] = nr_of_iterations
+
+    if similarity_measure_sigma is not None:
+        params['model']['registration_model']['similarity_measure']['sigma'] = similarity_measure_sigma
+
+    if similarity_measure_type is not None:
+        params['model']['registration_model']['similarity_measure']['type'] = similarity_measure_type
+
+    if compute_similarity_measure_at_low_res is not None:
+        params['model']['deformation']['compute_similarity_measure_at_low_res'] = compute_similarity_measure_at_low_res
+
+    if map_low_res_factor is not None:
+        params['model']['deformation']['map_low_res_factor'] = map_low_res_factor
+
+    if rel_ftol is not None:
+        params['optimizer']['single_scale']['rel_ftol'] = rel_ftol
+
+    if smoother_type is not None:
+        params['model']['registration_model']['forward_model']['smoother']['type'] = smoother_type
+
+
 class RegisterImagePair(object):
 
     def __init__(self):
@@ -408,7 +485,10 @@ class RegisterImagePair(object):
                         optimizer_name=None,
                         compute_inverse_map=False,
                         params=None,
-                        recording_step=None):
+                        recording_step=None,
+                        use_affine_pre_registration=False,
+                        roi_mask=None,
+                        roi_bounding_box=None):
         """
         Registers two images. Only ISource, ITarget, spacing, and model_name need to be specified.
         Default values will be used for all of the values that are not explicitly specified.
@@ -436,6 +516,9 @@ class RegisterImagePair(object):
         :param compute_inverse_map: for map-based models that inverse map can optionally be computed
         :param params: parameter structure to pass settings or filename to load the settings from file.
         :param recording_step: set tracking of all intermediate results in history each n-th step
+        :param use_affine_pre_registration: if set to True a multi-resolution affine registration is run first and used as initial map (map-based models only)
+        :param roi_mask: if given, the registration is computed on the bounding box of this mask only (enlarged by the margin in the roi settings) and the similarity measure is restricted to its voxels; the maps are returned for the full domain
+        :param roi_bounding_box: if given, the registration is computed on this bounding box only (list of [start,end) voxel indices for each spatial dimension)
         :return: n/a
         """
 
@@ -465,16 +548,7 @@ class RegisterImagePair(object):
                 else:
                     raise ValueError('Input image needs to be a numpy array')
 
-        if params is None:
-            self.params = pars.ParameterDict()
-        elif type(params) == pars.ParameterDict:
-            self.params = params
-        elif type(params) == type('acharacter'):
-            self.params = pars.ParameterDict()
-            self.params.load_JSON(params)
-            model_name = self.params['model']['registration_model']['type']
-        else:
-            raise ValueError('Unknown parameter format: ' + str(type(params)))
+        self.params, model_name = _get_registration_params(params, model_name)
 
         if use_batch_optimization or type(ISource) == torch.Tensor:
             self.ISource = ISource
@@ -485,38 +559,24 @@ class RegisterImagePair(object):
 
         self.spacing = spacing
 
+        if roi_mask is not None and type(roi_mask) != torch.Tensor:
+            roi_mask = AdaptVal(torch.from_numpy(roi_mask))
+
         if model_name not in self.available_models:
             print('Unknown model name: ' + model_name)
             MF.AvailableModels().print_available_models()
         else:
             # this model exists so let's use it
             self.useMap = self.available_models[model_name][2]
-            self.params['model']['deformation']['use_map'] = self.useMap
-            self.params['model']['registration_model']['type'] = model_name
-
-            if optimizer_name is not None:
-                self.params['optimizer']['name'] = optimizer_name
-
-            if nr_of_iterations is not None:
-                self.params['optimizer']['single_scale']['nr_of_iterations'] = nr_of_iterations
-
-            if similarity_measure_sigma is not None:
-                self.params['model']['registration_model']['similarity_measure']['sigma'] = similarity_measure_sigma
-
-            if similarity_measure_type is not None:
-                self.params['model']['registration_model']['similarity_measure']['type'] = similarity_measure_type
-
-            if compute_similarity_measure_at_low_res is not None:
-                self.params['model']['deformation']['compute_similarity_measure_at_low_res'] = compute_similarity_measure_at_low_res
-
-            if map_low_res_factor is not None:
-                self.params['model']['deformation']['map_low_res_factor'] = map_low_res_factor
-
-            if rel_ftol is not None:
-                self.params['optimizer']['single_scale']['rel_ftol'] = rel_ftol
-
-            if smoother_type is not None:
-                self.params['model']['registration_model']['forward_model']['smoother']['type'] = smoother_type
+            _set_registration_settings(self.params, model_name, self.useMap,
+                                       nr_of_iterations=nr_of_iterations,
+                                       similarity_measure_type=similarity_measure_type,
+                                       similarity_measure_sigma=similarity_measure_sigma,
+                                       compute_similarity_measure_at_low_res=compute_similarity_measure_at_low_res,
+                                       map_low_res_factor=map_low_res_factor,
+                                       rel_ftol=rel_ftol,
+                                       smoother_type=smoother_type,
+                                       optimizer_name=optimizer_name)
 
             if (checkpoint_dir is not None) and use_consensus_optimization:
                 self.params['optimizer']['consensus_settings']['checkpoint_output_directory'] = checkpoint_dir
@@ -533,7 +593,9 @@ class RegisterImagePair(object):
                                                                self.sz,
                                                                self.params,
                                                                compute_inverse_map=compute_inverse_map,
-                                                               default_learning_rate=learning_rate)
+                                                               default_learning_rate=learning_rate,
+                                                               roi_mask=roi_mask,
+                                                               roi_bounding_box=roi_bounding_box)
             else:
                 if use_consensus_optimization:
                     self.opt = MO.SimpleSingleScaleConsensusRegistration(self.ISource,
@@ -542,7 +604,9 @@ class RegisterImagePair(object):
                                                                          self.sz,
                                                                          self.params,
                                                                          compute_inverse_map=compute_inverse_map,
-                                                                         default_learning_rate=learning_rate)
+                                                                         default_learning_rate=learning_rate,
+                                                                         roi_mask=roi_mask,
+                                                                         roi_bounding_box=roi_bounding_box)
                 elif use_batch_optimization:
                     self.opt = MO.SimpleSingleScaleBatchRegistration(self.ISource,
                                                                      self.ITarget,
@@ -550,7 +614,9 @@ class RegisterImagePair(object):
                                                                      self.sz,
                                                                      self.params,
                                                                      compute_inverse_map=compute_inverse_map,
-                                                                     default_learning_rate=learning_rate)
+                                                                     default_learning_rate=learning_rate,
+                                                                     roi_mask=roi_mask,
+                                                                     roi_bounding_box=roi_bounding_box)
                 else:
                     self.opt = MO.SimpleSingleScaleRegistration(self.ISource,
                                                                 self.ITarget,
@@ -558,7 +624,9 @@ class RegisterImagePair(object):
                                                                 self.sz,
                                                                 self.params,
                                                                 compute_inverse_map=compute_inverse_map,
-                                                                default_learning_rate=learning_rate)
+                                                                default_learning_rate=learning_rate,
+                                                                roi_mask=roi_mask,
+                                                                roi_bounding_box=roi_bounding_box)
 
             if visualize_step is not None:
                 self.opt.get_optimizer().set_visualization(True)
@@ -570,6 +638,13 @@ class RegisterImagePair(object):
             if recording_step is not None:
                 self.opt.get_optimizer().set_recording_step(recording_step)
 
+            if use_affine_pre_registration:
+                if not self.useMap or use_batch_optimization:
+                    raise ValueError('Affine pre-registration is only supported for map-based models and without batch optimization')
+                affine_registration = AR.MultiResolutionAffineRegistration(self.spacing, self.params)
+                affine_registration.register(self.ISource, self.ITarget)
+                map0, map0_inverse = affine_registration.get_initial_maps(self.sz)
+                self.set_initial_map(map0, initial_inverse_map=map0_inverse)
 
             self.optimizer_has_been_initialized = True
 
@@ -584,8 +659,8 @@ class RegisterImagePair(object):
             if use_multi_scale and LSource is not None and LTarget is not None:
                 LSource = AdaptVal(torch.from_numpy(LSource)) if not type(LSource) == torch.Tensor else LSource
                 LTarget = AdaptVal(torch.from_numpy(LTarget)) if not type(LTarget) == torch.Tensor else LTarget
-                self.opt.optimizer.set_source_label( AdaptVal(LSource))
-                self.opt.optimizer.set_target_label( AdaptVal(LTarget))
+                self.opt.set_source_label( AdaptVal(LSource))
+                self.opt.set_target_label( AdaptVal(LTarget))
             if extra_info is not None:
                 self._set_analysis(self.opt.optimizer, extra_info)
 
@@ -596,3 +671,156 @@ class RegisterImagePair(object):
                     self.params.write_JSON_and_JSON_comments(json_config_out_filename)
                 else:
                     self.params.write_JSON(json_config_out_filename)
+
+
+class RegistrationSession(object):
+    """
+    Reusable registration session to register many image pairs of the same size with the same model.
+    The optimizer, the model (including its smoothers and Fourier filters) and the initial maps are created once for
+    a given (model, size, spacing). Between pairs only the individual (i.e., per-pair) model parameters and the
+    state of the optimizer are reset; shared parameters are kept.
+
+    .. code:: python
+
+        session = RegistrationSession(sz, spacing, model_name='lddmm_shooting_map', nr_of_iterations=50)
+        for warped_image, phi, phi_inverse in session.register_pairs(pairs):
+            ...
+    """
+
+    def __init__(self, sz, spacing, model_name=None,
+                 nr_of_iterations=None,
+                 learning_rate=None,
+                 similarity_measure_type=None,
+                 similarity_measure_sigma=None,
+                 map_low_res_factor=None,
+                 rel_ftol=None,
+                 smoother_type=None,
+                 optimizer_name=None,
+                 compute_inverse_map=False,
+                 params=None,
+                 print_iteration_output=False):
+        """
+        Constructor. Creates the optimizer and the model.
+
+        :param sz: size of the images (batch x channels x X x Y x Z); all registered pairs need to be of this size
+        :param spacing: image spacing [dx,dy,dz]
+        :param model_name: name of the desired registration model [string]
+        :param nr_of_iterations: nr of iterations (per pair)
+        :param learning_rate: learning rate of optimizer
+        :param similarity_measure_type: type of similarity measure ('ssd' or 'ncc')
+        :param similarity_measure_sigma: similarity measures are weighted by 1/sigma^2
+        :param map_low_res_factor: allows for parameterization of the registration at lower resolution than the image (0,1]
+        :param rel_ftol: relative function tolerance for optimizer
+        :param smoother_type: type of smoother (e.g., 'gaussian' or 'multiGaussian')
+        :param optimizer_name: name of the optimizer lbfgs_ls|adam|sgd
+        :param compute_inverse_map: for map-based models that inverse map can optionally be computed
+        :param params: parameter structure to pass settings or filename to load the settings from file.
+        :param print_iteration_output: if set to False (default) no output is printed for the individual iterations
+        """
+
+        self.available_models = MF.AvailableModels().get_models()
+
+        self.params, model_name = _get_registration_params(params, model_name)
+
+        if model_name not in self.available_models:
+            MF.AvailableModels().print_available_models()
+            raise ValueError('Unknown model name: ' + str(model_name))
+
+        self.sz = np.array(sz)
+        self.spacing = spacing
+        self.model_name = model_name
+        self.useMap = self.available_models[model_name][2]
+
+        # same settings as for RegisterImagePair.register_images
+        _set_registration_settings(self.params, model_name, self.useMap,
+                                   nr_of_iterations=nr_of_iterations,
+                                   similarity_measure_type=similarity_measure_type,
+                                   similarity_measure_sigma=similarity_measure_sigma,
+                                   map_low_res_factor=map_low_res_factor,
+                                   rel_ftol=rel_ftol,
+                                   smoother_type=smoother_type,
+                                   optimizer_name=optimizer_name)
+
+        self.opt = MO.SimpleSingleScaleRegistration(None, None, self.spacing, self.sz, self.params,
+                                                    compute_inverse_map=compute_inverse_map,
+                                                    default_learning_rate=learning_rate)
+
+        optimizer = self.opt.get_optimizer()
+        optimizer.set_visualization(False)
+        optimizer.set_visualize_step(None)
+        if not print_iteration_output:
+            optimizer.turn_iteration_output_off()
+
+        # the model graph (smoothers, Fourier filters, identity maps) is only built once here
+        optimizer.set_model(model_name)
+        self.initial_individual_parameters = optimizer.get_model_individual_parameters_snapshot()
+        """values to which the individual parameters are reset before each pair is registered"""
+
+        self.nr_of_registered_pairs = 0
+
+    def get_params(self):
+        """
+        Gets configuration parameters
+
+        :return: ParameterDict instance holding the algorithm parameters
+        """
+        return self.params
+
+    def get_opt(self):
+        """
+        Returns the simple registration object which is reused for all pairs
+
+        :return: SimpleSingleScaleRegistration instance
+        """
+        return self.opt
+
+    def _to_tensor(self, I):
+        if type(I) == torch.Tensor:
+            return AdaptVal(I)
+        elif type(I) == np.ndarray:
+            return AdaptVal(torch.from_numpy(I.copy()))
+        else:
+            raise ValueError('Input image needs to be a numpy array or a torch tensor')
+
+    def register(self, ISource, ITarget):
+        """
+        Registers one image pair (reusing the model of the session)
+
+        :param ISource: source image (of the size of the session)
+        :param ITarget: target image (of the size of the session)
+        :return: tuple (warped source image, map, inverse map); the maps are None for image-based models, the inverse
+            map is None if it is not computed
+        """
+
+        ISource = self._to_tensor(ISource)
+        ITarget = self._to_tensor(ITarget)
+
+        if list(ISource.size()) != list(self.sz) or list(ITarget.size()) != list(self.sz):
+            raise ValueError('Image size ' + str(list(ISource.size())) + ' does not match the size of the session ' + str(list(self.sz)))
+
+        optimizer = self.opt.get_optimizer()
+        if self.nr_of_registered_pairs > 0:
+            optimizer.reset_for_new_image_pair(self.initial_individual_parameters)
+
+        optimizer.register(ISource, ITarget)
+        self.nr_of_registered_pairs += 1
+
+        with torch.no_grad():
+            warped_image = optimizer.get_warped_image()
+            warped_image = warped_image.detach() if warped_image is not None else None
+            phi = optimizer.get_map()
+            phi = phi.detach() if phi is not None else None
+            phi_inverse = optimizer.get_inverse_map()
+            phi_inverse = phi_inverse.detach() if phi_inverse is not None else None
+
+        return warped_image, phi, phi_inverse
+
+    def register_pairs(self, pairs):
+        """
+        Registers a sequence of image pairs
+
+        :param pairs: iterable of (source image, target image) tuples
+        :return: generator yielding a tuple (warped source image, map, inverse map) per pair (see register)
+        """
+        for ISource, ITarget in pairs:
+            yield self.register(ISource, ITarget)
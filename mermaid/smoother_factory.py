@@ -14,9 +14,11 @@ import torch.nn.functional as F
 import numpy as np
 import numpy.testing as npt
 
-from .data_wrapper import USE_CUDA, MyTensor, AdaptVal
+from .data_wrapper import USE_CUDA, MyTensor, AdaptVal, amp_autocast, FP32Val
 from . import finite_differences as fd
 from . import utils
+from . import profiling
+from . import spectral_operators as SO
 # if float(torch.__version__[:3])<=1.1:
 #     from . import custom_pytorch_extensions as ce
 # else:
@@ -106,6 +108,16 @@ class Smoother(with_metaclass(ABCMeta, object)):
         """
         return 0
 
+    def set_inference_mode(self, inference_mode=True):
+        """
+        Can be overwritten by smoothers which contain learned networks; switches these networks into (or out of)
+        an inference mode which is faster for evaluation only (e.g., noise-free, folded convolutions).
+
+        :param inference_mode: if True inference mode is turned on, otherwise it is turned off
+        :return: n/a
+        """
+        pass
+
     def set_state_dict(self,state_dict):
         """
         If the smoother contains a torch state-dict, this function allows setting it externally (to initialize as needed).
@@ -228,17 +240,18 @@ class Smoother(with_metaclass(ABCMeta, object)):
         """
         sz = v.size()
         self.batch_size = sz[0]
-        if not multi_output:
-            if vout is not None:
-                Sv = vout
-            else:
-                Sv = MyTensor(v.size()).zero_()
+        with profiling.phase('smoothing'):
+            if not multi_output:
+                if vout is not None:
+                    Sv = vout
+                else:
+                    Sv = MyTensor(v.size()).zero_()
 
-            Sv[:] = self.apply_smooth(v,vout,pars,variables_from_optimizer, smooth_to_compute_regularizer_energy, clampCFL_dt)    # here must use :, very important !!!!
-            return Sv
-        else:
-            output = self.apply_smooth(v,vout,pars,variables_from_optimizer, smooth_to_compute_regularizer_energy, clampCFL_dt)
-            return output
+                Sv[:] = self.apply_smooth(v,vout,pars,variables_from_optimizer, smooth_to_compute_regularizer_energy, clampCFL_dt)    # here must use :, very important !!!!
+                return Sv
+            else:
+                output = self.apply_smooth(v,vout,pars,variables_from_optimizer, smooth_to_compute_regularizer_energy, clampCFL_dt)
+                return output
 
 
 
@@ -251,6 +264,8 @@ class DiffusionSmoother(Smoother):
         super(DiffusionSmoother,self).__init__(sz,spacing,params)
         self.iter = params[('iter', 5, 'Number of iterations' )]
         """number of iterations"""
+        self.use_fourier = params[('use_fourier', False, 'if True all iterations are applied at once in the Fourier domain (assumes periodic boundary conditions)')]
+        """if True the iterations are applied via their Fourier symbol"""
 
     def set_iter(self,iter):
         """
@@ -282,6 +297,20 @@ class DiffusionSmoother(Smoother):
         :return: smoothed image
         """
 
+        # multiply with smallest h^2 and divide by 2^dim to assure stability
+        tau = 0.5/(2**self.dim)*self.spacing.min()**2
+        nr_of_steps = self.iter*2**self.dim # so that we smooth the same indepdenent of dimension
+
+        if self.use_fourier:
+            # the explicit steps are diagonal in the Fourier domain, so all of them can be applied with two FFTs
+            symbol = SO.get_diffusion_symbol(v.size()[-self.dim:], self.spacing, tau, nr_of_steps, dtype=FP32Val(v).dtype, device=v.device)
+            Sv = self._do_CFL_clamping_if_necessary(SO.apply_symbol(v, symbol), clampCFL_dt=clampCFL_dt)
+            if vout is not None:
+                vout[:] = Sv
+                return vout
+            else:
+                return Sv
+
         # basically just solving the heat equation for a few steps
         if vout is not None:
             Sv = vout
@@ -289,10 +318,9 @@ class DiffusionSmoother(Smoother):
             Sv = v.clone()
 
         # now iterate and average based on the neighbors
-        for i in range(0,self.iter*2**self.dim): # so that we smooth the same indepdenent of dimension
-            # multiply with smallest h^2 and divide by 2^dim to assure stability
+        for i in range(0,nr_of_steps):
             for c in range(Sv.size()[1]):
-                Sv[:,c] = Sv[:,c] + 0.5/(2**self.dim)*self.fdt.lap(Sv[:,c])*self.spacing.min()**2 # multiply with smallest h^2 to assure stability
+                Sv[:,c] = Sv[:,c] + tau*self.fdt.lap(Sv[:,c])
 
 
         Sv = self._do_CFL_clamping_if_necessary(Sv,clampCFL_dt=clampCFL_dt)
@@ -300,6 +328,44 @@ class DiffusionSmoother(Smoother):
         return Sv
 
 
+class HelmholtzFourierSmoother(Smoother):
+    """
+    Smoothing with a power of the inverse Helmholtz operator :math:`L=\\gamma-\\alpha\\Delta` in the Fourier domain,
+    i.e., :math:`K=(L^\\dagger L)^{-1}` for the default power of 2 (assumes periodic boundary conditions).
+    The symbol is cached, so smoothing requires two FFTs.
+    """
+
+    def __init__(self, sz, spacing, params):
+        super(HelmholtzFourierSmoother,self).__init__(sz,spacing,params)
+        self.alpha = params[('alpha', 0.2, 'penalty for the 2nd derivative of the Helmholtz operator')]
+        """penalty for second derivative"""
+        self.gamma = params[('gamma', 1.0, 'penalty for the magnitude of the Helmholtz operator')]
+        """penalty for magnitude"""
+        self.power = params[('power', 2, 'the smoother is the inverse of this power of the Helmholtz operator (2: inverse of L^\\dagger L)')]
+        """power of the Helmholtz operator which is inverted"""
+
+    def apply_smooth(self, v, vout=None, pars=dict(), variables_from_optimizer=None, smooth_to_compute_regularizer_energy=False, clampCFL_dt=None):
+        """
+        Smoothes a vector field by applying the inverse Helmholtz operator in the Fourier domain
+
+        :param v: field to smooth, BxCxXxYxZ
+        :param vout: if not None returns the result in this variable
+        :param pars: dictionary that can contain various extra variables; for smoother this will for example be
+            the current image 'I' or the current map 'phi'. typically not used.
+        :param variables_from_optimizer: variables that can be passed from the optimizer (for example iteration count)
+        :return: smoothed field
+        """
+        symbol = SO.get_helmholtz_symbol(v.size()[-self.dim:], self.spacing, self.alpha, self.gamma, -self.power,
+                                         dtype=FP32Val(v).dtype, device=v.device)
+        smoothed_v = self._do_CFL_clamping_if_necessary(SO.apply_symbol(v, symbol), clampCFL_dt=clampCFL_dt)
+
+        if vout is not None:
+            vout[:] = smoothed_v
+            return vout
+        else:
+            return smoothed_v
+
+
 class GaussianSmoother(Smoother):
     """
     Gaussian smoothing in the spatial domain (hence, SLOW in high dimensions on the CPU at least).
@@ -419,7 +485,9 @@ class GaussianSpatialSmoother(GaussianSmoother):
             self._create_filter()
         # just doing a Gaussian smoothing
 
-        smoothed_v = self._filter_input_with_padding(v, vout)
+        # the spatial convolution can run in mixed precision, the smoothed field is returned in float32
+        with amp_autocast():
+            smoothed_v = FP32Val(self._filter_input_with_padding(v, vout))
         smoothed_v = self._do_CFL_clamping_if_necessary(smoothed_v,clampCFL_dt=clampCFL_dt)
 
         return smoothed_v
@@ -1255,6 +1323,15 @@ class LearnedMultiGaussianCombinationFourierSmoother(GaussianSmoother):
         self.pre_multi_gaussian_weights_optimizer_params.data.zero_()
         return self.pre_multi_gaussian_weights_optimizer_params
 
+    def set_inference_mode(self, inference_mode=True):
+        """
+        Switches the network which predicts the weights into (or out of) inference mode
+
+        :param inference_mode: if True inference mode is turned on, otherwise it is turned off
+        :return: n/a
+        """
+        self.ws.set_inference_mode(inference_mode)
+
     def get_penalty(self):
         # puts an squared two-norm penalty on the weights as deviations from the baseline
         # also adds a penalty for the network parameters
@@ -1640,6 +1717,7 @@ class AvailableSmoothers(object):
         # (smoother, description)
         self.smoothers = {
             'diffusion': (DiffusionSmoother,'smoothing via iterative solution of the diffusion equation'),
+            'helmholtz': (HelmholtzFourierSmoother, 'smoothing with the inverse Helmholtz operator in the Fourier domain'),
             'gaussian': (SingleGaussianFourierSmoother, 'Gaussian smoothing in the Fourier domain'),
             'adaptive_gaussian': (AdaptiveSingleGaussianFourierSmoother, 'Gaussian smoothing in the Fourier domain w/ optimization over std'),
             'multiGaussian': (MultiGaussianFourierSmoother, 'Multi Gaussian smoothing in the Fourier domain'),
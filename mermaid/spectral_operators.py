@@ -0,0 +1,206 @@
+"""
+Spectral (Fourier-domain) versions of the Laplacian and Helmholtz operators.
+
+On a periodic domain the finite difference Laplacian (with central differences, as in :mod:`mermaid.finite_differences`)
+is diagonal in the Fourier domain, with symbol :math:`\\sum_i -\\frac{4}{h_i^2}\\sin^2(\\pi k_i/N_i)`. Hence, the
+Helmholtz operator :math:`L=\\gamma-\\alpha\\Delta` and all its powers (for example :math:`L^{-1}`, :math:`L^{-1/2}`
+or :math:`L^\\dagger L=L^2`) can be applied with one forward and one inverse FFT, independent of the power
+(and, for example, of the number of explicit diffusion steps which are to be emulated).
+
+The symbols only depend on the size, the spacing and the operator parameters. They are memoized
+(least recently used entries are dropped first), so they are only created once per configuration.
+
+.. note::
+    The operators assume periodic boundary conditions, which differ from the boundary conditions of the finite
+    difference operators. Results therefore only agree away from the boundary (or for periodic fields).
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .data_wrapper import USE_CUDA, FP32Val
+
+if hasattr(torch, 'fft') and hasattr(torch.fft, 'rfftn'):
+    # torch >= 1.7 (complex tensors)
+    def _rfftn(x, dim):
+        return torch.fft.rfftn(x, dim=tuple(range(-dim, 0)))
+
+    def _irfftn(X, dim, signal_sizes):
+        return torch.fft.irfftn(X, s=tuple(signal_sizes), dim=tuple(range(-dim, 0)))
+
+    def _multiply_by_symbol(X, symbol):
+        return X * symbol
+else:
+    # legacy interface, complex numbers are stored in the last dimension
+    def _rfftn(x, dim):
+        return torch.rfft(x, dim, onesided=True)
+
+    def _irfftn(X, dim, signal_sizes):
+        return torch.irfft(X, dim, onesided=True, signal_sizes=list(signal_sizes))
+
+    def _multiply_by_symbol(X, symbol):
+        return X * symbol.unsqueeze(-1)
+
+
+_symbol_cache = OrderedDict()
+"""memoized Fourier symbols (least recently used entries are dropped first)"""
+_symbol_cache_max_nr_of_entries = 32
+
+
+def set_symbol_cache_size(max_nr_of_entries):
+    """Sets the maximal number of symbols which are kept in the cache.
+
+    :param max_nr_of_entries: maximal number of cached symbols (0 disables the cache)
+    """
+    global _symbol_cache_max_nr_of_entries
+    _symbol_cache_max_nr_of_entries = max_nr_of_entries
+    while len(_symbol_cache) > _symbol_cache_max_nr_of_entries:
+        _symbol_cache.popitem(last=False)
+
+
+def clear_symbol_cache():
+    """Removes all cached symbols (e.g., to free device memory)."""
+    _symbol_cache.clear()
+
+
+def _get_device(device):
+    if device is None:
+        return torch.device('cuda') if USE_CUDA else torch.device('cpu')
+    else:
+        return torch.device(device)
+
+
+def _get_cached_symbol(key, create_symbol):
+    symbol = _symbol_cache.pop(key, None)
+    if symbol is None:
+        symbol = create_symbol()
+    if _symbol_cache_max_nr_of_entries > 0:
+        _symbol_cache[key] = symbol
+        while len(_symbol_cache) > _symbol_cache_max_nr_of_entries:
+            _symbol_cache.popitem(last=False)
+    return symbol
+
+
+def _compute_negative_laplacian_symbol(sz, spacing):
+    """
+    Computes the symbol of the negative (i.e., positive semi-definite) discrete Laplacian on the one-sided
+    frequency grid of the real FFT
+
+    :param sz: spatial size [X,Y,Z]
+    :param spacing: spacing [dx,dy,dz]
+    :return: numpy array of size X x Y x (Z//2+1)
+    """
+    dim = len(sz)
+    symbol = np.zeros([int(s) for s in sz[:-1]] + [int(sz[-1]) // 2 + 1], dtype='float64')
+    for d in range(dim):
+        nr_of_frequencies = symbol.shape[d]
+        k = np.arange(nr_of_frequencies, dtype='float64')
+        s = 4. / (spacing[d] ** 2) * np.sin(np.pi * k / sz[d]) ** 2
+        shape = [1] * dim
+        shape[d] = nr_of_frequencies
+        symbol = symbol + s.reshape(shape)
+    return symbol
+
+
+def get_laplacian_symbol(sz, spacing, dtype=torch.float32, device=None):
+    """
+    Returns the Fourier symbol of the (periodic) discrete Laplacian
+
+    :param sz: spatial size [X,Y,Z] (without batch and channel dimensions)
+    :param spacing: spacing [dx,dy,dz]
+    :param dtype: torch data type
+    :param device: device of the symbol; if None the default device is used
+    :return: real tensor of size X x Y x (Z//2+1)
+    """
+    device = _get_device(device)
+    key = ('laplacian', tuple(int(s) for s in sz), tuple(float(s) for s in spacing), dtype, str(device))
+
+    def create_symbol():
+        return torch.from_numpy(-_compute_negative_laplacian_symbol(sz, spacing)).to(device=device, dtype=dtype)
+
+    return _get_cached_symbol(key, create_symbol)
+
+
+def get_helmholtz_symbol(sz, spacing, alpha, gamma, power=1., dtype=torch.float32, device=None):
+    """
+    Returns the Fourier symbol of a power of the (periodic) Helmholtz operator :math:`L=\\gamma-\\alpha\\Delta`,
+    i.e., power=1 for :math:`L`, power=-1 for :math:`L^{-1}`, power=-0.5 for :math:`L^{-1/2}` and power=2 for
+    :math:`L^\\dagger L`
+
+    :param sz: spatial size [X,Y,Z] (without batch and channel dimensions)
+    :param spacing: spacing [dx,dy,dz]
+    :param alpha: penalty for the second derivative
+    :param gamma: penalty for the magnitude
+    :param power: power of the operator
+    :param dtype: torch data type
+    :param device: device of the symbol; if None the default device is used
+    :return: real tensor of size X x Y x (Z//2+1)
+    """
+    if power < 0 and gamma <= 0:
+        raise ValueError('The Helmholtz operator can only be inverted for gamma>0')
+
+    device = _get_device(device)
+    key = ('helmholtz', tuple(int(s) for s in sz), tuple(float(s) for s in spacing),
+           float(alpha), float(gamma), float(power), dtype, str(device))
+
+    def create_symbol():
+        symbol = (gamma + alpha * _compute_negative_laplacian_symbol(sz, spacing)) ** power
+        return torch.from_numpy(symbol).to(device=device, dtype=dtype)
+
+    return _get_cached_symbol(key, create_symbol)
+
+
+def get_diffusion_symbol(sz, spacing, tau, nr_of_steps, dtype=torch.float32, device=None):
+    """
+    Returns the Fourier symbol of nr_of_steps explicit diffusion steps :math:`(1+\\tau\\Delta)^n`
+
+    :param sz: spatial size [X,Y,Z] (without batch and channel dimensions)
+    :param spacing: spacing [dx,dy,dz]
+    :param tau: time step of the explicit diffusion steps
+    :param nr_of_steps: number of diffusion steps
+    :param dtype: torch data type
+    :param device: device of the symbol; if None the default device is used
+    :return: real tensor of size X x Y x (Z//2+1)
+    """
+    device = _get_device(device)
+    key = ('diffusion', tuple(int(s) for s in sz), tuple(float(s) for s in spacing),
+           float(tau), int(nr_of_steps), dtype, str(device))
+
+    def create_symbol():
+        symbol = (1. - tau * _compute_negative_laplacian_symbol(sz, spacing)) ** int(nr_of_steps)
+        return torch.from_numpy(symbol).to(device=device, dtype=dtype)
+
+    return _get_cached_symbol(key, create_symbol)
+
+
+def apply_symbol(v, symbol):
+    """
+    Applies an operator given by its Fourier symbol to the trailing spatial dimensions of a field
+
+    :param v: field, format ...xXxYxZ (arbitrary leading batch/channel dimensions)
+    :param symbol: real symbol as returned by get_laplacian_symbol, get_helmholtz_symbol or get_diffusion_symbol
+    :return: filtered field (same size as v)
+    """
+    dim = symbol.dim()
+    v = FP32Val(v)
+    return _irfftn(_multiply_by_symbol(_rfftn(v, dim), symbol), dim, v.size()[-dim:])
+
+
+def apply_helmholtz_operator(v, spacing, alpha, gamma, power=1.):
+    """
+    Applies a power of the (periodic) Helmholtz operator :math:`L=\\gamma-\\alpha\\Delta` to a field
+
+    :param v: field, format ...xXxYxZ (the spatial dimension is given by the spacing)
+    :param spacing: spacing [dx,dy,dz]
+    :param alpha: penalty for the second derivative
+    :param gamma: penalty for the magnitude
+    :param power: power of the operator (see get_helmholtz_symbol)
+    :return: :math:`L^{power}v`
+    """
+    dim = len(spacing)
+    symbol = get_helmholtz_symbol(v.size()[-dim:], spacing, alpha, gamma, power, dtype=FP32Val(v).dtype, device=v.device)
+    return apply_symbol(v, symbol)
@@ -29,12 +29,14 @@ class SplineInterpolation_ND_BCXYZ(Module):
     avoid loops over pixels to obtain a reasonably high performance interpolation.
 
     """
-    def __init__(self, spacing, spline_order):
+    def __init__(self, spacing, spline_order, vectorized=None, deterministic=None):
         """
         Constructor for spline interpolation
 
         :param spacing: spacing of the map which will be used for interpolation (this is NOT the spacing of the image data from which to compute the interpolation coefficient)
         :param spline_order: desired order of the spline: [3,4,5,6,7,8,9]
+        :param vectorized: if True the spline taps are processed vectorized (if None the module default is used, see set_default_backward_mode)
+        :param deterministic: if True the gradient wrt. the coefficients is accumulated in a fixed order (if None the module default is used)
         """
         super(SplineInterpolation_ND_BCXYZ, self).__init__()
 
@@ -44,6 +46,11 @@ class SplineInterpolation_ND_BCXYZ(Module):
         self.spline_order = spline_order
         """spline order"""
 
+        self.vectorized = vectorized
+        """if True the interpolation and its gradient are computed for all taps at once"""
+        self.deterministic = deterministic
+        """if True the gradient wrt. the interpolation coefficients is accumulated in a fixed order"""
+
         self.n = spline_order # convenience short-hand for the spline order
         self.Ns = None # image dimension
 
@@ -555,14 +562,14 @@ class SplineInterpolation_ND_BCXYZ(Module):
             lt_z = (index[:,:,d,...]<0)
             ge_z = (index[:,:,d,...]>=0)
 
-            index[:,:,d,...][lt_z] = (-index[:,:,d,...][lt_z] - width2 * ((-index[:,:,d,...][lt_z]) / width2))
-            index[:,:,d,...][ge_z] = (index[:,:,d,...][ge_z] - width2 * (index[:,:,d,...][ge_z] / width2))
+            index[:,:,d,...][lt_z] = (-index[:,:,d,...][lt_z] - width2 * ((-index[:,:,d,...][lt_z]) // width2))
+            index[:,:,d,...][ge_z] = (index[:,:,d,...][ge_z] - width2 * (index[:,:,d,...][ge_z] // width2))
 
             ge_w = (index[:,:,d,...]>=width)
             index[:,:,d,...][ge_w] = width2 - index[:,:,d,...][ge_w]
 
         # perform interpolation (using a helper function to avoid large memory consumption of autograd)
-        w = perform_spline_interpolation_helper(c,weight,index)
+        w = perform_spline_interpolation_helper(c,weight,index,self.vectorized,self.deterministic)
 
         return w
 
@@ -586,215 +593,465 @@ class SplineInterpolation_ND_BCXYZ(Module):
 # functionals to avoid excessive memory consumption
 
 
-class PerformSplineInterpolationHelper(Function):
+use_vectorized_backward = True
+"""if True the spline interpolation (and its gradient) is computed for all taps of all but the first dimension at once instead of looping over batch, channels, and taps"""
+use_deterministic_accumulation = False
+"""if True the gradient wrt. the coefficients is accumulated in a fixed order (reproducible, but slower than index_add_)"""
+
+
+def set_default_backward_mode(vectorized=True, deterministic=False):
     """
-    Performs spline interpolation, given weights, indices, and coefficients.
-    This is simply a convenience class which avoids computing the gradient of the actual interpolation via automatic differentiation
-    (as this would be very memory intensive).
+    Sets how the spline interpolation gradients are computed by default
+
+    :param vectorized: if True the spline taps are gathered at once (one tap of the first dimension at a time, to bound
+        the memory) and accumulated by index_add_; otherwise the (slow) reference implementation which loops over batch,
+        channels, and taps is used
+    :param deterministic: if True the gradient wrt. the coefficients is accumulated in a fixed order, so results are reproducible
+        (also used if torch's deterministic algorithms are enabled)
+    :return: n/a
     """
+    global use_vectorized_backward, use_deterministic_accumulation
+    use_vectorized_backward = vectorized
+    use_deterministic_accumulation = deterministic
 
-    def __init__(self,index):
-        """
-        Constructor
 
-        :param index: index array for interpolation (as computed from _compute_interpolation_weights)
-        """
-        super(PerformSplineInterpolationHelper, self).__init__()
-        self.index = index
+def _get_linear_view(t):
+    """
+    Takes a tensor and converts it to a linear view (needed for fast accumulation via put_)
 
-    def forward(self, c, weight):
-        """
-        Performs the interpolation for given coefficients and weights (we do not compute the gradient wrt. the indices)
+    :param t: tensor
+    :return: linearized view
+    """
 
-        :param c: interpolation coefficients
-        :param weight: interpolation weights
-        :return: interpolated signal
-        """
+    lt = t.view(t.nelement())
+    return lt
+
+
+def _sub2ind(indices,target_sz):
+    """
+    Similar to matlab's sub2ind. Converts ijk indices to a linear index
+
+    :param indices: ijk indices (as a list)
+    :param target_sz: target size to which these indices belong
+    :return: linearized indices
+    """
+
+    aug_t_sz = list(target_sz) + [1] # augment one here, so we can easily compute the strides via products
+    dim = len(indices) # this is stored in a list
+    l_indices = MyLongTensor(indices[0].nelement()).zero_()
+    for d in range(dim):
+        l_indices += _get_linear_view(indices[d])*int(np.prod(aug_t_sz[d+1:]))
+    return l_indices
+
+
+def _accumulate(vals,indices,target_sz):
+    """
+    Necessary to compute the adjoint to the indexing into the coefficient array. Here we add entries based on where
+    they were mapped from (via indexing).
+
+    :param vals: Values
+    :param indices: indices
+    :param target_sz: target size
+    :return: Returns accumulated values
+    """
+
+    acc_res = MyTensor(target_sz).zero_()
 
-        # perform interpolation
-
-        sz_weight = weight.size()
-        self.batch_size = c.size()[0]
-        self.nr_of_channels = c.size()[1]
-        self.n = sz_weight[0]-1
-        self.dim = sz_weight[2]
-
-        self.c = c
-        self.weight = weight
-
-        w = MyTensor(*([self.batch_size, self.nr_of_channels] + list(sz_weight[3:]))).zero_()
-
-        if self.dim==1:
-            for b in range(0,self.batch_size):
-                b_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(b)
-                for ch in range(0,self.nr_of_channels):
-                    ch_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(ch)
-                    for k1 in range(0,self.n+1):
-                        w[b,ch,...] += weight[k1,b,0,...] * c[b_ind,ch_ind,self.index[k1,b,0,...]]
-        elif self.dim==2:
-            for b in range(0, self.batch_size):
-                b_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(b)
-                for ch in range(0, self.nr_of_channels):
-                    ch_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(ch)
-                    for k1 in range(0, self.n + 1):
-                        for k2 in range(0, self.n+1):
-                            w[b, ch, ...] += weight[k1, b, 0, ...] * weight[k2,b,1,...] \
-                                            * c[b_ind, ch_ind, self.index[k1, b, 0, ...],(self.index[k2,b,1,...])]
-        elif self.dim ==3:
-            for b in range(0, self.batch_size):
-                b_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(b)
-                for ch in range(0, self.nr_of_channels):
-                    ch_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(ch)
-                    for k1 in range(0, self.n + 1):
-                        for k2 in range(0, self.n + 1):
-                            for k3 in range(0, self.n+1):
-                                w[b,ch,...] +=  weight[k1, b, 0, ...] * weight[k2, b, 1, ...] * weight[k3,b,2,...] \
-                                                * c[b_ind, ch_ind, self.index[k1, b, 0, ...], self.index[k2, b, 1, ...], self.index[k3, b, 2, ...]]
+    l_acc_res = _get_linear_view(acc_res)
+    l_vals = _get_linear_view(vals)
+    l_indices = _sub2ind(indices,target_sz)
+
+    l_acc_res.put_(l_indices,l_vals,accumulate=True)
+
+    return acc_res
+
+
+def _accumulate_deterministically(vals, l_indices, nr_of_elements):
+    """
+    Adds the values into a linear array of the given size at the given (linear) indices. In contrast to index_add_
+    (which uses atomic additions on the GPU) the values are always summed in the same order: they are sorted by target
+    index (and by position for equal indices) and the segments are summed via a cumulative sum in double precision.
+
+    :param vals: values (linear)
+    :param l_indices: linear indices (same size as vals)
+    :param nr_of_elements: number of elements of the result
+    :return: accumulated values (linear)
+    """
+    nr_of_vals = vals.nelement()
+    # the keys are unique, hence the sorting order is uniquely defined
+    keys = l_indices * nr_of_vals + torch.arange(nr_of_vals, device=l_indices.device)
+    perm = torch.sort(keys)[1]
+
+    sorted_indices = l_indices[perm]
+    cumulative_vals = torch.cumsum(vals[perm].double(), 0)
+
+    unique_indices, counts = torch.unique_consecutive(sorted_indices, return_counts=True)
+    ends = torch.cumsum(counts, 0) - 1
+    segment_sums = cumulative_vals[ends]
+    segment_sums[1:] = segment_sums[1:] - cumulative_vals[ends[:-1]]
+
+    acc_res = torch.zeros(nr_of_elements, dtype=vals.dtype, device=vals.device)
+    acc_res[unique_indices] = segment_sums.to(vals.dtype)
+    return acc_res
+
+
+def _get_tap_weight(weight, d, first_tap):
+    """
+    Returns the interpolation weights of dimension d, shaped so that they broadcast over the tap dimensions
+
+    :param weight: interpolation weights ((n+1) x B x dim x X x Y x Z)
+    :param d: spatial dimension
+    :param first_tap: tap of the first dimension which is processed (see _get_tap_indices_and_weights)
+    :return: weights of size 1 x ... x (n+1) x ... x 1 x B x X x Y x Z (the taps of dimension d along tap dimension d)
+    """
+    dim = weight.size()[2]
+    shape = [1] * dim + [weight.size()[1]] + list(weight.size()[3:])
+    if d == 0:
+        return weight[first_tap:first_tap + 1, :, 0, ...].view(shape)
+    shape[d] = weight.size()[0]
+    return weight[:, :, d, ...].view(shape)
+
+
+def _get_tap_indices_and_weights(sz_c, weight, index, first_tap):
+    """
+    Computes the linear indices (into the spatial dimensions of the coefficients) and the weights of the spline taps
+    for one tap of the first dimension and all (n+1)^(dim-1) taps of the other dimensions. Processing the taps of
+    the first dimension one after the other bounds the size of the temporaries by (n+1)^(dim-1) (instead of (n+1)^dim)
+    times the number of interpolation points.
+
+    :param sz_c: size of the coefficient array (BxCxXxYxZ)
+    :param weight: interpolation weights ((n+1) x B x dim x X x Y x Z)
+    :param index: interpolation indices ((n+1) x B x dim x X x Y x Z)
+    :param first_tap: tap of the first dimension
+    :return: tuple (linear indices, weights), both of size 1 x (n+1) x ... x (n+1) x B x X x Y x Z (with dim tap dimensions)
+    """
+    dim = weight.size()[2]
+
+    l_indices = None
+    tap_weights = None
+    for d in range(dim):
+        stride = int(np.prod(sz_c[2 + d + 1:]))
+        cur_indices = _get_tap_weight(index, d, first_tap) * stride
+        cur_weights = _get_tap_weight(weight, d, first_tap)
+        if l_indices is None:
+            l_indices = cur_indices
+            tap_weights = cur_weights
         else:
-            raise ValueError('Dimension needs to be 1, 2, or 3.')
+            l_indices = l_indices + cur_indices
+            tap_weights = tap_weights * cur_weights
 
-        return w
+    return l_indices, tap_weights
 
-    def _get_linear_view(self,t):
-        """
-        Takes a tensor and converts it to a linear view (needed for fast accumulation via put_)
 
-        :param t: tensor
-        :return: linearized view
-        """
+def _gather_taps(c, l_indices):
+    """
+    Gathers the coefficients for the taps
 
-        lt = t.view(t.nelement())
-        return lt
+    :param c: coefficients (BxCxXxYxZ)
+    :param l_indices: linear tap indices as computed by _get_tap_indices_and_weights
+    :return: coefficients for the taps; nr_of_taps x B x C x (number of interpolation points)
+    """
+    batch_size = c.size()[0]
+    nr_of_channels = c.size()[1]
+    dim = c.dim() - 2
+    nr_of_points = int(np.prod(l_indices.size()[dim + 1:])) # the leading dim dimensions are the tap dimensions
+    c_flat = c.reshape(1, batch_size, nr_of_channels, -1)
+    l_indices = l_indices.reshape(-1, batch_size, 1, nr_of_points)
+    return torch.gather(c_flat.expand(l_indices.size()[0], -1, -1, -1), 3,
+                        l_indices.expand(-1, -1, nr_of_channels, -1))
 
-    def _sub2ind(self,indices,target_sz):
-        """
-        Similar to matlab's sub2ind. Converts ijk indices to a linear index
 
-        :param indices: ijk indices (as a list)
-        :param target_sz: target size to which these indices belong
-        :return: linearized indices
-        """
+def _interpolate_vectorized(c, weight, index):
+    """
+    Performs the interpolation for all taps of all but the first dimension at once (looping over the taps of the first one)
+
+    :param c: interpolation coefficients
+    :param weight: interpolation weights
+    :param index: interpolation indices
+    :return: interpolated signal
+    """
+    w = None
+    for first_tap in range(weight.size()[0]):
+        l_indices, tap_weights = _get_tap_indices_and_weights(c.size(), weight, index, first_tap)
+        c_taps = _gather_taps(c, l_indices)
+        cur_w = (c_taps * tap_weights.reshape(c_taps.size()[0], c_taps.size()[1], 1, -1)).sum(0)
+        w = cur_w if w is None else w + cur_w
+    return w.view([c.size()[0], c.size()[1]] + list(weight.size()[3:]))
+
 
-        aug_t_sz = list(target_sz) + [1] # augment one here, so we can easily compute the strides via products
-        dim = len(indices) # this is stored in a list
-        l_indices = MyLongTensor(indices[0].nelement()).zero_()
+def _interpolate_backward_vectorized(c, weight, index, grad_output, deterministic=False):
+    """
+    Computes the gradient with respect to the coefficients and the weights for all taps of all but the first
+    dimension at once (looping over the taps of the first one)
+
+    :param c: interpolation coefficients
+    :param weight: interpolation weights
+    :param index: interpolation indices
+    :param grad_output: grad output from previous "layer"
+    :param deterministic: if True the gradient wrt. the coefficients is accumulated in a fixed order
+    :return: tuple (gradient wrt. c, gradient wrt. weight)
+    """
+    batch_size = c.size()[0]
+    nr_of_channels = c.size()[1]
+    dim = weight.size()[2]
+    nr_of_taps = weight.size()[0]
+    nr_of_points = int(np.prod(weight.size()[3:]))
+    nr_of_coefficients = int(np.prod(c.size()[2:]))
+
+    grad_output = grad_output.reshape(1, batch_size, nr_of_channels, -1)
+    offsets = (torch.arange(batch_size * nr_of_channels, device=c.device) * nr_of_coefficients).view(1, batch_size, nr_of_channels, 1)
+
+    grad_c = None
+    grad_weight = torch.zeros_like(weight)
+    for first_tap in range(nr_of_taps):
+        l_indices, tap_weights = _get_tap_indices_and_weights(c.size(), weight, index, first_tap)
+
+        # gradient wrt. the coefficients: one scatter-add for these taps and all images and channels
+        full_indices = (l_indices.reshape(-1, batch_size, 1, nr_of_points) + offsets).view(-1)
+        vals = (tap_weights.reshape(-1, batch_size, 1, nr_of_points) * grad_output).view(-1)
+        if deterministic:
+            cur_grad_c = _accumulate_deterministically(vals, full_indices, c.nelement())
+        else:
+            cur_grad_c = torch.zeros(c.nelement(), dtype=c.dtype, device=c.device).index_add_(0, full_indices, vals)
+        # the taps are always added in the same order
+        grad_c = cur_grad_c if grad_c is None else grad_c + cur_grad_c
+
+        # gradient wrt. the weights: the derivative of the tap weight wrt. the weight in dimension d is the
+        # product of the weights of all other dimensions
+        c_taps_times_grad = (_gather_taps(c, l_indices) * grad_output).sum(2)
+        c_taps_times_grad = c_taps_times_grad.view(list(l_indices.size()[:dim]) + [batch_size, -1])
         for d in range(dim):
-            l_indices += self._get_linear_view(indices[d])*int(np.prod(aug_t_sz[d+1:]))
-        return l_indices
+            g = c_taps_times_grad
+            for e in range(dim):
+                if e != d:
+                    w_e = _get_tap_weight(weight, e, first_tap)
+                    g = g * w_e.reshape(list(w_e.size()[:dim]) + [batch_size, -1])
+            other_tap_dims = [e for e in range(dim) if e != d]
+            if len(other_tap_dims) > 0:
+                g = g.sum(dim=other_tap_dims, keepdim=True)
+            if d == 0:
+                grad_weight[first_tap, :, 0, ...] = g.view(weight[first_tap, :, 0, ...].size())
+            else:
+                grad_weight[:, :, d, ...] += g.view(weight[:, :, d, ...].size())
+
+    return grad_c.view(c.size()), grad_weight
+
+
+def _interpolate_by_looping(c, weight, index):
+    """
+    Performs the interpolation by looping over images, channels, and taps (reference implementation)
 
-    def _accumulate(self,vals,indices,target_sz):
-        """
-        Necessary to compute the adjoint to the indexing into the coefficient array. Here we add entries based on where
-        they were mapped from (via indexing).
+    :param c: interpolation coefficients
+    :param weight: interpolation weights
+    :param index: interpolation indices
+    :return: interpolated signal
+    """
 
-        :param vals: Values
-        :param indices: indices
-        :param target_sz: target size
-        :return: Returns accumulated values
-        """
+    sz_weight = weight.size()
+    batch_size = c.size()[0]
+    nr_of_channels = c.size()[1]
+    n = sz_weight[0]-1
+    dim = sz_weight[2]
+
+    w = MyTensor(*([batch_size, nr_of_channels] + list(sz_weight[3:]))).zero_()
+
+    if dim==1:
+        for b in range(0,batch_size):
+            b_ind = MyLongTensor(*(list(index.size()[3:]))).fill_(b)
+            for ch in range(0,nr_of_channels):
+                ch_ind = MyLongTensor(*(list(index.size()[3:]))).fill_(ch)
+                for k1 in range(0,n+1):
+                    w[b,ch,...] += weight[k1,b,0,...] * c[b_ind,ch_ind,index[k1,b,0,...]]
+    elif dim==2:
+        for b in range(0, batch_size):
+            b_ind = MyLongTensor(*(list(index.size()[3:]))).fill_(b)
+            for ch in range(0, nr_of_channels):
+                ch_ind = MyLongTensor(*(list(index.size()[3:]))).fill_(ch)
+                for k1 in range(0, n + 1):
+                    for k2 in range(0, n+1):
+                        w[b, ch, ...] += weight[k1, b, 0, ...] * weight[k2,b,1,...] \
+                                        * c[b_ind, ch_ind, index[k1, b, 0, ...],(index[k2,b,1,...])]
+    elif dim ==3:
+        for b in range(0, batch_size):
+            b_ind = MyLongTensor(*(list(index.size()[3:]))).fill_(b)
+            for ch in range(0, nr_of_channels):
+                ch_ind = MyLongTensor(*(list(index.size()[3:]))).fill_(ch)
+                for k1 in range(0, n + 1):
+                    for k2 in range(0, n + 1):
+                        for k3 in range(0, n+1):
+                            w[b,ch,...] +=  weight[k1, b, 0, ...] * weight[k2, b, 1, ...] * weight[k3,b,2,...] \
+                                            * c[b_ind, ch_ind, index[k1, b, 0, ...], index[k2, b, 1, ...], index[k3, b, 2, ...]]
+    else:
+        raise ValueError('Dimension needs to be 1, 2, or 3.')
+
+    return w
+
+
+def _interpolate_backward_by_looping(c, weight, index, grad_output):
+    """
+    Computes the gradient with respect to the coefficent array and the weights by looping over images, channels,
+    and taps (reference implementation)
+
+    :param c: interpolation coefficients
+    :param weight: interpolation weights
+    :param index: interpolation indices
+    :param grad_output: grad output from previous "layer"
+    :return: tuple (gradient wrt. c, gradient wrt. weight)
+    """
+
+    batch_size = c.size()[0]
+    nr_of_channels = c.size()[1]
+    n = weight.size()[0]-1
+    dim = weight.size()[2]
+
+    grad_c = MyTensor(c.size()).zero_()
+    grad_weight = MyTensor(weight.size()).zero_()
+
+    if dim==1:
+        # first compute the gradient with respect to the weight
+        for b in range(0, batch_size):
+            for k1 in range(0, n + 1):
+                for ch in range(0, nr_of_channels):
+                    grad_weight[k1,b,0,...] += grad_output[b,ch,...]*c[b, ch, ...][(index[k1, b, 0, ...])]
+
+
+        # now compute the gradient with respect to the coefficients c
+        for b in range(0, batch_size):
+            for ch in range(0, nr_of_channels):
+                for k1 in range(0, n + 1):
+                    grad_c[b, ch, ...] += _accumulate(weight[k1,b,0,...]*grad_output[b, ch,...], [index[k1, b, 0, ...]], c.size()[2:])
+
+    elif dim==2:
+        # first compute the gradient with respect to the weight
+        for b in range(0, batch_size):
+            for k1 in range(0, n + 1):
+                for k2 in range(0, n+1):
+                    for ch in range(0, nr_of_channels):
+                        grad_weight[k1, b, 0, ...] += grad_output[b, ch, ...] \
+                                                      * weight[k2,b,1,...]\
+                                                      * c[b, ch, ...][(index[k1, b, 0, ...]),(index[k2, b, 1, ...])]
+                        grad_weight[k2, b, 1, ...] += grad_output[b, ch, ...] \
+                                                      * weight[k1, b, 0, ...] \
+                                                      * c[b, ch, ...][(index[k1, b, 0, ...]), (index[k2, b, 1, ...])]
+
+        # now compute the gradient with respect to the coefficients c
+        for b in range(0, batch_size):
+            for ch in range(0, nr_of_channels):
+                for k1 in range(0, n + 1):
+                    for k2 in range(0, n + 1):
+                        grad_c[b, ch, ...] += _accumulate(weight[k1, b, 0, ...] * weight[k2,b,1,...] * grad_output[b, ch, ...],
+                                                          [index[k1, b, 0, ...],index[k2,b,1,...]], c.size()[2:])
+
+    elif dim==3:
+        # first compute the gradient with respect to the weight
+        for b in range(0, batch_size):
+            for k1 in range(0, n + 1):
+                for k2 in range(0, n + 1):
+                    for k3 in range(0, n + 1):
+                        for ch in range(0, nr_of_channels):
+                            grad_weight[k1, b, 0, ...] += grad_output[b, ch, ...] \
+                                                          * weight[k2, b, 1, ...] * weight[k3, b, 2, ...] \
+                                                          * c[b, ch, ...][
+                                                              (index[k1, b, 0, ...]), (index[k2, b, 1, ...]), (index[k3, b, 2, ...])]
+                            grad_weight[k2, b, 1, ...] += grad_output[b, ch, ...] \
+                                                          * weight[k1, b, 0, ...] * weight[k3, b, 2, ...]\
+                                                          * c[b, ch, ...][
+                                                              (index[k1, b, 0, ...]), (index[k2, b, 1, ...]), (index[k3, b, 2, ...])]
+                            grad_weight[k3, b, 2, ...] += grad_output[b, ch, ...] \
+                                                          * weight[k1, b, 0, ...] * weight[k2, b, 1, ...] \
+                                                          * c[b, ch, ...][
+                                                              (index[k1, b, 0, ...]), (index[k2, b, 1, ...]), (index[k3, b, 2, ...])]
+
+        # now compute the gradient with respect to the coefficients c
+        for b in range(0, batch_size):
+            for ch in range(0, nr_of_channels):
+                for k1 in range(0, n + 1):
+                    for k2 in range(0, n + 1):
+                        for k3 in range(0, n + 1):
+                            grad_c[b, ch, ...] += _accumulate(
+                                weight[k1, b, 0, ...] * weight[k2, b, 1, ...] * weight[k3,b,2,...] * grad_output[b, ch, ...],
+                                [index[k1, b, 0, ...], index[k2, b, 1, ...], index[k3, b, 2, ...]], c.size()[2:])
 
-        acc_res = MyTensor(target_sz).zero_()
+    else:
+        raise ValueError('Dimension needs to be 1, 2, or 3.')
 
-        l_acc_res = self._get_linear_view(acc_res)
-        l_vals = self._get_linear_view(vals)
-        l_indices = self._sub2ind(indices,target_sz)
+    return grad_c, grad_weight
 
-        l_acc_res.put_(l_indices,l_vals,accumulate=True)
 
-        return acc_res
+class PerformSplineInterpolationHelper(Function):
+    """
+    Performs spline interpolation, given weights, indices, and coefficients.
+    This is simply a convenience class which avoids computing the gradient of the actual interpolation via automatic differentiation
+    (as this would be very memory intensive).
+    """
 
-    def backward(self, grad_output):
+    @staticmethod
+    def forward(ctx, c, weight, index, vectorized, deterministic):
         """
-        Computes the gradient with respect to the coefficent array and the weights
+        Performs the interpolation for given coefficients and weights (we do not compute the gradient wrt. the indices)
 
-        :param grad_output: grad output from previous "layer"
-        :return: gradient
+        :param ctx: context
+        :param c: interpolation coefficients
+        :param weight: interpolation weights
+        :param index: index array for interpolation (as computed from _compute_interpolation_weights)
+        :param vectorized: if True the taps are processed vectorized, otherwise the reference implementation is used
+        :param deterministic: if True the gradient wrt. the coefficients is accumulated in a fixed order
+        :return: interpolated signal
         """
 
-        grad_c = MyTensor(self.c.size()).zero_()
-        grad_weight = MyTensor(self.weight.size()).zero_()
+        if weight.size()[2] not in [1, 2, 3]:
+            raise ValueError('Dimension needs to be 1, 2, or 3.')
 
-        if self.dim==1:
-            # first compute the gradient with respect to the weight
-            for b in range(0, self.batch_size):
-                for k1 in range(0, self.n + 1):
-                    for ch in range(0, self.nr_of_channels):
-                        grad_weight[k1,b,0,...] += grad_output[b,ch,...]*self.c[b, ch, ...][(self.index[k1, b, 0, ...])]
+        ctx.save_for_backward(c, weight, index)
+        ctx.vectorized = vectorized
+        ctx.deterministic = deterministic
 
+        if vectorized:
+            return _interpolate_vectorized(c, weight, index)
+        else:
+            return _interpolate_by_looping(c, weight, index)
 
-            # now compute the gradient with respect to the coefficients c
-            for b in range(0, self.batch_size):
-                for ch in range(0, self.nr_of_channels):
-                    for k1 in range(0, self.n + 1):
-                        grad_c[b, ch, ...] += self._accumulate(self.weight[k1,b,0,...]*grad_output[b, ch,...], [self.index[k1, b, 0, ...]], self.c.size()[2:])
+    @staticmethod
+    def backward(ctx, grad_output):
+        """
+        Computes the gradient with respect to the coefficent array and the weights
 
-        elif self.dim==2:
-            # first compute the gradient with respect to the weight
-            for b in range(0, self.batch_size):
-                for k1 in range(0, self.n + 1):
-                    for k2 in range(0, self.n+1):
-                        for ch in range(0, self.nr_of_channels):
-                            grad_weight[k1, b, 0, ...] += grad_output[b, ch, ...] \
-                                                          * self.weight[k2,b,1,...]\
-                                                          * self.c[b, ch, ...][(self.index[k1, b, 0, ...]),(self.index[k2, b, 1, ...])]
-                            grad_weight[k2, b, 1, ...] += grad_output[b, ch, ...] \
-                                                          * self.weight[k1, b, 0, ...] \
-                                                          * self.c[b, ch, ...][(self.index[k1, b, 0, ...]), (self.index[k2, b, 1, ...])]
-
-            # now compute the gradient with respect to the coefficients c
-            for b in range(0, self.batch_size):
-                for ch in range(0, self.nr_of_channels):
-                    for k1 in range(0, self.n + 1):
-                        for k2 in range(0, self.n + 1):
-                            grad_c[b, ch, ...] += self._accumulate(self.weight[k1, b, 0, ...] * self.weight[k2,b,1,...] * grad_output[b, ch, ...],
-                                                                   [self.index[k1, b, 0, ...],self.index[k2,b,1,...]], self.c.size()[2:])
-
-        elif self.dim==3:
-            # first compute the gradient with respect to the weight
-            for b in range(0, self.batch_size):
-                for k1 in range(0, self.n + 1):
-                    for k2 in range(0, self.n + 1):
-                        for k3 in range(0, self.n + 1):
-                            for ch in range(0, self.nr_of_channels):
-                                grad_weight[k1, b, 0, ...] += grad_output[b, ch, ...] \
-                                                              * self.weight[k2, b, 1, ...] * self.weight[k3, b, 2, ...] \
-                                                              * self.c[b, ch, ...][
-                                                                  (self.index[k1, b, 0, ...]), (self.index[k2, b, 1, ...]), (self.index[k3, b, 2, ...])]
-                                grad_weight[k2, b, 1, ...] += grad_output[b, ch, ...] \
-                                                              * self.weight[k1, b, 0, ...] * self.weight[k3, b, 2, ...]\
-                                                              * self.c[b, ch, ...][
-                                                                  (self.index[k1, b, 0, ...]), (self.index[k2, b, 1, ...]), (self.index[k3, b, 2, ...])]
-                                grad_weight[k3, b, 2, ...] += grad_output[b, ch, ...] \
-                                                              * self.weight[k1, b, 0, ...] * self.weight[k2, b, 1, ...] \
-                                                              * self.c[b, ch, ...][
-                                                                  (self.index[k1, b, 0, ...]), (self.index[k2, b, 1, ...]), (self.index[k3, b, 2, ...])]
-
-            # now compute the gradient with respect to the coefficients c
-            for b in range(0, self.batch_size):
-                for ch in range(0, self.nr_of_channels):
-                    for k1 in range(0, self.n + 1):
-                        for k2 in range(0, self.n + 1):
-                            for k3 in range(0, self.n + 1):
-                                grad_c[b, ch, ...] += self._accumulate(
-                                    self.weight[k1, b, 0, ...] * self.weight[k2, b, 1, ...] * self.weight[k3,b,2,...] * grad_output[b, ch, ...],
-                                    [self.index[k1, b, 0, ...], self.index[k2, b, 1, ...], self.index[k3, b, 2, ...]], self.c.size()[2:])
+        :param ctx: context
+        :param grad_output: grad output from previous "layer"
+        :return: gradient
+        """
+
+        c, weight, index = ctx.saved_tensors
 
+        if ctx.vectorized:
+            grad_c, grad_weight = _interpolate_backward_vectorized(c, weight, index, grad_output.contiguous(), ctx.deterministic)
         else:
-            raise ValueError('Dimension needs to be 1, 2, or 3.')
+            grad_c, grad_weight = _interpolate_backward_by_looping(c, weight, index, grad_output)
+
+        return grad_c, grad_weight, None, None, None
 
-        return grad_c, grad_weight
 
-def perform_spline_interpolation_helper(c,weight,index):
+def perform_spline_interpolation_helper(c,weight,index,vectorized=None,deterministic=None):
     """
     Helper function to instantiate the spline interpolation helper (for a more efficent gradient computation w/o automatic differentiation)
 
     :param c: interpolation coefficients
     :param weight: interpolation weights
     :param index: interpolation indices
+    :param vectorized: if True the taps are processed vectorized; if None the module default is used (see set_default_backward_mode)
+    :param deterministic: if True the gradient wrt. the coefficients is accumulated in a fixed order; if None the module
+        default is used (or True if torch's deterministic algorithms are enabled)
     :return: interpolated signal
     """
 
-    return PerformSplineInterpolationHelper(index)(c,weight)
+    if vectorized is None:
+        vectorized = use_vectorized_backward
+    if deterministic is None:
+        deterministic = use_deterministic_accumulation
+        if hasattr(torch, 'are_deterministic_algorithms_enabled') and torch.are_deterministic_algorithms_enabled():
+            deterministic = True
+
+    return PerformSplineInterpolationHelper.apply(c,weight,index,vectorized,deterministic)
 
 # for testing
 
@@ -0,0 +1,169 @@
+"""
+Lazy composition of affine transforms and maps (e.g., for multi-stage registration pipelines).
+
+Composing the result of every stage into a full-resolution map resamples (and hence smooths) the map once per stage.
+A :class:`TransformChain` instead only records the transforms of the individual stages. Consecutive affine
+transforms are merged analytically and the chain is only evaluated once, on the requested output grid (optionally
+in tiles to limit memory). Each map in the chain is then interpolated exactly once (at the final coordinates) and
+images are warped only once.
+
+The chain follows the convention for initial maps (see set_initial_map): a transform which is appended is applied
+*before* the transforms which are already in the chain, i.e., for stages :math:`\\phi_1,\\dots,\\phi_N` (appended in
+this order) the chain represents :math:`\\phi_1\\circ\\phi_2\\circ\\dots\\circ\\phi_N`, and the warped image is
+:math:`I_0\\circ\\phi_1\\circ\\dots\\circ\\phi_N`.
+
+The affine pre-registration (see :class:`mermaid.affine_registration.MultiResolutionAffineRegistration`) returns its
+result as a chain, which is evaluated on the grid of the deformable registration to obtain its initial maps. Further
+stages can be appended to this chain (instead of composing their maps).
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import torch
+
+from . import utils
+
+
+def _compose_affine_params(Ab_outer, Ab_inner):
+    """
+    Computes the parameters of the composition of two affine transforms (for arbitrary batch size)
+
+    :param Ab_outer: parameters of the transform which is applied last (batch size x param. vector)
+    :param Ab_inner: parameters of the transform which is applied first (batch size x param. vector)
+    :return: parameters of x -> A_outer(A_inner x+b_inner)+b_outer
+    """
+    dim = utils.get_dim_of_affine_transform(Ab_outer[0, :])
+    nr_of_images = Ab_outer.size()[0]
+
+    # columns are stacked, i.e., the parameter vector holds [A|b] column by column
+    M_outer = Ab_outer.view(nr_of_images, dim + 1, dim).transpose(1, 2)
+    M_inner = Ab_inner.view(nr_of_images, dim + 1, dim).transpose(1, 2)
+
+    A = torch.matmul(M_outer[:, :, :dim], M_inner[:, :, :dim])
+    b = torch.matmul(M_outer[:, :, :dim], M_inner[:, :, dim:]) + M_outer[:, :, dim:]
+
+    return torch.cat((A, b), dim=2).transpose(1, 2).contiguous().view(nr_of_images, -1)
+
+
+class TransformChain(object):
+    """
+    Records affine transforms, maps and displacement fields and composes them lazily
+    """
+
+    def __init__(self, spline_order=1):
+        """
+        Constructor
+
+        :param spline_order: spline order used to interpolate the maps and displacement fields of the chain
+        """
+        self.spline_order = spline_order
+        self.transforms = []
+        """list of (type, value, spacing) tuples, type is 'affine', 'map' or 'displacement'; first entry is applied last"""
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def append_affine(self, Ab):
+        """
+        Appends an affine transform; it is merged analytically with a preceding affine transform
+
+        :param Ab: affine transform parameters (batch size x param. vector, see utils.apply_affine_transform_to_map_multiNC)
+        :return: self
+        """
+        if len(self.transforms) > 0 and self.transforms[-1][0] == 'affine':
+            # T_prev(T_new(x)) = A_prev(A_new x+b_new)+b_prev
+            Ab_prev = self.transforms[-1][1]
+            self.transforms[-1] = ('affine', _compose_affine_params(Ab_prev, Ab), None)
+        else:
+            self.transforms.append(('affine', Ab, None))
+        return self
+
+    def append_map(self, phi, spacing):
+        """
+        Appends a map (for example the result of a registration stage which was started from the identity)
+
+        :param phi: map, format BxdimxXxYxZ
+        :param spacing: spacing of the map
+        :return: self
+        """
+        self.transforms.append(('map', phi, spacing))
+        return self
+
+    def append_displacement(self, u, spacing):
+        """
+        Appends a displacement field, i.e., the map x+u(x)
+
+        :param u: displacement field, format BxdimxXxYxZ
+        :param spacing: spacing of the displacement field
+        :return: self
+        """
+        self.transforms.append(('displacement', u, spacing))
+        return self
+
+    def append_chain(self, chain):
+        """
+        Appends all transforms of another chain (which will be applied before the transforms of this chain)
+
+        :param chain: transform chain
+        :return: self
+        """
+        for transform_type, value, spacing in chain.transforms:
+            if transform_type == 'affine':
+                self.append_affine(value)
+            else:
+                self.transforms.append((transform_type, value, spacing))
+        return self
+
+    def _apply(self, x):
+        """
+        Applies the chain to coordinates
+
+        :param x: coordinates, format BxdimxXxYxZ
+        :return: transformed coordinates
+        """
+        for transform_type, value, spacing in reversed(self.transforms):
+            if transform_type == 'affine':
+                x = utils.apply_affine_transform_to_map_multiNC(value, x)
+            elif transform_type == 'map':
+                x = utils.compute_warped_image_multiNC(value, x, spacing, self.spline_order, zero_boundary=False)
+            else:
+                x = x + utils.compute_warped_image_multiNC(value, x, spacing, self.spline_order, zero_boundary=False)
+        return x
+
+    def get_map(self, sz, spacing, tile_size=None):
+        """
+        Evaluates the chain on a grid
+
+        :param sz: size of the output grid (BxCxXxYxZ format)
+        :param spacing: spacing of the output grid
+        :param tile_size: if not None the map is evaluated in tiles of this many slices (along the first spatial dimension)
+        :return: map, format BxdimxXxYxZ
+        """
+        if len(self.transforms) == 0:
+            return utils.get_identity_map(sz, spacing)
+
+        # the chain is evaluated with the data type and on the device of its transforms (the tiles are written into the map)
+        value = self.transforms[0][1]
+        phi = utils.get_identity_map(sz, spacing, dtype=value.dtype, device=value.device)
+
+        if tile_size is None or tile_size >= phi.size()[2]:
+            return self._apply(phi)
+
+        for start in range(0, phi.size()[2], tile_size):
+            end = min(start + tile_size, phi.size()[2])
+            phi[:, :, start:end, ...] = self._apply(phi[:, :, start:end, ...])
+        return phi
+
+    def get_warped_image(self, I, spacing, spline_order=1, zero_boundary=True, tile_size=None):
+        """
+        Warps an image by the chain (the chain is evaluated on the grid of the image and the image is warped once)
+
+        :param I: image, format BxCxXxYxZ
+        :param spacing: spacing of the image
+        :param spline_order: spline order used to interpolate the image
+        :param zero_boundary: if True the image is zero outside of its domain
+        :param tile_size: if not None the map is evaluated in tiles of this many slices (along the first spatial dimension)
+        :return: warped image
+        """
+        phi = self.get_map(I.size(), spacing, tile_size=tile_size)
+        return utils.compute_warped_image_multiNC(I, phi, spacing, spline_order, zero_boundary=zero_boundary)
@@ -26,6 +26,7 @@ from . import module_parameters as pars
 from .spline_interpolation import SplineInterpolation_ND_BCXYZ
 
 import os
+from collections import OrderedDict
 
 try:
     from .libraries.functions.nn_interpolation import get_nn_interpolation
@@ -322,6 +323,64 @@ def apply_affine_transform_to_map_multiNC(Ab,phi):
     return phiR
 
 
+def _affine_params_to_normalized_theta(Ab, sz, spacing):
+    """Converts affine parameters (acting on maps in physical coordinates, see apply_affine_transform_to_map)
+    into the matrices expected by torch.nn.functional.affine_grid (acting on [-1,1]^d with reversed axes order).
+
+    With :math:`x=D(g+1)`, :math:`D=diag((sz-1)spacing/2)` the transform :math:`y=Ax+b` becomes
+    :math:`g_y=D^{-1}AD\\,g+D^{-1}(AD1+b)-1` in normalized coordinates.
+
+    :param Ab: affine transform parameter column vectors (batch size x param. vector)
+    :param sz: spatial size of the image XxYxZ
+    :param spacing: image spacing [dx,dy,dz]
+    :return: normalized transforms, batch size x dim x (dim+1)
+    """
+    dim = len(sz)
+    nr_of_images = Ab.size()[0]
+
+    M = Ab.view(nr_of_images, dim + 1, dim).transpose(1, 2)
+    A = M[:, :, :dim]
+    b = M[:, :, dim]
+
+    half_extent = torch.tensor([(sz[d] - 1) * spacing[d] / 2. if sz[d] > 1 else 1. for d in range(dim)],
+                               dtype=Ab.dtype, device=Ab.device)
+
+    A_normalized = A * half_extent.view(1, 1, dim) / half_extent.view(1, dim, 1)
+    t_normalized = (torch.matmul(A, half_extent.view(1, dim, 1)).squeeze(2) + b) / half_extent.view(1, dim) - 1.
+
+    # grid_sample expects the coordinates in reversed order (the last tensor dimension is x)
+    A_normalized = A_normalized.flip(1).flip(2)
+    t_normalized = t_normalized.flip(1)
+
+    return torch.cat((A_normalized, t_normalized.unsqueeze(2)), dim=2)
+
+
+def compute_affine_warped_image_multiNC(I0, Ab, spacing, spline_order=1, zero_boundary=False):
+    """Warps images by affine transforms. In 2D and 3D (for linear and nearest neighbor interpolation) the sampling
+    coordinates are generated on the fly (via affine_grid) and the images are sampled directly, i.e., no identity map
+    needs to be created and no dense map is transformed; otherwise falls back to the map-based warping.
+
+    :param I0: images to warp, format BxCxXxYxZ
+    :param Ab: affine transform parameter column vectors (batch size x param. vector)
+    :param spacing: image spacing [dx,dy,dz]
+    :param spline_order: 0 (nearest neighbor) or 1 (linear) use the fast path
+    :param zero_boundary: if True the image is zero outside of its domain, otherwise the boundary values are repeated
+    :return: returns the warped images, format BxCxXxYxZ
+    """
+    dim = I0.dim() - 2
+    if dim not in [2, 3] or spline_order not in [0, 1]:
+        id = _get_shared_identity_map(I0.size(), spacing, dtype=I0.dtype, device=I0.device)
+        phi = apply_affine_transform_to_map_multiNC(Ab, id)
+        return compute_warped_image_multiNC(I0, phi, spacing, spline_order, zero_boundary=zero_boundary)
+
+    theta = _affine_params_to_normalized_theta(Ab.type_as(I0), list(I0.size()[2:]), spacing)
+    grid = torch.nn.functional.affine_grid(theta, list(I0.size()), align_corners=True)
+    return torch.nn.functional.grid_sample(I0, grid,
+                                           mode='bilinear' if spline_order == 1 else 'nearest',
+                                           padding_mode='zeros' if zero_boundary else 'border',
+                                           align_corners=True)
+
+
 def compute_normalized_gaussian(X, mu, sig):
     """Computes a normalized Gaussian.
 
@@ -468,6 +527,49 @@ def compute_warped_image_multiNC(I0, phi, spacing, spline_order, zero_boundary=F
         raise ValueError('Images can only be warped in dimensions 1 to 3')
 
 
+def compute_inverse_map_by_fixed_point_iteration(phi, spacing, tolerance=1e-4, max_nr_of_iterations=50, spline_order=1, identity_map=None):
+    """Computes the inverse of a map by a fixed-point iteration (post-hoc, i.e., without integrating the inverse map).
+
+    With :math:`\\phi=id+u` the inverse is the fixed point of :math:`\\psi=id-u\\circ\\psi`, i.e., the iteration is
+    :math:`\\psi_{k+1}=\\psi_k-(\\phi\\circ\\psi_k-id)`. It converges if the displacement is contractive (which is
+    the case for the small and smooth displacements of a diffeomorphism sampled on a grid). The iteration is not
+    differentiated.
+
+    :param phi: map to invert, size BxdimxXxYxZ
+    :param spacing: spacing of the map [dx,dy,dz]
+    :param tolerance: the iteration stops once the residual is below this value
+    :param max_nr_of_iterations: maximal number of iterations (0 returns the initial guess :math:`id-u`)
+    :param spline_order: spline order used to interpolate the map
+    :param identity_map: identity map of the size of phi (created if not given)
+    :return: returns a tuple (phi_inverse, residual); residual is the maximal inconsistency :math:`\\|\\phi\\circ\\phi^{-1}(x)-x\\|` over all grid points (of the returned inverse)
+    """
+
+    if max_nr_of_iterations < 0:
+        raise ValueError('The maximal number of fixed-point iterations needs to be non-negative, but is {}'.format(max_nr_of_iterations))
+
+    with torch.no_grad():
+        if identity_map is None:
+            sz = [phi.size()[0], 1] + list(phi.size()[2:])
+            identity_map = _get_shared_identity_map(sz, spacing, dtype=phi.dtype, device=phi.device)
+
+        u = phi - identity_map
+
+        def _compute_residual(phi_inverse):
+            r = phi_inverse + compute_warped_image_multiNC(u, phi_inverse, spacing, spline_order, zero_boundary=False) - identity_map
+            return r, r.norm(p=2, dim=1).max().item()
+
+        phi_inverse = identity_map - u
+        r, residual = _compute_residual(phi_inverse)
+        for iter in range(max_nr_of_iterations):
+            if residual < tolerance:
+                break
+            phi_inverse = phi_inverse - r
+            # the residual always belongs to the current (i.e., the returned) inverse
+            r, residual = _compute_residual(phi_inverse)
+
+    return phi_inverse, residual
+
+
 def _get_low_res_spacing_from_spacing(spacing, sz, lowResSize):
     """Computes spacing for the low-res parametrization from image spacing.
 
@@ -658,6 +760,86 @@ def create_ND_scalar_field_parameter_multiNC(sz, nrOfI=1, nrOfC=1):
     csz = np.array([nrOfI,nrOfC]+list(csz))
     return Parameter(MyTensor(*(csz.tolist())).normal_(0.,1e-7))
 
+_identity_map_cache = OrderedDict()
+"""memoized identity maps (least recently used entries are dropped first)"""
+_identity_map_cache_max_nr_of_entries = 16
+
+
+def set_identity_map_cache_size(max_nr_of_entries):
+    """Sets the maximal number of identity maps which are kept by get_identity_map (and _get_shared_identity_map).
+
+    :param max_nr_of_entries: maximal number of cached identity maps (0 disables the cache)
+    """
+    global _identity_map_cache_max_nr_of_entries
+    _identity_map_cache_max_nr_of_entries = max_nr_of_entries
+    while len(_identity_map_cache) > _identity_map_cache_max_nr_of_entries:
+        _identity_map_cache.popitem(last=False)
+
+
+def clear_identity_map_cache():
+    """Removes all cached identity maps (e.g., to free device memory)."""
+    _identity_map_cache.clear()
+
+
+def _get_shared_identity_map(sz, spacing, dtype=torch.float32, device=None, centered=False):
+    """Returns a memoized identity map as a tensor on the device (keyed by size, spacing, dtype, device and centering),
+    i.e., the numpy grid is only created and copied to the device once. Used within mermaid only.
+
+    The returned tensor is shared between all callers and must therefore only be read. A cached map which has been
+    modified in place (by an in-place operation on the tensor itself) is detected via its version counter and
+    recreated. Modifications which bypass the version counter (e.g., via .data or a numpy view of the tensor) cannot be
+    detected.
+
+    :param sz: size of an image in BxCxXxYxZ format
+    :param spacing: list with spacing information [sx,sy,sz]
+    :param dtype: torch data type
+    :param device: device of the map; if None the default device is used (see AdaptVal)
+    :param centered: if True returns the centered identity map (see centered_identity_map_multiN)
+    :return: returns the (shared) identity map of size BxdimxXxYxZ
+    """
+    if device is None:
+        device = torch.device('cuda') if USE_CUDA else torch.device('cpu')
+    else:
+        device = torch.device(device)
+
+    key = (tuple(int(s) for s in sz), tuple(float(s) for s in spacing), dtype, str(device), centered)
+
+    entry = _identity_map_cache.pop(key, None)
+    if entry is not None and entry[0]._version != entry[1]:
+        print('WARNING: a cached identity map was modified in place; recreating it')
+        entry = None
+
+    if entry is None:
+        np_dtype = 'float64' if dtype == torch.float64 else 'float32'
+        if centered:
+            id = centered_identity_map_multiN(sz, spacing, dtype=np_dtype)
+        else:
+            id = identity_map_multiN(sz, spacing, dtype=np_dtype)
+        id = torch.from_numpy(id).to(device=device, dtype=dtype)
+        entry = (id, id._version)
+
+    if _identity_map_cache_max_nr_of_entries > 0:
+        _identity_map_cache[key] = entry
+        while len(_identity_map_cache) > _identity_map_cache_max_nr_of_entries:
+            _identity_map_cache.popitem(last=False)
+
+    return entry[0]
+
+
+def get_identity_map(sz, spacing, dtype=torch.float32, device=None, centered=False):
+    """Returns an identity map as a tensor on the device. It is copied from a memoized map, i.e., the numpy grid is only
+    created and copied to the device once; the returned tensor can be modified.
+
+    :param sz: size of an image in BxCxXxYxZ format
+    :param spacing: list with spacing information [sx,sy,sz]
+    :param dtype: torch data type
+    :param device: device of the map; if None the default device is used (see AdaptVal)
+    :param centered: if True returns the centered identity map (see centered_identity_map_multiN)
+    :return: returns the identity map of size BxdimxXxYxZ
+    """
+    return _get_shared_identity_map(sz, spacing, dtype=dtype, device=device, centered=centered).clone()
+
+
 def centered_identity_map_multiN(sz, spacing, dtype='float32'):
     """
     Create a centered identity map (shifted so it is centered around 0)
@@ -1095,7 +1277,7 @@ def resample_image(I, spacing, desiredSize, spline_order=1, zero_boundary=False,
     if identity_map is not None:
         idDes = identity_map
     else:
-        idDes = AdaptVal(torch.from_numpy(identity_map_multiN(desiredSizeNC, newspacing)))
+        idDes = _get_shared_identity_map(desiredSizeNC, newspacing)
     # now use this map for resampling
     ID = compute_warped_image_multiNC(I, idDes, newspacing, spline_order, zero_boundary)
 
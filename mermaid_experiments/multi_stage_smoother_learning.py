@@ -30,7 +30,8 @@ def do_registration(source_images,target_images,model_name,output_directory,
                     freeze_parameters=False,
                     start_from_previously_saved_parameters=True,
                     args_kvs=None,
-                    only_run_stage0_with_unchanged_config=False):
+                    only_run_stage0_with_unchanged_config=False,
+                    nr_of_distributed_processes=0):
 
     if load_shared_parameters_from_file is not None:
         shared_target_dir = os.path.join(output_directory,'shared')
@@ -79,6 +80,11 @@ def do_registration(source_images,target_images,model_name,output_directory,
     params_in['optimizer']['batch_settings']['parameter_output_dir'] = output_directory
     params_in['optimizer']['batch_settings']['start_from_previously_saved_parameters'] = start_from_previously_saved_parameters
 
+    if nr_of_distributed_processes>0:
+        # pairs are sharded across the processes; gradients of the shared (smoother) parameters are all-reduced
+        params_in['optimizer']['batch_settings']['distributed']['use_distributed'] = True
+        params_in['optimizer']['batch_settings']['distributed']['nr_of_processes'] = nr_of_distributed_processes
+
     params_in['model']['registration_model']['forward_model']['smoother']['type'] = 'learned_multiGaussianCombination'
     params_in['model']['registration_model']['forward_model']['smoother']['start_optimize_over_smoother_parameters_at_iteration'] = 0
     params_in['model']['registration_model']['forward_model']['smoother']['freeze_parameters'] = freeze_parameters
@@ -272,6 +278,8 @@ if __name__ == "__main__":
 
     parser.add_argument('--config_kvs', required=False, default=None, help='Allows specifying key value pairs that will override json settings; in format k1.k2.k3=val1;k1.k2=val2')
 
+    parser.add_argument('--nr_of_distributed_processes', required=False, type=int, default=0, help='If set to a value >0, the pairs are distributed over this many processes (typically one per GPU; gloo backend on the CPU) and the gradients of the shared parameters are all-reduced')
+
     args = parser.parse_args()
 
     if args.seed is not None:
@@ -524,6 +532,7 @@ if __name__ == "__main__":
                 freeze_parameters=False,
                 start_from_previously_saved_parameters=False,
                 args_kvs=args.config_kvs,
+                nr_of_distributed_processes=args.nr_of_distributed_processes,
                 only_run_stage0_with_unchanged_config=args.only_run_stage0_with_unchanged_config
             )
 
@@ -573,6 +582,7 @@ if __name__ == "__main__":
                 freeze_parameters=True,
                 start_from_previously_saved_parameters=True,
                 args_kvs=args.config_kvs,
+                nr_of_distributed_processes=args.nr_of_distributed_processes,
                 only_run_stage0_with_unchanged_config=args.only_run_stage0_with_unchanged_config
             )
 
@@ -625,7 +635,8 @@ if __name__ == "__main__":
                     optimize_over_weights=True,
                     freeze_parameters=False,
                     start_from_previously_saved_parameters=True,
-                    args_kvs=args.config_kvs
+                    args_kvs=args.config_kvs,
+                    nr_of_distributed_processes=args.nr_of_distributed_processes
                 )
 
                 if args.retain_intermediate_stage_results:
@@ -671,7 +682,8 @@ if __name__ == "__main__":
                     optimize_over_weights=True,
                     freeze_parameters=True,
                     start_from_previously_saved_parameters=True,
-                    args_kvs=args.config_kvs
+                    args_kvs=args.config_kvs,
+                    nr_of_distributed_processes=args.nr_of_distributed_processes
                 )
 
                 if args.retain_intermediate_stage_results:
@@ -725,7 +737,8 @@ if __name__ == "__main__":
                     optimize_over_weights=False,
                     freeze_parameters=False,
                     start_from_previously_saved_parameters=True,
-                    args_kvs=args.config_kvs
+                    args_kvs=args.config_kvs,
+                    nr_of_distributed_processes=args.nr_of_distributed_processes
                 )
 
                 if args.retain_intermediate_stage_results:
@@ -771,7 +784,8 @@ if __name__ == "__main__":
                     optimize_over_weights=False,
                     freeze_parameters=True,
                     start_from_previously_saved_parameters=True,
-                    args_kvs=args.config_kvs
+                    args_kvs=args.config_kvs,
+                    nr_of_distributed_processes=args.nr_of_distributed_processes
                 )
 
                 if args.retain_intermediate_stage_results:
@@ -0,0 +1,56 @@
+"""
+Benchmarks the batched regularizer energies of regularizer_factory (all images and vector field components in one
+tensor expression) against the image-by-image reference implementation for different batch sizes.
+Reports the time for a forward/backward pass.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+sys.path.insert(0,os.path.abspath('..'))
+
+import numpy as np
+import torch
+
+import mermaid.module_parameters as pars
+import mermaid.regularizer_factory as RF
+
+
+def _time_forward_backward(fcn, v, nr_of_iterations, device):
+    # returns the average time per forward/backward pass [s]
+    x = v.clone().requires_grad_(True)
+
+    for _ in range(3):
+        fcn(x).backward()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(nr_of_iterations):
+        x.grad = None
+        fcn(x).backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / nr_of_iterations
+
+
+def run_benchmark(spatial_sz=(32,32,32), batch_sizes=(1,2,4,8,16,32,64), nr_of_iterations=10):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    spacing = 1./(np.array(spatial_sz)-1)
+
+    print('Spatial size = {}; device = {}'.format(list(spatial_sz), device))
+    print('{:<16s} {:>6s} {:>14s} {:>14s} {:>8s}'.format('regularizer', 'batch', 'batched [ms]', 'looped [ms]', 'speedup'))
+    for regularizer_type in ['helmholtz','totalVariation','diffusion','curvature']:
+        regularizer = RF.RegularizerFactory(spacing).create_regularizer_by_name(regularizer_type, pars.ParameterDict())
+        for batch_size in batch_sizes:
+            v = torch.randn([batch_size,len(spatial_sz)]+list(spatial_sz), device=device)
+            rel_diff = abs(regularizer.compute_regularizer_multiN(v).item()/regularizer.compute_regularizer_multiN_by_looping(v).item()-1.)
+            t_batched = _time_forward_backward(regularizer.compute_regularizer_multiN, v, nr_of_iterations, device)
+            t_looped = _time_forward_backward(regularizer.compute_regularizer_multiN_by_looping, v, nr_of_iterations, device)
+            print('{:<16s} {:6d} {:14.3f} {:14.3f} {:8.2f}   (relative difference = {:.2e})'.format(
+                regularizer_type, batch_size, t_batched*1000., t_looped*1000., t_looped/t_batched, rel_diff))
+
+
+if __name__ == '__main__':
+    run_benchmark()
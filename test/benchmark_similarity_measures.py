@@ -0,0 +1,68 @@
+"""
+Benchmarks the throughput (forward/backward) of the mutual information similarity measures (with all voxels and with
+stochastic voxel subsampling) against LNCCSimilarity and SSD at equal image sizes.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+sys.path.insert(0,os.path.abspath('..'))
+
+import numpy as np
+import torch
+
+import mermaid.module_parameters as pars
+import mermaid.similarity_measure_factory as SM
+
+
+def _create_similarity_measure(similarity_measure_type, spacing, sampling_fraction=1.0):
+    params = pars.ParameterDict()
+    params[('similarity_measure', {}, 'settings for the similarity measure')]
+    params['similarity_measure']['type'] = similarity_measure_type
+    params['similarity_measure'][('mi', {}, 'settings for the mutual information similarity measures')]
+    params['similarity_measure']['mi']['sampling_fraction'] = sampling_fraction
+    params['similarity_measure'][('lncc', {}, 'settings for the lncc similarity measure')]
+    return SM.SimilarityMeasureFactory(spacing).create_similarity_measure(params)
+
+
+def _time_forward_backward(similarity_measure, I0, I1, nr_of_iterations, device):
+    # returns the average time per forward/backward pass [s]
+    I = I0.clone().requires_grad_(True)
+
+    def step():
+        I.grad = None
+        similarity_measure.compute_similarity_multiNC(I, I1).backward()
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(nr_of_iterations):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / nr_of_iterations
+
+
+def run_benchmark(sizes=([4,1,256,256],[1,1,64,64,64],[1,1,128,128,128]), nr_of_iterations=5):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print('device = {}'.format(device))
+    print('{:<20s} {:<22s} {:>10s} {:>16s}'.format('size', 'measure', 'time [ms]', 'Mvoxels/s'))
+
+    for sz in sizes:
+        spacing = 1./(np.array(sz[2:])-1)
+        I1 = torch.rand(sz, device=device)
+        I0 = 1. - I1**2 + 0.05*torch.randn(sz, device=device)
+        nr_of_voxels = float(np.prod(sz))
+
+        for name, similarity_measure_type, sampling_fraction in [('ssd', 'ssd', 1.), ('lncc', 'lncc', 1.),
+                                                                 ('mi', 'mi', 1.), ('nmi', 'nmi', 1.),
+                                                                 ('mi (10% of voxels)', 'mi', 0.1)]:
+            similarity_measure = _create_similarity_measure(similarity_measure_type, spacing, sampling_fraction)
+            t = _time_forward_backward(similarity_measure, I0, I1, nr_of_iterations, device)
+            print('{:<20s} {:<22s} {:10.2f} {:16.2f}'.format(str(sz), name, t*1000., nr_of_voxels/t/1e6))
+
+
+if __name__ == '__main__':
+    run_benchmark()
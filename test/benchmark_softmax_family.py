@@ -0,0 +1,79 @@
+"""
+Benchmarks the fused softmax family of deep_smoothers (weighted_softmax, weighted_linear_softmax, ...) against
+the unfused baseline implementations (see softmax_family_baseline.py) on 3D weight maps.
+Reports the time for a forward/backward pass and (on the GPU) the peak memory.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+sys.path.insert(0,os.path.abspath('..'))
+
+import torch
+
+import mermaid.deep_smoothers as DS
+import softmax_family_baseline as baseline
+
+
+def _time_forward_backward(fcn, input, nr_of_iterations, device):
+    # returns the average time per forward/backward pass [s] and the peak memory [MB]
+    x = input.clone().requires_grad_(True)
+    grad_output = torch.randn_like(input)
+
+    # warm up (TorchScript optimizes the kernels during the first calls)
+    for _ in range(3):
+        fcn(x).backward(grad_output)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(nr_of_iterations):
+        x.grad = None
+        fcn(x).backward(grad_output)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() / 1024. ** 2
+    else:
+        peak_memory = float('nan')
+    return (time.perf_counter() - start) / nr_of_iterations, peak_memory
+
+
+def run_benchmark(sz=(2,4,64,64,64), nr_of_iterations=20):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    input = torch.randn(sz, device=device)
+    # non-uniform weights which sum up to one
+    weights = [2.*(i+1)/(sz[1]*(sz[1]+1)) for i in range(sz[1])]
+    # the baseline square-root softmax takes the square root of the weights and hence needs them as a tensor
+    weights_t = torch.tensor(weights, device=device)
+
+    candidates = [
+        ('weighted_softmax', lambda x: DS.weighted_softmax(x, dim=1, weights=weights),
+                             lambda x: baseline.weighted_softmax(x, 1, weights)),
+        ('stable_softmax', lambda x: DS.stable_softmax(x, dim=1),
+                           lambda x: baseline.stable_softmax(x, 1)),
+        ('weighted_linear_softmax', lambda x: DS.weighted_linear_softmax(x, dim=1, weights=weights),
+                                    lambda x: baseline.weighted_linear_softmax(x, 1, weights)),
+        ('weighted_linear_softnorm', lambda x: DS.weighted_linear_softnorm(x, dim=1, weights=weights),
+                                     lambda x: baseline.weighted_linear_softnorm(x, 1, weights)),
+        ('linear_softmax', lambda x: DS.linear_softmax(x, dim=1),
+                           lambda x: baseline.linear_softmax(x, 1)),
+        ('linear_softnorm', lambda x: DS.linear_softnorm(x, dim=1),
+                            lambda x: baseline.linear_softnorm(x, 1)),
+        ('weighted_sqrt_softmax', lambda x: DS.weighted_sqrt_softmax(x, dim=1, weights=weights),
+                                  lambda x: baseline.weighted_sqrt_softmax(x, 1, weights_t)),
+    ]
+
+    print('Input size = {}; device = {}; kernels scripted = {}'.format(list(sz), device, DS.softmax_kernels_are_scripted))
+    print('{:<26s} {:>12s} {:>12s} {:>8s} {:>12s} {:>12s}'.format('function', 'fused [ms]', 'unfused [ms]', 'speedup', 'fused [MB]', 'unfused [MB]'))
+    for name, fused, unfused in candidates:
+        max_diff = (fused(input) - unfused(input)).abs().max().item()
+        t_fused, m_fused = _time_forward_backward(fused, input, nr_of_iterations, device)
+        t_unfused, m_unfused = _time_forward_backward(unfused, input, nr_of_iterations, device)
+        print('{:<26s} {:12.3f} {:12.3f} {:8.2f} {:12.1f} {:12.1f}   (max abs difference = {:.2e})'.format(
+            name, t_fused*1000., t_unfused*1000., t_unfused/t_fused, m_fused, m_unfused, max_diff))
+
+
+if __name__ == '__main__':
+    run_benchmark()
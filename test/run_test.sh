@@ -11,6 +11,65 @@ $PYCMD test_finite_differences.py $@
 echo "Running mermaid tests for: module_parameters"
 $PYCMD test_module_parameters.py $@
 
+echo "Running mermaid tests for: regularizers"
+$PYCMD test_regularizers.py $@
+
+echo "Running mermaid tests for: spectral operators"
+$PYCMD test_spectral_operators.py $@
+
+echo "Running mermaid tests for: spline interpolation"
+$PYCMD test_spline_interpolation.py $@
+
+echo "Running mermaid tests for: similarity measures"
+$PYCMD test_similarity_measures.py $@
+
+echo "Running mermaid tests for: regions of interest"
+$PYCMD test_roi.py $@
+
+echo "Running mermaid tests for: optimizer data loaders"
+$PYCMD test_optimizer_data_loaders.py $@
+
+echo "Running mermaid tests for: compiled step"
+$PYCMD test_compiled_step.py $@
+$PYCMD test_compiled_step_gpu.py $@
+
+echo "Running mermaid tests for: multi-tensor operations"
+$PYCMD test_multi_tensor.py $@
+
+echo "Running mermaid tests for: consensus optimization"
+$PYCMD test_consensus_optimization.py $@
+
+echo "Running mermaid tests for: distributed batch optimization"
+$PYCMD test_distributed_batch_optimization.py $@
+echo "Running mermaid tests for: automatic mixed precision"
+$PYCMD test_amp.py $@
+echo "Running mermaid tests for: profiling"
+$PYCMD test_profiling.py $@
+echo "Running mermaid tests for: deferred analysis"
+$PYCMD test_deferred_analysis.py $@
+echo "Running mermaid tests for: registration session"
+$PYCMD test_registration_session.py $@
+echo "Running mermaid tests for: model evaluation"
+$PYCMD test_model_evaluation.py $@
+echo "Running mermaid tests for: utils"
+$PYCMD test_utils.py $@
+echo "Running mermaid tests for: bucketed batch optimization"
+$PYCMD test_bucketed_batch_optimization.py $@
+echo "Running mermaid tests for: deep smoothers"
+$PYCMD test_deep_smoothers.py $@
+
+echo "Running mermaid tests for: deep networks"
+$PYCMD test_deep_networks.py $@
+
+echo "Running mermaid tests for: affine fast path"
+$PYCMD test_affine_registration.py $@
+
+echo "Running mermaid tests for: transform chain"
+$PYCMD test_transform_chain.py $@
+
+echo "Running mermaid tests for: registration server"
+$PYCMD test_registration_server.py $@
+
 echo "Running mermaid tests for: stn"
 $PYCMD test_stn_cpu.py $@
 $PYCMD test_stn_gpu.py $@
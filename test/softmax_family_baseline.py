@@ -0,0 +1,487 @@
+"""
+Baseline implementations of the softmax family of deep_smoothers (weighted_softmax, stable_softmax, ...).
+These are the channel-by-channel implementations as they were before the functions were fused; the tests
+compare the fused functions against them and benchmark_softmax_family.py uses them as the unfused reference.
+"""
+
+import torch
+
+
+def weighted_softmax(input, dim=None, weights=None ):
+    r"""Applies a softmax function.
+
+    Weighted_softmax is defined as:
+
+    :math:`weighted_softmax(x) = \frac{w_i exp(x_i)}{\sum_j w_j exp(x_j)}`
+
+    It is applied to all slices along dim, and will rescale them so that the elements
+    lie in the range `(0, 1)` and sum to 1.
+
+    See :class:`~torch.nn.WeightedSoftmax` for more details.
+
+    Arguments:
+        input (Variable): input
+        dim (int): A dimension along which weighted_softmax will be computed.
+
+    """
+    if dim is None:
+        raise ValueError('dimension needs to be defined!')
+
+    sz = input.size()
+    if weights is None: # just make them all one; this is the default softmax
+        weights = [1.]*sz[dim]
+
+    nr_of_weights = len(weights)
+    assert( sz[dim]==nr_of_weights )
+
+    ret = torch.zeros_like(input)
+
+    # for numerical reasons we first compute the maximum inout along the dimension and then
+    # subtract if from all the exponents (this assures that we do not get exp(100) and then a NaN
+    # this is ok, because we can multiply the nominator and denominator with the same constant
+    # and by doing this shift the exponentials
+
+    max_in,_ = torch.max(input, dim=dim)
+
+    if dim==0:
+        norm = torch.zeros_like(input[0,...])
+        for c in range(sz[0]):
+            norm += weights[c]*torch.exp(input[c,...]-max_in)
+        for c in range(sz[0]):
+            ret[c,...] = weights[c]*torch.exp(input[c,...]-max_in)/norm
+    elif dim==1:
+        norm = torch.zeros_like(input[:,0, ...])
+        for c in range(sz[1]):
+            norm += weights[c] * torch.exp(input[:,c, ...]-max_in)
+        for c in range(sz[1]):
+            ret[:,c, ...] = weights[c] * torch.exp(input[:,c, ...]-max_in) / norm
+    elif dim==2:
+        norm = torch.zeros_like(input[:,:,0, ...])
+        for c in range(sz[2]):
+            norm += weights[c] * torch.exp(input[:,:,c, ...]-max_in)
+        for c in range(sz[2]):
+            ret[:,:,c, ...] = weights[c] * torch.exp(input[:,:,c, ...]-max_in) / norm
+    elif dim==3:
+        norm = torch.zeros_like(input[:,:,:,0, ...])
+        for c in range(sz[3]):
+            norm += weights[c] * torch.exp(input[:,:,:,c, ...]-max_in)
+        for c in range(sz[3]):
+            ret[:,:,:,c, ...] = weights[c] * torch.exp(input[:,:,:,c, ...]-max_in) / norm
+    elif dim==4:
+        norm = torch.zeros_like(input[:,:,:,:,0, ...])
+        for c in range(sz[4]):
+            norm += weights[c] * torch.exp(input[:,:,:,:,c, ...]-max_in)
+        for c in range(sz[4]):
+            ret[:,:,:,:,c, ...] = weights[c] * torch.exp(input[:,:,:,:,c, ...]-max_in) / norm
+    else:
+        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
+
+    return ret
+
+
+def stable_softmax(input, dim=None):
+    r"""Applies a numerically stqable softmax function.
+
+    stable_softmax is defined as:
+
+    :math:`stable_softmax(x) = \frac{exp(x_i)}{\sum_j exp(x_j)}`
+
+    It is applied to all slices along dim, and will rescale them so that the elements
+    lie in the range `(0, 1)` and sum to 1.
+
+    See :class:`~torch.nn.StableSoftmax` for more details.
+
+    Arguments:
+        input (Variable): input
+        dim (int): A dimension along which stable_softmax will be computed.
+
+    """
+    if dim is None:
+        raise ValueError('dimension needs to be defined!')
+
+    sz = input.size()
+    ret = torch.zeros_like(input)
+
+    # for numerical reasons we first compute the maximum inout along the dimension and then
+    # subtract if from all the exponents (this assures that we do not get exp(100) and then a NaN
+    # this is ok, because we can multiply the nominator and denominator with the same constant
+    # and by doing this shift the exponentials
+
+    max_in,_ = torch.max(input, dim=dim)
+
+    if dim==0:
+        norm = torch.zeros_like(input[0,...])
+        for c in range(sz[0]):
+            norm += torch.exp(input[c,...]-max_in)
+        for c in range(sz[0]):
+            ret[c,...] = torch.exp(input[c,...]-max_in)/norm
+    elif dim==1:
+        norm = torch.zeros_like(input[:,0, ...])
+        for c in range(sz[1]):
+            norm += torch.exp(input[:,c, ...]-max_in)
+        for c in range(sz[1]):
+            ret[:,c, ...] = torch.exp(input[:,c, ...]-max_in) / norm
+    elif dim==2:
+        norm = torch.zeros_like(input[:,:,0, ...])
+        for c in range(sz[2]):
+            norm += torch.exp(input[:,:,c, ...]-max_in)
+        for c in range(sz[2]):
+            ret[:,:,c, ...] = torch.exp(input[:,:,c, ...]-max_in) / norm
+    elif dim==3:
+        norm = torch.zeros_like(input[:,:,:,0, ...])
+        for c in range(sz[3]):
+            norm += torch.exp(input[:,:,:,c, ...]-max_in)
+        for c in range(sz[3]):
+            ret[:,:,:,c, ...] = torch.exp(input[:,:,:,c, ...]-max_in) / norm
+    elif dim==4:
+        norm = torch.zeros_like(input[:,:,:,:,0, ...])
+        for c in range(sz[4]):
+            norm += torch.exp(input[:,:,:,:,c, ...]-max_in)
+        for c in range(sz[4]):
+            ret[:,:,:,:,c, ...] = torch.exp(input[:,:,:,:,c, ...]-max_in) / norm
+    else:
+        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
+
+    return ret
+
+
+def weighted_linear_softmax(input, dim=None, weights=None ):
+    r"""Applies a softmax function.
+
+    Weighted_linear_softmax is defined as:
+
+    :math:`weighted_linear_softmax(x) = \frac{clamp(x_i+w_i,0,1)}{\sum_j clamp(x_j+w_j,0,1)}`
+
+    It is applied to all slices along dim, and will rescale them so that the elements
+    lie in the range `(0, 1)` and sum to 1.
+
+    See :class:`~torch.nn.WeightedLinearSoftmax` for more details.
+
+    Arguments:
+        input (Variable): input
+        dim (int): A dimension along which weighted_linear_softmax will be computed.
+
+    """
+    if dim is None:
+        raise ValueError('dimension needs to be defined!')
+
+    sz = input.size()
+    if weights is None: # just make them all one/nr_of_weights
+        weights = [1./sz[dim]]*sz[dim]
+
+    nr_of_weights = len(weights)
+    assert( sz[dim]==nr_of_weights )
+
+    ret = torch.zeros_like(input)
+
+    # todo: subtracting the input mean (so that the values perturb around the offset and leave the sum constant)
+    # todo: seems highly beneficial for training, find a theoretical justification for this (-> tangent space)
+
+    input_offset = input.sum(dim=dim) / sz[dim]
+
+    if dim==0:
+        norm = torch.zeros_like(input[0,...])
+        for c in range(sz[0]):
+            norm += torch.clamp(weights[c]+input[c,...]-input_offset,min=0,max=1)
+        for c in range(sz[0]):
+            ret[c,...] = torch.clamp(weights[c]+input[c,...]-input_offset,min=0,max=1)/norm
+    elif dim==1:
+        norm = torch.zeros_like(input[:,0, ...])
+        for c in range(sz[1]):
+            norm += torch.clamp(weights[c]+input[:,c, ...]-input_offset,min=0,max=1)
+        for c in range(sz[1]):
+            ret[:,c, ...] = torch.clamp(weights[c]+input[:,c, ...]-input_offset,min=0,max=1)/norm
+    elif dim==2:
+        norm = torch.zeros_like(input[:,:,0, ...])
+        for c in range(sz[2]):
+            norm += torch.clamp(weights[c]+input[:,:,c, ...]-input_offset,min=0,max=1)
+        for c in range(sz[2]):
+            ret[:,:,c, ...] = torch.clamp(weights[c]+input[:,:,c, ...]-input_offset,min=0,max=1)/norm
+    elif dim==3:
+        norm = torch.zeros_like(input[:,:,:,0, ...])
+        for c in range(sz[3]):
+            norm += torch.clamp(weights[c]+input[:,:,:,c, ...]-input_offset,min=0,max=1)
+        for c in range(sz[3]):
+            ret[:,:,:,c, ...] = torch.clamp(weights[c]+input[:,:,:,c, ...]-input_offset,min=0,max=1)/norm
+    elif dim==4:
+        norm = torch.zeros_like(input[:,:,:,:,0, ...])
+        for c in range(sz[4]):
+            norm += torch.clamp(weights[c]+input[:,:,:,:,c, ...]-input_offset,min=0,max=1)
+        for c in range(sz[4]):
+            ret[:,:,:,:,c, ...] = torch.clamp(weights[c]+input[:,:,:,:,c, ...]-input_offset,min=0,max=1)/norm
+    else:
+        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
+
+    return ret
+
+
+def weighted_linear_softnorm(input, dim=None, weights=None ):
+    r"""Applies a weighted linear softnorm function.
+
+    Weighted_linear_softnorm is defined as:
+
+    :math:`weighted_linear_softnorm(x) = \frac{clamp(x_i+w_i,0,1)}{\sqrt{\sum_j clamp(x_j+w_j,0,1)**2}}`
+
+    It is applied to all slices along dim, and will rescale them so that the elements
+    lie in the range `(0, 1)` and sum to 1.
+
+    See :class:`~torch.nn.WeightedLinearSoftnorm` for more details.
+
+    Arguments:
+        input (Variable): input
+        dim (int): A dimension along which weighted_linear_softnorm will be computed.
+
+    """
+    if dim is None:
+        raise ValueError('dimension needs to be defined!')
+
+    sz = input.size()
+    if weights is None: # just make them all one/nr_of_weights
+        weights = [1./sz[dim]]*sz[dim]
+
+    nr_of_weights = len(weights)
+    assert( sz[dim]==nr_of_weights )
+
+    ret = torch.zeros_like(input)
+
+    # todo: subtracting the input mean (so that the values perturb around the offset and leave the sum constant)
+    # todo: seems highly beneficial for training, find a theoretical justification for this (-> tangent space)
+
+    # clamped_vals = torch.clamp(input, min=0, max=1)
+    # norm = torch.norm(clamped_vals, p=2, dim=dim)
+    #
+    # # todo: subtracting the input mean (so that the values perturb around the offset and leave the sum constant)
+    # # todo: seems highly beneficial for training, find a theoretical justification for this (-> tangent space)
+    #
+    # if dim == 0:
+    #     for c in range(sz[0]):
+    #         ret[c, ...] = clamped_vals[c, ...] / norm
+
+    clamped_vals = torch.zeros_like(input)
+
+    if dim==0:
+        input_offset = input.sum(dim=0)/sz[0]
+        for c in range(sz[0]):
+            clamped_vals[c,...] = torch.clamp(weights[c]+input[c,...]-input_offset,min=0,max=1)
+        norm = torch.norm(clamped_vals, p=2, dim=dim)
+        for c in range(sz[0]):
+            ret[c,...] = clamped_vals[c,...]/norm
+    elif dim==1:
+        input_offset = input.sum(dim=1)/sz[1]
+        for c in range(sz[1]):
+            clamped_vals[:,c,...] = torch.clamp(weights[c]+input[:,c, ...]-input_offset,min=0,max=1)
+        norm = torch.norm(clamped_vals, p=2, dim=dim)
+        for c in range(sz[1]):
+            ret[:,c, ...] = clamped_vals[:,c,...]/norm
+    elif dim==2:
+        input_offset = input.sum(dim=2)/sz[2]
+        for c in range(sz[2]):
+            clamped_vals[:,:,c,...] = torch.clamp(weights[c]+input[:,:,c, ...]-input_offset,min=0,max=1)
+        norm = torch.norm(clamped_vals, p=2, dim=dim)
+        for c in range(sz[2]):
+            ret[:,:,c, ...] = clamped_vals[:,:,c, ...]/norm
+    elif dim==3:
+        input_offset = input.sum(dim=3)/sz[3]
+        for c in range(sz[3]):
+            clamped_vals[:,:,:,c,...] = torch.clamp(weights[c]+input[:,:,:,c, ...]-input_offset,min=0,max=1)
+        norm = torch.norm(clamped_vals, p=2, dim=dim)
+        for c in range(sz[3]):
+            ret[:,:,:,c, ...] = clamped_vals[:,:,:,c, ...]/norm
+    elif dim==4:
+        input_offset = input.sum(dim=4)/sz[4]
+        for c in range(sz[4]):
+            clamped_vals[:,:,:,:,c,...] = torch.clamp(weights[c]+input[:,:,:,:,c, ...]-input_offset,min=0,max=1)
+        norm = torch.norm(clamped_vals, p=2, dim=dim)
+        for c in range(sz[4]):
+            ret[:,:,:,:,c, ...] = clamped_vals[:,:,:,:,c, ...]/norm
+    else:
+        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
+
+    return ret
+
+
+def linear_softnorm(input, dim=None):
+    r"""Normalizes so that the squares of the resulting values sum up to one and are positive.
+
+    linear_softnorm is defined as:
+
+    :math:`linear_softnorm(x) = \frac{clamp(x_i,0,1)}{\sqrt{\sum_j clamp(x_j,0,1)^2}}`
+
+    It is applied to all slices along dim, and will rescale them so that the elements
+    lie in the range `(0, 1)` and their squares sum to 1.
+
+    See :class:`~torch.nn.LinearSoftnorm` for more details.
+
+    Arguments:
+        input (Variable): input
+        dim (int): A dimension along which linear_softnorm will be computed.
+
+    """
+    if dim is None:
+        raise ValueError('dimension needs to be defined!')
+
+    sz = input.size()
+
+    ret = torch.zeros_like(input)
+    clamped_vals = torch.clamp(input, min=0, max=1)
+    norm = torch.norm(clamped_vals,p=2,dim=dim)
+
+    # todo: subtracting the input mean (so that the values perturb around the offset and leave the sum constant)
+    # todo: seems highly beneficial for training, find a theoretical justification for this (-> tangent space)
+
+    if dim==0:
+        for c in range(sz[0]):
+            ret[c,...] = clamped_vals[c,...]/norm
+    elif dim==1:
+        for c in range(sz[1]):
+            ret[:,c, ...] = clamped_vals[:,c,...]/norm
+    elif dim==2:
+        for c in range(sz[2]):
+            ret[:,:,c, ...] = clamped_vals[:,:,c,...]/norm
+    elif dim==3:
+        for c in range(sz[3]):
+            ret[:,:,:,c, ...] = clamped_vals[:,:,:,c,...]/norm
+    elif dim==4:
+        for c in range(sz[4]):
+            ret[:,:,:,:,c, ...] = clamped_vals[:,:,:,:,c,...]/norm
+    else:
+        raise ValueError('linear_softnorm is only supported for dimensions 0, 1, 2, 3, and 4.')
+
+    return ret
+
+
+def linear_softmax(input, dim=None):
+    r"""Applies linear a softmax function.
+
+    linear_softmax is defined as:
+
+    :math:`linear_softmax(x) = \frac{clamp(x_i,0,1)}{\sum_j clamp(x_j,0,1)}`
+
+    It is applied to all slices along dim, and will rescale them so that the elements
+    lie in the range `(0, 1)` and sum to 1.
+
+    See :class:`~torch.nn.LinearSoftmax` for more details.
+
+    Arguments:
+        input (Variable): input
+        dim (int): A dimension along which linear_softmax will be computed.
+
+    """
+    if dim is None:
+        raise ValueError('dimension needs to be defined!')
+
+    sz = input.size()
+
+    ret = torch.zeros_like(input)
+
+    if dim==0:
+        norm = torch.zeros_like(input[0,...])
+        for c in range(sz[0]):
+            norm += torch.clamp(input[c,...],min=0,max=1)
+        for c in range(sz[0]):
+            ret[c,...] = torch.clamp(input[c,...],min=0,max=1)/norm
+    elif dim==1:
+        norm = torch.zeros_like(input[:,0, ...])
+        for c in range(sz[1]):
+            norm += torch.clamp(input[:,c, ...],min=0,max=1)
+        for c in range(sz[1]):
+            ret[:,c, ...] = torch.clamp(input[:,c, ...],min=0,max=1)/norm
+    elif dim==2:
+        norm = torch.zeros_like(input[:,:,0, ...])
+        for c in range(sz[2]):
+            norm += torch.clamp(input[:,:,c, ...],min=0,max=1)
+        for c in range(sz[2]):
+            ret[:,:,c, ...] = torch.clamp(input[:,:,c, ...],min=0,max=1)/norm
+    elif dim==3:
+        norm = torch.zeros_like(input[:,:,:,0, ...])
+        for c in range(sz[3]):
+            norm += torch.clamp(input[:,:,:,c, ...],min=0,max=1)
+        for c in range(sz[3]):
+            ret[:,:,:,c, ...] = torch.clamp(input[:,:,:,c, ...],min=0,max=1)/norm
+    elif dim==4:
+        norm = torch.zeros_like(input[:,:,:,:,0, ...])
+        for c in range(sz[4]):
+            norm += torch.clamp(input[:,:,:,:,c, ...],min=0,max=1)
+        for c in range(sz[4]):
+            ret[:,:,:,:,c, ...] = torch.clamp(input[:,:,:,:,c, ...],min=0,max=1)/norm
+    else:
+        raise ValueError('linear_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
+
+    return ret
+
+
+def weighted_sqrt_softmax(input, dim=None, weights=None ):
+    r"""Applies a weighted square-root softmax function.
+
+    Weighted_sqrt_softmax is defined as:
+
+    :math:`weighted_sqrt_softmax(x) = \frac{\sqrt{w_i} exp(x_i)}{\sqrt{\sum_j w_j (exp(x_j))^2}}`
+
+    It is applied to all slices along dim, and will rescale them so that the elements
+    lie in the range `(0, 1)` and sum to 1.
+
+    See :class:`~torch.nn.WeightedSoftmax` for more details.
+
+    Arguments:
+        input (Variable): input
+        dim (int): A dimension along which weighted_softmax will be computed.
+
+    """
+    if dim is None:
+        raise ValueError('dimension needs to be defined!')
+
+    sz = input.size()
+    if weights is None: # just make them all one; this is the default softmax
+        weights = [1.]*sz[dim]
+
+    nr_of_weights = len(weights)
+    assert( sz[dim]==nr_of_weights )
+
+    ret = torch.zeros_like(input)
+
+    # for numerical reasons we first compute the maximum inout along the dimension and then
+    # subtract if from all the exponents (this assures that we do not get exp(100) and then a NaN
+    # this is ok, because we can multiply the nominator and denominator with the same constant
+    # and by doing this shift the exponentials
+
+    max_in, _ = torch.max(input, dim=dim)
+
+    if dim==0:
+        norm_sqr = torch.zeros_like(input[0,...])
+        for c in range(sz[0]):
+            norm_sqr += weights[c]*(torch.exp(input[c,...]-max_in))**2
+        norm = torch.sqrt(norm_sqr)
+        for c in range(sz[0]):
+            ret[c,...] = torch.sqrt(weights[c])*torch.exp(input[c,...]-max_in)/norm
+    elif dim==1:
+        norm_sqr = torch.zeros_like(input[:,0, ...])
+        for c in range(sz[1]):
+            norm_sqr += weights[c] * (torch.exp(input[:,c, ...]-max_in))**2
+        norm = torch.sqrt(norm_sqr)
+        for c in range(sz[1]):
+            ret[:,c, ...] = torch.sqrt(weights[c]) * torch.exp(input[:,c, ...]-max_in) / norm
+    elif dim==2:
+        norm_sqr = torch.zeros_like(input[:,:,0, ...])
+        for c in range(sz[2]):
+            norm_sqr += weights[c] * (torch.exp(input[:,:,c, ...]-max_in))**2
+        norm = torch.sqrt(norm_sqr)
+        for c in range(sz[2]):
+            ret[:,:,c, ...] = torch.sqrt(weights[c]) * torch.exp(input[:,:,c, ...]-max_in) / norm
+    elif dim==3:
+        norm_sqr = torch.zeros_like(input[:,:,:,0, ...])
+        for c in range(sz[3]):
+            norm_sqr += weights[c] * (torch.exp(input[:,:,:,c, ...]-max_in))**2
+        norm = torch.sqrt(norm_sqr)
+        for c in range(sz[3]):
+            ret[:,:,:,c, ...] = torch.sqrt(weights[c]) * torch.exp(input[:,:,:,c, ...]-max_in) / norm
+    elif dim==4:
+        norm_sqr = torch.zeros_like(input[:,:,:,:,0, ...])
+        for c in range(sz[4]):
+            norm_sqr += weights[c] * (torch.exp(input[:,:,:,:,c, ...]-max_in))**2
+        norm = torch.sqrt(norm_sqr)
+        for c in range(sz[4]):
+            ret[:,:,:,:,c, ...] = torch.sqrt(weights[c]) * torch.exp(input[:,:,:,:,c, ...]-max_in) / norm
+    else:
+        raise ValueError('weighted_softmax is only supported for dimensions 0, 1, 2, 3, and 4.')
+
+    return ret
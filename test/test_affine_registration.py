@@ -0,0 +1,64 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.utils as utils
+
+
+class Test_affine_fast_path(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        pass
+
+    def _compare_with_map_based_warping(self, sz, Ab):
+        spacing = 1./(np.array(sz[2:])-1)
+        I0 = torch.rand(sz)
+        id = torch.from_numpy(utils.identity_map_multiN(sz,spacing))
+        phi = utils.apply_affine_transform_to_map_multiNC(Ab,id)
+
+        for zero_boundary in [True,False]:
+            expected = utils.compute_warped_image_multiNC(I0,phi,spacing,1,zero_boundary=zero_boundary)
+            fast = utils.compute_affine_warped_image_multiNC(I0,Ab,spacing,1,zero_boundary=zero_boundary)
+            npt.assert_almost_equal(fast.numpy(),expected.numpy(),decimal=4)
+
+    def test_2d(self):
+        Ab = torch.tensor([[1.05,0.05,-0.05,0.95,0.02,-0.01],
+                           [0.98,-0.03,0.02,1.02,-0.03,0.04]])
+        self._compare_with_map_based_warping([2,1,12,14],Ab)
+
+    def test_3d(self):
+        Ab = torch.tensor([[1.02,0.01,-0.02,0.03,0.97,0.01,-0.01,0.02,1.01,0.02,-0.01,0.03]])
+        self._compare_with_map_based_warping([1,2,8,10,12],Ab)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
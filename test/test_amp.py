@@ -0,0 +1,109 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.multiscale_optimizer as MO
+import mermaid.data_wrapper as DW
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class Test_amp(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        DW.set_amp_enabled(False)
+
+    def test_cpu_autocast_uses_bfloat16(self):
+        DW.set_amp_enabled(True)
+        self.assertEqual(DW.get_amp_dtype(), torch.bfloat16)
+        a = torch.rand(4, 4)
+        with DW.amp_autocast():
+            self.assertEqual(torch.mm(a, a).dtype, torch.bfloat16)
+        DW.set_amp_enabled(False)
+        with DW.amp_autocast():
+            self.assertEqual(torch.mm(a, a).dtype, torch.float32)
+
+    def _register(self, use_amp):
+        DW.set_amp_enabled(use_amp)
+        params = pars.ParameterDict()
+        params.load_JSON('./json/test_svf_image_single_scale_config.json')
+        params['optimizer']['name'] = 'sgd'
+        params['optimizer']['single_scale']['nr_of_iterations'] = 5
+
+        I0, I1, spacing = eg.CreateSquares(2).create_image_pair(np.array([32, 32]), params)
+        sz = np.array(I0.shape)
+
+        torch.manual_seed(0)
+        so = MO.SimpleSingleScaleRegistration(torch.from_numpy(I0.copy()), torch.from_numpy(I1), spacing, sz, params)
+        so.get_optimizer().set_visualization(False)
+        so.register()
+        # bfloat16 has the range of float32, hence no loss scaling is used
+        self.assertIsNone(so.get_optimizer().grad_scaler)
+        return so.get_energy()
+
+    def test_bfloat16_energy_tracks_float32_energy(self):
+        energy = self._register(use_amp=False)
+        energy_amp = self._register(use_amp=True)
+        npt.assert_allclose(energy_amp[0], energy[0], rtol=2e-2)
+        npt.assert_allclose(energy_amp[1], energy[1], rtol=2e-2)
+
+    def test_external_closure_optimizer_is_not_loss_scaled(self):
+        DW.set_amp_enabled(True)
+        params = pars.ParameterDict()
+        params.load_JSON('./json/test_svf_image_single_scale_config.json')
+        params['optimizer']['single_scale']['nr_of_iterations'] = 3
+
+        I0, I1, spacing = eg.CreateSquares(2).create_image_pair(np.array([32, 32]), params)
+        sz = np.array(I0.shape)
+
+        torch.manual_seed(0)
+        so = MO.SimpleSingleScaleRegistration(torch.from_numpy(I0.copy()), torch.from_numpy(I1), spacing, sz, params)
+        opt = so.get_optimizer()
+        opt.set_visualization(False)
+        opt.set_optimizer(torch.optim.LBFGS)
+        opt.set_optimizer_params(dict(lr=0.1, max_iter=2))
+        # float16 (which would use loss scaling) is not available for autocast on the CPU, hence it is only reported
+        with mock.patch.object(MO, 'get_amp_dtype', return_value=torch.float16):
+            so.register()
+        # the closure is passed to LBFGS, which cannot be combined with loss scaling
+        self.assertIsNone(opt.grad_scaler)
+        self.assertTrue(np.isfinite(so.get_energy()[0]))
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
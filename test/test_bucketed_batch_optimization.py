@@ -0,0 +1,132 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+
+import shutil
+import tempfile
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.fileio as FIO
+import mermaid.multiscale_optimizer as MO
+
+
+class Test_bucketed_batch_optimization(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        self.directory = tempfile.mkdtemp()
+
+        # two pairs of each of three sizes written to disk (the batch optimizer reads its images from files);
+        # the pairs of size 14 and 16 share the bucket of size 16
+        self.source_filenames = []
+        self.target_filenames = []
+        im_io = FIO.ImageIO()
+        for sz in [14, 16, 20]:
+            params = pars.ParameterDict()
+            I0, I1, self.spacing = eg.CreateSquares(2, add_noise_to_bg=True).create_image_pair(np.array([sz, sz]), params)
+            for IS, IT in [(I0, I1), (I1, I0)]:
+                i = len(self.source_filenames)
+                source_filename = os.path.join(self.directory, 'source_{:d}.nrrd'.format(i))
+                target_filename = os.path.join(self.directory, 'target_{:d}.nrrd'.format(i))
+                im_io.write(source_filename, IS[0, 0, ...])
+                im_io.write(target_filename, IT[0, 0, ...])
+                self.source_filenames.append(source_filename)
+                self.target_filenames.append(target_filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _create_optimizer(self, similarity_measure_type='ssd'):
+        params = pars.ParameterDict()
+        params['model']['deformation']['use_map'] = True
+        params['model']['registration_model']['type'] = 'svf_vector_momentum_map'
+        params['model']['registration_model']['forward_model']['number_of_time_steps'] = 5
+        params['model']['registration_model']['forward_model']['smoother']['type'] = 'adaptive_multiGaussian'
+        params['model']['registration_model']['forward_model']['smoother']['multi_gaussian_stds'] = [0.05, 0.1, 0.15]
+        params['model']['registration_model']['forward_model']['smoother']['optimize_over_smoother_weights'] = True
+        params['model']['registration_model']['similarity_measure']['type'] = similarity_measure_type
+        params['model']['registration_model']['similarity_measure']['sigma'] = 0.1
+        params['optimizer']['single_scale']['nr_of_iterations'] = 3
+        params['optimizer']['single_scale']['rel_ftol'] = 1e-12
+        params['optimizer']['use_step_size_scheduler'] = True
+        params['optimizer']['scheduler']['patience'] = 0
+        params['data_loader']['bucketing']['canonical_sizes'] = [[16, 16], [24, 24]]
+
+        batch_settings = params['optimizer']['batch_settings']
+        batch_settings['use_size_buckets'] = True
+        batch_settings['batch_size'] = 2
+        batch_settings['shuffle'] = False
+        batch_settings['nr_of_epochs'] = 2
+        batch_settings['start_from_previously_saved_parameters'] = False
+        batch_settings['parameter_output_dir'] = os.path.join(self.directory, 'parameters')
+
+        bopt = MO.SingleScaleBatchRegistrationOptimizer([1, 1, 16, 16], self.spacing, True, None, params)
+        bopt.set_model('svf_vector_momentum_map')
+        bopt.set_optimizer_by_name('sgd')
+        bopt.set_visualization(False)
+        bopt.set_source_image(self.source_filenames)
+        bopt.set_target_image(self.target_filenames)
+        return bopt
+
+    def test_pairs_of_two_sizes_are_optimized_in_buckets(self):
+        bopt = self._create_optimizer()
+        bopt.optimize()
+
+        # one optimizer (and scheduler) per bucket (pairs of size 14 and 16 are optimized together)
+        self.assertEqual(len(bopt.bucket_optimizers), 2)
+        self.assertEqual(list(bopt.bucket_schedulers.keys()), [0, 1])
+        sizes = sorted(tuple(key[0][2:]) for key in bopt.bucket_optimizers)
+        self.assertEqual(sizes, [(16, 16), (24, 24)])
+
+        # each scheduler stepped on the energy of its own bucket
+        best_energies = [scheduler.best for scheduler in bopt.bucket_schedulers.values()]
+        self.assertNotAlmostEqual(best_energies[0], best_energies[1], places=5)
+
+        # the shared parameters of all buckets are updated with one optimizer state
+        ssOpt0, ssOpt1 = bopt.bucket_optimizers.values()
+        shared_pars1 = ssOpt1.model.get_shared_registration_parameters()
+        for name, par in ssOpt0.model.get_shared_registration_parameters().items():
+            self.assertIs(ssOpt0.optimizer_instance.state[par], ssOpt1.optimizer_instance.state[shared_pars1[name]])
+
+        self.assertTrue(os.path.isfile(os.path.join(bopt.parameter_output_dir, 'shared', 'shared_parameters.pt')))
+        for i in range(len(self.source_filenames)):
+            filename = os.path.join(bopt.parameter_output_dir, 'individual', 'individual_parameter_pair_{:05d}.pt'.format(i))
+            self.assertTrue(os.path.isfile(filename))
+
+    def test_non_voxelwise_similarity_measures_are_rejected(self):
+        bopt = self._create_optimizer(similarity_measure_type='lncc')
+        with self.assertRaises(ValueError):
+            bopt.optimize()
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,130 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.multiscale_optimizer as MO
+import mermaid.compiled_step as CS
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class Test_compiled_step(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        pass
+
+    def test_tensor_key(self):
+        t = torch.zeros(2, 3)
+        self.assertEqual(CS.get_tensor_key(t), CS.get_tensor_key(t))
+        self.assertEqual(CS.get_tensor_key(t, include_address=False), CS.get_tensor_key(torch.ones(2, 3), include_address=False))
+        self.assertNotEqual(CS.get_tensor_key(t), CS.get_tensor_key(t.clone()))
+        self.assertNotEqual(CS.get_tensor_key(t, include_address=False), CS.get_tensor_key(torch.zeros(3, 2), include_address=False))
+        self.assertIsNone(CS.get_tensor_key(None))
+
+    def test_optimizer_key_changes_with_learning_rate(self):
+        p = torch.nn.Parameter(torch.zeros(3))
+        optimizer = torch.optim.SGD([p], lr=0.1)
+        key = CS.get_optimizer_key(optimizer)
+        self.assertEqual(key, CS.get_optimizer_key(optimizer))
+        optimizer.param_groups[0]['lr'] = 0.05
+        self.assertNotEqual(key, CS.get_optimizer_key(optimizer))
+
+    @unittest.skipUnless(CS.is_torch_compile_available(), 'torch.compile is not available')
+    def test_compiled_function_recompiles_if_key_changes(self):
+        f = CS.CompiledFunction(lambda x: 2. * x + 1., backend='eager')
+        x = torch.rand(5)
+        npt.assert_almost_equal(f('a', x).numpy(), (2. * x + 1.).numpy(), decimal=6)
+        compiled_function = f.compiled_function
+        f('a', x)
+        self.assertIs(f.compiled_function, compiled_function)
+        f('b', x)
+        self.assertIsNot(f.compiled_function, compiled_function)
+
+    def _create_registration(self, mode):
+        params = pars.ParameterDict()
+        params.load_JSON('./json/test_svf_image_single_scale_config.json')
+        params['optimizer']['name'] = 'sgd'
+        params['optimizer']['single_scale']['nr_of_iterations'] = 5
+        params['optimizer'][('compiled_step', {}, 'opt-in compiled optimization step')]
+        params['optimizer']['compiled_step']['mode'] = mode
+
+        I0, I1, spacing = eg.CreateSquares(2).create_image_pair(np.array([32, 32]), params)
+        sz = np.array(I0.shape)
+
+        torch.manual_seed(0)
+        so = MO.SimpleSingleScaleRegistration(torch.from_numpy(I0.copy()), torch.from_numpy(I1), spacing, sz, params)
+        so.get_optimizer().set_visualization(False)
+        return so
+
+    def _register(self, mode):
+        so = self._create_registration(mode)
+        so.register()
+        return so.get_energy()
+
+    @unittest.skipUnless(CS.is_torch_compile_available(), 'torch.compile is not available')
+    def test_compiled_step_matches_eager_step(self):
+        energy = self._register('none')
+        energy_compiled = self._register('compile')
+        npt.assert_almost_equal(energy_compiled[0], energy[0], decimal=4)
+
+    @unittest.skipUnless(CS.is_torch_compile_available(), 'torch.compile is not available')
+    def test_compiled_energy_is_not_recompiled_over_the_iterations(self):
+        so = self._create_registration('compile')
+        so.register()
+        opt = so.get_optimizer()
+        self.assertEqual(opt._compiled_energy.nr_of_compilations, 1)
+
+        # the iteration counters are passed as tensors and are not part of the key
+        opt._compiled_energy = mock.Mock()
+        opt._call_compiled_energy({'iter': 3, 'epoch': None, 'scale': None, 'over_scale_iter_count': 3})
+        opt._call_compiled_energy({'iter': 4, 'epoch': None, 'scale': None, 'over_scale_iter_count': 4})
+        (key_0, _, _), (key_1, static_opt_variables, iteration_opt_variables) = \
+            [c[0] for c in opt._compiled_energy.call_args_list]
+        self.assertEqual(key_0, key_1)
+        self.assertNotIn('iter', static_opt_variables)
+        self.assertTrue(torch.is_tensor(iteration_opt_variables['iter']))
+        self.assertEqual(iteration_opt_variables['iter'].item(), 4)
+
+    def test_cuda_graph_mode_falls_back_without_cuda(self):
+        # CUDA is disabled for the tests, hence the step is compiled (or run eagerly)
+        energy = self._register('none')
+        energy_fallback = self._register('cuda_graph')
+        npt.assert_almost_equal(energy_fallback[0], energy[0], decimal=4)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,82 @@
+# start with the setup
+
+import os
+import sys
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.multiscale_optimizer as MO
+import mermaid.compiled_step as CS
+from mermaid.data_wrapper import AdaptVal
+
+
+@unittest.skipUnless(CS.is_cuda_graph_available(), 'CUDA graphs are not available')
+class Test_compiled_step_gpu(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        torch.cuda.manual_seed_all(0)
+
+    def tearDown(self):
+        pass
+
+    def _create_registration(self, mode, nr_of_iterations):
+        params = pars.ParameterDict()
+        params.load_JSON('./json/test_svf_image_single_scale_config.json')
+        params['optimizer']['name'] = 'sgd'
+        params['optimizer']['single_scale']['nr_of_iterations'] = nr_of_iterations
+        params['optimizer'][('compiled_step', {}, 'opt-in compiled optimization step')]
+        params['optimizer']['compiled_step']['mode'] = mode
+        params['optimizer']['compiled_step']['nr_of_warmup_steps'] = 2
+
+        I0, I1, spacing = eg.CreateSquares(2).create_image_pair(np.array([32, 32]), params)
+        sz = np.array(I0.shape)
+
+        torch.manual_seed(0)
+        so = MO.SimpleSingleScaleRegistration(AdaptVal(torch.from_numpy(I0.copy())), AdaptVal(torch.from_numpy(I1)),
+                                              spacing, sz, params)
+        so.get_optimizer().set_visualization(False)
+        return so
+
+    def test_cuda_graph_step_is_captured_and_matches_eager_step(self):
+        so = self._create_registration('none', 6)
+        so.register()
+        energy = so.get_energy()
+
+        so_graph = self._create_registration('cuda_graph', 6)
+        so_graph.register()
+        energy_graph = so_graph.get_energy()
+
+        opt = so_graph.get_optimizer()
+        self.assertEqual(opt._active_compiled_step_mode, 'cuda_graph')
+        # two warm-up steps, then the step is captured once and replayed
+        self.assertEqual(opt._cuda_graph_step.nr_of_captures, 1)
+        npt.assert_almost_equal(energy_graph[0], energy[0], decimal=4)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
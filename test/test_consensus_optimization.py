@@ -0,0 +1,111 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import shutil
+import tempfile
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.multiscale_optimizer as MO
+
+
+class Test_consensus_optimization(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        self.params = pars.ParameterDict()
+        I0, I1, self.spacing = eg.CreateSquares(2, add_noise_to_bg=True).create_image_pair(np.array([16, 16]), self.params)
+        # a tiny problem with two batches of two image pairs
+        self.ISource = torch.from_numpy(np.concatenate([I0, I0, I1, I1], axis=0))
+        self.ITarget = torch.from_numpy(np.concatenate([I1, 0.9 * I1, I0, 0.9 * I0], axis=0))
+        self.sz = np.array(self.ISource.size())
+        self.checkpoint_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint_directory)
+
+    def _optimize(self, use_parallel_workers, nr_of_epochs=2, continue_from_last_checkpoint=False):
+        params = pars.ParameterDict()
+        params['model']['deformation']['use_map'] = True
+        params['model']['registration_model']['type'] = 'svf_vector_momentum_map'
+        params['model']['registration_model']['forward_model']['number_of_time_steps'] = 5
+        params['model']['registration_model']['forward_model']['smoother']['type'] = 'adaptive_multiGaussian'
+        params['model']['registration_model']['forward_model']['smoother']['multi_gaussian_stds'] = [0.05, 0.1, 0.15]
+        params['model']['registration_model']['forward_model']['smoother']['optimize_over_smoother_weights'] = True
+        params['model']['registration_model']['similarity_measure']['type'] = 'ssd'
+        params['model']['registration_model']['similarity_measure']['sigma'] = 0.1
+        params['optimizer']['single_scale']['nr_of_iterations'] = 3
+        params['optimizer']['consensus_settings']['batch_size'] = 2
+        params['optimizer']['consensus_settings']['nr_of_epochs'] = nr_of_epochs
+        params['optimizer']['consensus_settings']['continue_from_last_checkpoint'] = continue_from_last_checkpoint
+        params['optimizer']['consensus_settings']['use_parallel_workers'] = use_parallel_workers
+        params['optimizer']['consensus_settings']['nr_of_workers'] = 2
+        params['optimizer']['consensus_settings']['checkpoint_output_directory'] = \
+            os.path.join(self.checkpoint_directory, 'parallel' if use_parallel_workers else 'sequential')
+
+        copt = MO.SingleScaleConsensusRegistrationOptimizer(self.sz, self.spacing, True, None, params)
+        copt.set_model('svf_vector_momentum_map')
+        copt.set_optimizer_by_name('sgd')
+        copt.set_visualization(False)
+        copt.set_source_image(self.ISource)
+        copt.set_target_image(self.ITarget)
+        copt.optimize()
+        return copt
+
+    def test_parallel_workers_match_sequential_optimization(self):
+        copt_sequential = self._optimize(use_parallel_workers=False)
+        copt_parallel = self._optimize(use_parallel_workers=True)
+
+        self.assertTrue(len(copt_sequential.current_consensus_state) > 0)
+        for k in copt_sequential.current_consensus_state:
+            npt.assert_almost_equal(copt_parallel.current_consensus_state[k].detach().cpu().numpy(),
+                                    copt_sequential.current_consensus_state[k].detach().cpu().numpy(), decimal=4)
+            npt.assert_almost_equal(copt_parallel.last_shared_state[k].detach().cpu().numpy(),
+                                    copt_sequential.last_shared_state[k].detach().cpu().numpy(), decimal=4)
+
+        phi_sequential = copt_sequential.get_map()['phi']
+        phi_parallel = copt_parallel.get_map()['phi']
+        self.assertEqual(len(phi_parallel), 2)
+        for phi_s, phi_p in zip(phi_sequential, phi_parallel):
+            npt.assert_almost_equal(phi_p.detach().cpu().numpy(), phi_s.detach().cpu().numpy(), decimal=4)
+
+    def test_history_of_last_epoch_is_kept_when_resuming(self):
+        for use_parallel_workers in [False, True]:
+            self._optimize(use_parallel_workers=use_parallel_workers)
+            # resumes from the checkpoint written above, i.e., the epochs are counted from a non-zero offset
+            copt = self._optimize(use_parallel_workers=use_parallel_workers, nr_of_epochs=1, continue_from_last_checkpoint=True)
+            batch_history = copt.get_history()['batch_history']
+            self.assertEqual(len(batch_history), 1)
+            self.assertEqual(len(batch_history[-1]), 1)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,113 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.deep_networks as DN
+import mermaid.module_parameters as pars
+
+
+class Test_inference_mode(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.im_sz = [32,32]
+        self.input = torch.randn(2,2,32,32)
+
+    def tearDown(self):
+        pass
+
+    def _create_network(self, network_type, normalization_type, use_noisy_convolution):
+        params = pars.ParameterDict()
+        params['normalization_type'] = normalization_type
+        params['normalize_last_layer_type'] = normalization_type
+        params['use_noisy_convolution'] = use_noisy_convolution
+        net = network_type(dim=2, n_in_channel=2, n_out_channel=3, im_sz=self.im_sz, params=params)
+        net.initialize_network_weights()
+        # a few training passes so that the batch normalizations have non-trivial running statistics
+        net.train()
+        with torch.no_grad():
+            for i in range(3):
+                net(torch.randn(self.input.size()))
+        return net
+
+    def _compare(self, net):
+        net.eval()
+        with torch.no_grad():
+            expected = net(self.input)
+            state_dict_keys = set(net.state_dict().keys())
+            net.set_inference_mode(True)
+            result = net(self.input)
+            self.assertEqual(state_dict_keys, set(net.state_dict().keys()))
+            net.set_inference_mode(False)
+            result_after_switching_back = net(self.input)
+        npt.assert_almost_equal(result.numpy(), expected.numpy(), decimal=4)
+        npt.assert_almost_equal(result_after_switching_back.numpy(), expected.numpy(), decimal=6)
+
+    def test_folded_layers_follow_parameter_changes(self):
+        net = self._create_network(DN.Unet, 'batch', use_noisy_convolution=True)
+        other_net = self._create_network(DN.Unet, 'batch', use_noisy_convolution=True)
+        optimizer = torch.optim.SGD(net.parameters(), lr=0.1)
+        net.set_inference_mode(True)
+
+        def optimizer_step():
+            net.train()
+            optimizer.zero_grad()
+            net(self.input).sum().backward()
+            optimizer.step()
+
+        def training_passes():
+            # updates the running statistics of the batch normalizations
+            net.train()
+            with torch.no_grad():
+                net(torch.randn(self.input.size()))
+
+        def load_state_dict():
+            net.load_state_dict(other_net.state_dict())
+
+        for change_parameters in [optimizer_step, training_passes, load_state_dict]:
+            change_parameters()
+            net.eval()
+            with torch.no_grad():
+                result = net(self.input)
+                net.set_inference_mode(False)
+                expected = net(self.input)
+                net.set_inference_mode(True)
+            npt.assert_almost_equal(result.numpy(), expected.numpy(), decimal=4)
+
+    def test_unet_noisy_convolution_batch_normalization(self):
+        self._compare(self._create_network(DN.Unet, 'batch', use_noisy_convolution=True))
+
+    def test_unet_noisy_convolution_group_normalization(self):
+        self._compare(self._create_network(DN.Unet, 'group', use_noisy_convolution=True))
+
+    def test_unet_batch_normalization(self):
+        self._compare(self._create_network(DN.Unet, 'batch', use_noisy_convolution=False))
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
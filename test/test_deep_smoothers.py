@@ -0,0 +1,175 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.deep_smoothers as DS
+import mermaid.custom_pytorch_extensions_module_version as ce
+
+# the softmax family as implemented before the functions were fused
+import softmax_family_baseline as baseline
+
+
+class Test_weighted_multi_gaussian_smoothing(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        sz = np.array([16,18])
+        self.spacing = 1./(sz-1)
+        self.gaussian_stds = torch.FloatTensor([0.05,0.1,0.2])
+        self.generator = ce.GaussianFourierFilterGenerator(sz, self.spacing, nr_of_slots=len(self.gaussian_stds))
+
+        self.momentum = torch.randn(2,2,16,18)
+        pre_weights = torch.rand(2,3,16,18)+0.1
+        self.weights = pre_weights/pre_weights.sum(dim=1,keepdim=True)
+
+    def tearDown(self):
+        pass
+
+    def _unfused(self, momentum, weights):
+        weighted_multi_smooth_v = DS.compute_weighted_multi_smooth_v(momentum=momentum, weights=weights,
+                                                                     gaussian_stds=self.gaussian_stds,
+                                                                     gaussian_fourier_filter_generator=self.generator)
+        ret = torch.zeros_like(momentum)
+        for n in range(momentum.size()[1]):
+            ret[:, n, ...] = torch.sum(weighted_multi_smooth_v[:, :, n, ...]*weights, dim=1)
+        return ret
+
+    def test_forward(self):
+        fused = DS.weighted_multi_gaussian_smoothing(self.momentum, self.weights, self.gaussian_stds, self.generator)
+        unfused = self._unfused(self.momentum, self.weights)
+        npt.assert_almost_equal(fused.numpy(), unfused.numpy(), decimal=5)
+
+    def test_backward(self):
+        grad_output = torch.randn(self.momentum.size())
+
+        m1 = self.momentum.clone().requires_grad_(True)
+        w1 = self.weights.clone().requires_grad_(True)
+        (DS.weighted_multi_gaussian_smoothing(m1, w1, self.gaussian_stds, self.generator)*grad_output).sum().backward()
+
+        m2 = self.momentum.clone().requires_grad_(True)
+        w2 = self.weights.clone().requires_grad_(True)
+        (self._unfused(m2, w2)*grad_output).sum().backward()
+
+        npt.assert_almost_equal(m1.grad.numpy(), m2.grad.numpy(), decimal=4)
+        npt.assert_almost_equal(w1.grad.numpy(), w2.grad.numpy(), decimal=4)
+
+    def test_fused_weight_post_processing(self):
+        # some of the weights are below the minimum weight and get clamped
+        weights = self.weights.clone()
+        weights[:,0,0:4,...] = 1e-4
+        grad_output = torch.randn(self.momentum.size())
+
+        for sqrt_weights in [False, True]:
+            m1 = self.momentum.clone().requires_grad_(True)
+            w1 = weights.clone().requires_grad_(True)
+            y1 = DS.weighted_multi_gaussian_smoothing(m1, w1, self.gaussian_stds, self.generator,
+                                                      min_weight=1e-3, sqrt_weights=sqrt_weights)
+
+            m2 = self.momentum.clone().requires_grad_(True)
+            w2 = weights.clone().requires_grad_(True)
+            w2_post = torch.clamp(w2, min=1e-3)
+            if sqrt_weights:
+                w2_post = torch.sqrt(w2_post)
+            y2 = self._unfused(m2, w2_post)
+
+            npt.assert_almost_equal(y1.detach().numpy(), y2.detach().numpy(), decimal=5)
+            (y1*grad_output).sum().backward()
+            (y2*grad_output).sum().backward()
+            npt.assert_almost_equal(m1.grad.numpy(), m2.grad.numpy(), decimal=4)
+            npt.assert_almost_equal(w1.grad.numpy(), w2.grad.numpy(), decimal=4)
+
+class Test_fused_softmax_family(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        # batch x nr_of_gaussians x X x Y x Z (the layout of the 3D weight maps)
+        self.input = torch.randn(2,4,5,6,7)
+        self.weights = [0.1,0.2,0.3,0.4]
+
+    def tearDown(self):
+        pass
+
+    def _compare(self, fused_fcn, unfused_fcn, with_weights, dim=1):
+        grad_output = torch.randn(self.input.size())
+
+        x1 = self.input.clone().requires_grad_(True)
+        x2 = self.input.clone().requires_grad_(True)
+        if with_weights:
+            w1 = torch.tensor(self.weights).requires_grad_(True)
+            w2 = torch.tensor(self.weights).requires_grad_(True)
+            y1 = fused_fcn(x1, dim=dim, weights=w1)
+            y2 = unfused_fcn(x2, dim, w2)
+        else:
+            y1 = fused_fcn(x1, dim=dim)
+            y2 = unfused_fcn(x2, dim)
+
+        npt.assert_almost_equal(y1.detach().numpy(), y2.detach().numpy(), decimal=5)
+        (y1*grad_output).sum().backward()
+        (y2*grad_output).sum().backward()
+        npt.assert_almost_equal(x1.grad.numpy(), x2.grad.numpy(), decimal=4)
+        if with_weights:
+            npt.assert_almost_equal(w1.grad.numpy(), w2.grad.numpy(), decimal=3)
+
+    def test_weighted_softmax(self):
+        self._compare(DS.weighted_softmax, baseline.weighted_softmax, with_weights=True)
+
+    def test_weighted_softmax_along_first_dimension(self):
+        self.input = torch.randn(4,5,6,7)
+        self._compare(DS.weighted_softmax, baseline.weighted_softmax, with_weights=True, dim=0)
+
+    def test_stable_softmax(self):
+        self._compare(DS.stable_softmax, baseline.stable_softmax, with_weights=False)
+
+    def test_weighted_linear_softmax(self):
+        self._compare(DS.weighted_linear_softmax, baseline.weighted_linear_softmax, with_weights=True)
+
+    def test_weighted_linear_softnorm(self):
+        self._compare(DS.weighted_linear_softnorm, baseline.weighted_linear_softnorm, with_weights=True)
+
+    def test_linear_softmax(self):
+        self.input = torch.rand(self.input.size())*1.2-0.1
+        self._compare(DS.linear_softmax, baseline.linear_softmax, with_weights=False)
+
+    def test_linear_softnorm(self):
+        self.input = torch.rand(self.input.size())*1.2-0.1
+        self._compare(DS.linear_softnorm, baseline.linear_softnorm, with_weights=False)
+
+    def test_weighted_sqrt_softmax(self):
+        self._compare(DS.weighted_sqrt_softmax, baseline.weighted_sqrt_softmax, with_weights=True)
+
+    def test_weighted_sqrt_softmax_gradient_for_zero_weight(self):
+        x = self.input.clone().requires_grad_(True)
+        w = torch.tensor([0.,0.2,0.3,0.5]).requires_grad_(True)
+        DS.weighted_sqrt_softmax(x, dim=1, weights=w).sum().backward()
+        self.assertTrue(torch.isfinite(x.grad).all())
+        self.assertTrue(torch.isfinite(w.grad).all())
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,132 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from collections import OrderedDict
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.multiscale_optimizer as MO
+
+
+class Test_deferred_analysis(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        pass
+
+    def _register(self, analysis_step, rel_ftol, nr_of_iterations, visualize_step=None, return_history=False):
+        params = pars.ParameterDict()
+        params.load_JSON('./json/test_svf_image_single_scale_config.json')
+        params['optimizer']['name'] = 'sgd'
+        params['optimizer']['use_step_size_scheduler'] = False
+        params['optimizer']['single_scale']['nr_of_iterations'] = nr_of_iterations
+        params['optimizer']['single_scale']['rel_ftol'] = rel_ftol
+        params['optimizer']['reporting']['analysis_step'] = analysis_step
+
+        I0, I1, spacing = eg.CreateSquares(2).create_image_pair(np.array([32, 32]), params)
+        sz = np.array(I0.shape)
+
+        torch.manual_seed(0)
+        so = MO.SimpleSingleScaleRegistration(torch.from_numpy(I0.copy()), torch.from_numpy(I1), spacing, sz, params)
+        opt = so.get_optimizer()
+        visualized_iterations = []
+        if visualize_step is None:
+            opt.set_visualization(False)
+        else:
+            opt.set_visualization(True)
+            opt.set_visualize_step(visualize_step)
+
+        def show_current_images(iter, **kwargs):
+            visualized_iterations.append(iter)
+
+        with mock.patch.object(MO.vizReg, 'show_current_images', side_effect=show_current_images):
+            so.register()
+
+        history = so.get_history()
+        if return_history:
+            return history
+        # iterations may be analyzed twice (if the last one is visualized after stopping)
+        energies = OrderedDict(zip(history['iter'], history['energy']))
+        return energies, visualized_iterations
+
+    def test_analysis_step_one_analyzes_every_iteration(self):
+        energies, _ = self._register(analysis_step=1, rel_ftol=1e-12, nr_of_iterations=7)
+        self.assertEqual(list(energies.keys()), list(range(7)))
+
+        # the deferred analysis analyzes the same iterations with the same energies
+        energies_deferred, _ = self._register(analysis_step=3, rel_ftol=1e-12, nr_of_iterations=7)
+        self.assertEqual(list(energies_deferred.keys()), list(range(7)))
+        npt.assert_almost_equal(np.array(list(energies_deferred.values())),
+                                np.array(list(energies.values())), decimal=5)
+
+    def test_deferred_analysis_keeps_the_energies_of_the_samples(self):
+        history = self._register(analysis_step=1, rel_ftol=1e-12, nr_of_iterations=7, return_history=True)
+        history_deferred = self._register(analysis_step=3, rel_ftol=1e-12, nr_of_iterations=7, return_history=True)
+        for key in ['similarity_energy', 'regularization_energy']:
+            self.assertEqual(len(history_deferred[key]), len(history[key]))
+            for e_deferred, e in zip(history_deferred[key], history[key]):
+                self.assertEqual(np.shape(e_deferred), np.shape(e))
+                npt.assert_almost_equal(e_deferred, e, decimal=5)
+
+    def test_deferred_analysis_stops_and_visualizes(self):
+        analysis_step = 4
+        energies, visualized = self._register(analysis_step=1, rel_ftol=1e-2, nr_of_iterations=40, visualize_step=3)
+        last_iteration = list(energies.keys())[-1]
+        self.assertLess(last_iteration, 40 - analysis_step)
+
+        energies_deferred, visualized_deferred = self._register(analysis_step=analysis_step, rel_ftol=1e-2,
+                                                                nr_of_iterations=40, visualize_step=3)
+        last_iteration_deferred = list(energies_deferred.keys())[-1]
+        # the tolerance is only checked at a read back, hence up to analysis_step-1 more iterations are done
+        self.assertGreaterEqual(last_iteration_deferred, last_iteration)
+        self.assertLess(last_iteration_deferred, last_iteration + analysis_step)
+        for i in energies:
+            npt.assert_almost_equal(energies_deferred[i], energies[i], decimal=5)
+
+        # all iterations which are a multiple of visualize_step are visualized (also if they are not a multiple of
+        # analysis_step), as well as the last one
+        for i in energies_deferred:
+            if i % 3 == 0:
+                self.assertIn(i, visualized_deferred)
+        self.assertIn(last_iteration_deferred, visualized_deferred)
+        self.assertEqual([i for i in visualized if i % 3 == 0],
+                         [i for i in visualized_deferred if i % 3 == 0 and i <= last_iteration])
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
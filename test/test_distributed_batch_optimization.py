@@ -0,0 +1,131 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+
+import shutil
+import tempfile
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.fileio as FIO
+import mermaid.multiscale_optimizer as MO
+
+
+class Test_distributed_batch_optimization(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        self.directory = tempfile.mkdtemp()
+        params = pars.ParameterDict()
+        I0, I1, self.spacing = eg.CreateSquares(2, add_noise_to_bg=True).create_image_pair(np.array([16, 16]), params)
+
+        # four pairs written to disk (the batch optimizer reads its images from files)
+        sources = [I0, I0, I1, I1]
+        targets = [I1, 0.9 * I1, I0, 0.9 * I0]
+        self.source_filenames = []
+        self.target_filenames = []
+        im_io = FIO.ImageIO()
+        for i, (IS, IT) in enumerate(zip(sources, targets)):
+            source_filename = os.path.join(self.directory, 'source_{:d}.nrrd'.format(i))
+            target_filename = os.path.join(self.directory, 'target_{:d}.nrrd'.format(i))
+            im_io.write(source_filename, IS[0, 0, ...])
+            im_io.write(target_filename, IT[0, 0, ...])
+            self.source_filenames.append(source_filename)
+            self.target_filenames.append(target_filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _optimize(self, use_distributed):
+        params = pars.ParameterDict()
+        params['model']['deformation']['use_map'] = True
+        params['model']['registration_model']['type'] = 'svf_vector_momentum_map'
+        params['model']['registration_model']['forward_model']['number_of_time_steps'] = 5
+        params['model']['registration_model']['forward_model']['smoother']['type'] = 'adaptive_multiGaussian'
+        params['model']['registration_model']['forward_model']['smoother']['multi_gaussian_stds'] = [0.05, 0.1, 0.15]
+        params['model']['registration_model']['forward_model']['smoother']['optimize_over_smoother_weights'] = True
+        params['model']['registration_model']['similarity_measure']['type'] = 'ssd'
+        params['model']['registration_model']['similarity_measure']['sigma'] = 0.1
+        params['optimizer']['single_scale']['nr_of_iterations'] = 3
+        params['optimizer']['single_scale']['rel_ftol'] = 1e-12
+        params['optimizer']['use_step_size_scheduler'] = False
+
+        batch_settings = params['optimizer']['batch_settings']
+        batch_settings['shuffle'] = False
+        batch_settings['nr_of_epochs'] = 2
+        batch_settings['start_from_previously_saved_parameters'] = False
+        batch_settings['parameter_output_dir'] = \
+            os.path.join(self.directory, 'distributed' if use_distributed else 'single_process')
+        if use_distributed:
+            # two processes with one pair each form the same batches as a single process with two pairs
+            batch_settings['batch_size'] = 1
+            batch_settings['distributed']['use_distributed'] = True
+            batch_settings['distributed']['nr_of_processes'] = 2
+            batch_settings['distributed']['backend'] = 'gloo'
+        else:
+            batch_settings['batch_size'] = 2
+
+        bopt = MO.SingleScaleBatchRegistrationOptimizer([1, 1, 16, 16], self.spacing, True, None, params)
+        bopt.set_model('svf_vector_momentum_map')
+        bopt.set_optimizer_by_name('sgd')
+        bopt.set_visualization(False)
+        bopt.set_source_image(self.source_filenames)
+        bopt.set_target_image(self.target_filenames)
+        bopt.optimize()
+        return bopt
+
+    def _load(self, bopt, *path):
+        return torch.load(os.path.join(bopt.parameter_output_dir, *path), map_location='cpu')
+
+    def test_distributed_matches_single_process_optimization(self):
+        bopt_single = self._optimize(use_distributed=False)
+        bopt_distributed = self._optimize(use_distributed=True)
+
+        shared_single = self._load(bopt_single, 'shared', 'shared_parameters.pt')
+        shared_distributed = self._load(bopt_distributed, 'shared', 'shared_parameters.pt')
+        self.assertTrue(len(shared_single) > 0)
+        for k in shared_single:
+            npt.assert_almost_equal(shared_distributed[k].detach().cpu().numpy(),
+                                    shared_single[k].detach().cpu().numpy(), decimal=4)
+
+        for i in range(len(self.source_filenames)):
+            filename = 'individual_parameter_pair_{:05d}.pt'.format(i)
+            individual_single = self._load(bopt_single, 'individual', filename)
+            individual_distributed = self._load(bopt_distributed, 'individual', filename)
+            self.assertEqual(len(individual_distributed), len(individual_single))
+            for p_single, p_distributed in zip(individual_single, individual_distributed):
+                self.assertEqual(p_distributed['name'], p_single['name'])
+                npt.assert_almost_equal(p_distributed['model_params'].detach().cpu().numpy(),
+                                        p_single['model_params'].detach().cpu().numpy(), decimal=4)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
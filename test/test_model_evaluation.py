@@ -0,0 +1,128 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.model_evaluation as ME
+import mermaid.utils as utils
+
+
+class Test_model_evaluation(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        params = pars.ParameterDict()
+        I0, I1, self.spacing = eg.CreateSquares(2).create_image_pair(np.array([16, 16]), params)
+        self.ISource = torch.from_numpy(I0)
+        self.ITarget = torch.from_numpy(I1)
+        self.sz = np.array(self.ISource.size())
+        self.model_name = 'svf_vector_momentum_map'
+        self.map_low_res_factor = 0.5
+        # momentum at the (low) resolution of the model
+        self.m = 0.1 * torch.randn(1, 2, 8, 8)
+
+    def tearDown(self):
+        pass
+
+    def _get_params(self):
+        params = pars.ParameterDict()
+        params['model']['registration_model']['type'] = self.model_name
+        params['model']['deformation']['use_map'] = True
+        params['model']['registration_model']['forward_model']['smoother']['type'] = 'gaussian'
+        params['model']['registration_model']['forward_model']['smoother']['gaussian_std'] = 0.15
+        return params
+
+    def test_model_evaluator_matches_evaluate_model(self):
+        IWarped, phi, _, _ = ME.evaluate_model(self.ISource, self.ITarget, self.sz, self.spacing,
+                                               model_name=self.model_name, use_map=True,
+                                               map_low_res_factor=self.map_low_res_factor,
+                                               individual_parameters={'m': self.m.clone()},
+                                               params=self._get_params(), visualize=False)
+
+        evaluator = ME.ModelEvaluator(self.sz, self.spacing, self._get_params(), model_name=self.model_name,
+                                      use_map=True, map_low_res_factor=self.map_low_res_factor)
+        IWarped_e, phi_e, phi_inverse_e = evaluator.evaluate(self.ISource, {'m': self.m.clone()}, ITarget_in=self.ITarget)
+
+        npt.assert_almost_equal(phi_e.cpu().numpy(), phi.detach().cpu().numpy(), decimal=5)
+        npt.assert_almost_equal(IWarped_e.cpu().numpy(), IWarped.detach().cpu().numpy(), decimal=5)
+        self.assertIsNone(phi_inverse_e)
+
+        # batches may contain the target images (which are passed through to the model)
+        results = list(evaluator.evaluate_batches([(self.ISource, {'m': self.m.clone()}, self.ITarget),
+                                                   (self.ISource, {'m': self.m.clone()})]))
+        self.assertEqual(len(results), 2)
+        for IWarped_b, phi_b, _ in results:
+            npt.assert_almost_equal(phi_b.cpu().numpy(), phi_e.cpu().numpy(), decimal=6)
+            npt.assert_almost_equal(IWarped_b.cpu().numpy(), IWarped_e.cpu().numpy(), decimal=6)
+
+    def test_evaluate_batches_passes_target_images(self):
+        evaluator = ME.ModelEvaluator(self.sz, self.spacing, self._get_params(), model_name=self.model_name,
+                                      use_map=True, map_low_res_factor=self.map_low_res_factor)
+        passed_target_images = []
+        set_dictionary = evaluator.model.set_dictionary_to_pass_to_integrator
+
+        def set_dictionary_to_pass_to_integrator(d):
+            passed_target_images.append(d['I1'])
+            set_dictionary(d)
+
+        evaluator.model.set_dictionary_to_pass_to_integrator = set_dictionary_to_pass_to_integrator
+        list(evaluator.evaluate_batches([(self.ISource, {'m': self.m.clone()}, self.ITarget)]))
+        self.assertEqual(len(passed_target_images), 1)
+        self.assertIsNotNone(passed_target_images[0])
+
+    def test_model_evaluator_reuses_its_buffers(self):
+        evaluator = ME.ModelEvaluator(self.sz, self.spacing, self._get_params(), model_name=self.model_name,
+                                      use_map=True, map_low_res_factor=self.map_low_res_factor)
+
+        low_res_ISource = evaluator._get_low_res_image(self.ISource, 'source')
+        expected = utils._compute_low_res_image(self.ISource, self.spacing, evaluator.low_res_size, evaluator.spline_order)
+        npt.assert_almost_equal(low_res_ISource.cpu().numpy(), expected.cpu().numpy(), decimal=6)
+
+        # a different image of the same size is computed into the same buffer
+        ITarget = self.ITarget.clone()
+        low_res_ITarget = evaluator._get_low_res_image(ITarget, 'source')
+        self.assertEqual(low_res_ITarget.data_ptr(), low_res_ISource.data_ptr())
+        expected = utils._compute_low_res_image(ITarget, self.spacing, evaluator.low_res_size, evaluator.spline_order)
+        npt.assert_almost_equal(low_res_ITarget.cpu().numpy(), expected.cpu().numpy(), decimal=6)
+
+        # modifying the image in place invalidates the buffer
+        ITarget.mul_(2.)
+        npt.assert_almost_equal(evaluator._get_low_res_image(ITarget, 'source').cpu().numpy(),
+                                2. * expected.cpu().numpy(), decimal=5)
+
+        # only the identity maps of the most recent batch size are kept
+        evaluator.evaluate(self.ISource, {'m': self.m.clone()})
+        evaluator.evaluate(torch.cat((self.ISource, self.ISource)), {'m': torch.cat((self.m, self.m))})
+        self.assertEqual(evaluator._identity_maps[0], 2)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
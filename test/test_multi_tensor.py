@@ -0,0 +1,94 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.multi_tensor as MT
+import mermaid.deep_smoothers as DS
+
+
+class Test_multi_tensor(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        pass
+
+    def _clip_norm_per_sample_by_loop(self, t, max_norm, norm_type):
+        t = t.clone()
+        for b in range(t.size()[0]):
+            param_norm = t[b, ...].norm(norm_type)
+            if param_norm > max_norm:
+                t[b, ...].mul_(max_norm / param_norm)
+        return t
+
+    def test_clamp(self):
+        for use_foreach in [True, False]:
+            tensors = [torch.randn(5), torch.randn(3)]
+            expected = [t.clamp(-0.5, 0.5) for t in tensors]
+            MT.clamp_(tensors, -0.5, 0.5, use_foreach=use_foreach)
+            for t, e in zip(tensors, expected):
+                npt.assert_almost_equal(t.numpy(), e.numpy(), decimal=6)
+
+    def test_clip_norm_per_sample(self):
+        for norm_type in [1, 2]:
+            for use_foreach in [True, False]:
+                tensors = [torch.randn(4, 3, 5, 5), 0.01 * torch.randn(2, 6), torch.zeros(3, 2)]
+                expected = [self._clip_norm_per_sample_by_loop(t, 1., norm_type) for t in tensors]
+                MT.clip_norm_per_sample_(tensors, 1., norm_type=norm_type, use_foreach=use_foreach)
+                for t, e in zip(tensors, expected):
+                    npt.assert_almost_equal(t.numpy(), e.numpy(), decimal=5)
+
+    def test_clip_norm_per_sample_of_tensors_of_different_types(self):
+        tensors = [torch.randn(4, 3, 5, 5), torch.randn(2, 6, dtype=torch.float64)]
+        expected = [self._clip_norm_per_sample_by_loop(t, 1., 2) for t in tensors]
+        MT.clip_norm_per_sample_(tensors, 1., norm_type=2, use_foreach=True)
+        for t, e in zip(tensors, expected):
+            npt.assert_almost_equal(t.numpy(), e.numpy(), decimal=5)
+
+    def test_foreach_optimizer_settings(self):
+        self.assertEqual(MT.get_foreach_optimizer_settings(torch.optim.SGD, use_foreach=False), dict())
+        p = torch.nn.Parameter(torch.zeros(3))
+        # the settings are always accepted by the optimizer
+        torch.optim.SGD([p], lr=0.1, **MT.get_foreach_optimizer_settings(torch.optim.SGD))
+        torch.optim.Adam([p], lr=0.1, **MT.get_foreach_optimizer_settings(torch.optim.Adam))
+
+    def test_projection_to_min(self):
+        for norm_type in ['sum', 'sum_of_squares']:
+            for dim in [0, 1]:
+                weights = torch.rand(3, 4, 6, 6) if dim == 1 else torch.rand(4, 6, 6)
+                projected_weights = DS._project_weights_to_min(weights, 0.05, norm_type=norm_type, dim=dim)
+                if norm_type == 'sum':
+                    npt.assert_almost_equal(projected_weights.sum(dim).numpy(), 1., decimal=5)
+                else:
+                    npt.assert_almost_equal((projected_weights ** 2).sum(dim).numpy(), 1., decimal=5)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,140 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import shutil
+import tempfile
+
+import mermaid.module_parameters as pars
+import mermaid.similarity_measure_factory as SM
+import mermaid.optimizer_data_loaders as OD
+import mermaid.fileio as FIO
+
+
+class Test_size_buckets(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        pass
+
+    def test_bucket_size(self):
+        canonical_sizes = [[64, 64], [32, 32], [32, 48]]
+        self.assertEqual(OD.get_bucket_size([30, 40], canonical_sizes), (32, 48))
+        self.assertEqual(OD.get_bucket_size([20, 20], canonical_sizes), (32, 32))
+        # no canonical size fits
+        self.assertEqual(OD.get_bucket_size([70, 20], canonical_sizes), (70, 20))
+        self.assertEqual(OD.get_bucket_size([70, 20], canonical_sizes, pad_to_multiple_of=16), (80, 32))
+        self.assertEqual(OD.get_bucket_size([70, 20]), (70, 20))
+
+    def test_padding_keeps_the_image_and_returns_its_mask(self):
+        I = np.random.rand(1, 5, 7).astype('float32')
+        I_padded, mask = OD.pad_image_to_size(I, [8, 8])
+        self.assertEqual(list(I_padded.shape), [1, 8, 8])
+        npt.assert_almost_equal(I_padded[:, :5, :7], I)
+        self.assertEqual(I_padded[:, 5:, :].sum() + I_padded[:, :, 7:].sum(), 0.)
+        self.assertEqual(mask.sum(), 35.)
+        self.assertEqual(mask[:, :5, :7].sum(), 35.)
+        with self.assertRaises(ValueError):
+            OD.pad_image_to_size(I, [4, 8])
+
+    def test_round_robin_batches(self):
+        buckets = [[0, 1, 2, 3, 4], [5, 6], [7]]
+        sampler = OD.RoundRobinBucketBatchSampler(buckets, batch_size=2, shuffle=False)
+        batches = list(sampler)
+        self.assertEqual(batches, [[0, 1], [5, 6], [7], [2, 3], [4]])
+        self.assertEqual(len(sampler), len(batches))
+
+        sampler = OD.RoundRobinBucketBatchSampler(buckets, batch_size=2, shuffle=True)
+        batches = list(sampler)
+        for batch in batches:
+            self.assertEqual(len(set(self._get_bucket_nr(buckets, idx) for idx in batch)), 1)
+        self.assertEqual(sorted(idx for batch in batches for idx in batch), list(range(8)))
+
+    def _get_bucket_nr(self, buckets, idx):
+        return [nr for nr, bucket in enumerate(buckets) if idx in bucket][0]
+
+    def test_pairs_of_different_sizes_share_a_bucket(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # the images of the first pair differ in size; all images have the same physical spacing
+            sizes = [([14, 14], [16, 12]), ([16, 16], [16, 16]), ([20, 20], [20, 20])]
+            source_filenames = []
+            target_filenames = []
+            im_io = FIO.ImageIO()
+            for i, (source_sz, target_sz) in enumerate(sizes):
+                source_filenames.append(os.path.join(directory, 'source_{:d}.nrrd'.format(i)))
+                target_filenames.append(os.path.join(directory, 'target_{:d}.nrrd'.format(i)))
+                im_io.write(source_filenames[-1], np.random.rand(*source_sz).astype('float32'))
+                im_io.write(target_filenames[-1], np.random.rand(*target_sz).astype('float32'))
+
+            params = pars.ParameterDict()
+            params['data_loader']['bucketing']['canonical_sizes'] = [[16, 16], [24, 24]]
+            dataset = OD.SizeBucketedPairwiseRegistrationDataset(os.path.join(directory, 'parameters'),
+                                                                 source_filenames, target_filenames, params)
+
+            self.assertEqual(dataset.get_buckets(), [[0, 1], [2]])
+            # the spacing is normalized for the padded size
+            npt.assert_almost_equal(dataset.get_bucket_spacing(0), np.array([1. / 15, 1. / 15]))
+            npt.assert_almost_equal(dataset.get_bucket_spacing(1), np.array([1. / 23, 1. / 23]))
+            for idx in [0, 1]:
+                sample = dataset[idx]
+                self.assertEqual(list(sample['ISource'].shape), [1, 16, 16])
+                self.assertEqual(list(sample['ITarget'].shape), [1, 16, 16])
+            self.assertEqual(dataset[0]['mask'].sum(), 16 * 12)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_padded_voxels_do_not_change_the_similarity(self):
+        params = pars.ParameterDict()
+        params[('similarity_measure', {}, 'settings for the similarity measure')]
+        spacing = np.array([0.1, 0.1])
+        sizes = [[6, 9], [8, 5]]
+        I0 = [np.random.rand(1, *sz).astype('float32') for sz in sizes]
+        I1 = [np.random.rand(1, *sz).astype('float32') for sz in sizes]
+
+        padded = [OD.pad_image_to_size(I, [8, 9]) for I in I0]
+        padded_target = [OD.pad_image_to_size(I, [8, 9]) for I in I1]
+        I0_batch = torch.from_numpy(np.stack([I for I, _ in padded]))
+        I1_batch = torch.from_numpy(np.stack([I for I, _ in padded_target]))
+        mask_batch = torch.from_numpy(np.stack([mask for _, mask in padded_target]))
+
+        for similarity_measure_type in ['ssd', 'ncc']:
+            params['similarity_measure']['type'] = similarity_measure_type
+            similarity_measure = SM.SimilarityMeasureFactory(spacing).create_similarity_measure(params)
+            sim = similarity_measure.compute_similarity_multiNC_in_mask(I0_batch, I1_batch, mask_batch)
+            expected = sum(similarity_measure.compute_similarity_multiNC(torch.from_numpy(I0[n]).unsqueeze(0),
+                                                                         torch.from_numpy(I1[n]).unsqueeze(0)).item()
+                           for n in range(2))
+            npt.assert_almost_equal(sim.item(), expected, decimal=4)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,115 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+
+import json
+import shutil
+import tempfile
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.multiscale_optimizer as MO
+import mermaid.profiling as profiling
+
+
+class Test_profiling(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_disabled_profiler_records_nothing(self):
+        profiler = profiling.PhaseProfiler(enabled=False)
+        with profiler.activate(), profiling.phase('a'):
+            pass
+        self.assertEqual(profiler.end_iteration(), dict())
+
+    def test_phase_names_counts_and_times(self):
+        profiler = profiling.PhaseProfiler(enabled=True, record_chrome_trace=True)
+        # CUDA is disabled for the tests
+        self.assertFalse(profiler.use_cuda)
+
+        with profiler.activate():
+            with profiling.phase('outer'):
+                for i in range(3):
+                    with profiling.phase('inner'):
+                        torch.rand(10, 10).sum()
+        # no active profiler outside of the activation block
+        self.assertIsNone(profiling.get_active_profiler())
+
+        stats = profiler.end_iteration()
+        self.assertEqual(set(stats.keys()), {'outer', 'inner'})
+        self.assertEqual(stats['outer']['count'], 1)
+        self.assertEqual(stats['inner']['count'], 3)
+        for name in stats:
+            self.assertGreaterEqual(stats[name]['wall_time'], 0.)
+            self.assertEqual(stats[name]['cuda_time'], 0.)
+            self.assertEqual(stats[name]['peak_memory'], 0)
+        # nested phases are included in the time of the enclosing phase
+        self.assertGreaterEqual(stats['outer']['wall_time'], stats['inner']['wall_time'])
+
+        # statistics are per iteration
+        self.assertEqual(profiler.end_iteration(), dict())
+
+        trace_filename = os.path.join(self.directory, 'trace.json')
+        profiler.export_chrome_trace(trace_filename)
+        with open(trace_filename) as f:
+            trace = json.load(f)
+        self.assertEqual(len(trace['traceEvents']), 4)
+
+    def test_optimizer_records_profile_per_iteration(self):
+        params = pars.ParameterDict()
+        params.load_JSON('./json/test_svf_image_single_scale_config.json')
+        params['optimizer']['name'] = 'sgd'
+        params['optimizer']['single_scale']['nr_of_iterations'] = 3
+        params['optimizer']['single_scale']['rel_ftol'] = 1e-12
+        params['optimizer']['profiling']['enabled'] = True
+
+        I0, I1, spacing = eg.CreateSquares(2).create_image_pair(np.array([32, 32]), params)
+        sz = np.array(I0.shape)
+
+        so = MO.SimpleSingleScaleRegistration(torch.from_numpy(I0.copy()), torch.from_numpy(I1), spacing, sz, params)
+        so.get_optimizer().set_visualization(False)
+        so.register()
+
+        profile = so.get_history()['profile']
+        self.assertEqual(len(profile), 3)
+        for stats in profile:
+            for name in ['optimizer_step', 'forward_model', 'loss', 'backward', 'similarity']:
+                self.assertIn(name, stats)
+                self.assertGreaterEqual(stats[name]['count'], 1)
+                self.assertGreaterEqual(stats[name]['wall_time'], 0.)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
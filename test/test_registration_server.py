@@ -0,0 +1,115 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+import mermaid.registration_server as RS
+
+
+class Test_registration_server(unittest.TestCase):
+
+    def setUp(self):
+        sz = np.array([1,1,16,16])
+        self.spacing = 1./(sz[2:]-1)
+        X,Y = np.meshgrid(np.linspace(-1,1,16),np.linspace(-1,1,16),indexing='ij')
+        self.ISource = (X**2+Y**2<0.4).astype('float32').reshape(sz)
+        self.ITarget = ((X-0.1)**2+Y**2<0.5).astype('float32').reshape(sz)
+
+        self.server = RS.RegistrationServer(model_name='svf_vector_momentum_map',
+                                            session_settings={'nr_of_iterations': 2, 'optimizer_name': 'sgd'},
+                                            batch_timeout=0.2)
+        host, port = self.server.start()
+        self.client = RS.RegistrationClient(host, port)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_session_is_reused(self):
+        for i in range(2):
+            warped_image, phi, phi_inverse = self.client.register(self.ISource, self.ITarget, self.spacing)
+            npt.assert_equal(warped_image.shape, self.ISource.shape)
+            npt.assert_equal(phi.shape, (1,2,16,16))
+            self.assertIsNone(phi_inverse)
+
+        status = self.client.get_status()
+        self.assertEqual(len(status['sessions']), 1)
+        self.assertEqual(status['nr_of_registered_pairs'], 2)
+
+    def test_compatible_requests_are_batched(self):
+        requests = [self.server.submit(self.ISource, self.ITarget, self.spacing) for i in range(3)]
+        for request in requests:
+            request.done.wait()
+            self.assertIsNone(request.error)
+            npt.assert_equal(request.result['phi'].shape, (1,2,16,16))
+
+        self.assertEqual(self.server.nr_of_registered_pairs, 3)
+        self.assertEqual(self.server.nr_of_batches, 1)
+
+    def test_pairs_of_a_batch_are_registered_independently(self):
+        alone = self.server.submit(self.ISource, self.ITarget, self.spacing)
+        alone.done.wait()
+
+        # batched with an unrelated request (with two pairs) the result is the same
+        other_pairs = np.concatenate([self.ITarget, 0.5 * self.ISource], axis=0)
+        requests = [self.server.submit(other_pairs, np.concatenate([self.ISource, self.ITarget], axis=0), self.spacing),
+                    self.server.submit(self.ISource, self.ITarget, self.spacing)]
+        for request in requests:
+            request.done.wait()
+            self.assertIsNone(request.error)
+        npt.assert_equal(requests[0].result['phi'].shape, (2,2,16,16))
+        npt.assert_almost_equal(requests[1].result['phi'], alone.result['phi'], decimal=5)
+
+        # requests with different numbers of pairs share one session
+        self.assertEqual(len(self.server.get_status()['sessions']), 1)
+
+    def test_malformed_requests_are_rejected(self):
+        host, port = self.server.get_address()
+        # not npz data, missing arrays and arrays of the wrong type
+        for body in [b'not an npz file', RS._arrays_to_npz_bytes({'source': self.ISource}),
+                     RS._arrays_to_npz_bytes({'source': self.ISource, 'target': self.ITarget, 'spacing': np.array(1.)})]:
+            connection = HTTPConnection(host, port)
+            try:
+                connection.request('POST', '/register', body=body)
+                response = connection.getresponse()
+                message = response.read().decode('utf-8')
+            finally:
+                connection.close()
+            self.assertEqual(response.status, 400)
+            self.assertTrue(len(message) > 0)
+
+        # the server keeps working
+        warped_image, _, _ = self.client.register(self.ISource, self.ITarget, self.spacing)
+        npt.assert_equal(warped_image.shape, self.ISource.shape)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,87 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+
+import mermaid.module_parameters as pars
+import mermaid.example_generation as eg
+import mermaid.simple_interface as SI
+
+
+class Test_registration_session(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        params = pars.ParameterDict()
+        self.I0, self.I1, self.spacing = eg.CreateSquares(2).create_image_pair(np.array([32, 32]), params)
+        self.sz = np.array(self.I0.shape)
+        self.model_name = 'svf_vector_momentum_map'
+        self.nr_of_iterations = 5
+
+    def tearDown(self):
+        pass
+
+    def _register_image_pair(self, ISource, ITarget):
+        si = SI.RegisterImagePair()
+        si.register_images(ISource, ITarget, self.spacing, model_name=self.model_name,
+                           nr_of_iterations=self.nr_of_iterations, visualize_step=None,
+                           similarity_measure_sigma=0.1, smoother_type='gaussian')
+        return si.get_map().detach().cpu().numpy()
+
+    def test_session_matches_register_image_pair(self):
+        session = SI.RegistrationSession(self.sz, self.spacing, model_name=self.model_name,
+                                         nr_of_iterations=self.nr_of_iterations,
+                                         similarity_measure_sigma=0.1, smoother_type='gaussian')
+        # the second pair is registered after resetting the individual parameters of the session
+        pairs = [(self.I0, self.I1), (self.I1, self.I0)]
+        results = list(session.register_pairs(pairs))
+        self.assertEqual(session.nr_of_registered_pairs, 2)
+
+        for (ISource, ITarget), (_, phi, _) in zip(pairs, results):
+            phi_expected = self._register_image_pair(ISource, ITarget)
+            npt.assert_almost_equal(phi.cpu().numpy(), phi_expected, decimal=4)
+
+    def test_settings_are_set_alike(self):
+        session = SI.RegistrationSession(self.sz, self.spacing, model_name=self.model_name,
+                                         nr_of_iterations=self.nr_of_iterations, rel_ftol=1e-5, optimizer_name='sgd')
+        params, model_name = SI._get_registration_params(None, self.model_name)
+        SI._set_registration_settings(params, model_name, True,
+                                      nr_of_iterations=self.nr_of_iterations, rel_ftol=1e-5, optimizer_name='sgd')
+        session_params = session.get_params()
+        self.assertEqual(session_params['model']['registration_model']['type'], params['model']['registration_model']['type'])
+        self.assertEqual(session_params['model']['deformation']['use_map'], params['model']['deformation']['use_map'])
+        self.assertEqual(session_params['optimizer']['name'], params['optimizer']['name'])
+        self.assertEqual(session_params['optimizer']['single_scale']['nr_of_iterations'],
+                         params['optimizer']['single_scale']['nr_of_iterations'])
+        self.assertEqual(session_params['optimizer']['single_scale']['rel_ftol'],
+                         params['optimizer']['single_scale']['rel_ftol'])
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,59 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.module_parameters as pars
+import mermaid.regularizer_factory as RF
+
+
+class Test_batched_regularizers(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        pass
+
+    def _compare(self, regularizer_type, spatial_sz):
+        spacing = 1./(np.array(spatial_sz)-1)
+        regularizer = RF.RegularizerFactory(spacing).create_regularizer_by_name(regularizer_type, pars.ParameterDict())
+        v = torch.randn([3,len(spatial_sz)]+list(spatial_sz))
+
+        batched = regularizer.compute_regularizer_multiN(v)
+        looped = regularizer.compute_regularizer_multiN_by_looping(v)
+        npt.assert_almost_equal(batched.item()/looped.item(), 1., decimal=5)
+
+    def test_regularizers(self):
+        for regularizer_type in ['helmholtz','totalVariation','diffusion','curvature']:
+            for spatial_sz in [[20],[12,14],[8,9,10]]:
+                self._compare(regularizer_type, spatial_sz)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,162 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.module_parameters as pars
+import mermaid.similarity_measure_factory as SM
+import mermaid.utils as utils
+import mermaid.roi as ROI
+import mermaid.example_generation as eg
+import mermaid.multiscale_optimizer as MO
+
+
+class Test_roi(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.sz = np.array([2, 1, 20, 24])
+        self.spacing = np.array([0.1, 0.2])
+        self.mask = torch.zeros(1, 1, 20, 24)
+        self.mask[:, :, 5:9, 2:12] = 1.
+
+    def tearDown(self):
+        pass
+
+    def _create_similarity_measure(self, similarity_measure_type):
+        params = pars.ParameterDict()
+        params[('similarity_measure', {}, 'settings for the similarity measure')]
+        params['similarity_measure']['type'] = similarity_measure_type
+        params['similarity_measure']['sigma'] = 0.5
+        return SM.SimilarityMeasureFactory(self.spacing).create_similarity_measure(params)
+
+    def test_bounding_box_from_mask(self):
+        self.assertEqual(ROI.get_bounding_box_from_mask(self.mask), [(5, 9), (2, 12)])
+        # the margin is clipped to the domain
+        self.assertEqual(ROI.get_bounding_box_from_mask(self.mask, margin=3), [(2, 12), (0, 15)])
+        self.assertEqual(ROI.get_bounding_box_from_mask(self.mask, margin=[1, 0]), [(4, 10), (2, 12)])
+        with self.assertRaises(ValueError):
+            ROI.get_bounding_box_from_mask(torch.zeros(1, 1, 4, 4))
+
+    def test_cropped_map_is_embedded_back(self):
+        bounding_box = ROI.get_bounding_box_from_mask(self.mask, margin=2)
+        phi = utils.get_identity_map(self.sz, self.spacing) + 0.01 * torch.randn(2, 2, 20, 24)
+        phi_roi = ROI.crop_map_to_bounding_box(phi, bounding_box, self.spacing)
+
+        # the cropped identity is the identity of the cropped domain
+        id_roi = ROI.crop_map_to_bounding_box(utils.get_identity_map(self.sz, self.spacing), bounding_box, self.spacing)
+        npt.assert_almost_equal(id_roi.numpy(), utils.get_identity_map(id_roi.size(), self.spacing).numpy(), decimal=5)
+
+        phi_embedded = ROI.embed_map_into_identity(phi_roi, bounding_box, self.sz, self.spacing)
+        id = utils.get_identity_map(self.sz, self.spacing)
+        npt.assert_almost_equal(ROI.crop_to_bounding_box(phi_embedded, bounding_box).numpy(),
+                                ROI.crop_to_bounding_box(phi, bounding_box).numpy(), decimal=5)
+        npt.assert_almost_equal(phi_embedded[:, :, :bounding_box[0][0], ...].numpy(),
+                                id[:, :, :bounding_box[0][0], ...].numpy(), decimal=5)
+        npt.assert_almost_equal(phi_embedded[:, :, :, bounding_box[1][1]:].numpy(),
+                                id[:, :, :, bounding_box[1][1]:].numpy(), decimal=5)
+
+    def test_low_resolution_identity_is_embedded_as_identity(self):
+        bounding_box = [(3, 14), (4, 21)]
+        low_res_sz = [2, 2, 6, 9]
+        low_res_spacing = self.spacing * np.array([10., 16.]) / (np.array(low_res_sz[2:]) - 1.)
+        phi_roi = utils.get_identity_map(low_res_sz, low_res_spacing)
+        phi = ROI.embed_map_into_identity(phi_roi, bounding_box, self.sz, self.spacing)
+        npt.assert_almost_equal(phi.numpy(), utils.get_identity_map(self.sz, self.spacing).numpy(), decimal=5)
+
+    def test_masked_ssd_only_uses_masked_voxels(self):
+        I0 = torch.rand(2, 1, 20, 24)
+        I1 = torch.rand(2, 1, 20, 24)
+        similarity_measure = self._create_similarity_measure('ssd')
+        sim = similarity_measure.compute_similarity_multiNC_in_mask(I0, I1, self.mask)
+        expected = (((I0 - I1) * self.mask) ** 2).sum() / 0.5 ** 2 * self.spacing.prod()
+        npt.assert_almost_equal(sim.item(), expected.item(), decimal=4)
+
+    def test_masked_voxelwise_measures_match_cropped_images(self):
+        I0 = torch.rand(2, 2, 20, 24)
+        I1 = torch.rand(2, 2, 20, 24)
+        bounding_box = ROI.get_bounding_box_from_mask(self.mask)
+        for similarity_measure_type in ['ssd', 'ncc', 'ncc_positive', 'ncc_negative']:
+            similarity_measure = self._create_similarity_measure(similarity_measure_type)
+            self.assertTrue(similarity_measure.voxelwise)
+            sim_masked = similarity_measure.compute_similarity_multiNC_in_mask(I0, I1, self.mask)
+            sim_cropped = similarity_measure.compute_similarity_multiNC(ROI.crop_to_bounding_box(I0, bounding_box),
+                                                                        ROI.crop_to_bounding_box(I1, bounding_box))
+            npt.assert_almost_equal(sim_masked.item(), sim_cropped.item(), decimal=4)
+
+    def test_masked_omt_masks_the_warped_source_image(self):
+        I0Source = torch.rand(2, 1, 20, 24)
+        I1 = torch.rand(2, 1, 20, 24)
+        phi = utils.get_identity_map(self.sz, self.spacing)
+        similarity_measure = self._create_similarity_measure('omt')
+        self.assertFalse(similarity_measure.voxelwise)
+        sim_masked = similarity_measure.compute_similarity_multiNC_in_mask(None, I1, self.mask, I0Source, phi)
+        # for the identity map, warping the masked source image is the same as masking the warped source image
+        sim_expected = similarity_measure.compute_similarity_multiNC(None, I1 * self.mask, I0Source * self.mask, phi)
+        sim_unmasked = similarity_measure.compute_similarity_multiNC(None, I1, I0Source, phi)
+        npt.assert_almost_equal(sim_masked.item(), sim_expected.item(), decimal=4)
+        self.assertNotAlmostEqual(sim_masked.item(), sim_unmasked.item(), places=4)
+
+    def _create_roi_registration(self):
+        params = pars.ParameterDict()
+        params.load_JSON('./json/test_svf_map_single_scale_config.json')
+        params['optimizer']['single_scale']['nr_of_iterations'] = 1
+        I0, I1, spacing = eg.CreateSquares(2).create_image_pair(np.array([32, 32]), params)
+        sz = np.array(I0.shape)
+        so = MO.SimpleSingleScaleRegistration(torch.from_numpy(I0.copy()), torch.from_numpy(I1), spacing, sz, params,
+                                              roi_bounding_box=[(8, 24), (10, 22)])
+        so.get_optimizer().set_visualization(False)
+        return so, torch.from_numpy((I0 > 0.5).astype('float32'))
+
+    def test_warped_label_is_given_on_the_full_domain(self):
+        so, LSource = self._create_roi_registration()
+        so.set_source_label(LSource)
+        so.set_target_label(LSource)
+        so.register()
+        self.assertEqual(list(so.get_warped_label().size()), list(LSource.size()))
+
+    def test_warped_label_requires_the_full_source_label(self):
+        so, LSource = self._create_roi_registration()
+        # a label of the region of interest only cannot be embedded into the full domain
+        so.get_optimizer().set_source_label(ROI.crop_to_bounding_box(LSource, so.roi_bounding_box).contiguous())
+        with self.assertRaises(ValueError):
+            so.get_warped_label()
+
+    def test_roi_is_rejected_for_batch_and_consensus_optimization(self):
+        params = pars.ParameterDict()
+        params.load_JSON('./json/test_svf_map_single_scale_config.json')
+        I0, I1, spacing = eg.CreateSquares(2).create_image_pair(np.array([32, 32]), params)
+        sz = np.array(I0.shape)
+        for registration_class in [MO.SimpleSingleScaleBatchRegistration, MO.SimpleSingleScaleConsensusRegistration]:
+            with self.assertRaises(ValueError):
+                registration_class(torch.from_numpy(I0.copy()), torch.from_numpy(I1), spacing, sz, params,
+                                   roi_bounding_box=[(8, 24), (10, 22)])
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
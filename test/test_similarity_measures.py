@@ -0,0 +1,176 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.module_parameters as pars
+import mermaid.similarity_measure_factory as SM
+import mermaid.similarity_helper_omt as OMT
+import mermaid.similarity_helper_mi as MI
+import mermaid.utils as utils
+
+
+class Test_batched_similarity_measures(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.spacing = np.array([0.1, 0.2])
+        self.I0 = torch.rand(3, 2, 12, 14)
+        self.I1 = torch.rand(3, 2, 12, 14)
+
+    def tearDown(self):
+        pass
+
+    def _create_similarity_measure(self, similarity_measure_type):
+        params = pars.ParameterDict()
+        params[('similarity_measure', {}, 'settings for the similarity measure')]
+        params['similarity_measure']['type'] = similarity_measure_type
+        params['similarity_measure']['sigma'] = 0.5
+        return SM.SimilarityMeasureFactory(self.spacing).create_similarity_measure(params)
+
+    def _sum_over_images_of_channel_averages(self, similarity_measure):
+        # evaluates the measure for each image and channel separately
+        sim = 0.
+        for n in range(self.I0.size()[0]):
+            for c in range(self.I0.size()[1]):
+                sim += similarity_measure.compute_similarity_multiNC(self.I0[n:n+1, c:c+1, ...], self.I1[n:n+1, c:c+1, ...]).item()
+        return sim / self.I0.size()[1]
+
+    def test_single_image_similarity_matches_looping(self):
+        similarity_measure = self._create_similarity_measure('ssd_single')
+        batched = similarity_measure.compute_similarity_multiNC(self.I0, self.I1)
+        looped = similarity_measure.compute_similarity_multiNC_by_looping(self.I0, self.I1)
+        npt.assert_almost_equal(batched.item(), looped.item(), decimal=3)
+
+    def test_batched_measures_match_per_image_and_channel_evaluation(self):
+        for similarity_measure_type in ['ssd', 'ssd_single', 'ncc', 'ncc_positive', 'ncc_negative']:
+            similarity_measure = self._create_similarity_measure(similarity_measure_type)
+            batched = similarity_measure.compute_similarity_multiNC(self.I0, self.I1)
+            npt.assert_almost_equal(batched.item(), self._sum_over_images_of_channel_averages(similarity_measure), decimal=3)
+
+
+class Test_batched_sinkhorn(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.I0 = torch.zeros(2, 12, 14)
+        self.I0[:, 3:7, 4:9] = 1.
+        self.I1 = torch.zeros(2, 12, 14)
+        self.I1[0, 4:8, 5:10] = 1.
+        self.I1[1, 2:6, 3:11] = 1.
+
+    def tearDown(self):
+        pass
+
+    def test_log_domain_sinkhorn_matches_reference(self):
+        engine = OMT.OMTSinkhornEngine(std_sinkhorn=0.1, max_nr_of_iterations=1000, tolerance=1e-7, warm_start=False)
+        value, _, _ = engine.solve(self.I0, self.I1)
+
+        for n in range(2):
+            reference = OMT.OTSimilarityGradient([1. / 11, 1. / 13], [12, 14], sinkhorn_iterations=1000, std_dev=0.1)
+            reference_value, _ = reference.compute_similarity(self.I0[n], self.I1[n])
+            npt.assert_almost_equal(value[n].item(), reference_value.item(), decimal=5)
+
+    def test_warm_start_reduces_the_number_of_iterations(self):
+        engine = OMT.OMTSinkhornEngine(std_sinkhorn=0.1, max_nr_of_iterations=1000, tolerance=1e-6, warm_start=True)
+        engine.solve(self.I0, self.I1)
+        nr_of_iterations_cold = engine.nr_of_iterations
+        engine.solve(self.I0, self.I1)
+        self.assertLess(engine.nr_of_iterations, nr_of_iterations_cold)
+
+    def test_warm_start_is_not_used_for_a_different_batch(self):
+        engine = OMT.OMTSinkhornEngine(std_sinkhorn=0.1, max_nr_of_iterations=1000, tolerance=1e-6, warm_start=True)
+        engine.solve(self.I0, self.I1)
+        other_I1 = self.I1.flip(1)
+        engine.solve(self.I0, other_I1)
+        nr_of_iterations = engine.nr_of_iterations
+        engine.reset()
+        engine.solve(self.I0, other_I1)
+        self.assertEqual(engine.nr_of_iterations, nr_of_iterations)
+
+    def test_chunked_kernel_application_matches_full_application(self):
+        L = torch.randn(2, 12, 14, dtype=torch.float64)
+        log_kernels = OMT.get_log_gibbs_kernels([12, 14], 0.1, dtype=torch.float64)
+        full = OMT._apply_log_kernels(L, log_kernels)
+
+        max_nr_of_elements_per_chunk = OMT._max_nr_of_elements_per_chunk
+        try:
+            # forces chunks of four entries (along both axes)
+            OMT._max_nr_of_elements_per_chunk = 4 * 2 * 12 * 14
+            chunked = OMT._apply_log_kernels(L, log_kernels)
+        finally:
+            OMT._max_nr_of_elements_per_chunk = max_nr_of_elements_per_chunk
+        npt.assert_almost_equal(chunked.numpy(), full.numpy(), decimal=10)
+
+    def test_gradient_through_the_map(self):
+        sz = [1, 1, 6, 6]
+        spacing = np.array([1. / 5, 1. / 5])
+        identity = torch.from_numpy(utils.identity_map_multiN(sz, spacing, dtype='float64'))
+        # maps to interior points which are not on the grid (where linear interpolation is not differentiable)
+        phi = (0.1 + 0.8 * identity + 0.3 * spacing[0] * torch.rand(identity.size(), dtype=torch.float64)).requires_grad_(True)
+        I0 = torch.exp(-((identity[:, 0:1] - 0.4) ** 2 + (identity[:, 1:2] - 0.5) ** 2) / 0.1)
+        I1 = torch.exp(-((identity[:, 0:1] - 0.6) ** 2 + (identity[:, 1:2] - 0.5) ** 2) / 0.1)
+        engine = OMT.OMTSinkhornEngine(std_sinkhorn=0.3, max_nr_of_iterations=10000, tolerance=1e-11, warm_start=False)
+
+        def similarity(phi):
+            I0_warped = utils.compute_warped_image_multiNC(I0, phi, spacing, 1)
+            return OMT.BatchedOTSimilarityHelper.apply(I0_warped, I1, engine)
+
+        self.assertTrue(torch.autograd.gradcheck(similarity, (phi,), eps=1e-6, atol=1e-6))
+
+
+class Test_mutual_information(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        pass
+
+    def test_parzen_histogram_gradient(self):
+        t0 = (1. + 5. * torch.rand(2, 20, dtype=torch.float64)).requires_grad_(True)
+        t1 = 1. + 5. * torch.rand(2, 20, dtype=torch.float64)
+        histogram = MI.ParzenJointHistogram.apply(t0, t1, 9)
+        npt.assert_almost_equal(histogram.sum(2).sum(1).detach().numpy(), np.ones(2))
+        self.assertTrue(torch.autograd.gradcheck(lambda t: MI.ParzenJointHistogram.apply(t, t1, 9), (t0,), eps=1e-6, atol=1e-5))
+
+    def test_mutual_information_is_largest_for_aligned_images(self):
+        params = pars.ParameterDict()
+        params[('similarity_measure', {}, 'settings for the similarity measure')]
+        params['similarity_measure']['type'] = 'mi'
+        similarity_measure = SM.SimilarityMeasureFactory(np.array([0.1, 0.1])).create_similarity_measure(params)
+
+        I1 = torch.rand(2, 1, 16, 16)
+        I0 = 1. - I1 ** 2 # a different modality, but functionally dependent
+        shuffled = I0.view(2, 1, -1)[:, :, torch.randperm(256)].view(2, 1, 16, 16)
+        self.assertLess(similarity_measure.compute_similarity_multiNC(I0, I1).item(),
+                        similarity_measure.compute_similarity_multiNC(shuffled, I1).item())
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,89 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.spectral_operators as SO
+
+
+def _periodic_laplacian(v, spacing):
+    # central second differences with periodic boundary conditions (over the trailing spatial dimensions)
+    dim = len(spacing)
+    lap = torch.zeros_like(v)
+    for d in range(dim):
+        axis = v.dim() - dim + d
+        lap = lap + (torch.roll(v, 1, axis) - 2 * v + torch.roll(v, -1, axis)) / spacing[d] ** 2
+    return lap
+
+
+class Test_spectral_operators(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        pass
+
+    def test_helmholtz_operator_matches_periodic_finite_differences(self):
+        for spatial_sz in [[16], [12, 15], [8, 9, 10]]:
+            spacing = 1. / (np.array(spatial_sz) - 1)
+            v = torch.randn([2, len(spatial_sz)] + spatial_sz, dtype=torch.float64)
+            Lv = SO.apply_helmholtz_operator(v, spacing, alpha=0.1, gamma=1.5)
+            Lv_fd = 1.5 * v - 0.1 * _periodic_laplacian(v, spacing)
+            npt.assert_almost_equal(Lv.numpy(), Lv_fd.numpy(), decimal=6)
+
+    def test_inverse_and_square_root(self):
+        spatial_sz = [12, 15]
+        spacing = 1. / (np.array(spatial_sz) - 1)
+        v = torch.randn([2, 2] + spatial_sz, dtype=torch.float64)
+        w = SO.apply_helmholtz_operator(SO.apply_helmholtz_operator(v, spacing, 0.1, 1., power=1.), spacing, 0.1, 1., power=-1.)
+        npt.assert_almost_equal(w.numpy(), v.numpy(), decimal=6)
+        w = SO.apply_helmholtz_operator(SO.apply_helmholtz_operator(v, spacing, 0.1, 1., power=-0.5), spacing, 0.1, 1., power=-0.5)
+        npt.assert_almost_equal(w.numpy(), SO.apply_helmholtz_operator(v, spacing, 0.1, 1., power=-1.).numpy(), decimal=6)
+
+    def test_diffusion_steps(self):
+        spatial_sz = [10, 11, 12]
+        spacing = 1. / (np.array(spatial_sz) - 1)
+        tau = 0.5 / 8 * spacing.min() ** 2
+        v = torch.randn([1, 3] + spatial_sz, dtype=torch.float64)
+        v_explicit = v.clone()
+        for i in range(20):
+            v_explicit = v_explicit + tau * _periodic_laplacian(v_explicit, spacing)
+        symbol = SO.get_diffusion_symbol(spatial_sz, spacing, tau, 20, dtype=torch.float64, device='cpu')
+        npt.assert_almost_equal(SO.apply_symbol(v, symbol).numpy(), v_explicit.numpy(), decimal=6)
+
+    def test_symbols_are_cached(self):
+        spacing = np.array([0.1, 0.1])
+        s1 = SO.get_helmholtz_symbol([8, 8], spacing, 0.1, 1., power=-2., device='cpu')
+        s2 = SO.get_helmholtz_symbol([8, 8], spacing, 0.1, 1., power=-2., device='cpu')
+        self.assertTrue(s1 is s2)
+        self.assertEqual(list(s1.size()), [8, 5])
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
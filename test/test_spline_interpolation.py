@@ -0,0 +1,84 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.spline_interpolation as SI
+
+
+class Test_spline_interpolation_helper(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        pass
+
+    def _get_random_input(self, sz_c, sz_points, nr_of_taps=4):
+        dim = len(sz_c) - 2
+        c = torch.randn(sz_c)
+        weight = torch.rand([nr_of_taps, sz_c[0], dim] + sz_points)
+        index = torch.zeros([nr_of_taps, sz_c[0], dim] + sz_points, dtype=torch.long)
+        for d in range(dim):
+            index[:, :, d, ...] = torch.randint(0, sz_c[2 + d], [nr_of_taps, sz_c[0]] + sz_points)
+        return c, weight, index
+
+    def _compute_value_and_gradients(self, c, weight, index, vectorized, deterministic=False):
+        c = c.clone().requires_grad_(True)
+        weight = weight.clone().requires_grad_(True)
+        w = SI.perform_spline_interpolation_helper(c, weight, index, vectorized, deterministic)
+        (w * torch.linspace(-1., 1., w.nelement()).view(w.size())).sum().backward()
+        return w.detach(), c.grad, weight.grad
+
+    def test_vectorized_matches_looping(self):
+        for sz_c, sz_points in [([2, 2, 9], [13]), ([2, 3, 6, 7], [5, 4]), ([2, 2, 5, 6, 4], [3, 4, 5])]:
+            c, weight, index = self._get_random_input(sz_c, sz_points)
+            looped = self._compute_value_and_gradients(c, weight, index, vectorized=False)
+            for deterministic in [False, True]:
+                vectorized = self._compute_value_and_gradients(c, weight, index, vectorized=True, deterministic=deterministic)
+                for r_vectorized, r_looped in zip(vectorized, looped):
+                    npt.assert_almost_equal(r_vectorized.numpy(), r_looped.numpy(), decimal=4)
+
+    def test_taps_are_gathered_for_one_tap_of_the_first_dimension_at_a_time(self):
+        c, weight, index = self._get_random_input([2, 2, 5, 6, 4], [3, 4, 5])
+        nr_of_taps = weight.size()[0]
+        l_indices, tap_weights = SI._get_tap_indices_and_weights(c.size(), weight, index, 1)
+        self.assertEqual(list(l_indices.size()), [1, nr_of_taps, nr_of_taps, 2, 3, 4, 5])
+        self.assertEqual(list(tap_weights.size()), [1, nr_of_taps, nr_of_taps, 2, 3, 4, 5])
+        npt.assert_almost_equal(tap_weights[0, 2, 0].numpy(),
+                                (weight[1, :, 0] * weight[2, :, 1] * weight[0, :, 2]).numpy(), decimal=6)
+
+    def test_deterministic_accumulation_is_reproducible(self):
+        c, weight, index = self._get_random_input([2, 2, 6, 7], [12, 12])
+        _, grad_c_1, _ = self._compute_value_and_gradients(c, weight, index, vectorized=True, deterministic=True)
+        _, grad_c_2, _ = self._compute_value_and_gradients(c, weight, index, vectorized=True, deterministic=True)
+        self.assertTrue(torch.equal(grad_c_1, grad_c_2))
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
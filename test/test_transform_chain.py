@@ -0,0 +1,92 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.utils as utils
+import mermaid.transform_chain as TC
+import mermaid.affine_registration as AR
+
+
+class Test_transform_chain(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.sz = [2,1,12,14]
+        self.spacing = 1./(np.array(self.sz[2:])-1)
+        self.id = torch.from_numpy(utils.identity_map_multiN(self.sz,self.spacing))
+
+        # small rotations/scalings + translations; parameter vectors [a11,a21,a12,a22,b1,b2]
+        self.Ab1 = torch.tensor([[1.05,0.05,-0.05,0.95,0.02,-0.01]]*2)
+        self.Ab2 = torch.tensor([[0.98,-0.03,0.02,1.02,-0.03,0.04]]*2)
+
+    def tearDown(self):
+        pass
+
+    def test_affines_are_merged(self):
+        chain = TC.TransformChain()
+        chain.append_affine(self.Ab1).append_affine(self.Ab2)
+        self.assertEqual(len(chain),1)
+
+        expected = utils.apply_affine_transform_to_map_multiNC(self.Ab1,utils.apply_affine_transform_to_map_multiNC(self.Ab2,self.id))
+        npt.assert_almost_equal(chain.get_map(self.sz,self.spacing).numpy(),expected.numpy(),decimal=5)
+
+    def test_identity_map_does_not_change_chain(self):
+        chain = TC.TransformChain()
+        chain.append_affine(self.Ab1).append_map(self.id.clone(),self.spacing)
+
+        expected = utils.apply_affine_transform_to_map_multiNC(self.Ab1,self.id)
+        npt.assert_almost_equal(chain.get_map(self.sz,self.spacing).numpy(),expected.numpy(),decimal=5)
+
+    def test_map_has_the_data_type_of_the_transforms(self):
+        chain = TC.TransformChain()
+        chain.append_affine(self.Ab1.double())
+        phi = chain.get_map(self.sz,self.spacing)
+        self.assertEqual(phi.dtype,torch.float64)
+        self.assertEqual(phi.device,self.Ab1.device)
+
+    def test_affine_pre_registration_maps_are_evaluated_by_chains(self):
+        affine_registration = AR.MultiResolutionAffineRegistration(self.spacing)
+        affine_registration.Ab = self.Ab1
+        phi, phi_inverse = affine_registration.get_initial_maps(self.sz)
+        npt.assert_almost_equal(phi.numpy(),utils.apply_affine_transform_to_map_multiNC(self.Ab1,self.id).numpy(),decimal=5)
+        # composing the map with its inverse gives the identity
+        chain, inverse_chain = affine_registration.get_transform_chains()
+        npt.assert_almost_equal(chain.append_chain(inverse_chain).get_map(self.sz,self.spacing).numpy(),self.id.numpy(),decimal=5)
+
+    def test_tiled_evaluation(self):
+        u = 0.01*torch.randn(self.id.size())
+        chain = TC.TransformChain()
+        chain.append_affine(self.Ab1).append_displacement(u,self.spacing).append_affine(self.Ab2)
+
+        npt.assert_almost_equal(chain.get_map(self.sz,self.spacing,tile_size=5).numpy(),
+                                chain.get_map(self.sz,self.spacing).numpy(),decimal=6)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,131 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import imp
+
+try:
+    imp.find_module('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+
+import mermaid.utils as utils
+
+
+class Test_inverse_map_by_fixed_point_iteration(unittest.TestCase):
+
+    def setUp(self):
+        self.sz = [1, 1, 32, 32]
+        self.spacing = np.array([1. / 31, 1. / 31])
+        self.identity_map = utils.get_identity_map(self.sz, self.spacing)
+
+    def tearDown(self):
+        pass
+
+    def _get_smooth_map(self):
+        # smooth displacement which vanishes at the boundary
+        X = self.identity_map[:, 0:1, ...]
+        Y = self.identity_map[:, 1:2, ...]
+        bump = torch.sin(np.pi * X) * torch.sin(np.pi * Y)
+        u = torch.cat([0.03 * bump, -0.02 * bump], dim=1)
+        return self.identity_map + u
+
+    def _get_inconsistency(self, phi, phi_inverse):
+        phi_of_phi_inverse = utils.compute_warped_image_multiNC(phi, phi_inverse, self.spacing, 1, zero_boundary=False)
+        return (phi_of_phi_inverse - self.identity_map).norm(p=2, dim=1).max().item()
+
+    def test_inverse_of_smooth_map(self):
+        phi = self._get_smooth_map()
+        phi_inverse, residual = utils.compute_inverse_map_by_fixed_point_iteration(phi, self.spacing, tolerance=1e-6)
+        # phi o phi_inverse is the identity (up to the interpolation error)
+        self.assertLess(self._get_inconsistency(phi, phi_inverse), 1e-3)
+        # the residual belongs to the returned inverse
+        self.assertAlmostEqual(residual, self._get_inconsistency(phi, phi_inverse), places=5)
+
+    def test_residual_belongs_to_returned_inverse(self):
+        phi = self._get_smooth_map()
+        for max_nr_of_iterations in [0, 1, 2]:
+            phi_inverse, residual = utils.compute_inverse_map_by_fixed_point_iteration(
+                phi, self.spacing, tolerance=0., max_nr_of_iterations=max_nr_of_iterations)
+            self.assertIsNotNone(residual)
+            self.assertAlmostEqual(residual, self._get_inconsistency(phi, phi_inverse), places=5)
+
+        # the initial guess id-u is returned without iterations
+        phi_inverse, _ = utils.compute_inverse_map_by_fixed_point_iteration(phi, self.spacing, max_nr_of_iterations=0)
+        npt.assert_almost_equal(phi_inverse.numpy(), (2 * self.identity_map - phi).numpy(), decimal=6)
+
+        with self.assertRaises(ValueError):
+            utils.compute_inverse_map_by_fixed_point_iteration(phi, self.spacing, max_nr_of_iterations=-1)
+
+
+class Test_identity_map_cache(unittest.TestCase):
+
+    def setUp(self):
+        utils.clear_identity_map_cache()
+        self.sz = [2, 1, 8, 10]
+        self.spacing = np.array([1. / 7, 1. / 9])
+
+    def tearDown(self):
+        utils.clear_identity_map_cache()
+        utils.set_identity_map_cache_size(16)
+
+    def test_cache_hit_returns_same_storage(self):
+        id_0 = utils._get_shared_identity_map(self.sz, self.spacing)
+        id_1 = utils._get_shared_identity_map(self.sz, self.spacing)
+        self.assertIs(id_1, id_0)
+        self.assertEqual(id_1.data_ptr(), id_0.data_ptr())
+        npt.assert_almost_equal(id_0.numpy(), utils.identity_map_multiN(self.sz, self.spacing), decimal=6)
+
+        # a different spacing is a different entry
+        id_2 = utils._get_shared_identity_map(self.sz, 2 * self.spacing)
+        self.assertNotEqual(id_2.data_ptr(), id_0.data_ptr())
+
+    def test_public_identity_map_is_an_independent_copy(self):
+        id_0 = utils._get_shared_identity_map(self.sz, self.spacing)
+        id_copy = utils.get_identity_map(self.sz, self.spacing)
+        self.assertNotEqual(id_copy.data_ptr(), id_0.data_ptr())
+        id_copy.add_(1.)
+        # the cached map is not affected
+        self.assertIs(utils._get_shared_identity_map(self.sz, self.spacing), id_0)
+        npt.assert_almost_equal(id_0.numpy(), utils.identity_map_multiN(self.sz, self.spacing), decimal=6)
+
+    def test_in_place_modification_is_detected(self):
+        id_0 = utils._get_shared_identity_map(self.sz, self.spacing)
+        version = id_0._version
+        id_0.add_(1.)
+        self.assertNotEqual(id_0._version, version)
+
+        # the modified map is not handed out again, but recreated
+        id_1 = utils._get_shared_identity_map(self.sz, self.spacing)
+        self.assertIsNot(id_1, id_0)
+        npt.assert_almost_equal(id_1.numpy(), utils.identity_map_multiN(self.sz, self.spacing), decimal=6)
+
+    def test_cache_can_be_disabled(self):
+        utils.set_identity_map_cache_size(0)
+        id_0 = utils._get_shared_identity_map(self.sz, self.spacing)
+        id_1 = utils._get_shared_identity_map(self.sz, self.spacing)
+        self.assertIsNot(id_1, id_0)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()